@@ -6,10 +6,42 @@ import argparse
 import logging
 import logging.config
 
-from twisted.internet import reactor
+from cardinal.reactors import (
+    REACTORS,
+    install_reactor,
+    installed_reactor,
+    requested_reactor,
+)
 
-from cardinal.config import ConfigParser, ConfigSpec
-from cardinal.bot import CardinalBotFactory
+# The reactor must be installed before anything imports it
+if __name__ == "__main__":
+    try:
+        install_reactor(requested_reactor(sys.argv[1:]))
+    except ValueError as e:
+        sys.exit(str(e))
+
+from twisted.internet import reactor  # noqa: E402
+
+from cardinal.config import ConfigParser, ConfigSpec  # noqa: E402
+from cardinal.bot import (  # noqa: E402
+    CardinalBotFactory,
+    NetworkManager,
+    server_info,
+)
+from cardinal.election import LeaderElection  # noqa: E402
+from cardinal import metrics, tracing  # noqa: E402
+from cardinal.timeline import Timeline  # noqa: E402
+from cardinal.memory import MemoryMonitor  # noqa: E402
+from cardinal.watchdog import Watchdog  # noqa: E402
+
+# Options which apply to the whole process, rather than to each network
+PROCESS_OPTIONS = ('storage', 'logging', 'networks', 'leader_election',
+                   'leader_lease', 'reactor', 'watchdog_threshold',
+                   'metrics_port', 'tracing', 'memory_interval')
+
+# Exit status when another instance took over, so that we are restarted as a
+# standby
+DEPOSED_EXIT_STATUS = 3
 
 
 def setup_logging(config=None):
@@ -24,7 +56,59 @@ def setup_logging(config=None):
     return logging.getLogger(__name__)
 
 
+def create_factory(config, logger, timeline=None):
+    """Creates a CardinalBotFactory for a network's config"""
+    # If no username is supplied, default to nickname
+    if config['username'] is None:
+        config['username'] = config['nickname']
+
+    # Servers to fail over between. Port and SSL default to the top-level
+    # settings, and the top-level network is used if no list is given.
+    servers = []
+    for server in config['servers'] or []:
+        if not isinstance(server, dict) or 'host' not in server:
+            logger.error("Invalid server in config, skipping: %s" % server)
+            continue
+
+        servers.append(server_info(server['host'],
+                                   server.get('port', config['port']),
+                                   server.get('ssl', config['ssl'])))
+
+    if not servers:
+        servers.append(server_info(config['network'],
+                                   config['port'],
+                                   config['ssl']))
+
+    logger.debug("Instantiating CardinalBotFactory for %s" % config['network'])
+    return CardinalBotFactory(config['network'],
+                              config['server_password'],
+                              config['server_commands'],
+                              config['channels'],
+                              config['nickname'],
+                              config['password'],
+                              config['username'],
+                              config['realname'],
+                              config['plugins'],
+                              config['censored_words'],
+                              config['blacklist'],
+                              config['storage'],
+                              config['who_cache_ttl'],
+                              config['ping_interval'],
+                              config['max_missed_pongs'],
+                              servers,
+                              config['ssl_verify'],
+                              config['ssl_certificate'],
+                              config['lazy_plugins'],
+                              config['warm_plugins'],
+                              config['isolated_plugins'],
+                              timeline)
+
+
 if __name__ == "__main__":
+    # Records how long starting up takes, from when the process started
+    timeline = Timeline()
+    timeline.mark('modules imported')
+
     # Create a new instance of ArgumentParser with a description about Cardinal
     arg_parser = argparse.ArgumentParser(description="""
 Cardinal IRC bot
@@ -36,6 +120,22 @@ https://github.com/JohnMaguire/Cardinal
 
     arg_parser.add_argument('config', metavar='config',
                             help='custom config location')
+    arg_parser.add_argument('--network', action='append', dest='networks',
+                            help='only run this network from the config '
+                                 '(may be given more than once)')
+    arg_parser.add_argument('--supervised', action='store_true',
+                            help='log to stderr for supervisor.py')
+    arg_parser.add_argument('--adopt', metavar='path',
+                            help='take over the connection of a running '
+                                 'Cardinal (used by the upgrade command)')
+    arg_parser.add_argument('--metrics-port', type=int, metavar='port',
+                            help='port to serve metrics on, overriding the '
+                                 'config (used by supervisor.py to give each '
+                                 'worker its own port)')
+    arg_parser.add_argument('--reactor', choices=REACTORS,
+                            help='event loop to run on, overriding the '
+                                 'config (asyncio lets plugins use asyncio '
+                                 'libraries)')
 
     # Parse command-line arguments
     args = arg_parser.parse_args()
@@ -52,6 +152,9 @@ https://github.com/JohnMaguire/Cardinal
     spec.add_option('server_password', str, None)
     spec.add_option('server_commands', list, [])
     spec.add_option('ssl', bool, True)
+    spec.add_option('ssl_verify', bool, True)
+    spec.add_option('ssl_certificate', str, None)
+    spec.add_option('servers', list, None)
     spec.add_option('storage', str, os.path.join(
         os.path.dirname(os.path.realpath(sys.argv[0])),
         'storage'
@@ -77,23 +180,44 @@ https://github.com/JohnMaguire/Cardinal
         "youtube"
     ])
     spec.add_option('blacklist', dict, {})
+    spec.add_option('lazy_plugins', bool, False)
+    spec.add_option('warm_plugins', bool, True)
+    spec.add_option('isolated_plugins', list, [])
+    spec.add_option('who_cache_ttl', int,
+                    CardinalBotFactory.DEFAULT_WHO_CACHE_TTL)
+    spec.add_option('ping_interval', int,
+                    CardinalBotFactory.DEFAULT_PING_INTERVAL)
+    spec.add_option('max_missed_pongs', int,
+                    CardinalBotFactory.DEFAULT_MAX_MISSED_PONGS)
     spec.add_option('logging', dict, None)
+    spec.add_option('networks', list, None)
+    spec.add_option('leader_election', bool, False)
+    spec.add_option('leader_lease', int, LeaderElection.LEASE_TIME)
+    spec.add_option('reactor', str, 'default')
+    spec.add_option('watchdog_threshold', int,
+                    int(Watchdog.DEFAULT_THRESHOLD * 1000))
+    spec.add_option('metrics_port', int, None)
+    spec.add_option('tracing', dict, None)
+    spec.add_option('memory_interval', int, MemoryMonitor.DEFAULT_INTERVAL)
 
     parser = ConfigParser(spec)
 
     # Load config file
     try:
-        config = parser.load_config(config_file)
+        with timeline.measure('load config'):
+            config = parser.load_config(config_file)
     except Exception:
         # Need to setup a logger early
         logger = setup_logging()
         logger.exception("Unable to load config: {}".format(config_file))
         sys.exit(1)
 
-    # Config loaded, setup the logger
-    logger = setup_logging(config['logging'])
+    # Config loaded, setup the logger. When supervised, the supervisor
+    # collects our logs and applies the logging config instead.
+    logger = setup_logging(None if args.supervised else config['logging'])
 
     logger.info("Config loaded: {}".format(config_file))
+    logger.info("Running on the {} reactor".format(installed_reactor()))
 
     # Determine storage directory
     if config['storage'] is not None:
@@ -118,42 +242,131 @@ https://github.com/JohnMaguire/Cardinal
                     "Initializing storage directory: {}".format(directory))
                 os.makedirs(directory)
 
-    # If no username is supplied, default to nickname
-    if config['username'] is None:
-        config['username'] = config['nickname']
+    # Each network may override the top-level options, except for those that
+    # apply to the whole process
+    factories = []
+    for overrides in config['networks'] or [{}]:
+        if not isinstance(overrides, dict):
+            logger.error("Invalid network in config, skipping: %s" % overrides)
+            continue
 
-    # Instance a new factory, and connect with/without SSL
-    logger.debug("Instantiating CardinalBotFactory")
-    factory = CardinalBotFactory(config['network'],
-                                 config['server_password'],
-                                 config['server_commands'],
-                                 config['channels'],
-                                 config['nickname'],
-                                 config['password'],
-                                 config['username'],
-                                 config['realname'],
-                                 config['plugins'],
-                                 config['censored_words'],
-                                 config['blacklist'],
-                                 config['storage'])
-
-    if not config['ssl']:
-        logger.info(
-            "Connecting over plaintext to %s:%d" %
-            (config['network'], config['port'])
-        )
+        network_config = dict(config)
+        for option, value in overrides.items():
+            if option not in spec.options or option in PROCESS_OPTIONS:
+                logger.warning("Option %s can't be set per network -- "
+                               "ignoring" % option)
+                continue
 
-        reactor.connectTCP(config['network'], config['port'], factory)
-    else:
-        logger.info(
-            "Connecting over SSL to %s:%d" %
-            (config['network'], config['port'])
-        )
+            if not isinstance(value, spec.options[option][0]):
+                logger.warning("Value passed in for option %s was invalid -- "
+                               "ignoring" % option)
+                continue
 
-        # For SSL, we need to import the SSL module from Twisted
-        from twisted.internet import ssl
-        reactor.connectSSL(config['network'], config['port'], factory,
-                           ssl.ClientContextFactory())
+            network_config[option] = value
+
+        # Top-level servers belong to the top-level network
+        if 'network' in overrides and 'servers' not in overrides:
+            network_config['servers'] = None
+
+        if args.networks and network_config['network'].lower() not in \
+                [network.lower() for network in args.networks]:
+            continue
+
+        factories.append(create_factory(network_config, logger, timeline))
+
+    if not factories:
+        logger.error("No valid networks in config")
+        sys.exit(1)
+
+    timeline.mark('networks created')
+
+    # Networks share the reactor, plugin modules, and storage
+    try:
+        networks = NetworkManager(factories)
+    except ValueError:
+        logger.exception("Unable to start networks")
+        sys.exit(1)
+
+    # Warns when plugins block the reactor for longer than the threshold (in
+    # milliseconds, or never if it is 0)
+    if config['watchdog_threshold'] > 0:
+        networks.watchdog = Watchdog(config['watchdog_threshold'] / 1000)
+        reactor.callWhenRunning(networks.watchdog.start)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      networks.watchdog.stop)
+
+    # Measures the memory retained by plugins every interval (in seconds, or
+    # only when asked to if it is 0, the default). Each measurement walks
+    # every object plugins retain on the reactor thread, which may take long
+    # enough to trip the watchdog and delay PONGs, so set an interval of at
+    # least a few minutes if enabling it.
+    networks.memory = MemoryMonitor(networks, config['memory_interval'])
+    if config['memory_interval'] > 0:
+        reactor.callWhenRunning(networks.memory.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', networks.memory.stop)
+
+    # Serves metrics for Prometheus to scrape, on the loopback interface.
+    # Workers run by supervisor.py are each given a port of their own.
+    if args.metrics_port is not None:
+        config['metrics_port'] = args.metrics_port
+    if config['metrics_port'] is not None:
+        metrics.listen_or_retry(config['metrics_port'])
+
+    # Records a sample of received lines, and the events, commands, thread
+    # pool calls and replies they cause, as spans in a JSONL file
+    if config['tracing'] is not None:
+        path = config['tracing'].get('path')
+        if path is None and config['storage'] is not None:
+            path = os.path.join(config['storage'], 'traces.jsonl')
+        sample_rate = config['tracing'].get('sample_rate',
+                                            tracing.Tracer.DEFAULT_SAMPLE_RATE)
+        if path is None or not isinstance(sample_rate, (int, float)):
+            logger.error("Tracing requires a path (or storage) and a "
+                         "numeric sample_rate")
+            sys.exit(1)
+
+        logger.info("Tracing %g of lines to %s" % (sample_rate, path))
+        tracer = tracing.Tracer(path, sample_rate)
+        tracer.trace_threadpool(reactor.getThreadPool())
+        tracing.install(tracer)
+        reactor.addSystemEventTrigger('after', 'shutdown', tracer.close)
+
+    # Instances sharing storage elect one of them to connect, and the others
+    # stand by to take over if it goes away
+    election = None
+    if config['leader_election']:
+        if config['storage'] is None or args.adopt:
+            logger.error("Leader election requires storage and can't be "
+                         "used when adopting a connection")
+            sys.exit(1)
+
+        # Workers running other networks from the same config don't compete
+        # with us
+        name = ','.join(sorted(factory.network for factory in factories))
+        election = LeaderElection(
+            os.path.join(config['storage'], 'leader', name + '.json'),
+            config['leader_lease'])
+        networks.election = election
+
+        election.elected.addCallback(lambda _: networks.connect())
+        election.deposed.addCallback(
+            lambda _: networks.quit('Another instance took over.'))
+
+        reactor.addSystemEventTrigger('before', 'shutdown', election.stop)
+        reactor.callWhenRunning(election.start)
+    elif args.adopt:
+        if len(factories) > 1:
+            logger.error("Can't adopt a connection for multiple networks")
+            sys.exit(1)
+
+        # If this fails, the old process carries on with the connection
+        d = factories[0].adopt(args.adopt)
+        d.addErrback(lambda failure: reactor.stop())
+    else:
+        networks.connect()
 
     # Run the Twisted reactor
     reactor.run()
+
+    if election is not None and election.deposed.called:
+        sys.exit(DEPOSED_EXIT_STATUS)
@@ -0,0 +1,242 @@
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from cardinal.reactors import REACTORS, available_reactors, install_reactor
+
+# Line sent by the benchmark's server, like a busy channel would
+BENCHMARK_LINE = ':nick!user@vhost PRIVMSG #channel :message number %d'
+
+
+def benchmark_bot(reactor):
+    """Creates a CardinalBot with no plugins, which isn't registered with
+    the server, to receive the benchmark's lines.
+
+    Keyword arguments:
+      reactor -- The reactor to run on.
+
+    Returns:
+      CardinalBot -- The bot, to be connected to the benchmark's server.
+    """
+    from cardinal.bot import CardinalBot
+    from cardinal.plugins import PluginManager
+    from cardinal.timeline import Timeline
+
+    bot = CardinalBot()
+    bot.performLogin = False
+    bot._reactor = reactor
+    bot.factory = argparse.Namespace(
+        network='benchmark',
+        adopted_state=None,
+        timeline=Timeline(),
+        db_locks={},
+    )
+    bot.plugin_manager = PluginManager(bot, [], [])
+
+    return bot
+
+
+def measure_throughput(reactor, lines):
+    """Measures how quickly IRC lines are received and handled by Cardinal.
+
+    A server on the loopback interface writes the lines as fast as it can to
+    a CardinalBot, which queues them and handles each of them in its
+    cooperative inbound task, firing events and looking for commands.
+
+    Keyword arguments:
+      reactor -- The reactor to run on.
+      lines -- Number of lines to send.
+
+    Returns:
+      Deferred -- Fires with the number of lines handled per second.
+    """
+    from twisted.internet import defer, endpoints, protocol
+
+    done = defer.Deferred()
+
+    class Server(protocol.Protocol):
+        def connectionMade(self):
+            self.transport.write(b''.join(
+                (BENCHMARK_LINE % i).encode() + b'\r\n'
+                for i in range(lines)))
+
+    bot = benchmark_bot(reactor)
+    received = []
+
+    def privmsg(cardinal, user, channel, message):
+        received.append(message)
+        if len(received) == lines:
+            elapsed = time.perf_counter() - started
+            bot.transport.loseConnection()
+            done.callback(lines / elapsed)
+
+    bot.event_manager.register_callback('irc.privmsg', privmsg)
+
+    port = reactor.listenTCP(0, protocol.Factory.forProtocol(Server),
+                             interface='127.0.0.1')
+    started = time.perf_counter()
+    endpoints.connectProtocol(
+        endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1',
+                                     port.getHost().port),
+        bot,
+    ).addErrback(done.errback)
+
+    done.addBoth(lambda result: port.stopListening().addCallback(
+        lambda _: result))
+    return done
+
+
+def measure_latency(reactor, calls, delay=0.001):
+    """Measures how late timed calls are run, one after another.
+
+    Keyword arguments:
+      reactor -- The reactor to run on.
+      calls -- Number of calls to time.
+      delay -- Time in seconds each call is scheduled for.
+
+    Returns:
+      Deferred -- Fires with a list of how late each call was, in seconds.
+    """
+    from twisted.internet import defer
+
+    done = defer.Deferred()
+    latencies = []
+
+    def schedule():
+        reactor.callLater(delay, called, time.perf_counter() + delay)
+
+    def called(expected):
+        latencies.append(max(time.perf_counter() - expected, 0))
+        if len(latencies) < calls:
+            schedule()
+        else:
+            done.callback(latencies)
+
+    schedule()
+    return done
+
+
+def summarize(throughputs, latencies):
+    """Summarizes the results of each round of a benchmark.
+
+    Keyword arguments:
+      throughputs -- Lines per second from each round.
+      latencies -- Lists of call latencies from each round.
+
+    Returns:
+      dict -- Median throughput, and median and 99th percentile latency in
+        milliseconds.
+    """
+    latencies = sorted(latency * 1000
+                       for round_ in latencies for latency in round_)
+
+    return {
+        'lines_per_second': statistics.median(throughputs),
+        'latency_p50': statistics.median(latencies),
+        'latency_p99': latencies[min(int(len(latencies) * 0.99),
+                                     len(latencies) - 1)],
+    }
+
+
+def run(name, lines, calls, rounds):
+    """Benchmarks the reactor installed in this process.
+
+    Returns:
+      dict -- Results from summarize(), and the reactor's name.
+    """
+    install_reactor(name)
+
+    from twisted.internet import defer, reactor
+
+    results = {}
+
+    @defer.inlineCallbacks
+    def benchmark():
+        throughputs, latencies = [], []
+        try:
+            # Warm up, then measure each round
+            yield measure_throughput(reactor, lines // 10 or 1)
+            for _ in range(rounds):
+                throughputs.append((yield measure_throughput(reactor, lines)))
+                latencies.append((yield measure_latency(reactor, calls)))
+
+            results.update(summarize(throughputs, latencies))
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(benchmark)
+    reactor.run()
+
+    results['reactor'] = name
+    return results
+
+
+def report(results):
+    """Formats benchmark results as a table"""
+    lines = ["%-10s %14s %14s %14s" %
+             ('reactor', 'lines/s', 'latency p50', 'latency p99')]
+    for result in results:
+        lines.append("%-10s %14.0f %12.3fms %12.3fms" % (
+            result['reactor'],
+            result['lines_per_second'],
+            result['latency_p50'],
+            result['latency_p99'],
+        ))
+
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m cardinal.benchmark',
+        description="Compares the event loops Cardinal can run on. Each "
+                    "reactor is benchmarked in a process of its own.")
+    parser.add_argument('--reactor', action='append', dest='reactors',
+                        choices=REACTORS,
+                        help='reactor to benchmark (may be given more than '
+                             'once, defaults to every available reactor)')
+    parser.add_argument('--lines', type=int, default=100000,
+                        help='IRC lines to receive in each round')
+    parser.add_argument('--calls', type=int, default=1000,
+                        help='timed calls to make in each round')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='rounds to take the median of')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    parser.add_argument('--run', choices=REACTORS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run(args.run, args.lines, args.calls, args.rounds)))
+        return
+
+    results = []
+    for name in args.reactors or available_reactors():
+        output = subprocess.run(
+            [sys.executable, '-m', 'cardinal.benchmark', '--run', name,
+             '--lines', str(args.lines),
+             '--calls', str(args.calls),
+             '--rounds', str(args.rounds)],
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        results.append(json.loads(output))
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    import twisted
+    print("Python %s, Twisted %s, %d lines and %d calls per round, "
+          "median of %d rounds" % (platform.python_version(),
+                                   twisted.__version__, args.lines,
+                                   args.calls, args.rounds))
+    print('\n'.join(report(results)))
+
+
+if __name__ == '__main__':
+    main()
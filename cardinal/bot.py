@@ -1,19 +1,38 @@
+import base64
+import fcntl
 import signal
 import json
 import logging
 import os
 import re
 import shutil
-from collections import namedtuple
+import sys
+import time
+from collections import deque, namedtuple
+from itertools import count
 from contextlib import contextmanager
 from datetime import datetime
 
-from twisted.internet import defer, protocol, reactor
+from twisted.internet import defer, endpoints, protocol, reactor, task
+from twisted.internet.interfaces import (
+    IHandshakeListener,
+    IOpenSSLClientConnectionCreator,
+)
 from twisted.internet.task import deferLater
+from twisted.python.failure import Failure
 from twisted.words.protocols import irc
+from zope.interface import implementer
 
+from cardinal.handover import (
+    HANDOVER_VERSION,
+    Adopter,
+    Handover,
+    handover_args,
+)
+from cardinal import metrics, tracing
 from cardinal.util import strip_formatting
 from cardinal.plugins import PluginManager, EventManager
+from cardinal.timeline import Timeline, plugin_report
 from cardinal.exceptions import (
     CommandNotFoundError,
     ConfigNotFoundError,
@@ -25,14 +44,99 @@ USER_REGEX = re.compile(r'^(.*?)!(.*?)@(.*?)$')
 
 user_info = namedtuple('user_info', ('nick', 'user', 'vhost'))
 
+server_info = namedtuple('server_info', ('host', 'port', 'ssl'))
+
+# IRCv3 batches - events holds the per-user event params seen in the batch
+batch_info = namedtuple('batch_info',
+                        ('reference', 'type', 'params', 'events'))
+
+# Batch types which are coalesced into a single event
+NETSPLIT = 'netsplit'
+NETJOIN = 'netjoin'
+
+# Quit messages during a netsplit are the names of the two split servers,
+# which many servers mask, e.g. "*.net *.split"
+NETSPLIT_REGEX = re.compile(
+    r'^[\w*-]+(\.[\w*-]+)+ [\w*-]+(\.[\w*-]+)+$')
+
+# Escapes used in IRCv3 message tag values
+TAG_ESCAPES = {
+    ':': ';',
+    's': ' ',
+    '\\': '\\',
+    'r': '\r',
+    'n': '\n',
+}
+
 # Database locking constants
 UNLOCKED = 'unlocked'
 LOCKED = 'locked'
 
 
+def parse_tags(raw_tags):
+    """Parses IRCv3 message tags into a dict.
+
+    e.g. "batch=yXNAbvnRHTRBv;time=2023-01-01T00:00:00Z" ->
+        {"batch": "yXNAbvnRHTRBv", "time": "2023-01-01T00:00:00Z"}
+    """
+    tags = {}
+    for tag in raw_tags.split(';'):
+        if not tag:
+            continue
+
+        key, _, value = tag.partition('=')
+
+        unescaped = ''
+        chars = iter(value)
+        for char in chars:
+            if char == '\\':
+                char = next(chars, '')
+                char = TAG_ESCAPES.get(char, char)
+            unescaped += char
+
+        tags[key] = unescaped
+
+    return tags
+
+
 class CardinalBot(irc.IRCClient, object):
     """Cardinal, in all its glory"""
 
+    CAPABILITIES = ('batch', 'multi-prefix', 'userhost-in-names')
+    """IRCv3 capabilities to request if the server supports them"""
+
+    NETSPLIT_WINDOW = 2
+    """Seconds to wait for more netsplit-style quits when the server doesn't
+    support batches"""
+
+    INBOUND_SLICE = 0.005
+    """Seconds of received lines to process before yielding to the reactor"""
+
+    INBOUND_BACKLOG_WARNING = 1000
+    """Log a warning when this many received lines are waiting"""
+
+    PRIORITY_COMMANDS = (b'PING', b'PONG')
+    """Commands processed as soon as they are received, ahead of a backlog"""
+
+    LAG_THROTTLE_THRESHOLD = 2
+    """Seconds of lag after which outgoing lines are rate limited"""
+
+    LAG_LINE_RATE_FACTOR = 0.25
+    """Seconds between outgoing lines per second of lag when rate limited"""
+
+    MAXIMUM_LINE_RATE = 2
+    """Maximum seconds between outgoing lines when rate limited"""
+
+    @property
+    def reactor(self):
+        """Allows us to inject a mock reactor in unit tests"""
+        return getattr(self, '_reactor', reactor)
+
+    @property
+    def heartbeatInterval(self):
+        """Twisted.irc.IRCClient seconds between PINGs to the server"""
+        return self.factory.ping_interval
+
     @property
     def network(self):
         return self.factory.network
@@ -108,28 +212,194 @@ class CardinalBot(irc.IRCClient, object):
         self.event_manager.register("irc.part", 3)
         self.event_manager.register("irc.kick", 4)
         self.event_manager.register("irc.quit", 2)
+        self.event_manager.register("irc.quit_batch", 1)
+        self.event_manager.register("irc.join_batch", 1)
+
+        # IRCv3 capabilities offered by the server and enabled by us
+        self._offered_capabilities = set()
+        self.capabilities = set()
+
+        # Open IRCv3 batches keyed by reference tag, and the batch the line
+        # currently being processed belongs to (if any)
+        self._batches = {}
+        self.current_batch = None
+
+        # Netsplits detected from quit messages, for servers that don't send
+        # batches. Maps quit message to a batch and its pending flush call.
+        self._netsplits = {}
+
+        # Received lines waiting to be processed, and the cooperative task
+        # processing them
+        self._inbound = deque()
+        self._inbound_buffer = b''
+        self._inbound_cooperator = None
+        self._inbound_task = None
+        self.inbound_backlog_peak = 0
+
+        # Traced outgoing lines and their spans, in the order they are queued
+        self._traced_lines = deque()
+
+        # Round-trip time of our last answered PING in seconds, and the
+        # outstanding PING, if any
+        self.lag = None
+        self._ping_tokens = count(1)
+        self._ping_token = None
+        self._ping_sent = None
+        self._missed_pongs = 0
+
+        # Channels we are receiving a NAMES reply for
+        self._names_pending = set()
 
         # State variables for the WHO command
         self._who_cache = {}
         self._who_deferreds = {}
+        self._who_results = {}
+        self._who_tokens = {}
+        self._who_token_counter = 0
+
+        # Raw ISUPPORT options, kept so they can be handed over to a new
+        # process
+        self._isupport_options = []
+
+        # Whether processing is paused for a handover, and whether this
+        # connection was adopted from another process
+        self.frozen = False
+        self._adopted = False
+
+    def connectionMade(self):
+        """Called by Twisted once connected to the server"""
+        state = self.factory.adopted_state
+        if state is not None:
+            # The connection is already registered
+            self.factory.adopted_state = None
+            self.performLogin = False
+
+        super().connectionMade()
+
+        metrics.INBOUND_BACKLOG.set_function(lambda: self.inbound_backlog,
+                                             self.network)
+        metrics.SERVER_LAG.set_function(lambda: self.lag, self.network)
+
+        if state is not None:
+            self._adopt(state)
+        else:
+            self.factory.timeline.end('connect')
+            self.factory.timeline.begin('register')
 
-        # Database file locks
-        self._db_locks = {}
+    def register(self, nickname, hostname='foo', servername='bar'):
+        """Begins capability negotiation before registering with the server.
+
+        Servers supporting IRCv3 will hold registration until we send CAP END.
+        Servers that don't support it will simply reject the CAP command.
+        """
+        self._offered_capabilities = set()
+        self.capabilities = set()
+        self.sendLine("CAP LS 302")
+
+        super().register(nickname, hostname, servername)
+
+    def irc_CAP(self, prefix, params):
+        """Called during capability negotiation"""
+        subcommand, args = params[1], params[2:]
+
+        if subcommand == 'LS':
+            # Multi-line replies have a "*" before the capability list
+            more = len(args) > 1 and args[0] == '*'
+            for cap in args[-1].split():
+                self._offered_capabilities.add(cap.split('=', 1)[0])
+
+            if more:
+                return
+
+            request = [cap for cap in self.CAPABILITIES
+                       if cap in self._offered_capabilities]
+
+            # Authenticate with our client certificate, if we have one
+            if self.factory.ssl_certificate and \
+                    'sasl' in self._offered_capabilities:
+                request.append('sasl')
+
+            if request:
+                self.logger.info(
+                    "Requesting capabilities: %s" % ' '.join(request))
+                self.sendLine("CAP REQ :%s" % ' '.join(request))
+                return
+
+            self._end_capability_negotiation()
+        elif subcommand == 'ACK':
+            acked = args[-1].split()
+            for cap in acked:
+                if cap.startswith('-'):
+                    self.capabilities.discard(cap[1:])
+                else:
+                    self.capabilities.add(cap)
+
+            self.logger.info("Enabled capabilities: %s" %
+                             ' '.join(sorted(self.capabilities)))
+
+            # Registration waits until SASL authentication completes
+            if 'sasl' in acked:
+                self.logger.info("Authenticating with SASL EXTERNAL")
+                self.sendLine("AUTHENTICATE EXTERNAL")
+                return
+
+            self._end_capability_negotiation()
+        elif subcommand == 'NAK':
+            self.logger.warning(
+                "Server rejected capabilities: %s" % args[-1])
+            self._end_capability_negotiation()
+        elif subcommand == 'DEL':
+            for cap in args[-1].split():
+                self.capabilities.discard(cap)
+
+    def irc_AUTHENTICATE(self, prefix, params):
+        """Called when the server is ready for SASL credentials.
+
+        With EXTERNAL, the server authenticates us by our client certificate,
+        so we send an empty response.
+        """
+        if params[0] == '+':
+            self.sendLine("AUTHENTICATE +")
+
+    def irc_903(self, prefix, params):
+        """Called when SASL authentication succeeds (RPL_SASLSUCCESS)"""
+        self.logger.info("SASL authentication succeeded")
+        self._end_capability_negotiation()
+
+    def irc_904(self, prefix, params):
+        """Called when SASL authentication fails (ERR_SASLFAIL)"""
+        self.logger.warning("SASL authentication failed: %s" % params[-1])
+        self._end_capability_negotiation()
+
+    # ERR_SASLTOOLONG, ERR_SASLABORTED, and ERR_SASLALREADY
+    irc_905 = irc_906 = irc_907 = irc_904
+
+    def _end_capability_negotiation(self):
+        # Only necessary before registration has completed
+        if not self._registered:
+            self.sendLine("CAP END")
 
     def signedOn(self):
         """Called once we've connected to a network"""
         super().signedOn()
 
         self.logger.info("Signed on as %s" % self.nickname)
+        self.factory.timeline.end('register')
 
         # Give the factory the instance it created in case it needs to
         # interface for error handling or metadata retention.
         self.factory.cardinal = self
 
-        # Setup PluginManager
-        self.plugin_manager = PluginManager(self,
-                                            self.factory.plugins,
-                                            self.factory.blacklist)
+        # Keep the TLS session so that reconnecting can skip a full handshake
+        self.factory.save_tls_session(self.transport)
+        self.factory.signed_on()
+
+        # Set the uptime as now and grab the boot time from the factory,
+        # before plugins are loaded, as workers are sent them
+        self.uptime = datetime.now()
+        self.booted = self.factory.booted
+
+        self._setup_plugin_manager()
 
         if self.factory.server_commands:
             self.logger.info("Sending server commands")
@@ -146,14 +416,67 @@ class CardinalBot(irc.IRCClient, object):
 
         # Attempt to join channels
         for channel in self.factory.channels:
+            self.factory.timeline.begin('join %s' % channel.lower())
             self.join(channel)
 
+        # Plugins with an asynchronous setup may still be setting up
+        self.plugin_manager.ready().addCallback(self._plugins_ready)
+
         # ChannelManager is only created if CHANMODES is supported
         self.channels = None
 
-        # Set the uptime as now and grab the  boot time from the factory
-        self.uptime = datetime.now()
-        self.booted = self.factory.booted
+    def _setup_plugin_manager(self):
+        # Setup PluginManager. It lives on the factory so that plugins stay
+        # loaded when we reconnect, and just need to be bound to this
+        # connection.
+        if self.factory.plugin_manager is None:
+            with self.factory.timeline.measure('load plugins'):
+                self.factory.plugin_manager = PluginManager(
+                    self,
+                    self.factory.plugins,
+                    self.factory.blacklist,
+                    self.factory.lazy_plugins,
+                    self.factory.isolated_plugins)
+
+            # Plugins with an asynchronous setup may still be setting up
+            self.factory.timeline.begin('set up plugins')
+
+            # Plugins that weren't imported yet are loaded once we're up
+            if self.factory.lazy_plugins and self.factory.warm_plugins:
+                self.factory.plugin_manager.warm()
+        else:
+            # Keep the events and callbacks registered by plugins
+            self.event_manager = \
+                self.factory.plugin_manager.cardinal.event_manager
+            self.event_manager.cardinal = self
+
+            self.factory.plugin_manager.rebind(self)
+
+        self.plugin_manager = self.factory.plugin_manager
+
+    def _plugins_ready(self, failed):
+        """Called once plugins with an asynchronous setup have finished it"""
+        if failed:
+            self.logger.warning("Plugins failed to set up: %s" %
+                                ', '.join(sorted(failed)))
+
+        plugins = self.factory.plugin_manager.plugins
+        self.logger.info("Plugins ready: %s" % ', '.join(sorted(plugins)))
+
+        self.factory.timeline.end('set up plugins')
+        self._check_started()
+
+    def _check_started(self):
+        """Reports the startup timeline once everything has started"""
+        timeline = self.factory.timeline
+        if timeline.finished or timeline.pending or \
+                self.factory.plugin_manager is None:
+            return
+
+        elapsed = timeline.finish()
+        self.logger.info("Started up in %.3fs:\n%s" % (elapsed, '\n'.join(
+            timeline.report() +
+            plugin_report(self.factory.plugin_manager.load_times))))
 
     def isupport(self, options):
         """Called for ISUPPORT messages. Provided by Twisted.
@@ -161,6 +484,8 @@ class CardinalBot(irc.IRCClient, object):
         options -- A partial list of all ISUPPORT options, possibly in the
           format "OPTION=value".
         """
+        self._isupport_options.extend(options)
+
         for option in options:
             # Setup the channel manager at this point - it should occur during
             # startup before we join channels. We need the result of CHANMODES
@@ -168,7 +493,12 @@ class CardinalBot(irc.IRCClient, object):
             if option.startswith('CHANMODES='):
                 self.channels = \
                     ChannelManager(self.supported.getFeature("CHANMODES"),
-                                   self.getChannelModeParams())
+                                   self.getChannelModeParams(),
+                                   self.supported.getFeature("PREFIX"))
+
+            # Needed to track ops and voices in channel membership
+            elif option.startswith('PREFIX=') and self.channels:
+                self.channels.set_prefixes(self.supported.getFeature("PREFIX"))
 
     def joined(self, channel):
         """Called when we join a channel.
@@ -182,6 +512,9 @@ class CardinalBot(irc.IRCClient, object):
             # Request the channel modes for this channel
             self.send("MODE {}".format(channel))
 
+        self.factory.timeline.end('join %s' % channel.lower())
+        self._check_started()
+
     def irc_RPL_CHANNELMODEIS(self, prefix, params):
         channel, modes, args = params[1], params[2], params[3:]
 
@@ -191,6 +524,29 @@ class CardinalBot(irc.IRCClient, object):
         if self.channels:
             self.channels.set_modes(channel, modes, args)
 
+    def irc_RPL_NAMREPLY(self, prefix, params):
+        """Called for each line of a NAMES reply, e.g. after joining"""
+        channel, names = params[2], params[3].split()
+
+        if not self.channels:
+            return
+
+        # A new NAMES reply replaces whatever membership we knew about
+        if channel not in self._names_pending:
+            self._names_pending.add(channel)
+            self.channels.clear_users(channel)
+
+        self.channels.add_names(channel, names)
+
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        """Called when a NAMES reply is complete"""
+        channel = params[1]
+        self._names_pending.discard(channel)
+
+        if self.channels and channel in self.channels:
+            self.logger.debug("%s has %d users" %
+                              (channel, len(self.channels[channel].users)))
+
     def left(self, channel):
         """Called when we leave a channel.
 
@@ -209,6 +565,289 @@ class CardinalBot(irc.IRCClient, object):
         if self.channels:
             self.channels.remove(channel)
 
+    @property
+    def inbound_backlog(self):
+        """Number of received lines waiting to be processed"""
+        return len(self._inbound)
+
+    def dataReceived(self, data):
+        """Called by Twisted with data received from the server.
+
+        Large bursts (NAMES, WHO, netjoins) are queued and processed by a
+        cooperative task which yields to the reactor every INBOUND_SLICE
+        seconds, so timers and outgoing lines aren't starved. PINGs and PONGs
+        skip the queue so the connection isn't considered dead during a burst.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        lines = (self._inbound_buffer + data.replace(b'\r', b'')).split(b'\n')
+        self._inbound_buffer = lines.pop()
+
+        if len(self._inbound_buffer) > self.MAX_LENGTH:
+            return self.lineLengthExceeded(self._inbound_buffer)
+
+        for line in lines:
+            if self._is_priority_line(line):
+                self.lineReceived(line)
+            else:
+                self._inbound.append(line)
+
+        backlog = len(self._inbound)
+        if backlog > self.inbound_backlog_peak:
+            self.inbound_backlog_peak = backlog
+            if backlog >= self.INBOUND_BACKLOG_WARNING:
+                self.logger.warning(
+                    "Inbound backlog is %d lines" % backlog)
+
+        if self._inbound and self._inbound_task is None:
+            if self._inbound_cooperator is None:
+                self._inbound_cooperator = self._create_inbound_cooperator()
+
+            self._inbound_task = self._inbound_cooperator.cooperate(
+                self._process_inbound())
+            self._inbound_task.whenDone().addBoth(self._inbound_done)
+
+    def _is_priority_line(self, line):
+        parts = line.split(b' ', 3)
+
+        # Skip tags and prefix to find the command
+        while parts and parts[0][:1] in (b'@', b':'):
+            parts.pop(0)
+
+        return bool(parts) and parts[0].upper() in self.PRIORITY_COMMANDS
+
+    def _create_inbound_cooperator(self):
+        slice_ = self.INBOUND_SLICE
+
+        def termination_predicate():
+            deadline = time.monotonic() + slice_
+            return lambda: time.monotonic() >= deadline
+
+        return task.Cooperator(
+            terminationPredicateFactory=termination_predicate,
+            scheduler=lambda f: self.reactor.callLater(0, f),
+        )
+
+    def _process_inbound(self):
+        while self._inbound:
+            self.lineReceived(self._inbound.popleft())
+            yield
+
+    def _inbound_done(self, result):
+        self._inbound_task = None
+
+        # Task stopped early (e.g. connection lost)
+        if isinstance(result, Failure):
+            result.trap(task.TaskStopped)
+
+    def connectionLost(self, reason):
+        """Called by Twisted when the connection is lost"""
+        if self._inbound_task is not None:
+            self._inbound_task.stop()
+        self._inbound.clear()
+
+        metrics.INBOUND_BACKLOG.remove(self.network)
+        metrics.SERVER_LAG.remove(self.network)
+        self._traced_lines.clear()
+
+        super().connectionLost(reason)
+
+        # Adopted connections weren't made by a connector, so the factory
+        # won't otherwise find out
+        if self._adopted:
+            self.factory.clientConnectionLost(None, reason)
+
+    def freeze(self):
+        """Stops processing the connection, so it can be handed over."""
+        self.frozen = True
+
+        self.transport.stopReading()
+        self.stopHeartbeat()
+
+        if self._inbound_task is not None:
+            self._inbound_task.stop()
+
+        if self._queueEmptying is not None:
+            self._queueEmptying.cancel()
+            self._queueEmptying = None
+
+    def thaw(self, state=None):
+        """Resumes processing the connection after a failed handover.
+
+        Keyword arguments:
+          state -- The state returned by export_state(), if it was called.
+        """
+        self.frozen = False
+
+        if state is not None:
+            outbound = state['outbound']
+            inbound = base64.b64decode(state['inbound'])
+        else:
+            outbound, self._queue = self._queue, []
+            inbound = b''
+
+        self.transport.startReading()
+        self.startHeartbeat()
+
+        for line in outbound:
+            self.sendLine(line)
+        self.dataReceived(inbound)
+
+    def export_state(self):
+        """Returns the state of the connection, for handing it over.
+
+        This should only be called while frozen. Received lines that haven't
+        been processed and lines waiting to be sent are moved into the state,
+        for the new process to handle.
+
+        Returns:
+          dict -- The state of the connection, which can be serialized as JSON.
+        """
+        channels = {}
+        for name in self.channels or []:
+            channel = self.channels[name]
+            channels[name] = {
+                'modes': channel.modes,
+                'users': [[member.user.nick,
+                           member.user.user,
+                           member.user.vhost,
+                           member.modes]
+                          for member in channel.users.values()],
+            }
+
+        inbound = b'\n'.join(list(self._inbound) + [self._inbound_buffer])
+        self._inbound.clear()
+        self._inbound_buffer = b''
+
+        outbound, self._queue = self._queue, []
+
+        return {
+            'version': HANDOVER_VERSION,
+            'server': list(self.factory.server),
+            'family': self.transport.getHandle().family,
+            'nickname': self.nickname,
+            'hostname': self.hostname,
+            'capabilities': sorted(self.capabilities),
+            'isupport': self._isupport_options,
+            'channels': channels,
+            'inbound': base64.b64encode(inbound).decode('ascii'),
+            'outbound': outbound,
+            'uptime': self.uptime.timestamp(),
+            'booted': self.factory.booted.timestamp(),
+        }
+
+    def _adopt(self, state):
+        """Restores the state of a connection adopted from another process"""
+        self._adopted = True
+
+        self._registered = True
+        self.nickname = self._attemptedNick = state['nickname']
+        self.hostname = state['hostname']
+        self._offered_capabilities = set(state['capabilities'])
+        self.capabilities = set(state['capabilities'])
+
+        # ChannelManager is created by isupport() if CHANMODES is supported
+        self.channels = None
+        self.supported.parse(state['isupport'])
+        self.isupport(state['isupport'])
+
+        for name, channel in state['channels'].items():
+            if not self.channels:
+                break
+
+            self.channels.add(name)
+            self.channels[name].modes = channel['modes']
+            for nick, user, vhost, modes in channel['users']:
+                self.channels.add_user(name, nick, modes, user, vhost)
+
+        self.logger.info("Adopted connection as %s in %d channels" %
+                         (self.nickname, len(state['channels'])))
+
+        self.factory.cardinal = self
+        self.uptime = datetime.fromtimestamp(state['uptime'])
+        self.booted = self.factory.booted
+
+        self._setup_plugin_manager()
+
+        self.startHeartbeat()
+
+        for line in state['outbound']:
+            self.sendLine(line)
+        self.dataReceived(base64.b64decode(state['inbound']))
+
+    def _createHeartbeat(self):
+        """Creates the LoopingCall used to PING the server"""
+        heartbeat = super()._createHeartbeat()
+        heartbeat.clock = self.reactor
+        return heartbeat
+
+    def _sendHeartbeat(self):
+        """Sends a PING with a unique token to measure lag.
+
+        If the server hasn't answered our previous PINGs in time, the
+        connection is assumed to be dead and is dropped so the factory will
+        reconnect, rather than waiting for the OS to notice.
+        """
+        now = self.reactor.seconds()
+
+        if self._ping_token is not None:
+            self._missed_pongs += 1
+
+            # We don't know the lag yet, but it's at least this much
+            self.lag = max(self.lag or 0, now - self._ping_sent)
+            self._adapt_line_rate()
+
+            self.logger.warning(
+                "No PONG received for %.1f seconds (%d missed)" %
+                (now - self._ping_sent, self._missed_pongs))
+
+            if self._missed_pongs >= self.factory.max_missed_pongs:
+                self.logger.error("Connection appears to be dead, dropping it")
+                self.transport.abortConnection()
+                return
+
+            # Keep timing from the first unanswered PING
+            self.sendLine("PING :%s" % self._ping_token)
+            return
+
+        self._ping_token = "cardinal-%d" % next(self._ping_tokens)
+        self._ping_sent = now
+        self.sendLine("PING :%s" % self._ping_token)
+
+    def irc_PONG(self, prefix, params):
+        """Called when the server answers a PING"""
+        if self._ping_token is None or params[-1] != self._ping_token:
+            return
+
+        self.lag = self.reactor.seconds() - self._ping_sent
+        self._ping_token = None
+        self._ping_sent = None
+        self._missed_pongs = 0
+
+        self.logger.debug("Lag to server: %.3f seconds" % self.lag)
+
+        self._adapt_line_rate()
+
+    def _adapt_line_rate(self):
+        """Slows outgoing lines while the server is lagging.
+
+        Flooding a lagged server only makes things worse, and is a good way
+        to get disconnected for excess flood.
+        """
+        if self.lag is not None and self.lag >= self.LAG_THROTTLE_THRESHOLD:
+            line_rate = min(self.lag * self.LAG_LINE_RATE_FACTOR,
+                            self.MAXIMUM_LINE_RATE)
+        elif self._queue:
+            # Lines already queued must still be sent in order
+            line_rate = 0
+        else:
+            line_rate = None
+
+        if line_rate != self.lineRate:
+            self.logger.info("Setting outgoing line rate to %s" % line_rate)
+            self.lineRate = line_rate
+
     def lineReceived(self, line):
         """Called for every line received from the server."""
         # The IRC spec does not specify a message encoding, meaning that some
@@ -228,6 +867,13 @@ class CardinalBot(irc.IRCClient, object):
 
         # Log raw output
         self.irc_logger.info(line)
+        metrics.LINES_RECEIVED.inc(self.network)
+
+        # Strip IRCv3 message tags as Twisted is unable to parse them
+        tags = {}
+        if line.startswith('@'):
+            raw_tags, _, line = line.partition(' ')
+            tags = parse_tags(raw_tags[1:])
 
         # Log if the command received is in the error range
         _, command, _ = irc.parsemsg(line)
@@ -236,13 +882,94 @@ class CardinalBot(irc.IRCClient, object):
                 "Received an error from the server: {}"
                 .format(line))
 
-        self.event_manager.fire("irc.raw", command, line)
+        # Events, commands and replies caused by the line are recorded in its
+        # trace, if it is sampled
+        span = tracing.trace('irc.line', network=self.network,
+                             command=command)
+        try:
+            with tracing.activate(span):
+                self.event_manager.fire("irc.raw", command, line)
+
+                # Send IRCClient the version of the line that has had
+                # non-UTF-8 characters replaced.
+                #
+                # Bug: https://twistedmatrix.com/trac/ticket/9443
+                self.current_batch = self._batches.get(tags.get('batch'))
+                try:
+                    super().lineReceived(line.encode('utf-8'))
+                finally:
+                    self.current_batch = None
+        finally:
+            if span is not None:
+                span.finish()
+
+    def irc_BATCH(self, prefix, params):
+        """Called when an IRCv3 batch is opened or closed"""
+        reference, params = params[0], params[1:]
+
+        if reference.startswith('+'):
+            batch = batch_info(
+                reference[1:],
+                params[0] if params else None,
+                params[1:],
+                [],
+            )
+            self._batches[batch.reference] = batch
+
+            self.logger.debug(
+                "Batch %s (%s) opened" % (batch.reference, batch.type))
+        elif reference.startswith('-'):
+            batch = self._batches.pop(reference[1:], None)
+            if batch is None:
+                self.logger.warning(
+                    "Received end of unknown batch: %s" % reference[1:])
+                return
+
+            self.logger.debug(
+                "Batch %s (%s) closed with %d events" %
+                (batch.reference, batch.type, len(batch.events)))
+
+            self._fire_batch(batch)
 
-        # Send IRCClient the version of the line that has had non-UTF-8
-        # characters replaced.
-        #
-        # Bug: https://twistedmatrix.com/trac/ticket/9443
-        super().lineReceived(line.encode('utf-8'))
+    def _fire_batch(self, batch):
+        """Fires the coalesced event for a completed batch."""
+        if not batch.events:
+            return
+
+        if batch.type == NETSPLIT:
+            self.event_manager.fire("irc.quit_batch", batch.events)
+        elif batch.type == NETJOIN:
+            self.event_manager.fire("irc.join_batch", batch.events)
+
+    def _get_netsplit_batch(self, reason):
+        """Returns the batch for a netsplit detected from a quit message.
+
+        Used for servers which don't support IRCv3 batches. Quits are
+        collected until none have been seen for NETSPLIT_WINDOW seconds.
+        """
+        if reason in self._netsplits:
+            batch, delayed_call = self._netsplits[reason]
+            delayed_call.reset(self.NETSPLIT_WINDOW)
+            return batch
+
+        batch = batch_info(None, NETSPLIT, reason.split(), [])
+        delayed_call = self.reactor.callLater(
+            self.NETSPLIT_WINDOW, self._flush_netsplit, reason)
+        self._netsplits[reason] = (batch, delayed_call)
+
+        self.logger.info("Netsplit detected: %s" % reason)
+
+        return batch
+
+    def _flush_netsplit(self, reason):
+        batch, _ = self._netsplits.pop(reason)
+        self._fire_batch(batch)
+
+    def _flush_netsplits(self):
+        for reason, (_, delayed_call) in list(self._netsplits.items()):
+            if delayed_call.active():
+                delayed_call.cancel()
+            self._flush_netsplit(reason)
 
     def irc_PRIVMSG(self, prefix, params):
         """Called when we receive a message in a channel or PM."""
@@ -320,6 +1047,13 @@ class CardinalBot(irc.IRCClient, object):
             (user + (new_nick,))
         )
 
+        if self.channels:
+            record = self.channels.get_user(user.nick)
+            self._invalidate_who_cache(record.channels if record else [])
+            self.channels.rename_user(user.nick, new_nick)
+        else:
+            self._invalidate_who_cache()
+
         self.event_manager.fire("irc.nick", user, new_nick)
 
     def irc_TOPIC(self, prefix, params):
@@ -395,6 +1129,14 @@ class CardinalBot(irc.IRCClient, object):
             (user + (channel,))
         )
 
+        if self.channels:
+            self.channels.add_user(channel, user.nick,
+                                   user=user.user, vhost=user.vhost)
+        self._invalidate_who_cache([channel])
+
+        if self.current_batch and self.current_batch.type == NETJOIN:
+            self.current_batch.events.append((user, channel))
+
         self.event_manager.fire("irc.join", user, channel)
 
     def irc_PART(self, prefix, params):
@@ -413,6 +1155,10 @@ class CardinalBot(irc.IRCClient, object):
             (user + (channel, reason if reason else "No Message"))
         )
 
+        if self.channels:
+            self.channels.remove_user(channel, user.nick)
+        self._invalidate_who_cache([channel])
+
         self.event_manager.fire("irc.part", user, channel, reason)
 
     def irc_KICK(self, prefix, params):
@@ -432,6 +1178,10 @@ class CardinalBot(irc.IRCClient, object):
             (user + (nick, channel, reason if reason else "No Message"))
         )
 
+        if self.channels:
+            self.channels.remove_user(channel, nick)
+        self._invalidate_who_cache([channel])
+
         self.event_manager.fire("irc.kick", user, channel, nick, reason)
 
     def irc_QUIT(self, prefix, params):
@@ -449,7 +1199,26 @@ class CardinalBot(irc.IRCClient, object):
             (user + (reason if reason else "No Message",))
         )
 
-        self.event_manager.fire("irc.quit", user, reason)
+        if self.channels:
+            self._invalidate_who_cache(self.channels.quit_user(user.nick))
+        else:
+            self._invalidate_who_cache()
+
+        # Collect netsplit quits so they can be fired as a single event, but
+        # still fire the event for each user for compatibility. Plugins can
+        # check current_batch to avoid processing a user twice.
+        batch = self.current_batch
+        if batch is None and reason and NETSPLIT_REGEX.match(reason):
+            batch = self._get_netsplit_batch(reason)
+
+        if batch and batch.type == NETSPLIT:
+            batch.events.append((user, reason))
+
+        previous_batch, self.current_batch = self.current_batch, batch
+        try:
+            self.event_manager.fire("irc.quit", user, reason)
+        finally:
+            self.current_batch = previous_batch
 
     def irc_RPL_WHOREPLY(self, prefix, params):
         """Called for each user in the WHO reply.
@@ -459,7 +1228,6 @@ class CardinalBot(irc.IRCClient, object):
         to the channel's Deferred once all users have been listed.
         """
         # Same format as other events (nickname!ident@hostname)
-        self.logger.info(params)
         user = user_info(
             params[5],  # nickname
             params[2],  # ident
@@ -467,23 +1235,88 @@ class CardinalBot(irc.IRCClient, object):
         )
         channel = params[1]
 
-        self._who_cache[channel].append(user)
+        self._add_who_result(channel, user)
+
+    def irc_RPL_WHOSPCRPL(self, prefix, params):
+        """Called for each user in a WHOX reply.
+
+        Fields are always returned in the same order, regardless of the order
+        requested: token, channel, ident, hostname, nickname, flags, account,
+        realname. The token lets us ignore replies to WHOX requests we didn't
+        make.
+        """
+        if len(params) < 6 or params[1] not in self._who_tokens:
+            return
+
+        user = user_info(
+            params[5],  # nickname
+            params[3],  # ident
+            params[4],  # hostname
+        )
+        channel = params[2]
+
+        self._add_who_result(channel, user)
+
+    # Twisted doesn't know the symbolic name for WHOX replies
+    irc_354 = irc_RPL_WHOSPCRPL
+
+    def _add_who_result(self, channel, user):
+        key = channel.lower()
+        if key not in self._who_results:
+            return
+
+        self._who_results[key].append(user)
+
+        # Fill in details NAMES couldn't tell us
+        if self.channels:
+            record = self.channels.get_user(user.nick)
+            if record is not None:
+                record.user, record.vhost = user.user, user.vhost
 
     def irc_RPL_ENDOFWHO(self, prefix, params):
         """Called when WHO reply is complete.
 
         This is the final piece of the `who()` method call. This indicates we
-        can consider the WHO listing complete, and resolve the Deferred for the
-        given channel.
+        can consider the WHO listing complete, and resolve the Deferreds for
+        the given channels. Batched requests end with a comma-separated list.
         """
-        self.logger.info(params)
-        channel = params[1]
+        mask = params[1]
+
+        self.logger.info("WHO reply received for %s" % mask)
+
+        for token, token_mask in list(self._who_tokens.items()):
+            if token_mask == mask.lower():
+                del self._who_tokens[token]
+
+        for channel in mask.lower().split(','):
+            if channel not in self._who_deferreds:
+                continue
+
+            users = self._who_results.pop(channel)
+            self._who_cache[channel] = (
+                self.reactor.seconds() + self.factory.who_cache_ttl,
+                users,
+            )
+
+            for d in self._who_deferreds.pop(channel):
+                d.callback(list(users))
+
+    def _invalidate_who_cache(self, channels=None):
+        """Drops cached WHO results after membership changes.
+
+        channels -- Channels to invalidate, or None for all channels.
+        """
+        if channels is None:
+            self._who_cache = {}
+            return
 
-        self.logger.info("WHO reply received for %s" % channel)
-        for d in self._who_deferreds[channel]:
-            d.callback(self._who_cache[channel])
+        for channel in channels:
+            self._who_cache.pop(channel.lower(), None)
 
-        del self._who_deferreds[channel]
+    def _next_who_token(self):
+        # WHOX tokens may be at most 3 digits
+        self._who_token_counter = self._who_token_counter % 999 + 1
+        return str(self._who_token_counter)
 
     def irc_INVITE(self, prefix, params):
         """Called when we are invited to a channel.
@@ -502,32 +1335,78 @@ class CardinalBot(irc.IRCClient, object):
         # Fire invite event, so plugins can hook into it
         self.event_manager.fire("irc.invite", user, channel)
 
-    def who(self, channel):
-        """Lists the users in a channel.
+    def who(self, channels):
+        """Lists the users in a channel or channels.
+
+        Results are cached for `who_cache_ttl` seconds, or until membership of
+        the channel changes. When the server supports WHOX, channels will be
+        batched into as few requests as the server allows.
 
         Keyword arguments:
-          channel -- Channel to list users of.
+          channels -- Channel or list of channels to list users of.
 
         Returns:
           Deferred -- A Deferred which will have its callbacks called when
-            the WHO response comes back from the server.
+            the WHO response comes back from the server. If a list of channels
+            was given, the result is a dict mapping channels to users.
         """
-        self.logger.info("WHO list requested for %s" % channel)
-
-        d = defer.Deferred()
-        if channel not in self._who_deferreds:
-            self._who_cache[channel] = []
-            self._who_deferreds[channel] = [d]
-
-            # Send the actual WHO command to the server. irc_RPL_WHOREPLY will
-            # receive a response when the server sends one.
-            self.logger.info("Making WHO request to server")
-            self.send("WHO %s" % channel)
+        if isinstance(channels, str):
+            single = True
+            channels = [channels]
         else:
-            self._who_deferreds[channel].append(d)
+            single = False
+
+        self.logger.info("WHO list requested for %s" % ', '.join(channels))
+
+        now = self.reactor.seconds()
+
+        deferreds = []
+        to_request = []
+        for channel in channels:
+            key = channel.lower()
+            d = defer.Deferred()
+            deferreds.append(d)
+
+            expires, users = self._who_cache.get(key, (0, None))
+            if expires > now:
+                d.callback(list(users))
+            elif key in self._who_deferreds:
+                self._who_deferreds[key].append(d)
+            else:
+                self._who_results[key] = []
+                self._who_deferreds[key] = [d]
+                to_request.append(channel)
+
+        # Send the actual WHO command to the server. irc_RPL_WHOREPLY or
+        # irc_RPL_WHOSPCRPL will receive a response when the server sends one.
+        if to_request:
+            self.logger.info("Making WHO request to server")
+            self._send_who(to_request)
+
+        if single:
+            return deferreds[0]
 
+        d = defer.gatherResults(deferreds)
+        d.addCallback(lambda results: dict(zip(channels, results)))
         return d
 
+    def _send_who(self, channels):
+        if not self.supported.hasFeature('WHOX'):
+            for channel in channels:
+                self.send("WHO %s" % channel)
+            return
+
+        # TARGMAX tells us how many channels we can ask for at once
+        limit = (self.supported.getFeature('TARGMAX') or {}).get('WHO', 1)
+        limit = limit or len(channels)
+
+        for i in range(0, len(channels), limit):
+            mask = ','.join(channels[i:i + limit])
+            token = self._next_who_token()
+            self._who_tokens[token] = mask.lower()
+
+            self.send("WHO %s %%tcuhnfar,%s" % (mask, token))
+
     def config(self, plugin):
         """Returns a given loaded plugin's config.
 
@@ -576,8 +1455,33 @@ class CardinalBot(irc.IRCClient, object):
             message = message.replace(word, replacement)
 
         self.logger.info("Sending in %s: %s" % (channel, message))
+        metrics.MESSAGES_SENT.inc(self.network)
+
+        span = tracing.start_span('sendMsg', target=channel)
+        with tracing.activate(span):
+            self.msg(channel, message, length)
+        if span is not None:
+            span.finish()
+
+    def sendLine(self, line):
+        """Called to send a line to the server, which may be queued by the
+        line rate limit.
+        """
+        metrics.LINES_SENT.inc(self.network)
+
+        # Traced lines are finished once they leave the flood queue
+        span = tracing.start_span('send', command=line.split(' ', 1)[0])
+        if span is not None:
+            self._traced_lines.append((line, span))
 
-        self.msg(channel, message, length)
+        super().sendLine(line)
+
+    def _reallySendLine(self, line):
+        """Called by Twisted to write a line, once the line rate allows"""
+        if self._traced_lines and self._traced_lines[0][0] is line:
+            self._traced_lines.popleft()[1].finish()
+
+        return super()._reallySendLine(line)
 
     def send(self, message):
         """Send a raw message to the server.
@@ -600,8 +1504,18 @@ class CardinalBot(irc.IRCClient, object):
 
     def disconnected(self):
         """Called by the factory when Cardinal loses connection to the server"""
-        if self.plugin_manager:
+        # Deliver any netsplit quits still waiting on more quits
+        self._flush_netsplits()
+        self._batches = {}
+
+        if not self.plugin_manager:
+            return
+
+        # Plugins are kept loaded for when we reconnect, unless we're quitting
+        if self.factory.disconnect:
             self.plugin_manager.unload_all()
+        else:
+            self.plugin_manager.disconnected()
 
     def get_db(self, name, network_specific=True, default=None):
         if default is None:
@@ -611,15 +1525,24 @@ class CardinalBot(irc.IRCClient, object):
             '-{}'.format(self.network) if network_specific else '') +
             '.json')
 
-        if db_path not in self._db_locks:
-            self._db_locks[db_path] = UNLOCKED
+        # Locks live on the factory, so they are shared with other networks
+        # in this process and survive reconnects
+        db_locks = self.factory.db_locks
+        if db_path not in db_locks:
+            db_locks[db_path] = UNLOCKED
 
         @contextmanager
         def db():
-            if self._db_locks[db_path] == LOCKED:
-                raise LockInUseError('DB {} locked'.format(db_path))
+            span = tracing.start_span('db', db=name)
+            if db_locks[db_path] == LOCKED:
+                metrics.DB_LOCK_ERRORS.inc(name)
+                error = LockInUseError('DB {} locked'.format(db_path))
+                if span is not None:
+                    span.finish(error)
+                raise error
 
-            self._db_locks[db_path] = LOCKED
+            db_locks[db_path] = LOCKED
+            opened = time.perf_counter()
 
             try:
                 # Create the DB if this is the first access
@@ -629,6 +1552,17 @@ class CardinalBot(irc.IRCClient, object):
 
                 # Load the DB as JSON, use it, then save the result
                 with open(db_path, 'r+') as f:
+                    # Plugins in workers open the DB from other processes
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        metrics.DB_LOCK_ERRORS.inc(name)
+                        error = LockInUseError(
+                            'DB {} locked by another process'.format(db_path))
+                        if span is not None:
+                            span.finish(error)
+                        raise error
+
                     # In the event that the DB cannot be loaded, check if a
                     # backup DB exists. If so, open it in read-only mode and
                     # load that instead. When we go to save, we'll write to the
@@ -658,7 +1592,10 @@ class CardinalBot(irc.IRCClient, object):
                     f.truncate()
                     json.dump(database, f)
             finally:
-                self._db_locks[db_path] = UNLOCKED
+                db_locks[db_path] = UNLOCKED
+                metrics.DB_SECONDS.observe(time.perf_counter() - opened, name)
+                if span is not None:
+                    span.finish()
 
         return db
 
@@ -682,6 +1619,25 @@ class CardinalBotFactory(protocol.ClientFactory):
     MAXIMUM_RECONNECTION_WAIT = 300
     """Maximum time in connections before reconnection attempt"""
 
+    DEFAULT_WHO_CACHE_TTL = 60
+    """Default time in seconds that WHO results are cached for"""
+
+    DEFAULT_PING_INTERVAL = 30
+    """Default time in seconds between PINGs used to measure lag"""
+
+    DEFAULT_MAX_MISSED_PONGS = 3
+    """Default number of unanswered PINGs before reconnecting"""
+
+    PROBE_TIMEOUT = 5
+    """Time in seconds to wait for a server to accept a probe connection"""
+
+    FAILOVER_WAIT = 1
+    """Time in seconds before reconnecting when other servers are available"""
+
+    HEALTHY_CONNECTION_TIME = 60
+    """Time in seconds a connection must stay signed on for before losing it
+    fails over quickly, rather than backing off"""
+
     @property
     def reactor(self):
         """Allows us to inject a mock reactor in unit tests"""
@@ -699,7 +1655,17 @@ class CardinalBotFactory(protocol.ClientFactory):
                  plugins,
                  censored_words,
                  blacklist,
-                 storage):
+                 storage,
+                 who_cache_ttl=DEFAULT_WHO_CACHE_TTL,
+                 ping_interval=DEFAULT_PING_INTERVAL,
+                 max_missed_pongs=DEFAULT_MAX_MISSED_PONGS,
+                 servers=None,
+                 ssl_verify=True,
+                 ssl_certificate=None,
+                 lazy_plugins=False,
+                 warm_plugins=True,
+                 isolated_plugins=None,
+                 timeline=None):
         """Boots the bot, triggers connection, and initializes logging.
 
         Keyword arguments:
@@ -714,6 +1680,22 @@ class CardinalBotFactory(protocol.ClientFactory):
           plugins -- A list of plugins to load on boot.
           blacklist -- A dict mapping plugins to lists of blacklisted channels.
           storage -- A string containing path to storage directory.
+          who_cache_ttl -- Seconds to cache WHO results for.
+          ping_interval -- Seconds between PINGs to the server.
+          max_missed_pongs -- Unanswered PINGs before reconnecting.
+          servers -- A list of server_info tuples to connect to with
+            connect(), ranked by latency and rotated through on failure.
+          ssl_verify -- Whether to verify the server's TLS certificate.
+          ssl_certificate -- Path to a PEM file containing a client
+            certificate and private key, used for SASL EXTERNAL.
+          lazy_plugins -- Whether to import plugins on first use, rather
+            than when signing on.
+          warm_plugins -- Whether to load lazy plugins in the background
+            after signing on.
+          isolated_plugins -- A list of plugins to run in worker processes,
+            so that they can't slow down or crash the bot.
+          timeline -- The process's startup Timeline, which this network's
+            startup is recorded after.
         """
         self.logger = logging.getLogger(__name__)
         self.network = network.lower()
@@ -728,6 +1710,18 @@ class CardinalBotFactory(protocol.ClientFactory):
         self.censored_words = censored_words
         self.blacklist = blacklist
         self.storage_path = storage
+        self.who_cache_ttl = who_cache_ttl
+        self.ping_interval = ping_interval
+        self.max_missed_pongs = max_missed_pongs
+        self.servers = servers or []
+        self.ssl_verify = ssl_verify
+        self.ssl_certificate = ssl_certificate
+        self.lazy_plugins = lazy_plugins
+        self.warm_plugins = warm_plugins
+        self.isolated_plugins = isolated_plugins or []
+
+        # Records how long each step of starting up took
+        self.timeline = Timeline(timeline)
 
         # Register SIGINT handler, so we can close the connection cleanly
         signal.signal(signal.SIGINT, self._sigint)
@@ -735,25 +1729,322 @@ class CardinalBotFactory(protocol.ClientFactory):
         # Cardinal will set an instance of itself here later
         self.cardinal = None
 
+        # Created by the first instance of Cardinal to sign on, and kept for
+        # future connections
+        self.plugin_manager = None
+
         # This will be set to True when we don't want to trigger reconnection
         # logic.
         self.disconnect = False
 
+        # Set by NetworkManager when running alongside other networks
+        self.networks = None
+
+        # State of a connection handed over by another process, used by the
+        # next CardinalBot instance
+        self.adopted_state = None
+
+        # Database file locks, replaced by NetworkManager with locks shared by
+        # every network
+        self.db_locks = {}
+
         # The time we first connected to the network with Cardinal
         self.booted = datetime.now()
 
         # Used for backing off when reconnecting
         self.last_reconnection_wait = None
 
+        # When the current connection signed on, and the number of times each
+        # server has dropped us before the connection became healthy (e.g.
+        # because we're banned or throttled). Servers which drop us are tried
+        # after those that don't.
+        self._signed_on = None
+        self._drops = {}
+
+        # The server we are connected (or connecting) to, and the remaining
+        # servers to try if it fails. Candidates are None until connect() is
+        # used, in which case Twisted's connector is reused for reconnecting.
+        self.server = None
+        self._candidates = None
+
+        # TLS options for each server, kept so sessions can be resumed
+        self._tls = {}
+
+    def connect(self):
+        """Connects to the lowest latency server that is reachable.
+
+        Returns:
+          Deferred -- Fires once a connection attempt has been started.
+        """
+        d = self.probe_servers()
+        d.addCallback(self._connect_ranked)
+        return d
+
+    def probe_servers(self):
+        """Measures how quickly each server accepts a connection.
+
+        All servers are probed at the same time. SSL servers must complete a
+        TLS handshake (verifying their certificate, if ssl_verify is set) to
+        be reachable.
+
+        Returns:
+          Deferred -- Fires with a list of servers. Reachable servers come
+            first, sorted by the number of times they've dropped us and then
+            by latency, followed by unreachable servers in their configured
+            order.
+        """
+        if len(self.servers) < 2:
+            return defer.succeed(list(self.servers))
+
+        self.timeline.begin('probe servers')
+        d = defer.gatherResults([self._probe(server)
+                                 for server in self.servers])
+
+        def rank(latencies):
+            reachable = sorted(
+                ((self._drops.get(self.servers[i], 0), latency, i)
+                 for i, latency in enumerate(latencies)
+                 if latency is not None))
+            unreachable = [i for i, latency in enumerate(latencies)
+                           if latency is None]
+
+            ranked = [self.servers[i] for _, _, i in reachable] + \
+                [self.servers[i] for i in unreachable]
+            self.timeline.end('probe servers')
+
+            self.logger.info("Server latencies: %s" % ', '.join(
+                "%s:%d (%s)" % (server.host, server.port,
+                                "%.3fs" % latency if latency is not None
+                                else "unreachable")
+                for server, latency in zip(self.servers, latencies)))
+
+            return ranked
+
+        return d.addCallback(rank)
+
+    def _probe(self, server):
+        """Returns a Deferred firing with connect latency or None on failure"""
+        start = self.reactor.seconds()
+
+        endpoint = endpoints.HostnameEndpoint(
+            self.reactor, server.host, server.port,
+            timeout=self.PROBE_TIMEOUT)
+        if not server.ssl:
+            d = endpoints.connectProtocol(endpoint, protocol.Protocol())
+        else:
+            endpoint = endpoints.wrapClientTLS(self.tls_options(server),
+                                               endpoint)
+            d = endpoints.connectProtocol(endpoint, _TLSProbe())
+            d.addCallback(self._handshake, start)
+
+        def connected(proto):
+            proto.transport.loseConnection()
+            return self.reactor.seconds() - start
+
+        def failed(failure):
+            self.logger.debug("Probe of %s:%d failed: %s" %
+                              (server.host, server.port,
+                               failure.getErrorMessage()))
+            return None
+
+        d.addCallbacks(connected, failed)
+        return d
+
+    def _handshake(self, proto, start):
+        """Waits for a probe's TLS handshake, within the probe's timeout"""
+        timeout = self.reactor.callLater(
+            max(self.PROBE_TIMEOUT - (self.reactor.seconds() - start), 0),
+            proto.transport.abortConnection)
+
+        def finished(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        return proto.handshake.addBoth(finished).addCallback(lambda _: proto)
+
+    def signed_on(self):
+        """Records that the connection has signed on"""
+        self._signed_on = self.reactor.seconds()
+
+    def _connect_ranked(self, servers):
+        self._candidates = deque(servers)
+        self._connect_next()
+
+    def _connect_next(self):
+        """Connects to the next candidate server."""
+        self.server = server = self._candidates.popleft()
+        self.timeline.begin('connect')
+
+        if not server.ssl:
+            self.logger.info(
+                "Connecting over plaintext to %s:%d" %
+                (server.host, server.port)
+            )
+
+            self.reactor.connectTCP(server.host, server.port, self)
+        else:
+            self.logger.info(
+                "Connecting over SSL to %s:%d" %
+                (server.host, server.port)
+            )
+
+            self.reactor.connectSSL(server.host, server.port, self,
+                                    self.tls_options(server))
+
+    def tls_options(self, server):
+        """Returns the TLS options used when connecting to a server.
+
+        The same options are returned each time, so that a reconnect can
+        resume the TLS session of the previous connection.
+
+        Keyword arguments:
+          server -- A server_info tuple.
+
+        Returns:
+          ResumableClientTLS -- A client connection creator for connectSSL().
+        """
+        if server in self._tls:
+            return self._tls[server]
+
+        # For SSL, we need to import the SSL module from Twisted
+        from twisted.internet import ssl
+
+        certificate = None
+        if self.ssl_certificate:
+            with open(self.ssl_certificate) as f:
+                certificate = ssl.PrivateCertificate.loadPEM(f.read())
+
+        # Twisted disables session tickets by default, which prevents TLS 1.2
+        # sessions from being resumed
+        if self.ssl_verify:
+            options = ssl.optionsForClientTLS(
+                server.host,
+                clientCertificate=certificate,
+                extraCertificateOptions={'enableSessionTickets': True})
+        else:
+            self.logger.warning(
+                "Not verifying TLS certificate of %s" % server.host)
+
+            kwargs = {'enableSessionTickets': True}
+            if certificate is not None:
+                kwargs['privateKey'] = certificate.privateKey.original
+                kwargs['certificate'] = certificate.original
+            options = ssl.CertificateOptions(**kwargs)
+
+        self._tls[server] = ResumableClientTLS(server.host, options)
+        return self._tls[server]
+
+    def save_tls_session(self, transport):
+        """Stores the TLS session of the current connection for reuse.
+
+        Keyword arguments:
+          transport -- The transport of an established connection.
+        """
+        tls = self._tls.get(self.server)
+        if tls is None:
+            return
+
+        # For TLS transports, the handle is the OpenSSL connection
+        get_session = getattr(transport.getHandle(), 'get_session', None)
+        if get_session is not None:
+            tls.session = get_session()
+
+    def hand_over(self):
+        """Hands the connection over to a new Cardinal process.
+
+        The new process is started with the same command line, and takes over
+        the connection without reconnecting or re-registering. Once it has,
+        this process exits.
+
+        Returns:
+          Deferred -- Fires once the new process has adopted the connection,
+            or fails with HandoverError, in which case we carry on as normal.
+        """
+        return Handover(self).start(handover_args(sys.argv))
+
+    def adopt(self, path):
+        """Adopts the connection of a process calling hand_over().
+
+        Keyword arguments:
+          path -- Path to the Unix socket the old process is listening on.
+
+        Returns:
+          Deferred -- Fires once the connection has been adopted.
+        """
+        return Adopter(self).start(path)
+
+    def adopt_connection(self, descriptor, state):
+        """Adopts a connected IRC socket and the state of its connection.
+
+        Keyword arguments:
+          descriptor -- File descriptor of the socket.
+          state -- The state exported by CardinalBot.export_state().
+        """
+        self.server = server_info(*state['server'])
+        self.booted = datetime.fromtimestamp(state['booted'])
+
+        # Reconnect through connect() if the adopted connection is lost, and
+        # fail over quickly, as the connection was healthy before handover
+        self._candidates = deque()
+        self._signed_on = \
+            self.reactor.seconds() - self.HEALTHY_CONNECTION_TIME
+
+        self.adopted_state = state
+        try:
+            self.reactor.adoptStreamConnection(descriptor, state['family'],
+                                               self)
+        finally:
+            self.adopted_state = None
+
+    def detach(self):
+        """Closes our copy of a socket that another process has adopted"""
+        self.disconnect = True
+
+        # Shutting the socket down would close it for the other process too
+        transport = self.cardinal.transport
+        transport._shouldShutdown = False
+        transport.loseConnection()
+
+    def _reconnect(self, connector):
+        # We may have been told to quit while waiting
+        if self.disconnect:
+            return
+
+        if self._candidates is None:
+            connector.connect()
+        else:
+            self.connect()
+
     def _sigint(self, signal, frame):
-        """Called when a SIGINT is received.
+        """Called when a SIGINT is received."""
+        self.quit('Received SIGINT.')
+
+    def quit(self, message):
+        """Quits the network without reconnecting.
 
-        Set disconnect to true since this was user-triggered, and make Cardinal
-        send a valid IRC QUIT.
+        Set disconnect to true so we don't reconnect, and make Cardinal send a
+        valid IRC QUIT. If we aren't connected, there's nothing to wait for, so
+        stop right away.
+
+        Keyword arguments:
+          message -- Message to insert into QUIT.
         """
         self.disconnect = True
-        if self.cardinal:
-            self.cardinal.quit('Received SIGINT.')
+        if self.cardinal and self.cardinal.connected:
+            self.cardinal.quit(message)
+        else:
+            self._stop()
+
+    def _stop(self):
+        # Give plugins a chance to finish closing
+        d = self.plugin_manager.closed() if self.plugin_manager \
+            else defer.succeed(None)
+
+        if self.networks is None:
+            d.addCallback(lambda _: self.reactor.stop())
+        else:
+            d.addCallback(lambda _: self.networks.stopped(self))
 
     def clientConnectionLost(self, connector, reason):
         """Called when we lose connection to the server.
@@ -764,29 +2055,55 @@ class CardinalBotFactory(protocol.ClientFactory):
         """
         self.cardinal.disconnected()
 
+        # A connection which stayed signed on for a while was healthy, while
+        # one that was dropped quickly (e.g. because we're banned or
+        # throttled) may be dropped again
+        healthy = self._signed_on is not None and \
+            self.reactor.seconds() - self._signed_on >= \
+            self.HEALTHY_CONNECTION_TIME
+        self._signed_on = None
+
         # This flag tells us if Cardinal was told to disconnect by a user. If
         # not, we'll attempt to reconnect.
-        if not self.disconnect:
-            self.logger.info(
-                "Connection lost (%s), reconnecting in %d seconds." %
-                (reason, self.MINIMUM_RECONNECTION_WAIT)
-            )
-
-            # Reset the last reconnection wait time since this is the first
-            # time we've disconnected since a successful connection and then
-            # wait before connecting.
-            self.last_reconnection_wait = self.MINIMUM_RECONNECTION_WAIT
-            deferLater(
-                self.reactor,
-                self.last_reconnection_wait,
-                connector.connect
-            )
-        else:
+        if self.disconnect:
             self.logger.info(
                 "Disconnected successfully (%s), quitting." % reason
             )
 
-            self.reactor.stop()
+            self._stop()
+            return
+
+        if not healthy:
+            # Back off, so that a server which keeps dropping us isn't
+            # reconnected to in a tight loop. Probing again will rank it after
+            # servers which haven't dropped us.
+            if self.server is not None:
+                self._drops[self.server] = self._drops.get(self.server, 0) + 1
+            self._back_off(connector, "Connection lost (%s)" % reason)
+            return
+
+        if self.server is not None:
+            self._drops.pop(self.server, None)
+
+        # Reset the last reconnection wait time since this is the first
+        # time we've disconnected since a successful connection and then
+        # wait before connecting. If there are other servers to fail over
+        # to, there's no need to wait as long.
+        self.last_reconnection_wait = None
+        wait_time = self.FAILOVER_WAIT \
+            if self._candidates is not None and len(self.servers) > 1 \
+            else self.MINIMUM_RECONNECTION_WAIT
+        self.logger.info(
+            "Connection lost (%s), reconnecting in %d seconds." %
+            (reason, wait_time)
+        )
+
+        deferLater(
+            self.reactor,
+            wait_time,
+            self._reconnect,
+            connector
+        )
 
     def clientConnectionFailed(self, connector, reason):
         """Called when a connection attempt fails.
@@ -795,6 +2112,23 @@ class CardinalBotFactory(protocol.ClientFactory):
           connector -- Twisted IRC connector. Provided by Twisted.
           reason -- Reason connection failed. Provided by Twisted.
         """
+        # Rotate to the next server rather than backing off against a dead one
+        if self._candidates:
+            self.logger.info(
+                "Could not connect to %s:%d (%s), trying next server" %
+                (self.server.host, self.server.port, reason))
+            self._connect_next()
+            return
+
+        self._back_off(connector, "Could not connect (%s)" % reason)
+
+    def _back_off(self, connector, problem):
+        """Waits longer each time before reconnecting.
+
+        Keyword arguments:
+          connector -- Twisted IRC connector.
+          problem -- Description of what went wrong, for logging.
+        """
         # If we disconnected on our first connection attempt, then we don't
         # need to calculate a wait time, we can just use the minimum time
         if not self.last_reconnection_wait:
@@ -808,8 +2142,7 @@ class CardinalBotFactory(protocol.ClientFactory):
                 wait_time = self.MAXIMUM_RECONNECTION_WAIT
 
         self.logger.info(
-            "Could not connect (%s), retrying in %d seconds" %
-            (reason, wait_time)
+            "%s, retrying in %d seconds" % (problem, wait_time)
         )
 
         # Update the last connection wait time, then wait and try to connect
@@ -817,12 +2150,158 @@ class CardinalBotFactory(protocol.ClientFactory):
         deferLater(
             self.reactor,
             self.last_reconnection_wait,
-            connector.connect
+            self._reconnect,
+            connector
         )
 
 
+@implementer(IHandshakeListener)
+class _TLSProbe(protocol.Protocol):
+    """Probes a server, firing handshake once the TLS handshake completes"""
+
+    def __init__(self):
+        self.handshake = defer.Deferred()
+
+    def handshakeCompleted(self):
+        self.handshake.callback(None)
+
+    def connectionLost(self, reason):
+        if not self.handshake.called:
+            self.handshake.errback(reason)
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class ResumableClientTLS:
+    """Client TLS options which resume the last session when reconnecting"""
+
+    def __init__(self, hostname, options):
+        """Constructor for ResumableClientTLS
+
+        Keyword arguments:
+          hostname -- The server's hostname, used for SNI.
+          options -- Options from optionsForClientTLS(), or CertificateOptions
+            if the server's certificate shouldn't be verified.
+        """
+        self.hostname = hostname
+        self.options = options
+
+        # Set by CardinalBotFactory once a connection has been established
+        self.session = None
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        """Creates the OpenSSL connection for a new TLS connection"""
+        if IOpenSSLClientConnectionCreator.providedBy(self.options):
+            connection = self.options.clientConnectionForTLS(tlsProtocol)
+        else:
+            from OpenSSL import SSL
+            connection = SSL.Connection(self.options.getContext(), None)
+            connection.set_app_data(tlsProtocol)
+            connection.set_tlsext_host_name(self.hostname.encode('idna'))
+
+        if self.session is not None:
+            connection.set_session(self.session)
+
+        return connection
+
+
+class NetworkManager:
+    """Runs several networks in one process.
+
+    Each network has its own factory and connection, while the reactor,
+    imported plugin modules, and database locks are shared.
+    """
+
+    @property
+    def reactor(self):
+        """Allows us to inject a mock reactor in unit tests"""
+        return getattr(self, '_reactor', reactor)
+
+    def __init__(self, factories):
+        """Constructor for NetworkManager
+
+        Keyword arguments:
+          factories -- A list of CardinalBotFactory instances, one per network.
+
+        Raises:
+          ValueError -- When two factories are for the same network.
+        """
+        self.logger = logging.getLogger(__name__)
+
+        networks = [factory.network for factory in factories]
+        for network in set(networks):
+            if networks.count(network) > 1:
+                # Network-specific databases would be shared
+                raise ValueError("Network %s is configured more than once" %
+                                 network)
+
+        self.factories = factories
+        self.db_locks = {}
+
+        # Set when instances elect a leader to connect
+        self.election = None
+
+        # Set when the reactor is watched for plugins blocking it
+        self.watchdog = None
+
+        # Set when the memory retained by plugins is measured
+        self.memory = None
+
+        # Networks that haven't quit
+        self._running = set(networks)
+
+        for factory in factories:
+            factory.networks = self
+            factory.db_locks = self.db_locks
+
+        # Each factory registers its own handler, replace it with one that
+        # disconnects every network
+        signal.signal(signal.SIGINT, self._sigint)
+
+    def connect(self):
+        """Connects to every network.
+
+        Returns:
+          Deferred -- Fires once a connection attempt to each network has
+            been started.
+        """
+        return defer.gatherResults(
+            [factory.connect() for factory in self.factories])
+
+    def stopped(self, factory):
+        """Called when a network quits, rather than reconnecting.
+
+        Stops the reactor once every network has quit.
+
+        Keyword arguments:
+          factory -- The factory for the network that quit.
+        """
+        self._running.discard(factory.network)
+        if not self._running:
+            self.reactor.stop()
+        else:
+            self.logger.info("Network %s quit, still running: %s" %
+                             (factory.network,
+                              ', '.join(sorted(self._running))))
+
+    def quit(self, message):
+        """Quits every network, stopping the reactor once they have quit.
+
+        Keyword arguments:
+          message -- Message to insert into QUIT.
+        """
+        for factory in self.factories:
+            factory.quit(message)
+
+    def _sigint(self, signal, frame):
+        for factory in self.factories:
+            factory._sigint(signal, frame)
+
+
 class ChannelManager:
-    def __init__(self, chanmodes, param_modes):
+    DEFAULT_PREFIXES = {'o': ('@', 0), 'v': ('+', 1)}
+    """Used when the server doesn't advertise PREFIX"""
+
+    def __init__(self, chanmodes, param_modes, prefixes=None):
         self.logger = logging.getLogger(__name__)
 
         # chanmodes dict (from Twisted):
@@ -838,8 +2317,15 @@ class ChannelManager:
         # Keeping this around so we can make a call to irc.parseModes
         self._twisted_param_modes = param_modes
 
+        self.set_prefixes(prefixes or self.DEFAULT_PREFIXES)
+
         self._channels = {}
 
+        # Maps lowercased nicks to User records. Each record holds the names
+        # of the channels the user is in, so QUIT and NICK don't need to scan
+        # every channel.
+        self.users = {}
+
     def __len__(self):
         return len(self._channels)
 
@@ -852,11 +2338,154 @@ class ChannelManager:
     def __bool__(self):
         return True
 
+    def set_prefixes(self, prefixes):
+        """Sets the channel membership prefixes (e.g. @ for op, + for voice)
+
+        prefixes -- Dict from Twisted's PREFIX feature mapping modes to a
+          tuple of (prefix, priority).
+        """
+        self.prefixes = {mode: prefix
+                         for mode, (prefix, _) in prefixes.items()}
+        self._prefix_modes = {prefix: mode for mode, prefix
+                              in self.prefixes.items()}
+
+        # Highest ranked mode first, so the display prefix can be found
+        self._mode_rank = ''.join(
+            mode for mode, _ in sorted(prefixes.items(),
+                                       key=lambda item: item[1][1]))
+
     def add(self, name):
-        self._channels[name] = Channel(name)
+        if name in self._channels:
+            self.remove(name)
+
+        self._channels[name] = Channel(name, self._mode_rank, self.prefixes)
 
     def remove(self, name):
-        del self._channels[name]
+        chan = self._channels.pop(name)
+
+        for key in chan.users:
+            self._remove_channel_from_user(key, name)
+
+    def get_user(self, nick):
+        """Returns the User record for a nick, or None if not tracked."""
+        return self.users.get(nick.lower())
+
+    def add_user(self, channel, nick, modes='', user=None, vhost=None):
+        """Adds a user to a channel's membership.
+
+        channel -- Name of the channel.
+        nick -- The user's nick.
+        modes -- Prefix modes the user holds in the channel (e.g. "ov").
+        user -- The user's ident, if known.
+        vhost -- The user's hostname, if known.
+        """
+        try:
+            chan = self._channels[channel]
+        except KeyError:
+            self.logger.debug(
+                f"Can't add {nick} to untracked channel: {channel}")
+            return
+
+        key = sys.intern(nick.lower())
+        record = self.users.get(key)
+        if record is None:
+            record = self.users[key] = User(sys.intern(nick))
+
+        if user is not None:
+            record.user = user
+        if vhost is not None:
+            record.vhost = vhost
+
+        record.channels.add(chan.name)
+
+        member = chan.users.get(key)
+        if member is None:
+            chan.users[key] = Member(record, sys.intern(modes))
+        else:
+            member.modes = sys.intern(modes)
+
+    def add_names(self, channel, names):
+        """Adds users from a NAMES reply to a channel's membership.
+
+        names -- List of names, optionally prefixed (e.g. "@nick"), and
+          optionally in nick!user@host format.
+        """
+        for name in names:
+            modes = ''
+            while name and name[0] in self._prefix_modes:
+                modes += self._prefix_modes[name[0]]
+                name = name[1:]
+
+            if not name:
+                continue
+
+            user = vhost = None
+            if '!' in name:
+                name, _, userhost = name.partition('!')
+                user, _, vhost = userhost.partition('@')
+
+            self.add_user(channel, name, modes, user, vhost)
+
+    def clear_users(self, channel):
+        """Removes all users from a channel, e.g. before a fresh NAMES."""
+        try:
+            chan = self._channels[channel]
+        except KeyError:
+            return
+
+        for key in chan.users:
+            self._remove_channel_from_user(key, channel)
+
+        chan.users = {}
+
+    def remove_user(self, channel, nick):
+        """Removes a user from a channel's membership (PART or KICK)."""
+        try:
+            chan = self._channels[channel]
+        except KeyError:
+            return
+
+        key = nick.lower()
+        if chan.users.pop(key, None) is not None:
+            self._remove_channel_from_user(key, channel)
+
+    def quit_user(self, nick):
+        """Removes a user from every channel they were in.
+
+        Returns:
+          list -- Names of the channels the user was in.
+        """
+        record = self.users.pop(nick.lower(), None)
+        if record is None:
+            return []
+
+        for channel in record.channels:
+            self._channels[channel].users.pop(nick.lower(), None)
+
+        return list(record.channels)
+
+    def rename_user(self, nick, new_nick):
+        """Updates a user's nick in every channel they are in."""
+        record = self.users.pop(nick.lower(), None)
+        if record is None:
+            return
+
+        key = sys.intern(new_nick.lower())
+        record.nick = sys.intern(new_nick)
+        self.users[key] = record
+
+        for channel in record.channels:
+            users = self._channels[channel].users
+            users[key] = users.pop(nick.lower())
+
+    def _remove_channel_from_user(self, key, channel):
+        record = self.users.get(key)
+        if record is None:
+            return
+
+        record.channels.discard(channel)
+        if not record.channels:
+            del self.users[key]
 
     def set_modes(self, channel, modes, args):
         try:
@@ -877,7 +2506,14 @@ class ChannelManager:
 
         # set modes
         for mode, param in added:
-            if self.chanmodes.get(mode) == "addressModes":
+            if mode in self.prefixes:
+                member = chan.users.get(param.lower()) if param else None
+                if member and mode not in member.modes:
+                    member.modes = sys.intern(''.join(
+                        m for m in self._mode_rank
+                        if m in member.modes or m == mode))
+
+            elif self.chanmodes.get(mode) == "addressModes":
                 chan.modes[mode] = chan.modes.get(mode, []).append(param)
 
             elif self.chanmodes.get(mode) in ("param", "setParam"):
@@ -893,6 +2529,12 @@ class ChannelManager:
 
         # unset modes
         for mode, param in removed:
+            if mode in self.prefixes:
+                member = chan.users.get(param.lower()) if param else None
+                if member:
+                    member.modes = sys.intern(member.modes.replace(mode, ''))
+                continue
+
             # ignore unset modes
             if mode not in chan.modes:
                 self.logger.error("Cannot set unset mode '{mode}'"
@@ -918,7 +2560,7 @@ class ChannelManager:
 
 
 class Channel:
-    def __init__(self, name):
+    def __init__(self, name, mode_rank='ov', prefixes=None):
         self.name = name
 
         # modes dict:
@@ -927,6 +2569,69 @@ class Channel:
         #  paramless modes - mode: None
         self.modes = {}
 
+        # users dict:
+        #  lowercased nick - Member
+        self.users = {}
+
+        # Prefix modes ordered from highest rank to lowest, and the prefix
+        # characters they're displayed with
+        self._mode_rank = mode_rank
+        self._prefixes = prefixes or {'o': '@', 'v': '+'}
+
+    def __contains__(self, nick):
+        return nick.lower() in self.users
+
     def allows_color(self):
         # +c bans color
         return 'c' not in self.modes
+
+    def nicks(self):
+        """Returns the nicks of the users in the channel."""
+        return [member.user.nick for member in self.users.values()]
+
+    def get_modes(self, nick):
+        """Returns prefix modes a user holds (e.g. "ov"), or None if absent."""
+        member = self.users.get(nick.lower())
+        return member.modes if member else None
+
+    def get_prefix(self, nick):
+        """Returns the display prefix for a user's highest mode (e.g. "@")."""
+        modes = self.get_modes(nick)
+        for mode in self._mode_rank:
+            if modes and mode in modes:
+                return self._prefixes[mode]
+        return ''
+
+    def is_op(self, nick):
+        return 'o' in (self.get_modes(nick) or '')
+
+    def is_voiced(self, nick):
+        return 'v' in (self.get_modes(nick) or '')
+
+
+class User:
+    """A user seen in one or more channels we are in."""
+    __slots__ = ('nick', 'user', 'vhost', 'channels')
+
+    def __init__(self, nick, user=None, vhost=None):
+        self.nick = nick
+        self.user = user
+        self.vhost = vhost
+
+        # Names of channels we share with this user
+        self.channels = set()
+
+    def __repr__(self):
+        return f"User({self.nick!r}, {self.user!r}, {self.vhost!r})"
+
+
+class Member:
+    """A user's membership in a channel."""
+    __slots__ = ('user', 'modes')
+
+    def __init__(self, user, modes=''):
+        self.user = user
+        self.modes = modes
+
+    def __repr__(self):
+        return f"Member({self.user!r}, {self.modes!r})"
@@ -0,0 +1,169 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import socket
+import uuid
+
+from twisted.internet import defer, reactor, task
+
+
+class LeaderElection:
+    """Elects one of several Cardinal instances to connect to IRC.
+
+    Instances sharing a storage volume compete for a lease kept in a file on
+    it. The leader renews the lease while it runs, and the others poll the
+    file, taking over once the lease has expired. Updates to the file are
+    serialized with flock(), which works across containers sharing a volume.
+    """
+
+    LEASE_TIME = 15
+    """Time in seconds a lease lasts without being renewed"""
+
+    def __init__(self, path, lease_time=None, identity=None):
+        """Constructor for LeaderElection
+
+        Keyword arguments:
+          path -- Path to the lease file, shared by every instance.
+          lease_time -- Time in seconds a lease lasts without being renewed.
+          identity -- Identifies this instance in the lease file.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.lease_time = lease_time or self.LEASE_TIME
+        self.identity = identity or '%s:%d:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        # Leases are renewed (or checked by standbys) a few times per lease,
+        # so a missed renewal doesn't lose it
+        self.interval = self.lease_time / 3.0
+
+        self.leader = False
+        self.expires = None
+
+        # Fire when we become leader, and when we lose leadership
+        self.elected = defer.Deferred()
+        self.deposed = defer.Deferred()
+
+        self._loop = None
+        self._waiting_on = None
+
+    @property
+    def reactor(self):
+        """Allows us to inject a mock reactor in unit tests"""
+        return getattr(self, '_reactor', reactor)
+
+    def start(self):
+        """Starts competing for the lease, checking it right away"""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.logger.info("Starting leader election as %s" % self.identity)
+
+        self._loop = task.LoopingCall(self.check)
+        self._loop.clock = self.reactor
+        self._loop.start(self.interval)
+
+    def stop(self):
+        """Stops competing for the lease, releasing it if we hold it.
+
+        Releasing the lease lets a standby take over without waiting for it to
+        expire.
+        """
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+        if self.leader:
+            try:
+                self._update(release=True)
+            except (OSError, ValueError):
+                self.logger.exception("Unable to release leader lease")
+            self.leader = False
+
+    def check(self):
+        """Renews the lease if we hold it, or takes it if it has expired"""
+        try:
+            owner, expires = self._update()
+        except (OSError, ValueError) as e:
+            self.logger.warning("Unable to update leader lease: %s" % e)
+
+            # A standby may take over once the lease expires, so stop before
+            # then if we can't renew it
+            if self.leader and \
+                    self.reactor.seconds() >= self.expires - self.interval:
+                self._depose("couldn't renew lease")
+            return
+
+        if owner is None:
+            # Another instance was updating the lease, try again later
+            return
+
+        if owner == self.identity:
+            self.expires = expires
+            if not self.leader:
+                self.leader = True
+                self.logger.info("Elected leader")
+                self.elected.callback(None)
+        elif self.leader:
+            self._depose("lease taken by %s" % owner)
+        elif self._waiting_on != owner:
+            self._waiting_on = owner
+            self.logger.info("Standing by, %s is the leader" % owner)
+
+    def _depose(self, reason):
+        self.logger.error("Lost leadership: %s" % reason)
+
+        self.leader = False
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+        self.deposed.callback(None)
+
+    def _update(self, release=False):
+        """Takes or renews the lease if it's free or ours.
+
+        Keyword arguments:
+          release -- Give up the lease instead of renewing it.
+
+        Returns:
+          tuple -- The owner of the lease and when it expires, or (None, None)
+            if another instance holds the lock on the file.
+        """
+        with open(self.path, 'a+') as f:
+            # Other instances only hold the lock briefly, so wait for it when
+            # releasing rather than leaving the lease to expire
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if release
+                            else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return None, None
+                raise
+
+            f.seek(0)
+            contents = f.read()
+            lease = json.loads(contents) if contents.strip() else {}
+
+            now = self.reactor.seconds()
+            owner = lease.get('owner')
+            expires = lease.get('expires', 0)
+
+            if owner != self.identity and expires > now:
+                return owner, expires
+
+            if release:
+                expires = 0
+            else:
+                owner, expires = self.identity, now + self.lease_time
+
+            f.seek(0)
+            f.truncate()
+            json.dump({'owner': owner, 'expires': expires}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+            return owner, expires
@@ -32,3 +32,7 @@ class EventCallbackError(CardinalException):
 
 class EventRejectedMessage(CardinalException):
     """Raised when an event callback wants to reject an event."""
+
+
+class HandoverError(CardinalException):
+    """Raised when a connection can't be handed over to a new process."""
@@ -0,0 +1,31 @@
+from twisted.internet import defer
+
+from cardinal.decorators import command
+
+# Fired by tests to finish setting up
+setups = []
+
+
+class TestAsyncSetupPlugin:
+    def __init__(self):
+        self.calls = []
+        self.closing = None
+
+    @command('async')
+    def async_command(self, *args):
+        self.calls.append(args)
+
+    def close(self):
+        self.closing = defer.Deferred()
+        return self.closing
+
+
+async def setup():
+    d = defer.Deferred()
+    setups.append(d)
+    await d
+
+    return TestAsyncSetupPlugin()
+
+
+entrypoint = setup
@@ -0,0 +1,53 @@
+import os
+
+from twisted.internet import defer
+
+from cardinal.decorators import command, event, help, regex
+from cardinal.exceptions import EventRejectedMessage
+
+
+class TestIsolatedPlugin:
+    def __init__(self, cardinal, config):
+        self.greeting = config['greeting'] if config else 'hello'
+        self.db = cardinal.get_db('isolated')
+
+    @command('pid')
+    @help("Replies with the worker's process ID")
+    def pid(self, cardinal, user, channel, msg):
+        cardinal.sendMsg(channel, '%s %s %d' %
+                         (self.greeting, user.nick, os.getpid()))
+
+    @regex(r'^count (\w+)$')
+    def count(self, cardinal, user, channel, msg):
+        with self.db() as db:
+            db[user.nick] = db.get(user.nick, 0) + 1
+            cardinal.sendMsg(channel, str(db[user.nick]))
+
+    @command('state')
+    @defer.inlineCallbacks
+    def state(self, cardinal, user, channel, msg):
+        users = yield cardinal.who(channel)
+        batch = cardinal.current_batch
+
+        cardinal.sendMsg(channel, ' '.join((
+            batch.type if batch else 'none',
+            str(cardinal.config('config_valid_json')['test']),
+            cardinal.supported.getFeature('NETWORK'),
+            ','.join(user.nick for user in users),
+        )))
+
+    @command('crash')
+    def crash(self, cardinal, user, channel, msg):
+        os._exit(1)
+
+    @event('irc.join')
+    def joined(self, cardinal, user, channel):
+        if channel == '#ignored':
+            raise EventRejectedMessage
+        cardinal.sendMsg(channel, 'welcome %s' % user.nick)
+
+    def close(self, cardinal):
+        cardinal.sendMsg('#chan', 'bye')
+
+
+entrypoint = TestIsolatedPlugin
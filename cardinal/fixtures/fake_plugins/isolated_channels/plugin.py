@@ -0,0 +1,14 @@
+from cardinal.decorators import command
+
+
+class TestIsolatedChannelsPlugin:
+    def __init__(self, cardinal):
+        self.cardinal = cardinal
+
+    @command('ops')
+    def ops(self, cardinal, user, channel, msg):
+        if self.cardinal.channels[channel].is_op(user.nick):
+            cardinal.sendMsg(channel, 'op')
+
+
+entrypoint = TestIsolatedChannelsPlugin
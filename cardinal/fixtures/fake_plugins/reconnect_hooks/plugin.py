@@ -0,0 +1,14 @@
+class TestReconnectHooksPlugin:
+    def __init__(self, cardinal):
+        self.cardinal = cardinal
+        self.disconnected = None
+        self.reconnected = None
+
+    def on_disconnect(self, cardinal):
+        self.disconnected = cardinal
+
+    def on_reconnect(self, cardinal):
+        self.reconnected = cardinal
+
+
+entrypoint = TestReconnectHooksPlugin
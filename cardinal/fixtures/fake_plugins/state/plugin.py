@@ -0,0 +1,14 @@
+class TestStatePlugin:
+    STATE_VERSION = 1
+
+    def __init__(self):
+        self.cache = {}
+
+    def export_state(self):
+        return self.cache
+
+    def import_state(self, state):
+        self.cache = state
+
+
+entrypoint = TestStatePlugin
@@ -0,0 +1,324 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from twisted.internet import defer, endpoints, protocol
+from twisted.internet.interfaces import IFileDescriptorReceiver
+from twisted.protocols import basic
+from zope.interface import implementer
+
+from cardinal.exceptions import HandoverError
+
+HANDOVER_VERSION = 1
+"""Version of the state format, bumped when it changes incompatibly"""
+
+ADOPTED = b'adopted'
+"""Sent by the new process once it has taken over the connection"""
+
+
+def handover_args(argv):
+    """Returns the command line for the process taking over the connection.
+
+    Keyword arguments:
+      argv -- The command line of this process, usually sys.argv.
+
+    Returns:
+      list -- argv without any --adopt option from a previous handover.
+    """
+    args = list(argv)
+    if '--adopt' in args:
+        i = args.index('--adopt')
+        del args[i:i + 2]
+
+    return args
+
+
+@implementer(IFileDescriptorReceiver)
+class HandoverProtocol(basic.Int32StringReceiver):
+    """Carries the IRC socket and connection state between processes"""
+
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, handover):
+        self.handover = handover
+
+    def connectionMade(self):
+        self.handover.connectionMade(self)
+
+    def fileDescriptorReceived(self, descriptor):
+        self.handover.fileDescriptorReceived(descriptor)
+
+    def stringReceived(self, string):
+        self.handover.stringReceived(self, string)
+
+    def connectionLost(self, reason):
+        self.handover.connectionLost(self, reason)
+
+
+class Handover:
+    """Hands a live IRC connection over to a new Cardinal process.
+
+    The new process is started with --adopt and connects back over a Unix
+    socket. It's sent a duplicate of the IRC socket and the state of the
+    connection, and once it has adopted them this process closes its copy of
+    the socket without quitting IRC, and exits.
+    """
+
+    TIMEOUT = 30
+    """Time in seconds for the new process to adopt the connection"""
+
+    FLUSH_INTERVAL = 0.05
+    """Time in seconds between checks for unsent data"""
+
+    def __init__(self, factory):
+        """Constructor for Handover
+
+        Keyword arguments:
+          factory -- The CardinalBotFactory whose connection is handed over.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.factory = factory
+        self.reactor = factory.reactor
+
+        self.deferred = defer.Deferred()
+        self.state = None
+
+        self._directory = None
+        self._port = None
+        self._stopped = None
+        self._process = None
+        self._timeout = None
+        self._adopted = False
+
+    def start(self, args):
+        """Starts the new process and waits for it to adopt the connection.
+
+        Keyword arguments:
+          args -- Command line for the new process, without the interpreter.
+
+        Returns:
+          Deferred -- Fires once the connection is adopted, or fails with
+            HandoverError.
+        """
+        cardinal = self.factory.cardinal
+        if cardinal is None or not cardinal.connected or \
+                not cardinal._registered:
+            return defer.fail(HandoverError("Not connected"))
+
+        # The TLS state lives in this process' memory and can't be sent along
+        # with the socket
+        if self.factory.server.ssl:
+            return defer.fail(HandoverError(
+                "TLS connections can't be handed over"))
+
+        networks = self.factory.networks
+        if networks is not None and len(networks.factories) > 1:
+            return defer.fail(HandoverError(
+                "Can't hand over when running multiple networks"))
+
+        # The new process would have to win the election too, and a standby
+        # could beat it
+        if networks is not None and networks.election is not None:
+            return defer.fail(HandoverError(
+                "Can't hand over with leader election enabled"))
+
+        # Keep the path short, as Unix socket paths are limited in length
+        self._directory = tempfile.mkdtemp(prefix='cardinal-')
+        path = os.path.join(self._directory, 'handover.sock')
+
+        factory = protocol.Factory()
+        factory.buildProtocol = lambda addr: HandoverProtocol(self)
+        self._port = self.reactor.listenUNIX(path, factory)
+
+        self.logger.info("Starting new process to hand connection over to")
+        self._process = self.reactor.spawnProcess(
+            protocol.ProcessProtocol(),
+            sys.executable,
+            [sys.executable] + args + ['--adopt', path],
+            env=os.environ,
+            path=os.getcwd(),
+            # Share our stdio, so logs go to the same place
+            childFDs={0: 0, 1: 1, 2: 2},
+        )
+
+        self._timeout = self.reactor.callLater(
+            self.TIMEOUT, self._fail,
+            HandoverError("New process didn't adopt the connection"))
+
+        return self.deferred
+
+    def connectionMade(self, proto):
+        # Only one process may adopt the connection
+        self._stop_listening()
+
+        cardinal = self.factory.cardinal
+        cardinal.freeze()
+
+        d = self._flushed(cardinal.transport)
+        d.addCallback(lambda _: self._send(proto))
+
+    def _flushed(self, transport):
+        """Returns a Deferred firing once data written to IRC has been sent"""
+        d = defer.Deferred()
+
+        def check():
+            # Twisted buffers written data until the socket accepts it
+            pending = len(getattr(transport, 'dataBuffer', b'')) - \
+                getattr(transport, 'offset', 0) + \
+                getattr(transport, '_tempDataLen', 0)
+            if pending > 0 and not self.deferred.called:
+                self.reactor.callLater(self.FLUSH_INTERVAL, check)
+            else:
+                d.callback(None)
+
+        check()
+        return d
+
+    def _send(self, proto):
+        if self.deferred.called:
+            return
+
+        cardinal = self.factory.cardinal
+        self.state = cardinal.export_state()
+
+        proto.transport.sendFileDescriptor(cardinal.transport.fileno())
+        proto.sendString(json.dumps(self.state).encode('utf-8'))
+
+    def fileDescriptorReceived(self, descriptor):
+        # We only send descriptors
+        os.close(descriptor)
+
+    def stringReceived(self, proto, string):
+        if string != ADOPTED:
+            return
+
+        self._adopted = True
+        self._cleanup()
+
+        self.logger.info("Connection adopted by new process, exiting")
+        self.factory.detach()
+
+        self.deferred.callback(None)
+
+    def connectionLost(self, proto, reason):
+        if not self._adopted:
+            self._fail(HandoverError(
+                "New process exited without adopting the connection"))
+
+    def _fail(self, error):
+        if self.deferred.called:
+            return
+
+        self.logger.error("Handover failed: %s" % error)
+
+        if self._process is not None:
+            try:
+                self._process.signalProcess('KILL')
+            except Exception:
+                pass
+
+        cardinal = self.factory.cardinal
+        if cardinal is not None and cardinal.frozen:
+            cardinal.thaw(self.state)
+
+        self._cleanup()
+        self.deferred.errback(error)
+
+    def _cleanup(self):
+        if self._timeout is not None and self._timeout.active():
+            self._timeout.cancel()
+        self._timeout = None
+
+        self._stop_listening()
+
+        if self._directory is not None:
+            directory, self._directory = self._directory, None
+            # The port removes its socket file once it has stopped
+            self._stopped.addBoth(
+                lambda _: shutil.rmtree(directory, ignore_errors=True))
+
+    def _stop_listening(self):
+        if self._port is not None:
+            self._stopped = defer.maybeDeferred(self._port.stopListening)
+            self._port = None
+
+
+class Adopter:
+    """Adopts an IRC connection handed over by a running Cardinal process"""
+
+    def __init__(self, factory):
+        """Constructor for Adopter
+
+        Keyword arguments:
+          factory -- The CardinalBotFactory which should adopt the connection.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.factory = factory
+        self.reactor = factory.reactor
+
+        self.deferred = defer.Deferred()
+        self._descriptor = None
+
+    def start(self, path):
+        """Connects to the old process and adopts its connection.
+
+        Keyword arguments:
+          path -- Path to the Unix socket the old process is listening on.
+
+        Returns:
+          Deferred -- Fires once the connection is adopted, or fails if it
+            couldn't be.
+        """
+        endpoint = endpoints.UNIXClientEndpoint(self.reactor, path)
+        d = endpoints.connectProtocol(endpoint, HandoverProtocol(self))
+        d.addErrback(self._fail)
+
+        return self.deferred
+
+    def connectionMade(self, proto):
+        pass
+
+    def fileDescriptorReceived(self, descriptor):
+        self._descriptor = descriptor
+
+    def stringReceived(self, proto, string):
+        try:
+            if self._descriptor is None:
+                raise HandoverError("No socket was received")
+
+            state = json.loads(string.decode('utf-8'))
+            if state.get('version') != HANDOVER_VERSION:
+                raise HandoverError("Unsupported state version: %s" %
+                                    state.get('version'))
+
+            self.factory.adopt_connection(self._descriptor, state)
+        except Exception as e:
+            proto.transport.loseConnection()
+            self._fail(e)
+            return
+        finally:
+            # The reactor has its own copy of the socket
+            if self._descriptor is not None:
+                os.close(self._descriptor)
+                self._descriptor = None
+
+        proto.sendString(ADOPTED)
+        proto.transport.loseConnection()
+
+        self.deferred.callback(None)
+
+    def connectionLost(self, proto, reason):
+        self._fail(HandoverError("Lost connection to the old process"))
+
+    def _fail(self, error):
+        if self.deferred.called:
+            return
+
+        if not isinstance(error, Exception):
+            error = error.value
+
+        self.logger.error("Couldn't adopt connection: %s" % error)
+        self.deferred.errback(error)
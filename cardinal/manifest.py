@@ -0,0 +1,213 @@
+import ast
+import re
+
+
+class _Unresolvable(Exception):
+    """Raised when a plugin's manifest can't be determined statically"""
+
+
+def read_manifest(path):
+    """Reads a plugin's commands and event callbacks without importing it.
+
+    The plugin's source is parsed, and the arguments of the command, regex,
+    help, and event decorators on its entrypoint class are evaluated. Only
+    literals, module-level constants, string concatenation, and re.compile()
+    are supported.
+
+    Keyword arguments:
+      path -- Path to the plugin's plugin.py.
+
+    Returns:
+      dict -- With a list of commands (each with the method name, and its
+        commands, regex, and help attributes if set) and a list of callbacks
+        (each with the method name and event_names). None if the plugin can't
+        be described statically, in which case it must be imported to find
+        out.
+    """
+    try:
+        with open(path, 'r') as f:
+            tree = ast.parse(f.read(), path)
+    except (OSError, SyntaxError, ValueError):
+        return None
+
+    try:
+        return _ManifestReader(tree).read()
+    except _Unresolvable:
+        return None
+
+
+class _ManifestReader:
+    DECORATORS = ('command', 'regex', 'help', 'event')
+
+    def __init__(self, tree):
+        self.tree = tree
+
+        # Module-level constants, skipping any that are reassigned since we
+        # can't tell which value a decorator would see
+        self.names = {}
+        reassigned = set()
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and len(node.targets) == 1 and \
+                    isinstance(node.targets[0], ast.Name):
+                name = node.targets[0].id
+                if name in self.names:
+                    reassigned.add(name)
+                self.names[name] = node.value
+
+        for name in reassigned:
+            del self.names[name]
+
+    def read(self):
+        entrypoint = self._entrypoint()
+        classes = [node for node in self.tree.body
+                   if isinstance(node, ast.ClassDef) and
+                   node.name == entrypoint]
+        if len(classes) != 1:
+            raise _Unresolvable()
+
+        # Inherited methods could be commands too
+        cls = classes[0]
+        if any(not (isinstance(base, ast.Name) and base.id == 'object')
+               for base in cls.bases):
+            raise _Unresolvable()
+
+        # Plugins registering their own events must be loaded for other
+        # plugins to use them
+        for node in ast.walk(self.tree):
+            if isinstance(node, ast.Attribute) and \
+                    node.attr == 'event_manager':
+                raise _Unresolvable()
+
+        commands = []
+        callbacks = []
+        for node in cls.body:
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+
+            attributes = self._read_decorators(node)
+
+            if 'commands' in attributes or 'regex' in attributes:
+                command = {'method': node.name}
+                for attribute in ('commands', 'regex', 'help'):
+                    if attribute in attributes:
+                        command[attribute] = attributes[attribute]
+                commands.append(command)
+
+            if 'events' in attributes:
+                callbacks.append({
+                    'method': node.name,
+                    'event_names': attributes['events'],
+                })
+
+        return {'commands': commands, 'callbacks': callbacks}
+
+    def _entrypoint(self):
+        """Returns the name of the plugin's class"""
+        # Old-style plugins return an instance from setup()
+        entrypoint = self.names.get('entrypoint', ast.Name(id='setup'))
+        if not isinstance(entrypoint, ast.Name):
+            raise _Unresolvable()
+
+        functions = [node for node in self.tree.body
+                     if isinstance(node, (ast.FunctionDef,
+                                          ast.AsyncFunctionDef)) and
+                     node.name == entrypoint.id]
+        if not functions:
+            return entrypoint.id
+        if len(functions) != 1:
+            raise _Unresolvable()
+
+        # Factories, which may be asynchronous, must instantiate the class in
+        # every return statement
+        classes = set()
+        for node in ast.walk(functions[0]):
+            if isinstance(node, ast.Return):
+                if not (isinstance(node.value, ast.Call) and
+                        isinstance(node.value.func, ast.Name)):
+                    raise _Unresolvable()
+                classes.add(node.value.func.id)
+
+        if len(classes) != 1:
+            raise _Unresolvable()
+
+        return classes.pop()
+
+    def _read_decorators(self, function):
+        attributes = {}
+
+        # Decorators are applied from the bottom up
+        for decorator in reversed(function.decorator_list):
+            if not isinstance(decorator, ast.Call):
+                continue
+
+            func = decorator.func
+            name = func.id if isinstance(func, ast.Name) else \
+                func.attr if isinstance(func, ast.Attribute) else None
+            if name not in self.DECORATORS:
+                continue
+
+            if len(decorator.args) != 1 or decorator.keywords:
+                raise _Unresolvable()
+            value = self._evaluate(decorator.args[0])
+
+            if name == 'regex':
+                attributes['regex'] = value
+                continue
+
+            if isinstance(value, str):
+                value = [value]
+
+            if name == 'command':
+                attributes['commands'] = value
+            elif name == 'event':
+                attributes['events'] = value
+            else:
+                attributes['help'] = value + attributes.get('help', [])
+
+        return attributes
+
+    def _evaluate(self, node, depth=0):
+        if depth > 10:
+            raise _Unresolvable()
+
+        if isinstance(node, ast.Constant) and \
+                isinstance(node.value, (str, int)):
+            return node.value
+
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [self._evaluate(element, depth + 1)
+                    for element in node.elts]
+
+        if isinstance(node, ast.Name) and node.id in self.names:
+            return self._evaluate(self.names[node.id], depth + 1)
+
+        if isinstance(node, ast.BinOp) and \
+                isinstance(node.op, (ast.Add, ast.BitOr)):
+            left = self._evaluate(node.left, depth + 1)
+            right = self._evaluate(node.right, depth + 1)
+            try:
+                return left + right if isinstance(node.op, ast.Add) \
+                    else left | right
+            except TypeError:
+                raise _Unresolvable()
+
+        if isinstance(node, ast.Attribute) and self._is_re(node.value) and \
+                isinstance(getattr(re, node.attr, None), re.RegexFlag):
+            return getattr(re, node.attr)
+
+        if isinstance(node, ast.Call) and \
+                isinstance(node.func, ast.Attribute) and \
+                node.func.attr == 'compile' and self._is_re(node.func.value):
+            args = [self._evaluate(arg, depth + 1) for arg in node.args]
+            kwargs = {keyword.arg: self._evaluate(keyword.value, depth + 1)
+                      for keyword in node.keywords}
+            try:
+                return re.compile(*args, **kwargs)
+            except (TypeError, re.error):
+                raise _Unresolvable()
+
+        raise _Unresolvable()
+
+    @staticmethod
+    def _is_re(node):
+        return isinstance(node, ast.Name) and node.id == 're'
@@ -0,0 +1,287 @@
+import builtins
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import types
+from collections import namedtuple
+
+from twisted.internet import reactor, task
+
+from cardinal import metrics
+
+# Memory use at a point in time. plugins maps (network, plugin) to the
+# approximate size of each plugin instance, caches maps (network, cache) to
+# the size of the bot's caches, and allocations maps plugins to the memory
+# allocated by their code (if tracemalloc is tracing.)
+memory_snapshot = namedtuple('memory_snapshot', ['time', 'plugins', 'caches',
+                                                 'allocations'])
+
+# Objects which are shared rather than owned by whatever refers to them
+SHARED_TYPES = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    types.CodeType,
+    types.FrameType,
+    logging.Logger,
+)
+
+
+def deep_size(obj, exclude=(), limit=1000000):
+    """Approximates the memory retained by an object and what it refers to.
+
+    Classes, modules, functions and loggers are shared, so they aren't
+    counted. Objects referred to by more than one plugin are counted for
+    each.
+
+    Keyword arguments:
+      obj -- The object to measure.
+      exclude -- Objects which aren't counted, or followed, e.g. the
+        instance of CardinalBot passed to plugins.
+      limit -- Maximum number of objects to count.
+
+    Returns:
+      int -- Size in bytes.
+    """
+    seen = {id(excluded) for excluded in exclude}
+    pending = [obj]
+    size = 0
+
+    while pending and len(seen) < limit:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+            continue
+
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+
+    return size
+
+
+def plugin_of_file(filename, directories):
+    """Returns the plugin a source file belongs to, or None.
+
+    Keyword arguments:
+      filename -- Path of the file.
+      directories -- Directories plugins are loaded from.
+    """
+    for directory in directories:
+        relative = os.path.relpath(filename, directory)
+        if not relative.startswith(os.pardir) and os.sep in relative:
+            return relative.split(os.sep, 1)[0]
+
+    return None
+
+
+class MemoryMonitor:
+    """Takes snapshots of the memory used by plugins, and the bot's caches.
+
+    Snapshots are taken on demand, and every interval if one is given.
+    Each snapshot walks the objects retained by every plugin on the reactor
+    thread, which can take long enough to delay PONGs, so they aren't taken
+    regularly by default. Allocations are attributed to plugins while
+    tracemalloc is tracing, which makes allocating memory slower, so it is
+    started on demand too.
+    """
+
+    DEFAULT_INTERVAL = 0
+    """Default time in seconds between snapshots, or 0 to take them only on
+    demand"""
+
+    OBJECT_LIMIT = 100000
+    """Maximum number of objects counted for each plugin or cache, to bound
+    the time a snapshot blocks the reactor. Larger ones are underestimated.
+    """
+
+    TRACEBACK_FRAMES = 10
+    """Frames kept for each allocation, to find the plugin that made it"""
+
+    @property
+    def reactor(self):
+        """Allows us to inject a mock reactor in unit tests"""
+        return getattr(self, '_reactor', reactor)
+
+    def __init__(self, networks, interval=DEFAULT_INTERVAL):
+        """Constructor for MemoryMonitor
+
+        Keyword arguments:
+          networks -- The NetworkManager whose plugins are measured.
+          interval -- Time in seconds between snapshots.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.networks = networks
+        self.interval = interval
+
+        # The two most recent snapshots, to compare
+        self.previous = None
+        self.latest = None
+
+        # Memory allocated by each line of plugins' code, in the two most
+        # recent snapshots taken while tracing
+        self._lines = None
+        self._previous_lines = None
+
+        self._loop = None
+
+    def start(self):
+        """Takes a snapshot every interval"""
+        self._loop = task.LoopingCall(self.snapshot)
+        self._loop.clock = self.reactor
+        self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        """Stops taking snapshots, and tracing allocations"""
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+
+        self.stop_tracing()
+
+    @property
+    def tracing(self):
+        """Whether allocations are being traced"""
+        return tracemalloc.is_tracing()
+
+    def start_tracing(self):
+        """Starts tracing allocations, so they can be attributed to plugins"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.TRACEBACK_FRAMES)
+
+    def stop_tracing(self):
+        """Stops tracing allocations, freeing tracemalloc's memory"""
+        self._lines = self._previous_lines = None
+        metrics.PLUGIN_ALLOCATED.clear()
+        metrics.PLUGIN_ALLOCATED_GROWTH.clear()
+
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def snapshot(self):
+        """Measures plugins and caches, and updates their metrics.
+
+        Returns:
+          memory_snapshot -- The new snapshot.
+        """
+        started = time.perf_counter()
+
+        plugins, caches = {}, {}
+        for factory in self.networks.factories:
+            plugin_manager = factory.plugin_manager
+            if plugin_manager is None:
+                continue
+
+            # Plugins share the bot, so it isn't counted for each of them
+            exclude = (factory, factory.cardinal, plugin_manager,
+                       plugin_manager.cardinal, self.reactor)
+            for name, plugin in list(plugin_manager.plugins.items()):
+                if plugin['instance'] is not None:
+                    plugins[factory.network, name] = deep_size(
+                        plugin['instance'], exclude, self.OBJECT_LIMIT)
+
+            # Module globals, excluding the functions and classes in them
+            caches[factory.network, 'modules'] = deep_size(
+                [vars(module)
+                 for module in plugin_manager._module_cache.values()],
+                exclude + (vars(builtins),), self.OBJECT_LIMIT)
+            if factory.cardinal is not None:
+                caches[factory.network, 'who'] = deep_size(
+                    factory.cardinal._who_cache, exclude, self.OBJECT_LIMIT)
+
+        allocations = None
+        if tracemalloc.is_tracing():
+            self._previous_lines = self._lines
+            allocations, self._lines = self._allocations(
+                tracemalloc.take_snapshot())
+
+        self.previous, self.latest = self.latest, memory_snapshot(
+            time.time(), plugins, caches, allocations)
+
+        metrics.PLUGIN_MEMORY.clear()
+        for labels, size in plugins.items():
+            metrics.PLUGIN_MEMORY.set(size, *labels)
+        metrics.CACHE_MEMORY.clear()
+        for labels, size in caches.items():
+            metrics.CACHE_MEMORY.set(size, *labels)
+        metrics.PLUGIN_ALLOCATED.clear()
+        for plugin, size in (allocations or {}).items():
+            metrics.PLUGIN_ALLOCATED.set(size, plugin)
+        metrics.PLUGIN_ALLOCATED_GROWTH.clear()
+        for plugin, size in self.growth().get('allocations', {}).items():
+            metrics.PLUGIN_ALLOCATED_GROWTH.set(size, plugin)
+
+        self.logger.debug("Took memory snapshot in %.3fs" %
+                          (time.perf_counter() - started))
+        return self.latest
+
+    def _plugin_directories(self):
+        return {factory.plugin_manager.plugins_directory
+                for factory in self.networks.factories
+                if factory.plugin_manager is not None}
+
+    def _allocations(self, traces):
+        """Totals the memory allocated by each plugin's code, and by each
+        line of it. Memory allocated by libraries is attributed to the
+        innermost line of a plugin that called them.
+        """
+        directories = self._plugin_directories()
+
+        allocations, lines = {}, {}
+        for statistic in traces.statistics('traceback'):
+            for frame in statistic.traceback:
+                plugin = plugin_of_file(frame.filename, directories)
+                if plugin is not None:
+                    allocations[plugin] = \
+                        allocations.get(plugin, 0) + statistic.size
+                    line = '%s:%d' % (frame.filename, frame.lineno)
+                    lines[line] = lines.get(line, 0) + statistic.size
+                    break
+
+        return allocations, lines
+
+    def growth(self):
+        """Compares the two most recent snapshots.
+
+        Returns:
+          dict -- Change in the size of each plugin, cache, and plugin's
+            allocations, by field and then by the keys of the snapshot's
+            dicts, e.g. growth['plugins'][network, plugin]. Empty if there
+            is only one snapshot.
+        """
+        if self.previous is None:
+            return {}
+
+        growth = {}
+        for field in ('plugins', 'caches', 'allocations'):
+            latest = getattr(self.latest, field)
+            previous = getattr(self.previous, field)
+
+            # Allocations can only be compared if both snapshots traced them
+            if latest is None or previous is None:
+                growth[field] = {}
+                continue
+
+            growth[field] = {key: size - previous.get(key, 0)
+                             for key, size in latest.items()}
+
+        return growth
+
+    def top_allocations(self, count):
+        """Returns the lines in plugins whose allocations grew the most
+        between the two most recent snapshots taken while tracing.
+
+        Returns:
+          list -- (file:line, change in bytes) tuples, largest first.
+        """
+        if self._lines is None or self._previous_lines is None:
+            return []
+
+        growth = {line: size - self._previous_lines.get(line, 0)
+                  for line, size in self._lines.items()}
+        largest = sorted(growth, key=growth.get, reverse=True)[:count]
+
+        return [(line, growth[line]) for line in largest if growth[line] > 0]
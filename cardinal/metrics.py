@@ -0,0 +1,423 @@
+import bisect
+import logging
+import math
+
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
+from twisted.web import resource, server
+
+# Content type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10)
+
+# Time in seconds between attempts to listen on a port that is in use
+LISTEN_RETRY_WAIT = 60
+
+
+class Metric:
+    """A metric, with a value for each combination of its labels"""
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        """Constructor for Metric
+
+        Keyword arguments:
+          name -- Name of the metric, e.g. cardinal_lines_received_total.
+          help -- Description of the metric.
+          labels -- Names of the metric's labels. Values for them are passed
+            positionally, in the same order.
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError("Metric %s takes %d labels (%d given)" %
+                             (self.name, len(self.labels), len(labels)))
+        return labels
+
+    def value(self, *labels):
+        """Returns the metric's value for the labels, or None if unset"""
+        return self._values.get(self._key(labels))
+
+    def remove(self, *labels):
+        """Removes the metric's value for the labels"""
+        self._values.pop(self._key(labels), None)
+
+    def clear(self):
+        """Removes the metric's value for every label"""
+        self._values.clear()
+
+    def samples(self):
+        """Returns (suffix, labels, value) tuples to render"""
+        return [('', tuple(zip(self.labels, labels)), value)
+                for labels, value in sorted(self._values.items(), key=_order)]
+
+    def render(self):
+        """Renders the metric in the Prometheus text format"""
+        lines = [
+            '# HELP %s %s' % (self.name, self.help.replace('\\', '\\\\')
+                              .replace('\n', '\\n')),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+        for suffix, labels, value in self.samples():
+            if value is None:
+                continue
+
+            pairs = ','.join('%s="%s"' % (name, _escape(label))
+                             for name, label in labels)
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        '{%s}' % pairs if pairs else '',
+                                        _format(value)))
+
+        return lines
+
+
+class Counter(Metric):
+    """A count which only goes up, e.g. of lines received"""
+
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        """Increments the count for the labels"""
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value which goes up and down, e.g. the lag to the server.
+
+    Values may be functions, which are called when the metric is rendered.
+    """
+
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        """Sets the value for the labels"""
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function, *labels):
+        """Sets a function returning the value for the labels.
+
+        The function may return None when there is no value.
+        """
+        self._values[self._key(labels)] = function
+
+    def value(self, *labels):
+        value = super().value(*labels)
+        return value() if callable(value) else value
+
+    def samples(self):
+        return [('', tuple(zip(self.labels, labels)),
+                 value() if callable(value) else value)
+                for labels, value in sorted(self._values.items(), key=_order)]
+
+
+class Histogram(Metric):
+    """Counts observations, e.g. of latency, in buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """Constructor for Histogram
+
+        Keyword arguments:
+          buckets -- Upper bounds of the buckets, in increasing order.
+        """
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """Records an observation for the labels"""
+        key = self._key(labels)
+        try:
+            counts, total = self._values[key]
+        except KeyError:
+            counts, total = [0] * (len(self.buckets) + 1), 0
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._values[key] = (counts, total + value)
+
+    def value(self, *labels):
+        """Returns the number and sum of observations for the labels"""
+        key = self._key(labels)
+        if key not in self._values:
+            return None
+
+        counts, total = self._values[key]
+        return sum(counts), total
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total) in sorted(self._values.items(),
+                                              key=_order):
+            pairs = tuple(zip(self.labels, labels))
+
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(('_bucket', pairs + (('le', _format(bound)),),
+                                cumulative))
+
+            samples.append(('_sum', pairs, total))
+            samples.append(('_count', pairs, cumulative))
+
+        return samples
+
+
+class Registry:
+    """Holds metrics, and renders them for Prometheus to scrape"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, labels=()):
+        """Returns the counter with a name, creating it if needed"""
+        return self._metric(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        """Returns the gauge with a name, creating it if needed"""
+        return self._metric(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """Returns the histogram with a name, creating it if needed"""
+        return self._metric(Histogram, name, help, labels, buckets=buckets)
+
+    def _metric(self, cls, name, help, labels, **kwargs):
+        """Returns an existing metric, so that plugins may create metrics
+        again when they are reloaded.
+
+        Raises:
+          ValueError -- When a different metric has the same name.
+        """
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+        elif type(metric) is not cls or metric.labels != tuple(labels):
+            raise ValueError("Metric %s already exists with different type "
+                             "or labels" % name)
+
+        return metric
+
+    def render(self):
+        """Renders every metric in the Prometheus text format"""
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(resource.Resource):
+    """Serves a registry's metrics over HTTP"""
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        super().__init__()
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', CONTENT_TYPE.encode('ascii'))
+        return self.registry.render().encode('utf-8')
+
+
+def listen(port, interface='127.0.0.1', registry=None, _reactor=None,
+           metrics_resource=None):
+    """Serves metrics at /metrics for Prometheus to scrape.
+
+    Keyword arguments:
+      port -- TCP port to listen on.
+      interface -- Address to listen on. Defaults to the loopback interface,
+        as the metrics aren't authenticated.
+      registry -- Registry to serve. Defaults to REGISTRY.
+      metrics_resource -- Resource to serve instead of the registry, e.g. one
+        combining the metrics of several processes.
+
+    Returns:
+      IListeningPort -- The port being listened on.
+    """
+    root = resource.Resource()
+    root.putChild(b'metrics', metrics_resource or MetricsResource(
+        registry if registry is not None else REGISTRY))
+
+    port = (_reactor or reactor).listenTCP(port, server.Site(root),
+                                           interface=interface)
+    logging.getLogger(__name__).info(
+        "Serving metrics on http://%s:%d/metrics" %
+        (interface, port.getHost().port))
+    return port
+
+
+def listen_or_retry(port, interface='127.0.0.1', registry=None,
+                    retry_wait=LISTEN_RETRY_WAIT, _reactor=None,
+                    metrics_resource=None):
+    """Serves metrics like listen(), but doesn't fail if the port is in use.
+
+    Instead, an error is logged and listening is retried every retry_wait
+    seconds, e.g. until a process we're taking over from exits. The bot runs
+    without serving metrics meanwhile.
+
+    Returns:
+      IListeningPort -- The port being listened on, or None if listening will
+        be retried.
+    """
+    _reactor = _reactor or reactor
+    try:
+        return listen(port, interface, registry, _reactor, metrics_resource)
+    except CannotListenError as e:
+        logging.getLogger(__name__).error(
+            "Unable to serve metrics on port %d (%s), retrying in %d seconds"
+            % (port, e.socketError, retry_wait))
+        _reactor.callLater(retry_wait, listen_or_retry, port, interface,
+                           registry, retry_wait, _reactor, metrics_resource)
+        return None
+
+
+def merge(scrapes, label):
+    """Combines metrics rendered by several processes, adding a label to
+    tell their samples apart.
+
+    Keyword arguments:
+      scrapes -- A list of (label value, text) tuples, where text is in the
+        Prometheus text format.
+      label -- Name of the label to add, e.g. worker.
+
+    Returns:
+      str -- The metrics in the Prometheus text format, with each metric's
+        HELP and TYPE once, followed by every process's samples of it.
+    """
+    families = {}
+    for value, text in scrapes:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('#'):
+                parts = line.split(' ', 3)
+                if len(parts) < 3 or parts[1] not in ('HELP', 'TYPE'):
+                    continue
+
+                family = parts[2]
+                headers, _ = families.setdefault(family, ({}, []))
+                headers.setdefault(parts[1], line)
+            elif line.strip():
+                name = line.split('{', 1)[0].split(' ', 1)[0]
+                if family is None or not name.startswith(family):
+                    family = name
+                families.setdefault(family, ({}, []))[1].append(
+                    _add_label(line, label, value))
+
+    lines = []
+    for family in sorted(families):
+        headers, samples = families[family]
+        lines.extend(headers[kind] for kind in ('HELP', 'TYPE')
+                     if kind in headers)
+        lines.extend(samples)
+
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _add_label(sample, label, value):
+    pair = '%s="%s"' % (label, _escape(value))
+    name, brace, rest = sample.partition('{')
+    if brace:
+        return '%s{%s,%s' % (name, pair, rest)
+
+    name, _, rest = sample.partition(' ')
+    return '%s{%s} %s' % (name, pair, rest)
+
+
+def _order(item):
+    # Sort values by their labels, which may not all be strings
+    return tuple(str(label) for label in item[0])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def _format(value):
+    if value == math.inf:
+        return '+Inf'
+    elif value == -math.inf:
+        return '-Inf'
+    elif isinstance(value, bool):
+        return str(int(value))
+
+    return repr(value)
+
+
+# The registry that Cardinal's metrics are kept in
+REGISTRY = Registry()
+
+LINES_RECEIVED = REGISTRY.counter(
+    'cardinal_lines_received_total',
+    "Lines received from the server", ['network'])
+LINES_SENT = REGISTRY.counter(
+    'cardinal_lines_sent_total',
+    "Lines sent to the server", ['network'])
+MESSAGES_SENT = REGISTRY.counter(
+    'cardinal_messages_sent_total',
+    "Messages sent to channels and users", ['network'])
+INBOUND_BACKLOG = REGISTRY.gauge(
+    'cardinal_inbound_backlog',
+    "Received lines waiting to be processed", ['network'])
+SERVER_LAG = REGISTRY.gauge(
+    'cardinal_server_lag_seconds',
+    "Lag to the server, measured with PINGs", ['network'])
+
+EVENTS_FIRED = REGISTRY.counter(
+    'cardinal_events_fired_total',
+    "Events fired", ['event'])
+EVENT_SECONDS = REGISTRY.histogram(
+    'cardinal_event_callback_seconds',
+    "Time taken by plugins' event callbacks", ['plugin', 'event'])
+EVENT_ERRORS = REGISTRY.counter(
+    'cardinal_event_callback_errors_total',
+    "Unhandled errors in plugins' event callbacks", ['plugin', 'event'])
+COMMAND_SECONDS = REGISTRY.histogram(
+    'cardinal_command_seconds',
+    "Time taken by plugins' commands", ['plugin', 'command'])
+COMMAND_ERRORS = REGISTRY.counter(
+    'cardinal_command_errors_total',
+    "Unhandled errors in plugins' commands", ['plugin', 'command'])
+
+DB_SECONDS = REGISTRY.histogram(
+    'cardinal_db_seconds',
+    "Time databases were open for, including loading and saving them",
+    ['db'])
+DB_LOCK_ERRORS = REGISTRY.counter(
+    'cardinal_db_lock_errors_total',
+    "Attempts to open a database that was already open", ['db'])
+
+REACTOR_LAG = REGISTRY.gauge(
+    'cardinal_reactor_lag_seconds',
+    "How late the watchdog's last heartbeat on the reactor was")
+REACTOR_STALLS = REGISTRY.counter(
+    'cardinal_reactor_stalls_total',
+    "Times the reactor was blocked for longer than the watchdog threshold",
+    ['plugin', 'kind', 'name'])
+
+PLUGIN_MEMORY = REGISTRY.gauge(
+    'cardinal_plugin_memory_bytes',
+    "Approximate memory retained by each plugin instance, as of the last "
+    "memory snapshot", ['network', 'plugin'])
+CACHE_MEMORY = REGISTRY.gauge(
+    'cardinal_cache_memory_bytes',
+    "Approximate memory retained by the bot's caches, as of the last memory "
+    "snapshot", ['network', 'cache'])
+PLUGIN_ALLOCATED = REGISTRY.gauge(
+    'cardinal_plugin_allocated_bytes',
+    "Memory allocated by each plugin's code and still in use, as of the last "
+    "memory snapshot taken while tracing allocations", ['plugin'])
+PLUGIN_ALLOCATED_GROWTH = REGISTRY.gauge(
+    'cardinal_plugin_allocated_growth_bytes',
+    "Change in memory allocated by each plugin's code between the last two "
+    "memory snapshots taken while tracing allocations", ['plugin'])
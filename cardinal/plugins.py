@@ -1,3 +1,5 @@
+import ast
+import hashlib
 import os
 import re
 import string
@@ -7,10 +9,15 @@ import inspect
 import linecache
 import random
 import json
-from collections import defaultdict
+import time
+from collections import defaultdict, namedtuple
 from copy import copy
 from importlib import reload
 
+from cardinal import metrics, tracing
+from cardinal.manifest import read_manifest
+from cardinal.util import run_coroutine
+from cardinal.watchdog import plugin_of, running
 from cardinal.exceptions import (
     CommandNotFoundError,
     ConfigNotFoundError,
@@ -21,7 +28,10 @@ from cardinal.exceptions import (
     PluginError,
 )
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+reload_result = namedtuple('reload_result', ['reloaded', 'skipped', 'failed'])
 
 
 class PluginManager:
@@ -37,10 +47,20 @@ class PluginManager:
     the plugin for handling.
     """
 
+    WARM_INTERVAL = 0.1
+    """Time in seconds between loading each plugin when warming up"""
+
+    @property
+    def reactor(self):
+        """Allows us to inject a mock reactor in unit tests"""
+        return getattr(self, '_reactor', reactor)
+
     def __init__(self,
                  cardinal,
                  plugins,
                  blacklist,
+                 lazy=False,
+                 isolated=None,
                  _plugin_module_import_prefix='plugins',
                  _plugin_module_directory=None):
         """Creates a new instance, optionally with a list of plugins to load
@@ -48,6 +68,10 @@ class PluginManager:
         Keyword arguments:
           cardinal -- An instance of `CardinalBot` to pass to plugins.
           plugins -- A list of plugins to be loaded when instanced.
+          blacklist -- Maps plugin names to channels they are blacklisted in.
+          lazy -- Whether to wait until plugins are used to import them.
+          isolated -- A list of plugins to run in worker processes of their
+            own, rather than in this one.
 
         Raises:
           TypeError -- When the `plugins` argument is not a list.
@@ -56,6 +80,8 @@ class PluginManager:
         self.logger = logging.getLogger(__name__)
         self.cardinal = cardinal
         self._blacklist = blacklist
+        self.lazy = lazy
+        self.isolated = isolated or []
 
         # Module name from which plugins are imported. This exists to assist
         # in unit testing.
@@ -75,6 +101,26 @@ class PluginManager:
         self.plugins = {}
         self._module_cache = {}
 
+        # Plugins whose setup or close hasn't finished yet, and a token for
+        # the latest load of each plugin that is setting up
+        self._pending = {}
+        self._closing = {}
+        self._loading = {}
+
+        # Maps plugin names to the time in seconds each step of their most
+        # recent load took
+        self.load_times = {}
+
+        # Fingerprints of each plugin's files when it was loaded, the other
+        # plugins it imports, and the digests of files keyed by path, mtime,
+        # and size
+        self._fingerprints = {}
+        self._dependencies = {}
+        self._digests = {}
+
+        # State exported by plugins being reloaded, for their new instance
+        self._states = {}
+
         self.load(plugins)
 
     def __iter__(self):
@@ -131,22 +177,19 @@ class PluginManager:
             module = reload(self._module_cache[plugin])
         else:
             module = importlib.import_module(
-                '%s.%s.%s' %
-                (self._plugin_module_import_prefix,
-                 plugin,
-                 suffix))
+                self._plugin_module_name(plugin, suffix))
 
         self._module_cache[plugin] = module
 
         return module
 
+    def _plugin_module_name(self, plugin, suffix='plugin'):
+        """Returns the name a plugin's module is imported as"""
+        return '%s.%s.%s' % (self._plugin_module_import_prefix, plugin, suffix)
+
     def _instantiate_plugin(self, module, config=None):
         """Creates an instance of the plugin module.
 
-        If the setup() function of the plugin's module takes an argument then
-        we will provide the instance of CardinalBot to the plugin. If it takes
-        two, we will provide Cardinal, and its config.
-
         Keyword arguments:
           module -- The module to instantiate.
           config -- A config, if any, belonging to the plugin.
@@ -155,45 +198,9 @@ class PluginManager:
           object -- The instance of the plugin.
 
         Raises:
-          PluginError -- When a plugin's setup function has more than one
-            argument.
+          PluginError -- When a plugin's entrypoint is invalid.
         """
-        if hasattr(module, 'entrypoint'):
-            entrypoint = module.entrypoint
-        # Old-style - will be deprecated in a future release of Cardinal
-        elif hasattr(module, 'setup') and inspect.isfunction(module.setup):
-            entrypoint = module.setup
-        else:
-            raise PluginError(
-                "Plugin must define an entrypoint attribute pointing to "
-                "the plugin's class definition or factory method/function."
-            )
-
-        try:
-            signature = inspect.signature(entrypoint)
-        except TypeError:
-            raise PluginError(
-                "Plugin's entrypoint must be a callable returning a new "
-                "instance of the plugin."
-            )
-
-        # Check whether the setup method on the module accepts an argument. If
-        # it does, they are expecting our instance of CardinalBot to be passed
-        # in. If not, just call setup. If there is more than one argument
-        # accepted, the method is invalid.
-        kwargs = {}
-        for param in signature.parameters:
-            if param == 'cardinal':
-                kwargs['cardinal'] = self.cardinal
-            elif param == 'config':
-                kwargs['config'] = config
-            else:
-                raise PluginError(
-                    "Unknown parameter {} in entrypoint signature"
-                    .format(param)
-                )
-
-        return entrypoint(**kwargs)
+        return instantiate_plugin(module, self.cardinal, config)
 
     def _register_plugin_callbacks(self, callbacks):
         """Registers callbacks found in a plugin
@@ -280,25 +287,49 @@ class PluginManager:
           PluginError -- When a plugin's close function has more than one
             argument.
         """
+        self._close_instance(plugin, self.plugins[plugin]['instance'])
 
-        instance = self.plugins[plugin]['instance']
+    def _close_instance(self, plugin, instance):
+        """Calls the close method on an instance of a plugin.
 
-        if hasattr(instance, 'close') and inspect.ismethod(instance.close):
-            # The plugin has a close method, so we now need to check how
-            # many arguments the method has. If it only has one, then the
-            # argument must be 'self' and therefore they aren't expecting
-            # us to pass in an instance of CardinalBot. If there are two
-            # arguments, they expect CardinalBot. Anything else is invalid.
-            argspec = inspect.getfullargspec(
-                instance.close
-            )
+        The close method may return a Deferred or coroutine, in which case the
+        plugin is tracked until it finishes closing. Loading the plugin again
+        waits for that, as does shutting down.
 
-            if len(argspec.args) == 1:
-                instance.close()
-            elif len(argspec.args) == 2:
-                instance.close(self.cardinal)
-            else:
-                raise PluginError("Unknown arguments for close function")
+        Keyword arguments:
+          plugin -- The name of the plugin.
+          instance -- The instance to close.
+
+        Raises:
+          PluginError -- When a plugin's close function has more than one
+            argument.
+        """
+        result = close_plugin(instance, self.cardinal)
+        if not _is_async(result):
+            return
+
+        d = _ensure_deferred(result)
+        self._closing[plugin] = d
+
+        def failed(failure):
+            self.logger.error("Didn't close plugin cleanly: %s\n%s" %
+                              (plugin, failure.getTraceback()))
+
+        def done(_):
+            if self._closing.get(plugin) is d:
+                del self._closing[plugin]
+
+        d.addErrback(failed)
+        d.addCallback(done)
+
+    def closed(self):
+        """Waits for plugins that are still closing.
+
+        Returns:
+          Deferred -- Fires once every plugin has finished closing.
+        """
+        return defer.DeferredList(
+            [_observe(d) for d in list(self._closing.values())])
 
     def _load_plugin_config(self, plugin):
         """Loads a JSON config for a given plugin
@@ -410,18 +441,35 @@ class PluginManager:
             for command in plugin['commands']:
                 yield command
 
-    def load(self, plugins):
+    def load(self, plugins, lazy=None):
         """Takes either a plugin name or a list of plugins and loads them.
 
         This involves attempting to import the plugin's module, import the
         plugin's config module, instance the plugin's object, and finding its
         commands and events.
 
+        When loading lazily, plugins that aren't already loaded are only
+        registered using their manifest, and are imported the first time one
+        of their commands or events is called.
+
+        Plugins whose entrypoint returns a Deferred or coroutine are set up
+        concurrently, and are added once it fires with their instance. Use
+        ready() to wait for them.
+
+        Plugins that are already loaded are reloaded, and may hand their state
+        over to their new instance with export_state() and import_state().
+
+        Isolated plugins are started in a worker process, which is set up
+        asynchronously. They are never loaded lazily.
+
         Keyword arguments:
           plugins -- This can be either a single or list of plugin names.
+          lazy -- Whether to load plugins lazily. Defaults to the manager's
+            setting.
 
         Returns:
-          list -- A list of failed plugins, or an empty list.
+          list -- A list of failed plugins, or an empty list. Plugins still
+            setting up aren't included.
 
         Raises:
           TypeError -- When the `plugins` argument is not a string or list.
@@ -436,85 +484,440 @@ class PluginManager:
                 "Plugins argument must be a string or list of plugins"
             )
 
+        if lazy is None:
+            lazy = self.lazy
+
         # List of plugins which failed to load
         failed_plugins = []
 
         for plugin in plugins:
+            # Plugins that are already running are reloaded straight away
+            if lazy and plugin not in self.isolated and \
+                    (plugin not in self.plugins or
+                     self.plugins[plugin]['lazy']) and \
+                    self._load_lazy_stubs(plugin):
+                continue
+
             # Reload flag so we can update the reload counter if necessary
             self.logger.info("Attempting to load plugin: %s" % plugin)
 
-            # Import each plugin's module with our own hacky function to reload
-            # modules that have already been imported previously
-            try:
-                if plugin in list(self.plugins.keys()):
-                    self.logger.info("Already loaded, unloading first: %s" %
-                                     plugin)
+            result = self._load_plugin(plugin)
+            if result is False:
+                self._states.pop(plugin, None)
+                failed_plugins.append(plugin)
+            elif isinstance(result, defer.Deferred):
+                self._track_setup(plugin, result)
+
+        return failed_plugins
+
+    def _load_plugin(self, plugin):
+        """Imports and sets up a plugin.
+
+        Keyword arguments:
+          plugin -- Name of the plugin.
+
+        Returns:
+          bool -- Whether the plugin loaded, or a Deferred firing with it if
+            the plugin's setup is asynchronous. The Deferred fires with None if
+            the plugin was unloaded before its setup finished.
+        """
+        # Import each plugin's module with our own hacky function to reload
+        # modules that have already been imported previously
+        blacklist = self._get_blacklist(plugin)
+        times = self.load_times[plugin] = {}
+        try:
+            if plugin in list(self.plugins.keys()):
+                if self.plugins[plugin]['lazy']:
+                    # Nothing to close, just remove the stubs
+                    self._unregister_plugin_callbacks(plugin)
+                    del self.plugins[plugin]
+                else:
+                    self.logger.info(
+                        "Already loaded, unloading first: %s" % plugin)
+
+                    # Keep the plugin's state for its new instance
+                    state = self._export_state(plugin)
+                    if state is not None:
+                        self._states[plugin] = state
 
                     self.unload(plugin)
 
+            self._fingerprint_plugin(plugin)
+
+            # Isolated plugins are imported by their worker
+            module = None
+            if plugin not in self.isolated:
+                start = time.monotonic()
                 module = self._import_module(plugin)
-            except Exception:
-                # Probably a syntax error in the plugin, log the exception
-                self.logger.exception(
-                    "Could not load plugin module: %s" % plugin
-                )
-                failed_plugins.append(plugin)
+                times['import'] = time.monotonic() - start
+        except Exception:
+            # Probably a syntax error in the plugin, log the exception
+            self.logger.exception(
+                "Could not load plugin module: %s" % plugin
+            )
+            return False
 
-                continue
+        # Attempt to load the config file for the given plugin.
+        config = None
+        start = time.monotonic()
+        try:
+            config = self._load_plugin_config(plugin)
+        except ConfigNotFoundError:
+            self.logger.debug(
+                "No config found for plugin: %s" % plugin
+            )
+        times['config'] = time.monotonic() - start
 
-            # Attempt to load the config file for the given plugin.
-            config = None
-            try:
-                config = self._load_plugin_config(plugin)
-            except ConfigNotFoundError:
-                self.logger.debug(
-                    "No config found for plugin: %s" % plugin
-                )
+        # Identifies this load, so a setup that finishes after the plugin was
+        # unloaded or loaded again is discarded
+        token = self._loading[plugin] = object()
 
-            # Instanstiate the plugin
-            try:
+        # Let the previous instance finish closing first, as the new one may
+        # need the resources it releases
+        if plugin in self._closing:
+            d = _observe(self._closing[plugin])
+            d.addCallback(lambda _: self._setup_plugin(
+                plugin, module, config, blacklist, token))
+            return d
+
+        return self._setup_plugin(plugin, module, config, blacklist, token)
+
+    def _setup_plugin(self, plugin, module, config, blacklist, token):
+        """Instantiates a plugin, waiting for it if its setup is asynchronous.
+
+        Returns:
+          bool -- Whether the plugin loaded, or a Deferred firing with it.
+        """
+        # Instanstiate the plugin
+        start = time.monotonic()
+        try:
+            if plugin in self.isolated:
+                # Imported here, as the worker imports this module
+                from cardinal.worker import WorkerPlugin
+                instance = WorkerPlugin(self, plugin, config).start()
+            else:
                 instance = self._instantiate_plugin(module, config)
-            except Exception:
-                self.logger.exception(
-                    "Could not instantiate plugin: %s" % plugin
-                )
-                failed_plugins.append(plugin)
+        except Exception:
+            self.logger.exception(
+                "Could not instantiate plugin: %s" % plugin
+            )
+            return False
 
-                continue
+        def setup_done(instance):
+            if self._loading.get(plugin) is token:
+                self.load_times[plugin]['setup'] = time.monotonic() - start
+            return self._add_plugin(plugin, instance, config, blacklist, token)
 
-            commands = self._get_plugin_commands(instance)
-            callbacks = self._get_plugin_callbacks(instance)
+        if not _is_async(instance):
+            return setup_done(instance)
 
-            try:
-                # do this last to ensure the rollback functionality works
-                # correctly to remove callbacks if loading fails
-                callback_ids = self._register_plugin_callbacks(callbacks)
-            except Exception:
-                self.logger.exception(
-                    "Could not register events for plugin: %s" % plugin
-                )
+        self.logger.debug("Waiting for plugin to set up: %s" % plugin)
 
-                failed_plugins.append(plugin)
+        def failed(failure):
+            self.logger.error("Could not instantiate plugin: %s\n%s" %
+                              (plugin, failure.getTraceback()))
+            return False
 
-                continue
+        d = _ensure_deferred(instance)
+        d.addCallbacks(setup_done, failed)
+        return d
 
-            self.plugins[plugin] = {
-                'name': plugin,
-                'instance': instance,
-                'commands': commands,
-                'callbacks': callbacks,
-                'callback_ids': callback_ids,
-                'config': config,
-                'blacklist': (
-                    copy(self._blacklist[plugin])
-                    if plugin in self._blacklist else
-                    []
-                ),
-            }
-
-            self.logger.info("Plugin %s successfully loaded" % plugin)
+    def _add_plugin(self, plugin, instance, config, blacklist, token):
+        """Registers the commands and callbacks of a plugin's instance.
 
-        return failed_plugins
+        Returns:
+          bool -- Whether the plugin loaded, or None if it has been unloaded
+            or loaded again since this instance started setting up.
+        """
+        if self._loading.get(plugin) is not token:
+            self.logger.info("Discarding outdated instance of plugin: %s" %
+                             plugin)
+            self._close_instance(plugin, instance)
+            return None
+        del self._loading[plugin]
+
+        if plugin in self._states:
+            self._import_state(plugin, instance, self._states.pop(plugin))
+
+        start = time.monotonic()
+        commands = self._get_plugin_commands(instance)
+        callbacks = self._get_plugin_callbacks(instance)
+
+        try:
+            # do this last to ensure the rollback functionality works
+            # correctly to remove callbacks if loading fails
+            callback_ids = self._register_plugin_callbacks(callbacks)
+        except Exception:
+            self.logger.exception(
+                "Could not register events for plugin: %s" % plugin
+            )
+            return False
+        self.load_times[plugin]['register'] = time.monotonic() - start
+
+        self.plugins[plugin] = {
+            'name': plugin,
+            'instance': instance,
+            'commands': commands,
+            'callbacks': callbacks,
+            'callback_ids': callback_ids,
+            'config': config,
+            'blacklist': blacklist,
+            'lazy': False,
+        }
+
+        self.logger.info("Plugin %s successfully loaded" % plugin)
+        return True
+
+    def _export_state(self, plugin):
+        """Exports the state of a plugin that is about to be reloaded.
+
+        Plugins may define an export_state() method returning any object,
+        which is passed to import_state(state) on their new instance. The
+        state is tagged with the plugin's STATE_VERSION attribute, and is only
+        imported by an instance with the same version.
+
+        Returns:
+          tuple -- The plugin's STATE_VERSION and its state, or None if it
+            doesn't export any.
+        """
+        instance = self.plugins[plugin]['instance']
+        if not inspect.ismethod(getattr(instance, 'export_state', None)):
+            return None
+
+        try:
+            state = instance.export_state()
+        except Exception:
+            self.logger.exception(
+                "Could not export state of plugin: %s" % plugin)
+            return None
+
+        return getattr(instance, 'STATE_VERSION', None), state
+
+    def _import_state(self, plugin, instance, exported):
+        """Passes state exported by a plugin's previous instance to its new one
+        """
+        version, state = exported
+        if not inspect.ismethod(getattr(instance, 'import_state', None)):
+            return
+
+        new_version = getattr(instance, 'STATE_VERSION', None)
+        if new_version != version:
+            self.logger.info(
+                "Dropping state of plugin %s, version %s doesn't match %s" %
+                (plugin, version, new_version))
+            return
+
+        try:
+            instance.import_state(state)
+        except Exception:
+            self.logger.exception(
+                "Could not import state of plugin: %s" % plugin)
+        else:
+            self.logger.info("Kept state of plugin: %s" % plugin)
+
+    def _track_setup(self, plugin, d):
+        """Keeps track of an asynchronous setup until it finishes"""
+        self._pending[plugin] = d
+
+        def done(loaded):
+            if self._pending.get(plugin) is d:
+                del self._pending[plugin]
+                if loaded is False:
+                    self._states.pop(plugin, None)
+            return loaded
+
+        d.addCallback(done)
+
+    def ready(self, plugins=None):
+        """Waits for plugins that are still setting up.
+
+        Plugins whose setup is asynchronous are set up at the same time, and
+        only become available once their setup finishes.
+
+        Keyword arguments:
+          plugins -- Names of the plugins to wait for. Defaults to every
+            plugin that is setting up.
+
+        Returns:
+          Deferred -- Fires with a list of the plugins that failed to set up.
+        """
+        pending = [(plugin, d) for plugin, d in list(self._pending.items())
+                   if plugins is None or plugin in plugins]
+
+        def failed(results):
+            return [plugin for (plugin, _), (_, loaded)
+                    in zip(pending, results) if loaded is False]
+
+        d = defer.DeferredList([_observe(d) for _, d in pending])
+        d.addCallback(failed)
+        return d
+
+    def _load_lazy_stubs(self, plugin):
+        """Registers a plugin from its manifest, without importing it.
+
+        Each command and event callback in the manifest is replaced by a stub
+        which loads the plugin, then calls the real method.
+
+        Keyword arguments:
+          plugin -- Name of the plugin.
+
+        Returns:
+          bool -- False if the plugin has no manifest, or nothing that would
+            trigger loading it, so it must be loaded now.
+        """
+        manifest = read_manifest(
+            os.path.join(self.plugins_directory, plugin, 'plugin.py'))
+        if not manifest or \
+                not (manifest['commands'] or manifest['callbacks']):
+            return False
+
+        blacklist = self._get_blacklist(plugin)
+        if plugin in self.plugins:
+            self.unload(plugin)
+        self._loading.pop(plugin, None)
+        self._fingerprint_plugin(plugin)
+
+        commands = [self._lazy_command(plugin, command)
+                    for command in manifest['commands']]
+        callbacks = [{
+            'event_names': callback['event_names'],
+            'method': self._lazy_callback(plugin, callback['method']),
+        } for callback in manifest['callbacks']]
+
+        try:
+            callback_ids = self._register_plugin_callbacks(callbacks)
+        except Exception:
+            return False
+
+        config = None
+        try:
+            config = self._load_plugin_config(plugin)
+        except ConfigNotFoundError:
+            pass
+
+        self.plugins[plugin] = {
+            'name': plugin,
+            'instance': None,
+            'commands': commands,
+            'callbacks': callbacks,
+            'callback_ids': callback_ids,
+            'config': config,
+            'blacklist': blacklist,
+            'lazy': True,
+        }
+
+        self.logger.info("Plugin %s will be loaded on first use" % plugin)
+        return True
+
+    def _lazy_command(self, plugin, manifest):
+        """Creates a command which loads a plugin before calling it"""
+        def command(cardinal, user, channel, message):
+            return self._call_lazy(plugin, manifest['method'],
+                                   cardinal, user, channel, message)
+
+        command.__name__ = manifest['method']
+        command.__module__ = self._plugin_module_name(plugin)
+        for attribute in ('commands', 'regex', 'help'):
+            if attribute in manifest:
+                setattr(command, attribute, manifest[attribute])
+
+        return command
+
+    def _lazy_callback(self, plugin, method):
+        """Creates an event callback which loads a plugin before calling it"""
+        def callback(cardinal, *params):
+            return self._call_lazy(plugin, method, cardinal, *params)
+
+        callback.__name__ = method
+        callback.__module__ = self._plugin_module_name(plugin)
+        return callback
+
+    def _load_lazy(self, plugin):
+        """Loads a lazily registered plugin, if it isn't loaded yet.
+
+        Keyword arguments:
+          plugin -- Name of the plugin.
+
+        Returns:
+          object -- The plugin's instance, or a Deferred firing with it if
+            the plugin's setup is asynchronous.
+
+        Raises:
+          PluginError -- When the plugin fails to load.
+        """
+        if plugin in self.plugins and not self.plugins[plugin]['lazy']:
+            return self.plugins[plugin]['instance']
+
+        if plugin not in self._pending:
+            if self.load(plugin, lazy=False):
+                raise PluginError("Plugin failed to load: %s" % plugin)
+
+            if plugin not in self._pending:
+                return self.plugins[plugin]['instance']
+
+        def loaded(result):
+            if not result:
+                raise PluginError("Plugin failed to load: %s" % plugin)
+            return self.plugins[plugin]['instance']
+
+        return _observe(self._pending[plugin]).addCallback(loaded)
+
+    def _call_lazy(self, plugin, method, *args):
+        """Loads a lazily registered plugin and calls one of its methods"""
+        instance = self._load_lazy(plugin)
+        if isinstance(instance, defer.Deferred):
+            return instance.addCallback(
+                lambda instance: call_plugin(getattr(instance, method), *args))
+
+        return getattr(instance, method)(*args)
+
+    def warm(self):
+        """Loads lazily registered plugins in the background.
+
+        Plugins are loaded one at a time, WARM_INTERVAL seconds apart, so that
+        we keep responding to the server in between.
+
+        Returns:
+          Deferred -- Fires once every plugin has been loaded (or failed to).
+        """
+        pending = sorted(name for name, plugin in self.plugins.items()
+                         if plugin['lazy'])
+        if pending:
+            self.logger.info("Warming up plugins: %s" % ', '.join(pending))
+
+        d = defer.Deferred()
+
+        def load_next():
+            loading = None
+            while pending:
+                plugin = pending.pop(0)
+                if plugin in self.plugins and self.plugins[plugin]['lazy']:
+                    self.load(plugin, lazy=False)
+                    loading = plugin
+                    break
+
+            # Wait for an asynchronous setup before loading the next one
+            ready = self.ready([loading]) if loading else defer.succeed([])
+            if pending:
+                ready.addCallback(lambda _: self.reactor.callLater(
+                    self.WARM_INTERVAL, load_next))
+            else:
+                ready.addCallback(lambda _: d.callback(None))
+
+        self.reactor.callLater(self.WARM_INTERVAL, load_next)
+        return d
+
+    def _get_blacklist(self, plugin):
+        """Returns the channels a plugin is blacklisted in.
+
+        Plugins start with the blacklist from the config, except for lazily
+        loaded plugins, which keep their blacklist once they are imported.
+        """
+        if plugin in self.plugins and self.plugins[plugin]['lazy']:
+            return self.plugins[plugin]['blacklist']
+
+        return copy(self._blacklist[plugin]) \
+            if plugin in self._blacklist else []
 
     def unload(self, plugins):
         """Takes either a plugin name or a list of plugins and unloads them.
@@ -546,6 +949,13 @@ class PluginManager:
         for plugin in plugins:
             self.logger.info("Attempting to unload plugin: %s" % plugin)
 
+            # A plugin still setting up is discarded once its setup finishes
+            if plugin in self._loading and plugin not in self.plugins:
+                del self._loading[plugin]
+                self.logger.info("Cancelled setup of plugin: %s" % plugin)
+                continue
+            self._loading.pop(plugin, None)
+
             if plugin not in self.plugins:
                 self.logger.warning("Plugin was never loaded: %s" % plugin)
                 failed_plugins.append(plugin)
@@ -568,9 +978,144 @@ class PluginManager:
             # eventually do garbage collection. We only opened it in one
             # location, so we'll get rid of that now.
             del self.plugins[plugin]
+            self._fingerprints.pop(plugin, None)
+            self._dependencies.pop(plugin, None)
 
         return failed_plugins
 
+    def reload(self, plugins=None):
+        """Reloads plugins whose source files or config changed.
+
+        Plugins are fingerprinted when they are loaded, and skipped if none
+        of their files changed since. Plugins importing from a changed plugin
+        are reloaded along with it, so that they don't keep using the old
+        module.
+
+        Keyword arguments:
+          plugins -- Names of the plugins to check. Defaults to every loaded
+            plugin.
+
+        Returns:
+          reload_result -- Lists of the plugins which were reloaded, skipped
+            as unchanged, and failed to load. Plugins still setting up are
+            counted as reloaded.
+        """
+        if plugins is None:
+            plugins = sorted(self.plugins.keys())
+
+        changed = [plugin for plugin in plugins
+                   if plugin not in self.plugins or
+                   self._fingerprints.get(plugin) != self._fingerprint(plugin)]
+
+        # Reload dependents after the plugins they depend on
+        queue = list(changed)
+        while queue:
+            dependency = queue.pop(0)
+            for plugin in sorted(self.plugins.keys()):
+                if plugin not in changed and \
+                        dependency in self._dependencies.get(plugin, ()):
+                    self.logger.info("Reloading %s, which depends on %s" %
+                                     (plugin, dependency))
+                    changed.append(plugin)
+                    queue.append(plugin)
+
+        skipped = [plugin for plugin in plugins if plugin not in changed]
+        if skipped:
+            self.logger.info("Skipping unchanged plugins: %s" %
+                             ', '.join(skipped))
+
+        failed = self.load(changed) if changed else []
+
+        return reload_result(
+            [plugin for plugin in changed if plugin not in failed],
+            skipped,
+            failed,
+        )
+
+    def _fingerprint_plugin(self, plugin):
+        """Records a plugin's fingerprint and dependencies as it's loaded"""
+        self._fingerprints[plugin] = self._fingerprint(plugin)
+        self._dependencies[plugin] = self._find_dependencies(plugin)
+
+    def _plugin_files(self, plugin):
+        """Returns the paths of a plugin's source files and config.
+
+        Tests are left out, as they aren't imported by the plugin.
+        """
+        directory = os.path.join(self.plugins_directory, plugin)
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs
+                             if d != '__pycache__' and not d.startswith('.'))
+            for name in sorted(files):
+                if (name.endswith('.py') and not name.startswith('test_')) or \
+                        (name == 'config.json' and root == directory):
+                    paths.append(os.path.join(root, name))
+
+        return paths
+
+    def _fingerprint(self, plugin):
+        """Fingerprints a plugin's source files and config.
+
+        Files are only hashed when their modification time or size changed
+        since they were last hashed, so that fingerprinting unchanged plugins
+        is cheap. Comparing hashes means files that were merely touched don't
+        count as changed.
+
+        Returns:
+          dict -- Maps the paths of the plugin's files to their SHA-256 digest.
+        """
+        fingerprint = {}
+        for path in self._plugin_files(plugin):
+            try:
+                stat = os.stat(path)
+                key = (stat.st_mtime_ns, stat.st_size)
+
+                cached = self._digests.get(path)
+                if cached is None or cached[0] != key:
+                    with open(path, 'rb') as f:
+                        cached = self._digests[path] = \
+                            (key, hashlib.sha256(f.read()).hexdigest())
+            except OSError:
+                continue
+
+            fingerprint[path] = cached[1]
+
+        return fingerprint
+
+    def _find_dependencies(self, plugin):
+        """Returns the other plugins a plugin's source files import from"""
+        prefix = self._plugin_module_import_prefix + '.'
+
+        dependencies = set()
+        for path in self._plugin_files(plugin):
+            if not path.endswith('.py'):
+                continue
+
+            try:
+                with open(path, 'r') as f:
+                    tree = ast.parse(f.read(), path)
+            except (OSError, SyntaxError, ValueError):
+                continue
+
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Import):
+                    modules = [alias.name for alias in node.names]
+                elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                    # e.g. from plugins import youtube
+                    modules = [node.module + '.' + alias.name
+                               for alias in node.names] \
+                        if node.module + '.' == prefix else [node.module]
+                else:
+                    continue
+
+                for module in modules:
+                    if module.startswith(prefix):
+                        dependencies.add(module[len(prefix):].split('.')[0])
+
+        dependencies.discard(plugin)
+        return dependencies
+
     def unload_all(self):
         """Unloads all loaded plugins.
 
@@ -582,6 +1127,49 @@ class PluginManager:
         self.logger.info("Unloading all plugins")
         self.unload([plugin for plugin, data in list(self.plugins.items())])
 
+    def rebind(self, cardinal):
+        """Binds loaded plugins to a new instance of CardinalBot.
+
+        Plugins are kept loaded across reconnects rather than being rebuilt
+        each time. Any plugin keeping a reference to the old CardinalBot in a
+        `cardinal` attribute will have it replaced, and plugins with an
+        on_reconnect(cardinal) method will have it called.
+
+        Keyword arguments:
+          cardinal -- The new instance of `CardinalBot`.
+        """
+        self.logger.info("Rebinding plugins to new connection")
+
+        old_cardinal, self.cardinal = self.cardinal, cardinal
+
+        for name, plugin in list(self.plugins.items()):
+            instance = plugin['instance']
+            if getattr(instance, 'cardinal', None) is old_cardinal:
+                instance.cardinal = cardinal
+
+            self._call_hook(name, 'on_reconnect')
+
+    def disconnected(self):
+        """Notifies plugins that the connection to the server was lost.
+
+        Plugins with an on_disconnect(cardinal) method will have it called.
+        They remain loaded and will be rebound if we reconnect.
+        """
+        for name in list(self.plugins.keys()):
+            self._call_hook(name, 'on_disconnect')
+
+    def _call_hook(self, plugin, hook):
+        """Calls an optional hook method on a plugin, logging any errors."""
+        method = getattr(self.plugins[plugin]['instance'], hook, None)
+        if method is None or not inspect.ismethod(method):
+            return
+
+        try:
+            method(self.cardinal)
+        except Exception:
+            self.logger.exception(
+                "Error calling %s for plugin: %s" % (hook, plugin))
+
     def blacklist(self, plugin, channels):
         """Blacklists a plugin from given channels.
 
@@ -661,6 +1249,24 @@ class PluginManager:
 
         return self.plugins[plugin]['config']
 
+    def get_instance(self, plugin):
+        """Returns a plugin's instance, for use by other plugins.
+
+        Plugins registered lazily are loaded first, so this should be used
+        rather than reading the instance from plugins.
+
+        Keyword arguments:
+          plugin -- A string containing the name of a plugin.
+
+        Returns:
+          Deferred -- Fires with the plugin's instance, or fails with
+            PluginError when the plugin isn't loaded or fails to load.
+        """
+        if plugin not in self.plugins:
+            return defer.fail(PluginError("Plugin not loaded: %s" % plugin))
+
+        return defer.maybeDeferred(self._load_lazy, plugin)
+
     def call_command(self, user, channel, message):
         """Checks a message to see if it appears to be a command and calls it.
 
@@ -727,15 +1333,25 @@ class PluginManager:
         """Calls a command method and treats it as a Deferred.
 
         Keyword arguments:
-          command -- A callable for the command that may return a Deferred.
+          command -- A callable for the command that may return a Deferred or
+            coroutine.
           user -- A tuple containing a user's nick, ident, and hostname.
           channel -- A string representing where replies should be sent.
           message -- A string containing a message received by CardinalBot.
         """
         args = (self.cardinal, user, channel, message)
 
-        d = defer.maybeDeferred(
-            command, *args)
+        plugin = plugin_of(command) or ''
+        span = tracing.start_span('command', plugin=plugin,
+                                  command=command.__name__, channel=channel)
+
+        started = time.perf_counter()
+        with running(command, 'command', command.__name__), \
+                tracing.activate(span):
+            d = call_plugin(command, *args)
+        d.addBoth(_measure, started, metrics.COMMAND_SECONDS,
+                  metrics.COMMAND_ERRORS, plugin, command.__name__)
+        tracing.finish_when_fired(d, span)
 
         def errback(failure):
             self.logger.error('Unhandled error: {}'.format(failure))
@@ -920,16 +1536,26 @@ class EventManager:
                 "Can't call an event that does not exist: %s" % name
             )
 
+        metrics.EVENTS_FIRED.inc(name)
+
         callbacks = self.registered_callbacks[name]
         self.logger.debug(
             "Calling %d callbacks for event: %s" %
             (len(callbacks), name)
         )
 
+        # Callbacks may load or unload plugins, changing the callbacks
         cb_deferreds = []
-        for callback_id, callback in callbacks.items():
-            d = defer.maybeDeferred(
-                callback, self.cardinal, *params)
+        for callback_id, callback in list(callbacks.items()):
+            plugin = plugin_of(callback) or ''
+            span = tracing.start_span('event', event=name, plugin=plugin)
+
+            started = time.perf_counter()
+            with running(callback, 'event', name), tracing.activate(span):
+                d = call_plugin(callback, self.cardinal, *params)
+            d.addBoth(_measure, started, metrics.EVENT_SECONDS,
+                      metrics.EVENT_ERRORS, plugin, name)
+            tracing.finish_when_fired(d, span)
 
             # It is necessary to pass callback_id in to this function in order
             # to make sure it doesn't change when the loop iterates
@@ -1023,3 +1649,157 @@ class EventManager:
         default.)
         """
         return ''.join(random.choice(chars) for _ in range(6))
+
+
+def instantiate_plugin(module, cardinal, config=None):
+    """Creates an instance of the plugin module.
+
+    If the setup() function of the plugin's module takes an argument then
+    we will provide the instance of CardinalBot to the plugin. If it takes
+    two, we will provide Cardinal, and its config.
+
+    Keyword arguments:
+      module -- The module to instantiate.
+      cardinal -- The instance of CardinalBot to pass to the plugin.
+      config -- A config, if any, belonging to the plugin.
+
+    Returns:
+      object -- The instance of the plugin.
+
+    Raises:
+      PluginError -- When a plugin's setup function has more than one
+        argument.
+    """
+    if hasattr(module, 'entrypoint'):
+        entrypoint = module.entrypoint
+    # Old-style - will be deprecated in a future release of Cardinal
+    elif hasattr(module, 'setup') and inspect.isfunction(module.setup):
+        entrypoint = module.setup
+    else:
+        raise PluginError(
+            "Plugin must define an entrypoint attribute pointing to "
+            "the plugin's class definition or factory method/function."
+        )
+
+    try:
+        signature = inspect.signature(entrypoint)
+    except TypeError:
+        raise PluginError(
+            "Plugin's entrypoint must be a callable returning a new "
+            "instance of the plugin."
+        )
+
+    # Check whether the setup method on the module accepts an argument. If
+    # it does, they are expecting our instance of CardinalBot to be passed
+    # in. If not, just call setup. If there is more than one argument
+    # accepted, the method is invalid.
+    kwargs = {}
+    for param in signature.parameters:
+        if param == 'cardinal':
+            kwargs['cardinal'] = cardinal
+        elif param == 'config':
+            kwargs['config'] = config
+        else:
+            raise PluginError(
+                "Unknown parameter {} in entrypoint signature"
+                .format(param)
+            )
+
+    return entrypoint(**kwargs)
+
+
+def close_plugin(instance, cardinal):
+    """Calls the close method on an instance of a plugin, if it has one.
+
+    Keyword arguments:
+      instance -- The instance to close.
+      cardinal -- The instance of CardinalBot to pass to the plugin.
+
+    Returns:
+      object -- Whatever the close method returned, which may be a Deferred or
+        coroutine if the plugin closes asynchronously.
+
+    Raises:
+      PluginError -- When a plugin's close function has more than one
+        argument.
+    """
+    if not hasattr(instance, 'close') or not inspect.ismethod(instance.close):
+        return None
+
+    # The plugin has a close method, so we now need to check how many
+    # arguments the method has. If it only has one, then the argument must be
+    # 'self' and therefore they aren't expecting us to pass in an instance of
+    # CardinalBot. If there are two arguments, they expect CardinalBot.
+    # Anything else is invalid.
+    argspec = inspect.getfullargspec(instance.close)
+
+    if len(argspec.args) == 1:
+        return instance.close()
+    elif len(argspec.args) == 2:
+        return instance.close(cardinal)
+
+    raise PluginError("Unknown arguments for close function")
+
+
+def call_plugin(method, *args):
+    """Calls a plugin's command or event callback.
+
+    Like defer.maybeDeferred(), except that coroutines are run with
+    run_coroutine(), so they may await asyncio futures on the asyncio reactor.
+
+    Returns:
+      Deferred -- Fires with the method's result, or fails with its exception.
+    """
+    try:
+        result = method(*args)
+    except Exception:
+        return defer.fail()
+
+    if isinstance(result, defer.Deferred):
+        return result
+    elif inspect.iscoroutine(result):
+        return run_coroutine(result)
+
+    return defer.succeed(result)
+
+
+def _measure(result, started, histogram, errors, *labels):
+    """Records how long a plugin's method took, and whether it failed.
+
+    Events rejected by a callback aren't counted as errors.
+    """
+    histogram.observe(time.perf_counter() - started, *labels)
+    if isinstance(result, Failure) and not result.check(EventRejectedMessage):
+        errors.inc(*labels)
+
+    return result
+
+
+def _is_async(result):
+    """Whether a plugin's entrypoint or close method returned before finishing
+    """
+    return isinstance(result, defer.Deferred) or inspect.iscoroutine(result)
+
+
+def _ensure_deferred(result):
+    """Wraps the coroutine returned by a plugin's setup or close in a Deferred
+    """
+    if inspect.iscoroutine(result):
+        return run_coroutine(result)
+    return result
+
+
+def _observe(d):
+    """Returns a new Deferred firing with the result of another.
+
+    The result of the observed Deferred is left untouched, so it can be
+    observed any number of times.
+    """
+    observer = defer.Deferred()
+
+    def fire(result):
+        observer.callback(result)
+        return result
+
+    d.addBoth(fire)
+    return observer
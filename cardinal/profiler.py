@@ -0,0 +1,185 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from twisted.internet import defer, reactor
+
+# Functions that threads wait in when they have nothing to do, by file name.
+# Samples of idle threads aren't counted as work.
+IDLE_FUNCTIONS = {
+    ('epollreactor.py', 'doPoll'),
+    ('pollreactor.py', 'doPoll'),
+    ('selectreactor.py', 'doSelect'),
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+}
+
+
+def reactor_threads(_reactor=None):
+    """Returns the threads worth profiling: the reactor thread (which this
+    must be called on), and the reactor's thread pool.
+
+    Returns:
+      dict -- Names of the threads, by thread ID.
+    """
+    _reactor = _reactor or reactor
+    threads = {threading.get_ident(): 'reactor'}
+
+    threadpool = getattr(_reactor, 'threadpool', None)
+    for thread in getattr(threadpool, 'threads', []):
+        if thread.ident is not None:
+            threads[thread.ident] = thread.name
+
+    return threads
+
+
+class SamplingProfiler:
+    """Profiles running code by sampling the stacks of threads.
+
+    Samples are taken by a thread of its own, so the profiled threads aren't
+    changed. Taking a sample holds the GIL though, so the interval between
+    samples is doubled whenever sampling takes more than max_overhead of the
+    time.
+    """
+
+    DEFAULT_INTERVAL = 0.005
+    """Default time in seconds between samples"""
+
+    DEFAULT_MAX_OVERHEAD = 0.05
+    """Default fraction of time that may be spent taking samples"""
+
+    def __init__(self, threads, interval=DEFAULT_INTERVAL,
+                 max_overhead=DEFAULT_MAX_OVERHEAD, clock=time.perf_counter):
+        """Constructor for SamplingProfiler
+
+        Keyword arguments:
+          threads -- A dict of names of the threads to sample, by thread ID.
+          interval -- Time in seconds between samples.
+          max_overhead -- Fraction of time that may be spent sampling.
+          clock -- Returns the current time.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.threads = threads
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.clock = clock
+
+        # Number of samples of each collapsed stack, and of idle threads
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle = 0
+
+        # Time spent taking samples, and time spent profiling
+        self.overhead = 0
+        self.elapsed = 0
+
+        self._stopped = threading.Event()
+
+    def sample(self):
+        """Takes a sample of each thread's stack"""
+        started = self.clock()
+
+        frames = sys._current_frames()
+        for ident, name in self.threads.items():
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+
+            self.samples += 1
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in \
+                    IDLE_FUNCTIONS:
+                self.idle += 1
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(name)
+
+            self.stacks[';'.join(reversed(stack))] += 1
+
+        self.overhead += self.clock() - started
+
+    def profile(self, duration):
+        """Takes samples until the duration has passed, or stop() is called.
+
+        Keyword arguments:
+          duration -- Time in seconds to profile for.
+        """
+        started = self.clock()
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+            self.elapsed = self.clock() - started
+            if self.elapsed >= duration:
+                break
+
+            if self.overhead > self.elapsed * self.max_overhead:
+                self.interval *= 2
+                self.logger.info("Sampling too often, increasing interval "
+                                 "to %.3fs" % self.interval)
+
+        self.elapsed = self.clock() - started
+
+    def start(self, duration):
+        """Profiles for a duration in a thread of its own.
+
+        Returns:
+          Deferred -- Fires with this object once profiling has finished.
+        """
+        d = defer.Deferred()
+
+        def run():
+            try:
+                self.profile(duration)
+            except Exception:
+                self.logger.exception("Profiling failed")
+            reactor.callFromThread(d.callback, self)
+
+        threading.Thread(target=run, name='cardinal-profiler',
+                         daemon=True).start()
+        return d
+
+    def stop(self):
+        """Stops profiling early"""
+        self._stopped.set()
+
+    def top_functions(self, count):
+        """Returns the functions most samples were taken in.
+
+        Keyword arguments:
+          count -- Number of functions to return.
+
+        Returns:
+          list -- (function, fraction of samples) tuples, with the functions
+            which were running most often first. Only the function at the top
+            of each stack is counted, not those calling it.
+        """
+        if not self.samples:
+            return []
+
+        functions = Counter()
+        for stack, samples in self.stacks.items():
+            functions[stack.rpartition(';')[2]] += samples
+
+        return [(function, samples / self.samples)
+                for function, samples in functions.most_common(count)]
+
+    def write(self, path):
+        """Writes the samples as collapsed stacks, which tools such as
+        flamegraph.pl and speedscope read.
+        """
+        with open(path, 'w') as f:
+            for stack, samples in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, samples))
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s:%s' % (frame.f_globals.get('__name__', '?'),
+                      getattr(code, 'co_qualname', code.co_name))
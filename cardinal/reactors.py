@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import select
+import sys
+
+# Reactors which may be chosen with the reactor option. The default is the
+# best reactor Twisted has for the platform (epoll on Linux), and uvloop is
+# the asyncio reactor running on uvloop's event loop.
+REACTORS = ('default', 'epoll', 'asyncio', 'uvloop')
+
+
+def requested_reactor(argv):
+    """Finds the reactor chosen on the command line or in the config file.
+
+    This runs before the arguments and config are parsed properly, as the
+    reactor must be installed before anything imports it.
+
+    Keyword arguments:
+      argv -- Command-line arguments, without the program name.
+
+    Returns:
+      str -- Name of the reactor, or 'default'.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('config', nargs='?')
+    parser.add_argument('--reactor')
+    args, _ = parser.parse_known_args(argv)
+
+    if args.reactor is not None:
+        return args.reactor
+
+    try:
+        with open(args.config, 'r') as f:
+            reactor = json.load(f).get('reactor')
+    except (AttributeError, OSError, TypeError, ValueError):
+        reactor = None
+
+    return reactor if isinstance(reactor, str) else 'default'
+
+
+def install_reactor(name):
+    """Installs a reactor. Must be called before the reactor is imported.
+
+    Keyword arguments:
+      name -- One of REACTORS.
+
+    Raises:
+      ValueError -- When the reactor is unknown or unavailable (e.g. uvloop
+        isn't installed), or a reactor has already been installed.
+    """
+    if name not in REACTORS:
+        raise ValueError("Unknown reactor: %s (choose from %s)" %
+                         (name, ', '.join(REACTORS)))
+
+    if name == 'default':
+        return
+
+    if name not in available_reactors():
+        raise ValueError("The %s reactor isn't available on this system" %
+                         name)
+
+    if 'twisted.internet.reactor' in sys.modules:
+        raise ValueError("A reactor has already been installed")
+
+    if name == 'epoll':
+        from twisted.internet import epollreactor
+        epollreactor.install()
+        return
+
+    if name == 'uvloop':
+        import uvloop
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+
+    from twisted.internet import asyncioreactor
+
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(loop)
+
+
+def available_reactors():
+    """Returns the reactors which can be installed on this system"""
+    available = ['default']
+    if hasattr(select, 'epoll'):
+        available.append('epoll')
+    available.append('asyncio')
+    if importlib.util.find_spec('uvloop') is not None:
+        available.append('uvloop')
+
+    return available
+
+
+def installed_reactor():
+    """Returns the name of the reactor that is installed"""
+    from twisted.internet import reactor
+
+    loop = getattr(reactor, '_asyncioEventloop', None)
+    if loop is not None:
+        return 'uvloop' if type(loop).__module__.startswith('uvloop') \
+            else 'asyncio'
+    elif type(reactor).__name__ == 'EPollReactor':
+        return 'epoll'
+
+    return 'default'
@@ -0,0 +1,397 @@
+import logging
+import os
+import re
+import sys
+
+import requests
+from twisted.internet import defer, error, protocol, reactor, threads
+from twisted.web import resource, server
+
+from cardinal import metrics
+
+# Format of log lines written by workers, which log to stderr with the default
+# format from cardinal.py
+WORKER_LOG_REGEX = re.compile(
+    r'^\S+ \S+ - (\S+) - (DEBUG|INFO|WARNING|ERROR|CRITICAL) - (.*)$')
+
+
+def group_networks(config, groups=None):
+    """Decides which networks each worker process should run.
+
+    Keyword arguments:
+      config -- The parsed Cardinal config.
+      groups -- A list of lists of network names which should share a worker.
+
+    Returns:
+      list -- A list of lists of network names, one per worker. Networks
+        which aren't in a group get a worker of their own.
+
+    Raises:
+      ValueError -- When a group contains a network that isn't configured.
+    """
+    networks = [network.get('network', config.get('network'))
+                for network in config.get('networks') or [{}]]
+    networks = [network.lower() for network in networks if network]
+
+    # Without any network names, a single worker runs the default network
+    if not networks and not groups:
+        return [[]]
+
+    workers = []
+    grouped = set()
+    for group in groups or []:
+        group = [network.lower() for network in group]
+        for network in group:
+            if network not in networks:
+                raise ValueError("Network %s is not configured" % network)
+        grouped.update(group)
+        workers.append(group)
+
+    workers.extend([network] for network in networks
+                   if network not in grouped)
+
+    return workers
+
+
+class Worker:
+    """A Cardinal process running one or more networks"""
+
+    def __init__(self, name, args, metrics_port=None):
+        """Constructor for Worker
+
+        Keyword arguments:
+          name -- Used to identify the worker in logs.
+          args -- Arguments for the Python interpreter.
+          metrics_port -- Port the worker serves metrics on, if any.
+        """
+        self.name = name
+        self.args = args
+        self.metrics_port = metrics_port
+
+        # Set while the worker is running
+        self.process = None
+        self.started = None
+
+        # Statistics about the worker
+        self.starts = 0
+        self.crashes = 0
+        self.last_exit = None
+
+        # Time to wait before the next restart, doubled on each crash
+        self.restart_wait = None
+        self.restart_call = None
+
+        # Logger name and level of the last log line, for lines such as
+        # tracebacks which continue it
+        self.last_log = ('cardinal', logging.INFO)
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """Relays a worker's output and notifies the supervisor when it exits"""
+
+    def __init__(self, supervisor, worker):
+        self.supervisor = supervisor
+        self.worker = worker
+        self._buffers = {}
+
+    def childDataReceived(self, childFD, data):
+        lines = (self._buffers.get(childFD, b'') + data).split(b'\n')
+        self._buffers[childFD] = lines.pop()
+
+        for line in lines:
+            self.supervisor.log(self.worker, line)
+
+    def processEnded(self, reason):
+        for line in self._buffers.values():
+            if line:
+                self.supervisor.log(self.worker, line)
+        self._buffers = {}
+
+        self.supervisor.worker_ended(self.worker, reason)
+
+
+class Supervisor:
+    """Runs Cardinal workers and restarts them when they crash"""
+
+    MINIMUM_RESTART_WAIT = 1
+    """Minimum time in seconds before restarting a crashed worker"""
+
+    MAXIMUM_RESTART_WAIT = 300
+    """Maximum time in seconds before restarting a crashed worker"""
+
+    STABLE_UPTIME = 60
+    """Time in seconds a worker must run for its restart wait to be reset"""
+
+    SCRAPE_TIMEOUT = 5
+    """Time in seconds to wait for a worker's metrics"""
+
+    @property
+    def reactor(self):
+        """Allows us to inject a mock reactor in unit tests"""
+        return getattr(self, '_reactor', reactor)
+
+    def __init__(self, script, config_file, groups, metrics_port=None):
+        """Constructor for Supervisor
+
+        Keyword arguments:
+          script -- Path to cardinal.py.
+          config_file -- Path to the config file shared by every worker.
+          groups -- A list of lists of network names, one per worker.
+          metrics_port -- The metrics_port from the config, if any. Workers
+            can't share it, so each serves metrics on one of the ports
+            following it instead.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.stopping = False
+
+        self.workers = []
+        for index, group in enumerate(groups):
+            args = [script, config_file, '--supervised']
+            for network in group:
+                args += ['--network', network]
+
+            worker_port = None
+            if metrics_port is not None:
+                worker_port = metrics_port + index + 1
+                args += ['--metrics-port', str(worker_port)]
+
+            self.workers.append(Worker(','.join(group) or 'cardinal', args,
+                                       worker_port))
+
+        # The supervisor's metrics, served along with its workers' metrics
+        self.registry = metrics.Registry()
+        self.worker_starts = self.registry.counter(
+            'cardinal_worker_starts_total',
+            "Times each worker has been started", ['worker'])
+        self.worker_crashes = self.registry.counter(
+            'cardinal_worker_crashes_total',
+            "Times each worker has crashed", ['worker'])
+        self.scrape_errors = self.registry.counter(
+            'cardinal_worker_scrape_errors_total',
+            "Failed attempts to collect each worker's metrics", ['worker'])
+        up = self.registry.gauge(
+            'cardinal_worker_up',
+            "Whether each worker is running", ['worker'])
+        uptime = self.registry.gauge(
+            'cardinal_worker_uptime_seconds',
+            "Time each worker has been running for", ['worker'])
+        last_exit = self.registry.gauge(
+            'cardinal_worker_last_exit_status',
+            "Exit status of each worker when it last exited, or minus the "
+            "signal that killed it", ['worker'])
+
+        for worker in self.workers:
+            up.set_function(lambda worker=worker: int(worker.process is not
+                                                      None), worker.name)
+            uptime.set_function(
+                lambda worker=worker: self.reactor.seconds() - worker.started
+                if worker.started is not None else None, worker.name)
+            last_exit.set_function(lambda worker=worker: worker.last_exit,
+                                   worker.name)
+
+    def start(self):
+        """Starts every worker"""
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def _spawn(self, worker):
+        worker.restart_call = None
+
+        self.logger.info("Starting worker %s" % worker.name)
+        worker.process = self.reactor.spawnProcess(
+            WorkerProtocol(self, worker),
+            sys.executable,
+            [sys.executable, '-u'] + worker.args,
+            env=os.environ,
+        )
+        worker.started = self.reactor.seconds()
+        worker.starts += 1
+        self.worker_starts.inc(worker.name)
+
+    def log(self, worker, line):
+        """Logs a line of output from a worker.
+
+        Lines are logged with the logger name and level used by the worker,
+        so that they are handled by the supervisor's logging config.
+
+        Keyword arguments:
+          worker -- The worker that wrote the line.
+          line -- A line of output, as bytes.
+        """
+        line = line.decode('utf-8', errors='replace').rstrip('\r')
+
+        match = WORKER_LOG_REGEX.match(line)
+        if match:
+            name, level, line = match.groups()
+            worker.last_log = (name, logging.getLevelName(level))
+
+        name, level = worker.last_log
+        logging.getLogger(name).log(level, "[%s] %s" % (worker.name, line))
+
+    def worker_ended(self, worker, reason):
+        """Called when a worker exits.
+
+        Workers which exit cleanly, such as when told to quit by an admin, are
+        not restarted. Crashed workers are restarted, waiting longer each time
+        they crash without staying up for STABLE_UPTIME.
+
+        Keyword arguments:
+          worker -- The worker that exited.
+          reason -- A Failure wrapping ProcessDone or ProcessTerminated.
+        """
+        uptime = self.reactor.seconds() - worker.started
+        worker.process = None
+        worker.started = None
+        worker.last_exit = reason.value.exitCode \
+            if reason.value.exitCode is not None \
+            else -reason.value.signal
+
+        if self.stopping or reason.check(error.ProcessDone):
+            self.logger.info("Worker %s exited" % worker.name)
+            if not any(w.process or w.restart_call for w in self.workers):
+                self.logger.info("All workers have exited, stopping")
+                self.reactor.stop()
+            return
+
+        worker.crashes += 1
+        self.worker_crashes.inc(worker.name)
+        if worker.restart_wait is None or uptime >= self.STABLE_UPTIME:
+            worker.restart_wait = self.MINIMUM_RESTART_WAIT
+        else:
+            worker.restart_wait = min(worker.restart_wait * 2,
+                                      self.MAXIMUM_RESTART_WAIT)
+
+        self.logger.warning(
+            "Worker %s crashed (exit status %d), restarting in %d seconds" %
+            (worker.name, worker.last_exit, worker.restart_wait))
+
+        worker.restart_call = self.reactor.callLater(
+            worker.restart_wait, self._spawn, worker)
+
+    def stop(self):
+        """Tells every worker to quit, then stops once they have exited"""
+        if self.stopping:
+            return
+
+        self.logger.info("Stopping workers")
+        self.stopping = True
+
+        for worker in self.workers:
+            if worker.restart_call is not None:
+                worker.restart_call.cancel()
+                worker.restart_call = None
+
+            if worker.process is not None:
+                try:
+                    worker.process.signalProcess('INT')
+                except error.ProcessExitedAlready:
+                    pass
+
+        if not any(worker.process for worker in self.workers):
+            self.reactor.stop()
+
+    def stats(self):
+        """Returns statistics about each worker.
+
+        Returns:
+          dict -- Maps worker names to dicts with the worker's pid, uptime,
+            starts, crashes, and last exit status.
+        """
+        now = self.reactor.seconds()
+
+        return {
+            worker.name: {
+                'pid': worker.process.pid if worker.process else None,
+                'uptime': (now - worker.started
+                           if worker.started is not None else None),
+                'starts': worker.starts,
+                'crashes': worker.crashes,
+                'last_exit': worker.last_exit,
+            } for worker in self.workers
+        }
+
+    def serve_metrics(self, port):
+        """Serves the metrics of the supervisor and every worker, combined,
+        for Prometheus to scrape.
+
+        Keyword arguments:
+          port -- TCP port to listen on, on the loopback interface.
+        """
+        metrics.listen_or_retry(port, _reactor=self.reactor,
+                                metrics_resource=SupervisorMetrics(self))
+
+    def collect(self):
+        """Collects the metrics of every running worker, and combines them
+        with the supervisor's own. Each worker's samples are labelled with
+        the worker's name.
+
+        Returns:
+          Deferred -- Fires with the metrics in the Prometheus text format.
+            Workers which can't be scraped are left out, and counted in
+            cardinal_worker_scrape_errors_total.
+        """
+        workers = [worker for worker in self.workers
+                   if worker.process is not None and
+                   worker.metrics_port is not None]
+        d = defer.gatherResults([self._scrape(worker) for worker in workers])
+
+        def combine(texts):
+            return self.registry.render() + metrics.merge(
+                [(worker.name, text)
+                 for worker, text in zip(workers, texts) if text is not None],
+                'worker')
+
+        return d.addCallback(combine)
+
+    def _scrape(self, worker):
+        """Returns a Deferred firing with a worker's metrics, or None"""
+        d = threads.deferToThread(
+            requests.get,
+            'http://127.0.0.1:%d/metrics' % worker.metrics_port,
+            timeout=self.SCRAPE_TIMEOUT)
+
+        def scraped(r):
+            r.raise_for_status()
+            return r.text
+
+        def failed(failure):
+            self.scrape_errors.inc(worker.name)
+            self.logger.warning("Unable to collect metrics of worker %s: %s" %
+                                (worker.name, failure.getErrorMessage()))
+            return None
+
+        return d.addCallback(scraped).addErrback(failed)
+
+
+class SupervisorMetrics(resource.Resource):
+    """Serves the combined metrics of a supervisor and its workers"""
+
+    isLeaf = True
+
+    def __init__(self, supervisor):
+        super().__init__()
+        self.supervisor = supervisor
+
+    def render_GET(self, request):
+        # The client may go away while workers are scraped
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+
+        def respond(text):
+            if finished:
+                return
+
+            request.setHeader(b'Content-Type',
+                              metrics.CONTENT_TYPE.encode('ascii'))
+            request.write(text.encode('utf-8'))
+            request.finish()
+
+        def failed(failure):
+            self.supervisor.logger.error(
+                "Unable to collect metrics: %s" % failure.getErrorMessage())
+            if not finished:
+                request.setResponseCode(500)
+                request.finish()
+
+        self.supervisor.collect().addCallbacks(respond, failed)
+        return server.NOT_DONE_YET
@@ -0,0 +1,72 @@
+import json
+import subprocess
+import sys
+from unittest.mock import patch
+
+import pytest
+from twisted.internet import defer, reactor
+
+from cardinal.benchmark import (
+    benchmark_bot,
+    measure_latency,
+    measure_throughput,
+    report,
+    summarize,
+)
+from cardinal.bot import CardinalBot
+
+
+@defer.inlineCallbacks
+def test_measure_throughput():
+    with patch.object(CardinalBot, '_process_inbound', autospec=True,
+                      side_effect=CardinalBot._process_inbound) as process:
+        lines_per_second = yield measure_throughput(reactor, 100)
+
+    assert lines_per_second > 0
+
+    # Lines were handled by Cardinal's cooperative inbound task
+    assert process.called
+
+
+def test_benchmark_bot():
+    bot = benchmark_bot(reactor)
+
+    assert isinstance(bot, CardinalBot)
+    assert bot.network == 'benchmark'
+    assert bot.plugin_manager.plugins == {}
+
+
+@defer.inlineCallbacks
+def test_measure_latency():
+    latencies = yield measure_latency(reactor, 10, delay=0)
+    assert len(latencies) == 10
+    assert all(latency >= 0 for latency in latencies)
+
+
+def test_summarize():
+    summary = summarize([100, 300, 200],
+                        [[0.001] * 98 + [0.002, 0.010], [0.003]])
+
+    assert summary == {
+        'lines_per_second': 200,
+        'latency_p50': pytest.approx(1),
+        'latency_p99': pytest.approx(3),
+    }
+    assert report([dict(summary, reactor='epoll')]) == [
+        "reactor           lines/s    latency p50    latency p99",
+        "epoll                 200        1.000ms        3.000ms",
+    ]
+
+
+def test_benchmark_installs_reactor():
+    output = subprocess.run(
+        [sys.executable, '-m', 'cardinal.benchmark', '--json',
+         '--reactor', 'asyncio', '--lines', '100', '--calls', '10',
+         '--rounds', '1'],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+
+    results = json.loads(output)
+    assert [result['reactor'] for result in results] == ['asyncio']
+    assert results[0]['lines_per_second'] > 0
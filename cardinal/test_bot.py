@@ -1,21 +1,28 @@
+import json
 import logging
 import os
 import signal
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
 
 import pytest
-from unittest.mock import Mock, call, patch
-from twisted.internet import defer
+from unittest.mock import ANY, Mock, call, patch
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
 from twisted.internet.task import Clock
 from twisted.words.protocols.irc import ServerSupportedFeatures
 
-from cardinal import exceptions, plugins
+from cardinal import exceptions, metrics, plugins, tracing
 from cardinal.bot import (
     CardinalBot,
     CardinalBotFactory,
     ChannelManager,
+    NetworkManager,
+    parse_tags,
+    server_info,
     user_info,
 )
+from cardinal.timeline import Timeline
 
 from .unittest_util import tempdir
 
@@ -40,6 +47,17 @@ class TestCardinalBot:
         self.factory.blacklist = {}
         self.factory.booted = datetime.now()
         self.factory.storage_path = '.'
+        self.factory.who_cache_ttl = 60
+        self.factory.plugin_manager = None
+        self.factory.disconnect = False
+        self.factory.ping_interval = 30
+        self.factory.max_missed_pongs = 3
+        self.factory.ssl_certificate = None
+        self.factory.db_locks = {}
+        self.factory.lazy_plugins = False
+        self.factory.warm_plugins = True
+        self.factory.isolated_plugins = []
+        self.factory.timeline = Timeline()
 
         self.event_manager = mock_event_manager.return_value
 
@@ -78,6 +96,8 @@ class TestCardinalBot:
             call("irc.part", 3),
             call("irc.kick", 4),
             call("irc.quit", 2),
+            call("irc.quit_batch", 1),
+            call("irc.join_batch", 1),
         ]
 
         assert self.cardinal._who_cache == {}
@@ -136,12 +156,55 @@ class TestCardinalBot:
 
         mock_plugin_manager.assert_called_once_with(self.cardinal,
                                                     self.factory.plugins,
-                                                    self.factory.blacklist)
+                                                    self.factory.blacklist,
+                                                    False,
+                                                    [])
         assert isinstance(self.cardinal.plugin_manager, plugins.PluginManager)
+        assert self.factory.plugin_manager is self.cardinal.plugin_manager
+        assert not self.cardinal.plugin_manager.warm.called
 
         assert isinstance(self.cardinal.uptime, datetime)
         assert self.cardinal.booted == self.factory.booted
 
+    @pytest.mark.parametrize("warm_plugins", [True, False])
+    @patch.object(CardinalBot, 'send')
+    @patch('cardinal.bot.PluginManager', autospec=True)
+    def test_signedOn_lazy_plugins(self, mock_plugin_manager, mock_send,
+                                   warm_plugins):
+        del self.cardinal.plugin_manager
+        self.factory.lazy_plugins = True
+        self.factory.warm_plugins = warm_plugins
+
+        self.cardinal.signedOn()
+
+        mock_plugin_manager.assert_called_once_with(self.cardinal,
+                                                    self.factory.plugins,
+                                                    self.factory.blacklist,
+                                                    True,
+                                                    [])
+        assert self.cardinal.plugin_manager.warm.called is warm_plugins
+
+    @patch.object(CardinalBot, 'send')
+    @patch('cardinal.bot.PluginManager', autospec=True)
+    def test_signedOn_reconnect_keeps_plugins(
+            self,
+            mock_plugin_manager,
+            _mock_send,
+    ):
+        old_cardinal = Mock(spec=CardinalBot)
+        old_cardinal.event_manager = old_event_manager = Mock()
+        plugin_manager = self.factory.plugin_manager = \
+            Mock(spec=plugins.PluginManager)
+        plugin_manager.cardinal = old_cardinal
+
+        self.cardinal.signedOn()
+
+        assert not mock_plugin_manager.called
+        plugin_manager.rebind.assert_called_once_with(self.cardinal)
+        assert self.cardinal.plugin_manager is plugin_manager
+        assert self.cardinal.event_manager is old_event_manager
+        assert old_event_manager.cardinal is self.cardinal
+
     @patch.object(CardinalBot, 'join')
     @patch.object(CardinalBot, 'msg')
     @patch.object(CardinalBot, 'send')
@@ -194,6 +257,36 @@ class TestCardinalBot:
         # need to request modes to track channel
         mock_send.assert_called_once_with("MODE #bots")
 
+    @patch.object(CardinalBot, 'send')
+    def test_startup_reported(self, _mock_send, caplog):
+        clock = Clock()
+        timeline = self.factory.timeline = Timeline(clock=clock.seconds)
+        self.factory.plugin_manager = Mock(spec=plugins.PluginManager)
+        self.factory.plugin_manager.plugins = {'ping': {}}
+        self.factory.plugin_manager.load_times = {
+            'ping': {'import': 0.25, 'setup': 0.5}}
+
+        timeline.begin('set up plugins')
+        timeline.begin('join #bots')
+        timeline.begin('join #channel')
+        clock.advance(1)
+
+        self.cardinal.joined('#Bots')
+        self.cardinal._plugins_ready([])
+        assert not timeline.finished
+
+        clock.advance(1)
+        with caplog.at_level(logging.INFO, logger='cardinal.bot'):
+            self.cardinal.joined('#channel')
+
+        assert timeline.finished
+        assert timeline.duration == 2
+        assert "Started up in 2.000s:\n" \
+            "   0.000s   +1.000s  join #bots\n" \
+            "   0.000s   +1.000s  set up plugins\n" \
+            "   0.000s   +2.000s  join #channel\n" \
+            "ping 0.750s (import 0.250s, setup 0.500s)" in caplog.text
+
     @patch('cardinal.bot.irc.IRCClient.lineReceived')
     def test_lineReceived(self, mock_parent_linereceived):
         line = b':irc.example.com TEST :foobar foobar'
@@ -205,6 +298,52 @@ class TestCardinalBot:
         )
         mock_parent_linereceived.assert_called_once_with(line)
 
+    @patch('cardinal.bot.irc.IRCClient._reallySendLine')
+    @patch('cardinal.bot.irc.IRCClient.lineReceived')
+    def test_lineReceived_traced(self, mock_parent_linereceived,
+                                 mock_really_send_line):
+        def fire(name, *params):
+            self.cardinal.sendMsg('#channel', 'reply')
+        self.event_manager.fire.side_effect = fire
+
+        with tempdir('traces') as path:
+            tracer = tracing.Tracer(os.path.join(path, 'traces.jsonl'), 1)
+            tracing.install(tracer)
+            try:
+                self.cardinal.lineReceived(
+                    b':nick!user@host PRIVMSG #channel :.weather')
+            finally:
+                tracing.install(None)
+                tracer.close()
+
+            with open(tracer.path) as f:
+                spans = [json.loads(line) for line in f]
+
+        mock_really_send_line.assert_called_once_with(
+            'PRIVMSG #channel :reply')
+        assert [span['name'] for span in spans] == \
+            ['send', 'sendMsg', 'irc.line']
+
+        send, send_msg, line = spans
+        assert line['attributes'] == {
+            'network': 'irc.darkscience.net',
+            'command': 'PRIVMSG',
+        }
+        assert send_msg['parent_id'] == line['span_id']
+        assert send_msg['attributes'] == {'target': '#channel'}
+        assert send['parent_id'] == send_msg['span_id']
+        assert send['attributes'] == {'command': 'PRIVMSG'}
+        assert self.cardinal._traced_lines == deque()
+
+    @patch('cardinal.bot.irc.IRCClient.lineReceived')
+    def test_lineReceived_metrics(self, mock_parent_linereceived):
+        received = metrics.LINES_RECEIVED.value('irc.darkscience.net') or 0
+
+        self.cardinal.lineReceived(b':irc.example.com TEST :foobar')
+
+        assert metrics.LINES_RECEIVED.value('irc.darkscience.net') == \
+            received + 1
+
     @patch('cardinal.bot.irc.IRCClient.lineReceived')
     def test_lineReceived_non_utf8(self, mock_parent_linereceived):
         line = b":irc-us-east-2.darkscience.net 332 Cardinal #pirates :\x031 \x0311,10[\x031]\x031,1\x1f\xc3\x82\xc2\xaf\x1f\x0313,6[\x031]\x031,1\x1f\xc3\x82\xc2\xaf\x1f\x0311,10[\x031]\x031,1\x1f\xc3\x82\xc2\xaf\x1f\x0313,6[\x031]\x031,1\x1f\xc3\x82\xc2\xaf\x1f\x0311,10[\x031]\x031,1\x1f\xc3\x82\xc2\xaf\x1f\x0313,6[\x031]\x031,1\x1f\xc3\x82\xc2\xaf\x1f\x0311,10[\x031]\x03\x0311,6\x030 Pirates Game! - Welcome aboard Dark Sails, Season 4, Mod: Pauper Privateers! - \x1dJoin wit\' !Pirates\x1d - \x0311\x1fwww.piratesirc.com\x1f \x0311,6\x0311,10[\x031]\x031,1\x1f\xc3\x82\xc2\xaf\x1f\x0313,6[\x031]\x031,1\x1f\xc3\x82\xc2"  # noqa: E501
@@ -232,6 +371,145 @@ class TestCardinalBot:
         mock_parent_linereceived.assert_called_once_with(line)
         # Errors are logged, but we don't test for log messages
 
+    def test_dataReceived_processed_cooperatively(self):
+        clock = self.cardinal._reactor = Clock()
+
+        with patch.object(self.cardinal, 'lineReceived') as mock_lineReceived:
+            self.cardinal.dataReceived(
+                b':a JOIN #channel\r\n:b JOIN #channel\r\n:c JOI')
+            assert not mock_lineReceived.called
+            assert self.cardinal.inbound_backlog == 2
+
+            self.cardinal.dataReceived(b'N #channel\r\n')
+            assert self.cardinal.inbound_backlog == 3
+
+            clock.advance(0)
+
+        assert mock_lineReceived.mock_calls == [
+            call(b':a JOIN #channel'),
+            call(b':b JOIN #channel'),
+            call(b':c JOIN #channel'),
+        ]
+        assert self.cardinal.inbound_backlog == 0
+        assert self.cardinal.inbound_backlog_peak == 3
+        assert self.cardinal._inbound_task is None
+
+    def test_dataReceived_yields_to_reactor(self):
+        self.cardinal._reactor = mock_reactor = Mock()
+        self.cardinal.INBOUND_SLICE = 0
+
+        with patch.object(self.cardinal, 'lineReceived') as mock_lineReceived:
+            self.cardinal.dataReceived(b':a JOIN #a\n:b JOIN #b\n')
+
+            # Each slice processes a line then reschedules itself
+            mock_reactor.callLater.call_args[0][1]()
+            assert mock_lineReceived.call_count == 1
+
+            mock_reactor.callLater.call_args[0][1]()
+            assert mock_lineReceived.call_count == 2
+
+    def test_dataReceived_ping_skips_backlog(self):
+        self.cardinal._reactor = Clock()
+
+        with patch.object(self.cardinal, 'lineReceived') as mock_lineReceived:
+            self.cardinal.dataReceived(
+                b':a JOIN #channel\r\nPING :irc.example.com\r\n'
+                b'@time=now :irc.example.com PONG Cardinal :token\r\n')
+
+        assert mock_lineReceived.mock_calls == [
+            call(b'PING :irc.example.com'),
+            call(b'@time=now :irc.example.com PONG Cardinal :token'),
+        ]
+        assert self.cardinal.inbound_backlog == 1
+
+    def test_connectionLost_stops_inbound_processing(self):
+        self.cardinal._reactor = Clock()
+        self.cardinal.dataReceived(b':a JOIN #channel\r\n')
+
+        with patch('cardinal.bot.irc.IRCClient.connectionLost'):
+            self.cardinal.connectionLost(None)
+
+        assert self.cardinal.inbound_backlog == 0
+        assert self.cardinal._inbound_task is None
+
+    def test_connection_gauges(self):
+        self.factory.adopted_state = None
+        self.cardinal._reactor = Clock()
+
+        with patch('cardinal.bot.irc.IRCClient.connectionMade'):
+            self.cardinal.connectionMade()
+
+        self.cardinal.dataReceived(b':a JOIN #channel\r\n')
+        self.cardinal.lag = 0.5
+        assert metrics.INBOUND_BACKLOG.value('irc.darkscience.net') == 1
+        assert metrics.SERVER_LAG.value('irc.darkscience.net') == 0.5
+
+        with patch('cardinal.bot.irc.IRCClient.connectionLost'):
+            self.cardinal.connectionLost(None)
+
+        assert metrics.INBOUND_BACKLOG.value('irc.darkscience.net') is None
+        assert metrics.SERVER_LAG.value('irc.darkscience.net') is None
+
+    def test_heartbeat_measures_lag(self):
+        clock = self.cardinal._reactor = Clock()
+
+        with patch.object(self.cardinal, 'sendLine') as mock_sendLine:
+            self.cardinal.startHeartbeat()
+            clock.advance(self.factory.ping_interval)
+
+        mock_sendLine.assert_called_once_with('PING :cardinal-1')
+
+        clock.advance(0.5)
+        # PONGs for other PINGs are ignored
+        self.cardinal.irc_PONG('irc.example.com',
+                               ['irc.example.com', 'irc.example.com'])
+        assert self.cardinal.lag is None
+
+        self.cardinal.irc_PONG('irc.example.com',
+                               ['irc.example.com', 'cardinal-1'])
+        assert self.cardinal.lag == 0.5
+        assert self.cardinal.lineRate is None
+
+        self.cardinal.stopHeartbeat()
+
+    def test_heartbeat_reconnects_after_missed_pongs(self):
+        clock = self.cardinal._reactor = Clock()
+        self.cardinal.transport = Mock()
+
+        with patch.object(self.cardinal, 'sendLine'):
+            self.cardinal.startHeartbeat()
+            clock.advance(self.factory.ping_interval)
+
+            for _ in range(self.factory.max_missed_pongs - 1):
+                clock.advance(self.factory.ping_interval)
+            assert not self.cardinal.transport.abortConnection.called
+            assert self.cardinal.lag == self.factory.ping_interval * 2
+
+            clock.advance(self.factory.ping_interval)
+
+        self.cardinal.transport.abortConnection.assert_called_once_with()
+        self.cardinal.stopHeartbeat()
+
+    def test_line_rate_adapts_to_lag(self):
+        self.cardinal.lag = CardinalBot.LAG_THROTTLE_THRESHOLD * 2
+        self.cardinal._adapt_line_rate()
+        assert self.cardinal.lineRate == \
+            self.cardinal.lag * CardinalBot.LAG_LINE_RATE_FACTOR
+
+        self.cardinal.lag = 1000
+        self.cardinal._adapt_line_rate()
+        assert self.cardinal.lineRate == CardinalBot.MAXIMUM_LINE_RATE
+
+        # Queued lines keep being sent in order after lag recovers
+        self.cardinal._queue = ['PRIVMSG #channel :queued']
+        self.cardinal.lag = 0.1
+        self.cardinal._adapt_line_rate()
+        assert self.cardinal.lineRate == 0
+
+        self.cardinal._queue = []
+        self.cardinal._adapt_line_rate()
+        assert self.cardinal.lineRate is None
+
     def test_irc_PRIVMSG(self):
         self.plugin_manager.call_command.side_effect = \
             exceptions.CommandNotFoundError  # should be caught
@@ -465,6 +743,234 @@ class TestCardinalBot:
             None,
         )
 
+    def test_irc_QUIT_netsplit_batch(self):
+        prefix, source = self.get_user()
+        reason = 'irc.example.com hub.example.com'
+
+        self.cardinal.lineReceived(
+            b':irc.example.com BATCH +yXNAbvnRHTRBv netsplit '
+            b'irc.example.com hub.example.com')
+
+        fired = []
+        self.event_manager.fire.side_effect = \
+            lambda *args: fired.append((args, self.cardinal.current_batch))
+        self.cardinal.lineReceived(
+            '@batch=yXNAbvnRHTRBv :{} QUIT :{}'.format(prefix, reason)
+            .encode('utf-8'))
+
+        # Per-user event is still fired, tagged with its batch
+        (args, batch), = [f for f in fired if f[0][0] == 'irc.quit']
+        assert args == ('irc.quit', source, reason)
+        assert batch.type == 'netsplit'
+
+        fired.clear()
+        self.cardinal.lineReceived(b':irc.example.com BATCH -yXNAbvnRHTRBv')
+
+        assert ('irc.quit_batch', [(source, reason)]) in \
+            [args for args, _ in fired]
+        assert self.cardinal.current_batch is None
+
+    def test_irc_JOIN_netjoin_batch(self):
+        prefix, source = self.get_user()
+
+        self.cardinal.irc_BATCH('irc.example.com', ['+ref', 'netjoin'])
+        self.cardinal.current_batch = self.cardinal._batches['ref']
+        self.cardinal.irc_JOIN(prefix, ['#channel'])
+        self.cardinal.current_batch = None
+        self.cardinal.irc_BATCH('irc.example.com', ['-ref'])
+
+        assert self.event_manager.fire.mock_calls == [
+            call('irc.join', source, '#channel'),
+            call('irc.join_batch', [(source, '#channel')]),
+        ]
+
+    def test_irc_QUIT_netsplit_without_batch(self):
+        clock = self.cardinal._reactor = Clock()
+        prefix, source = self.get_user()
+        reason = 'irc.example.com hub.example.com'
+
+        self.cardinal.irc_QUIT(prefix, [reason])
+        clock.advance(CardinalBot.NETSPLIT_WINDOW - 1)
+        self.cardinal.irc_QUIT('other!user@vhost', [reason])
+        clock.advance(CardinalBot.NETSPLIT_WINDOW - 1)
+
+        # Window is reset by each quit
+        assert call('irc.quit_batch', ANY) not in \
+            self.event_manager.fire.mock_calls
+
+        clock.advance(1)
+        self.event_manager.fire.assert_called_with('irc.quit_batch', [
+            (source, reason),
+            (user_info('other', 'user', 'vhost'), reason),
+        ])
+
+    def test_irc_QUIT_masked_netsplit(self):
+        clock = self.cardinal._reactor = Clock()
+        prefix, source = self.get_user()
+        reason = '*.net *.split'
+
+        self.cardinal.irc_QUIT(prefix, [reason])
+        clock.advance(CardinalBot.NETSPLIT_WINDOW)
+
+        self.event_manager.fire.assert_called_with(
+            'irc.quit_batch', [(source, reason)])
+
+    @pytest.mark.parametrize("reason", [
+        'Quit: irc.example.com is slow',
+        '*',
+        'Ping timeout: 240 seconds',
+    ])
+    def test_irc_QUIT_not_netsplit(self, reason):
+        self.cardinal._reactor = Clock()
+        prefix, source = self.get_user()
+
+        self.cardinal.irc_QUIT(prefix, [reason])
+
+        assert self.cardinal._netsplits == {}
+
+    def test_disconnected_flushes_netsplits(self):
+        self.cardinal._reactor = Clock()
+        prefix, source = self.get_user()
+        reason = 'irc.example.com hub.example.com'
+
+        self.cardinal.irc_QUIT(prefix, [reason])
+        self.cardinal.disconnected()
+
+        self.event_manager.fire.assert_called_with(
+            'irc.quit_batch', [(source, reason)])
+        assert self.cardinal._netsplits == {}
+
+    @pytest.mark.parametrize("raw_tags,expected", [
+        ('batch=ref', {'batch': 'ref'}),
+        ('a=1;b;c=', {'a': '1', 'b': '', 'c': ''}),
+        (r'msg=hello\sworld\:\\', {'msg': 'hello world;\\'}),
+    ])
+    def test_parse_tags(self, raw_tags, expected):
+        assert parse_tags(raw_tags) == expected
+
+    def test_register_requests_capabilities(self):
+        with patch.object(self.cardinal, 'sendLine') as mock_sendLine:
+            self.cardinal.register('Cardinal')
+
+        assert mock_sendLine.mock_calls[0] == call('CAP LS 302')
+
+        with patch.object(self.cardinal, 'sendLine') as mock_sendLine:
+            self.cardinal.irc_CAP('irc.example.com',
+                                  ['*', 'LS', '*', 'sasl=PLAIN multi-prefix'])
+            assert not mock_sendLine.called
+
+            self.cardinal.irc_CAP('irc.example.com',
+                                  ['*', 'LS', 'batch server-time'])
+            mock_sendLine.assert_called_once_with(
+                'CAP REQ :batch multi-prefix')
+
+        with patch.object(self.cardinal, 'sendLine') as mock_sendLine:
+            self.cardinal.irc_CAP('irc.example.com',
+                                  ['*', 'ACK', 'batch multi-prefix'])
+            mock_sendLine.assert_called_once_with('CAP END')
+
+        assert self.cardinal.capabilities == {'batch', 'multi-prefix'}
+
+    @pytest.mark.parametrize("numeric", ['903', '904'])
+    def test_sasl_external(self, numeric):
+        self.factory.ssl_certificate = 'client.pem'
+
+        with patch.object(self.cardinal, 'sendLine') as mock_sendLine:
+            self.cardinal.register('Cardinal')
+            mock_sendLine.reset_mock()
+
+            self.cardinal.irc_CAP('irc.example.com',
+                                  ['*', 'LS', 'sasl=EXTERNAL batch'])
+            mock_sendLine.assert_called_once_with('CAP REQ :batch sasl')
+
+        with patch.object(self.cardinal, 'sendLine') as mock_sendLine:
+            self.cardinal.irc_CAP('irc.example.com',
+                                  ['*', 'ACK', 'batch sasl'])
+            self.cardinal.irc_AUTHENTICATE('irc.example.com', ['+'])
+            assert mock_sendLine.mock_calls == [
+                call('AUTHENTICATE EXTERNAL'),
+                call('AUTHENTICATE +'),
+            ]
+
+        # Registration continues whether or not authentication succeeded
+        with patch.object(self.cardinal, 'sendLine') as mock_sendLine:
+            getattr(self.cardinal, 'irc_' + numeric)(
+                'irc.example.com', ['Cardinal', 'SASL authentication'])
+            mock_sendLine.assert_called_once_with('CAP END')
+
+    def test_irc_CAP_nothing_to_request(self):
+        with patch.object(self.cardinal, 'sendLine') as mock_sendLine:
+            self.cardinal.irc_CAP('irc.example.com',
+                                  ['*', 'LS', 'server-time'])
+
+        mock_sendLine.assert_called_once_with('CAP END')
+        assert self.cardinal.capabilities == set()
+
+    def test_membership_tracking(self):
+        self.cardinal.channels.add('#channel')
+        self.cardinal.channels.add('#other')
+
+        self.cardinal.irc_RPL_NAMREPLY('irc.example.com', [
+            'Cardinal', '=', '#channel', '@+op +voiced nick'])
+        self.cardinal.irc_RPL_NAMREPLY('irc.example.com', [
+            'Cardinal', '=', '#channel', 'Cardinal'])
+        self.cardinal.irc_RPL_ENDOFNAMES('irc.example.com', [
+            'Cardinal', '#channel', 'End of /NAMES list.'])
+        self.cardinal.irc_JOIN('nick!user@vhost', ['#other'])
+
+        channel = self.cardinal.channels['#channel']
+        assert sorted(channel.nicks()) == ['Cardinal', 'nick', 'op', 'voiced']
+        assert channel.is_op('op') and channel.is_voiced('op')
+        assert channel.is_voiced('voiced') and not channel.is_op('voiced')
+        assert channel.get_prefix('op') == '@'
+        assert channel.get_modes('nobody') is None
+
+        user = self.cardinal.channels.get_user('NICK')
+        assert (user.nick, user.user, user.vhost) == ('nick', 'user', 'vhost')
+        assert user.channels == {'#channel', '#other'}
+
+        self.cardinal.irc_MODE('op!user@vhost', ['#channel', '+o', 'nick'])
+        self.cardinal.irc_MODE('op!user@vhost', ['#channel', '-o', 'op'])
+        assert channel.is_op('nick')
+        assert not channel.is_op('op') and channel.is_voiced('op')
+
+        self.cardinal.irc_NICK('nick!user@vhost', ['NewNick'])
+        assert 'nick' not in channel and 'newnick' in channel
+        assert channel.is_op('NewNick')
+        assert 'NewNick' in self.cardinal.channels['#other']
+
+        self.cardinal.irc_PART('NewNick!user@vhost', ['#other'])
+        assert 'NewNick' not in self.cardinal.channels['#other']
+        assert user.channels == {'#channel'}
+
+        self.cardinal.irc_KICK('op!user@vhost', ['#channel', 'voiced'])
+        assert 'voiced' not in channel
+        assert self.cardinal.channels.get_user('voiced') is None
+
+        self.cardinal.irc_QUIT('NewNick!user@vhost', ['Bye'])
+        assert 'NewNick' not in channel
+        assert self.cardinal.channels.get_user('NewNick') is None
+
+    def test_names_reply_replaces_membership(self):
+        self.cardinal.channels.add('#channel')
+        self.cardinal.channels.add_user('#channel', 'stale')
+
+        self.cardinal.irc_RPL_NAMREPLY('irc.example.com', [
+            'Cardinal', '=', '#channel', 'nick!user@vhost'])
+
+        channel = self.cardinal.channels['#channel']
+        assert channel.nicks() == ['nick']
+        assert self.cardinal.channels.get_user('stale') is None
+        assert self.cardinal.channels.get_user('nick').vhost == 'vhost'
+
+    def test_left_removes_membership(self):
+        self.cardinal.channels.add('#channel')
+        self.cardinal.channels.add_user('#channel', 'nick')
+
+        self.cardinal.left('#channel')
+
+        assert self.cardinal.channels.get_user('nick') is None
+
     def test_irc_unknown_no_op(self):
         prefix, _ = self.get_user()
         self.cardinal.irc_unknown(prefix, 'UNKNOWN', [])
@@ -520,6 +1026,75 @@ class TestCardinalBot:
         users2 = yield d2
         assert users == users2
 
+    @defer.inlineCallbacks
+    def test_who_cached(self):
+        clock = self.cardinal._reactor = Clock()
+        _, user = self.get_user()
+        channel = '#channel'
+
+        with patch.object(self.cardinal, 'sendLine') as mock_sendLine:
+            d = self.cardinal.who(channel)
+            self.cardinal.irc_RPL_WHOREPLY('irc.example.com', [
+                'Cardinal', channel, user.user, user.vhost,
+                'irc.example.com', user.nick, 'H', '0 Mr. Cardinal',
+            ])
+            self.cardinal.irc_RPL_ENDOFWHO('irc.example.com', [
+                'Cardinal', channel, 'End of /WHO list.'
+            ])
+            assert (yield d) == [user]
+
+            # Served from cache
+            assert (yield self.cardinal.who(channel)) == [user]
+            mock_sendLine.assert_called_once_with('WHO #channel')
+
+            # Expired
+            clock.advance(self.factory.who_cache_ttl)
+            self.cardinal.who(channel)
+            assert mock_sendLine.call_count == 2
+
+    def test_who_cache_invalidated_by_membership(self):
+        self.cardinal._reactor = Clock()
+        self.cardinal._who_cache = {
+            '#channel': (60, []),
+            '#other': (60, []),
+        }
+
+        self.cardinal.irc_JOIN('nick!user@vhost', ['#channel'])
+
+        assert list(self.cardinal._who_cache) == ['#other']
+
+    @defer.inlineCallbacks
+    def test_who_whox_batched(self):
+        self.cardinal.supported.parse(['WHOX', 'TARGMAX=WHO:2'])
+        _, user = self.get_user()
+        channels = ['#one', '#two', '#three']
+
+        with patch.object(self.cardinal, 'sendLine') as mock_sendLine:
+            d = self.cardinal.who(channels)
+
+        assert mock_sendLine.mock_calls == [
+            call('WHO #one,#two %tcuhnfar,1'),
+            call('WHO #three %tcuhnfar,2'),
+        ]
+
+        # Replies for tokens we didn't request are ignored
+        self.cardinal.irc_354('irc.example.com', [
+            'Cardinal', '999', '#one', 'other', 'vhost', 'other', 'H', '0',
+            'Other'])
+        for token, channel in (('1', '#one'), ('1', '#two'), ('2', '#three')):
+            self.cardinal.irc_354('irc.example.com', [
+                'Cardinal', token, channel, user.user, user.vhost, user.nick,
+                'H', '0', 'Mr. Cardinal'])
+
+        self.cardinal.irc_RPL_ENDOFWHO('irc.example.com', [
+            'Cardinal', '#one,#two', 'End of /WHO list.'])
+        self.cardinal.irc_RPL_ENDOFWHO('irc.example.com', [
+            'Cardinal', '#three', 'End of /WHO list.'])
+
+        result = yield d
+        assert result == {channel: [user] for channel in channels}
+        assert self.cardinal._who_tokens == {}
+
     def test_config_raises_without_plugin_manager(self):
         self.cardinal.plugin_manager = None
         with pytest.raises(exceptions.PluginError):
@@ -555,6 +1130,17 @@ class TestCardinalBot:
 
         msg_mock.assert_called_once_with(channel, message, length)
 
+    def test_sendMsg_metrics(self):
+        sent = metrics.MESSAGES_SENT.value('irc.darkscience.net') or 0
+        lines = metrics.LINES_SENT.value('irc.darkscience.net') or 0
+
+        with patch('cardinal.bot.irc.IRCClient.sendLine') as sendLine_mock:
+            self.cardinal.sendMsg('#channel', 'message')
+
+        sendLine_mock.assert_called_once_with('PRIVMSG #channel :message')
+        assert metrics.MESSAGES_SENT.value('irc.darkscience.net') == sent + 1
+        assert metrics.LINES_SENT.value('irc.darkscience.net') == lines + 1
+
     def test_sendMsg_censored_words(self):
         # passes through to Twisted w/ additional logging
         channel = '#channel'
@@ -607,6 +1193,14 @@ class TestCardinalBot:
     def test_disconnected(self):
         self.cardinal.disconnected()
 
+        self.cardinal.plugin_manager.disconnected.assert_called_once_with()
+        assert not self.cardinal.plugin_manager.unload_all.called
+
+    def test_disconnected_quitting(self):
+        self.factory.disconnect = True
+
+        self.cardinal.disconnected()
+
         self.cardinal.plugin_manager.unload_all.assert_called_once()
 
 
@@ -636,6 +1230,22 @@ class TestCardinalBot:
             with db() as db2:
                 assert db1 == db2
 
+    def test_get_db_metrics(self):
+        opened, _ = metrics.DB_SECONDS.value('metrics') or (0, 0)
+        errors = metrics.DB_LOCK_ERRORS.value('metrics') or 0
+
+        with tempdir('database') as database_path:
+            self.factory.storage_path = os.path.dirname(database_path)
+            db = self.cardinal.get_db('metrics')
+
+            with db():
+                with pytest.raises(exceptions.LockInUseError):
+                    with db():
+                        pass
+
+        assert metrics.DB_SECONDS.value('metrics')[0] == opened + 1
+        assert metrics.DB_LOCK_ERRORS.value('metrics') == errors + 1
+
     def test_db_contextmanager_locks(self):
         with tempdir('database') as database_path:
             self.factory.storage_path = os.path.dirname(database_path)
@@ -657,6 +1267,47 @@ class TestCardinalBot:
                     with db2():
                         pass
 
+    def test_db_locks_shared_between_networks(self):
+        other = CardinalBot()
+        other.factory = Mock(spec=CardinalBotFactory)
+        other.factory.network = 'irc.example.com'
+        other.factory.db_locks = self.factory.db_locks
+
+        with tempdir('database') as database_path:
+            self.factory.storage_path = other.factory.storage_path = \
+                os.path.dirname(database_path)
+
+            with self.cardinal.get_db('test', network_specific=False)():
+                with pytest.raises(exceptions.LockInUseError):
+                    with other.get_db('test', network_specific=False)():
+                        pass
+
+                # Network-specific databases are separate files
+                with self.cardinal.get_db('test')():
+                    with other.get_db('test')():
+                        pass
+
+    def test_db_locks_shared_between_processes(self):
+        # Plugins in workers have locks of their own, so the file is locked
+        other = CardinalBot()
+        other.factory = Mock(spec=CardinalBotFactory)
+        other.factory.network = self.factory.network
+        other.factory.db_locks = {}
+
+        with tempdir('database') as database_path:
+            self.factory.storage_path = other.factory.storage_path = \
+                os.path.dirname(database_path)
+
+            with self.cardinal.get_db('test')() as db:
+                db['x'] = True
+
+                with pytest.raises(exceptions.LockInUseError):
+                    with other.get_db('test')():
+                        pass
+
+            with other.get_db('test')() as db:
+                assert db == {'x': True}
+
     def test_db_corrupted(self):
         with tempdir('database') as database_path:
             self.factory.storage_path = os.path.dirname(database_path)
@@ -788,6 +1439,7 @@ class TestCardinalBotFactory:
 
         # Defaults that aren't passed in
         assert self.factory.cardinal is None
+        assert self.factory.plugin_manager is None
         assert self.factory.disconnect is False
         assert isinstance(self.factory.booted, datetime)
         assert self.factory.last_reconnection_wait is None
@@ -803,6 +1455,12 @@ class TestCardinalBotFactory:
         assert factory.plugins == plugins
         assert factory.blacklist == blacklist
         assert factory.storage_path == storage
+        assert factory.who_cache_ttl == \
+            CardinalBotFactory.DEFAULT_WHO_CACHE_TTL
+        assert factory.ping_interval == \
+            CardinalBotFactory.DEFAULT_PING_INTERVAL
+        assert factory.max_missed_pongs == \
+            CardinalBotFactory.DEFAULT_MAX_MISSED_PONGS
 
     def test_sigint_handler(self):
         mock_cardinal = Mock(spec=CardinalBot)
@@ -816,12 +1474,32 @@ class TestCardinalBotFactory:
         mock_cardinal.quit.assert_called_once_with('Received SIGINT.')
 
     def test_sigint_handler_without_cardinal(self):
+        self.factory._reactor = Mock()
         assert self.factory.disconnect is False
 
         os.kill(os.getpid(), signal.SIGINT)
 
         assert self.factory.disconnect is True
 
+        # Nothing to disconnect from, so stop right away
+        self.factory._reactor.stop.assert_called_once_with()
+
+    def test_sigint_handler_while_reconnecting(self):
+        self.factory._reactor = clock = Clock()
+        clock.stop = Mock()
+        self.factory.cardinal = Mock(spec=CardinalBot)
+        self.factory.cardinal.connected = 0
+        mock_connector = Mock()
+
+        self.factory.clientConnectionFailed(mock_connector,
+                                            'Called by unit test')
+        os.kill(os.getpid(), signal.SIGINT)
+        clock.advance(self.factory.last_reconnection_wait)
+
+        assert not self.factory.cardinal.quit.called
+        assert not mock_connector.connect.called
+        clock.stop.assert_called_once_with()
+
     def test_reconnection(self):
         assert self.factory.disconnect is False
 
@@ -918,6 +1596,251 @@ class TestCardinalBotFactory:
         clock.advance(self.factory.MAXIMUM_RECONNECTION_WAIT)
         mock_connector.connect.assert_called_once()
 
+    @defer.inlineCallbacks
+    def test_probe_servers_with_local_listeners(self):
+        server_factory = protocol.Factory.forProtocol(protocol.Protocol)
+        live = reactor.listenTCP(0, server_factory, interface='127.0.0.1')
+        dead = reactor.listenTCP(0, server_factory, interface='127.0.0.1')
+        dead_port = dead.getHost().port
+        yield dead.stopListening()
+
+        try:
+            dead_server = server_info('127.0.0.1', dead_port, False)
+            live_server = server_info('127.0.0.1', live.getHost().port, False)
+            self.factory.servers = [dead_server, live_server]
+
+            ranked = yield self.factory.probe_servers()
+        finally:
+            yield live.stopListening()
+
+        assert ranked == [live_server, dead_server]
+
+    @defer.inlineCallbacks
+    def test_probe_servers_sorts_by_latency(self):
+        servers = [server_info('slow', 6667, False),
+                   server_info('down', 6667, False),
+                   server_info('fast', 6697, True)]
+        self.factory.servers = servers
+        latencies = {'slow': 0.5, 'down': None, 'fast': 0.01}
+
+        with patch.object(self.factory, '_probe') as mock_probe:
+            mock_probe.side_effect = \
+                lambda server: defer.succeed(latencies[server.host])
+            ranked = yield self.factory.probe_servers()
+
+        assert ranked == [servers[2], servers[0], servers[1]]
+
+    def test_connect_rotates_servers_on_failure(self):
+        servers = [server_info('one', 6667, False),
+                   server_info('two', 6667, False)]
+        self.factory.servers = servers
+        self.factory._reactor = clock = Clock()
+        clock.connectTCP = Mock()
+
+        with patch.object(self.factory, 'probe_servers',
+                          return_value=defer.succeed(servers)):
+            self.factory.connect()
+
+        clock.connectTCP.assert_called_once_with('one', 6667, self.factory)
+        assert self.factory.server == servers[0]
+
+        # Next server is tried immediately
+        self.factory.clientConnectionFailed(Mock(), 'Called by unit test')
+        clock.connectTCP.assert_called_with('two', 6667, self.factory)
+        assert self.factory.last_reconnection_wait is None
+
+        # All servers failed, back off and probe again
+        with patch.object(self.factory, 'connect') as mock_connect:
+            self.factory.clientConnectionFailed(Mock(), 'Called by unit test')
+            assert self.factory.last_reconnection_wait == \
+                CardinalBotFactory.MINIMUM_RECONNECTION_WAIT
+
+            clock.advance(self.factory.last_reconnection_wait)
+            mock_connect.assert_called_once_with()
+
+    def test_connect_ssl_reuses_tls_options(self):
+        server = server_info('irc.example.com', 6697, True)
+        self.factory._candidates = deque([server, server])
+        self.factory._reactor = mock_reactor = Mock()
+
+        self.factory._connect_next()
+        self.factory._connect_next()
+
+        tls = self.factory.tls_options(server)
+        assert mock_reactor.connectSSL.mock_calls == \
+            [call('irc.example.com', 6697, self.factory, tls)] * 2
+        assert IOpenSSLClientConnectionCreator.providedBy(tls)
+
+        # Hostname verification is done by Twisted's client options
+        assert IOpenSSLClientConnectionCreator.providedBy(tls.options)
+
+    def test_tls_session_resumed_on_reconnect(self):
+        server = self.factory.server = \
+            server_info('irc.example.com', 6697, True)
+        tls = self.factory.tls_options(server)
+
+        transport = Mock()
+        session = transport.getHandle.return_value.get_session.return_value
+        self.factory.save_tls_session(transport)
+        assert tls.session is session
+
+        with patch.object(tls.options, 'clientConnectionForTLS') as mock_new:
+            connection = tls.clientConnectionForTLS(Mock())
+
+        assert connection is mock_new.return_value
+        connection.set_session.assert_called_once_with(session)
+
+    def test_save_tls_session_plaintext(self):
+        self.factory.server = server_info('irc.example.com', 6667, False)
+
+        # Nothing to save, and no TLS options are created
+        self.factory.save_tls_session(Mock())
+        assert self.factory._tls == {}
+
+    @pytest.mark.parametrize("verify", [True, False])
+    def test_tls_options_client_certificate(self, verify):
+        self.factory.ssl_verify = verify
+        server = server_info('irc.example.com', 6697, True)
+
+        with tempdir('tls') as tls_path:
+            self.factory.ssl_certificate = os.path.join(tls_path, 'client.pem')
+            with open(self.factory.ssl_certificate, 'wb') as f:
+                f.write(self._self_signed_pem('Cardinal'))
+
+            connection = self.factory.tls_options(server) \
+                .clientConnectionForTLS(Mock())
+
+        certificate = connection.get_certificate(as_cryptography=True)
+        assert certificate.subject.rfc4514_string() == 'CN=Cardinal'
+
+    @staticmethod
+    def _self_signed_pem(common_name):
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.x509.oid import NameOID
+
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name(
+            [x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+        now = datetime.utcnow()
+        certificate = x509.CertificateBuilder() \
+            .subject_name(name) \
+            .issuer_name(name) \
+            .public_key(key.public_key()) \
+            .serial_number(x509.random_serial_number()) \
+            .not_valid_before(now) \
+            .not_valid_after(now + timedelta(days=1)) \
+            .sign(key, hashes.SHA256())
+
+        return key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ) + certificate.public_bytes(serialization.Encoding.PEM)
+
+    def test_connection_lost_fails_over_quickly(self):
+        self.factory.servers = [server_info('one', 6667, False),
+                                server_info('two', 6667, False)]
+        self.factory.server = self.factory.servers[0]
+        self.factory._candidates = deque()
+        self.factory._reactor = clock = Clock()
+        self.factory.cardinal = Mock(spec=CardinalBot)
+        self.factory.last_reconnection_wait = 40
+        self.factory._drops = {self.factory.servers[0]: 1}
+
+        self.factory.signed_on()
+        clock.advance(CardinalBotFactory.HEALTHY_CONNECTION_TIME)
+
+        with patch.object(self.factory, 'connect') as mock_connect:
+            self.factory.clientConnectionLost(Mock(), 'Called by unit test')
+            clock.advance(CardinalBotFactory.FAILOVER_WAIT)
+
+        mock_connect.assert_called_once_with()
+
+        # A healthy connection resets backoff, and the server's drops
+        assert self.factory.last_reconnection_wait is None
+        assert self.factory._drops == {}
+
+    def test_connection_dropped_early_backs_off(self):
+        servers = [server_info('one', 6667, False),
+                   server_info('two', 6667, False)]
+        self.factory.servers = servers
+        self.factory._reactor = clock = Clock()
+        self.factory.cardinal = Mock(spec=CardinalBot)
+
+        waits = []
+        with patch.object(self.factory, 'connect') as mock_connect:
+            for _ in range(3):
+                self.factory.server = servers[0]
+                self.factory._candidates = deque([servers[1]])
+
+                # Signed on, but dropped before the connection was healthy
+                self.factory.signed_on()
+                clock.advance(1)
+                self.factory.clientConnectionLost(Mock(),
+                                                  'Called by unit test')
+                waits.append(self.factory.last_reconnection_wait)
+
+                clock.advance(self.factory.last_reconnection_wait - 1)
+                assert mock_connect.call_count == len(waits) - 1
+                clock.advance(1)
+                assert mock_connect.call_count == len(waits)
+
+        assert waits == [CardinalBotFactory.MINIMUM_RECONNECTION_WAIT * 2 ** i
+                         for i in range(3)]
+        assert self.factory._drops == {servers[0]: 3}
+
+    @defer.inlineCallbacks
+    def test_probe_servers_demotes_dropping_servers(self):
+        servers = [server_info('fast', 6667, False),
+                   server_info('slow', 6667, False)]
+        self.factory.servers = servers
+        self.factory._drops = {servers[0]: 2}
+        latencies = {'fast': 0.01, 'slow': 0.5}
+
+        with patch.object(self.factory, '_probe') as mock_probe:
+            mock_probe.side_effect = \
+                lambda server: defer.succeed(latencies[server.host])
+            ranked = yield self.factory.probe_servers()
+
+        assert ranked == [servers[1], servers[0]]
+
+    @defer.inlineCallbacks
+    def test_probe_ssl_servers_over_tls(self):
+        from twisted.internet import ssl
+
+        self.factory.ssl_verify = False
+        certificate = ssl.PrivateCertificate.loadPEM(
+            self._self_signed_pem('irc.example.com'))
+
+        class Hangup(protocol.Protocol):
+            def dataReceived(self, data):
+                self.transport.loseConnection()
+
+        tls = reactor.listenSSL(
+            0, protocol.Factory.forProtocol(protocol.Protocol),
+            certificate.options(), interface='127.0.0.1')
+        plaintext = reactor.listenTCP(
+            0, protocol.Factory.forProtocol(Hangup), interface='127.0.0.1')
+
+        try:
+            # Accepts TCP connections, but not TLS handshakes
+            plaintext_server = server_info(
+                '127.0.0.1', plaintext.getHost().port, True)
+            tls_server = server_info('127.0.0.1', tls.getHost().port, True)
+            self.factory.servers = [plaintext_server, tls_server]
+
+            latency = yield self.factory._probe(plaintext_server)
+            assert latency is None
+
+            ranked = yield self.factory.probe_servers()
+        finally:
+            yield tls.stopListening()
+            yield plaintext.stopListening()
+
+        assert ranked == [tls_server, plaintext_server]
+
     def test_bypass_reconnection(self):
         # Mark that we purposefully disconnected
         self.factory.disconnect = True
@@ -928,3 +1851,92 @@ class TestCardinalBotFactory:
         self.factory.clientConnectionLost(None, 'Called by unit test')
 
         self.factory._reactor.stop.assert_called_once()
+
+
+class TestNetworkManager:
+    def setup_method(self):
+        self.factories = [self._create_factory(network)
+                          for network in ('irc.one.test', 'IRC.Two.Test')]
+        self.networks = NetworkManager(self.factories)
+        self.networks._reactor = Mock()
+
+    def teardown_method(self, method):
+        # remove signal handler set by the network manager
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    @staticmethod
+    def _create_factory(network):
+        factory = CardinalBotFactory(
+            network=network,
+            server_password=None,
+            server_commands=[],
+            channels=['#channel'],
+            nickname='Cardinal',
+            password=None,
+            username='cardinal',
+            realname='Cardinal',
+            plugins=[],
+            censored_words={},
+            blacklist={},
+            storage='/path/to/storage',
+        )
+        factory._reactor = Mock()
+        factory.cardinal = Mock(spec=CardinalBot)
+
+        return factory
+
+    def test_constructor(self):
+        for factory in self.factories:
+            assert factory.networks is self.networks
+            assert factory.db_locks is self.networks.db_locks
+
+        assert signal.getsignal(signal.SIGINT) == self.networks._sigint
+
+    def test_constructor_duplicate_network(self):
+        with pytest.raises(ValueError):
+            NetworkManager([self._create_factory('irc.one.test'),
+                            self._create_factory('IRC.ONE.TEST')])
+
+    def test_connect(self):
+        for factory in self.factories:
+            factory.connect = Mock(return_value=defer.succeed(None))
+
+        self.networks.connect()
+
+        for factory in self.factories:
+            factory.connect.assert_called_once_with()
+
+    def test_reactor_stops_once_every_network_quits(self):
+        one, two = self.factories
+        one.disconnect = two.disconnect = True
+
+        one.clientConnectionLost(None, 'Called by unit test')
+        assert not self.networks.reactor.stop.called
+        assert not one.reactor.stop.called
+
+        two.clientConnectionLost(None, 'Called by unit test')
+        self.networks.reactor.stop.assert_called_once_with()
+
+    def test_sigint_quits_every_network(self):
+        self.networks._sigint(signal.SIGINT, None)
+
+        for factory in self.factories:
+            assert factory.disconnect is True
+            factory.cardinal.quit.assert_called_once_with('Received SIGINT.')
+
+    def test_quit(self):
+        one, two = self.factories
+        two.cardinal = None
+
+        self.networks.quit('Another instance took over.')
+
+        assert one.disconnect is True
+        one.cardinal.quit.assert_called_once_with(
+            'Another instance took over.')
+
+        # Not connected, so it has quit already
+        assert two.disconnect is True
+        assert not self.networks.reactor.stop.called
+
+        one.clientConnectionLost(None, 'Called by unit test')
+        self.networks.reactor.stop.assert_called_once_with()
@@ -0,0 +1,128 @@
+import json
+import os
+
+import pytest
+from unittest.mock import Mock, patch
+from twisted.internet.task import Clock
+
+from cardinal.election import LeaderElection
+
+from .unittest_util import tempdir
+
+
+class TestLeaderElection:
+    @pytest.fixture(autouse=True)
+    def setup_method_fixture(self):
+        with tempdir('election') as directory:
+            self.path = os.path.join(directory, 'leader', 'irc.test.json')
+            self.clock = Clock()
+            # Wall clock time, as leases are compared between hosts
+            self.clock.advance(1000)
+
+            self.one = self.create_election('one')
+            self.two = self.create_election('two')
+
+            yield
+
+            self.one.stop()
+            self.two.stop()
+
+    def create_election(self, identity):
+        election = LeaderElection(self.path, 15, identity)
+        election._reactor = self.clock
+
+        election.on_elected = Mock()
+        election.on_deposed = Mock()
+        election.elected.addCallback(election.on_elected)
+        election.deposed.addCallback(election.on_deposed)
+
+        return election
+
+    def read_lease(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def test_elected(self):
+        self.one.start()
+
+        assert self.one.leader
+        self.one.on_elected.assert_called_once_with(None)
+        assert self.read_lease() == {'owner': 'one', 'expires': 1015}
+
+        # The lease is renewed
+        self.clock.advance(5)
+        assert self.read_lease() == {'owner': 'one', 'expires': 1020}
+
+    def test_standby_takes_over_expired_lease(self):
+        self.one.start()
+        self.two.start()
+
+        assert not self.two.leader
+        for _ in range(10):
+            self.clock.advance(5)
+        assert not self.two.on_elected.called
+
+        # The leader hangs or dies without releasing the lease
+        self.one._loop.stop()
+        expires = self.read_lease()['expires']
+
+        while not self.two.leader:
+            self.clock.advance(5)
+
+        assert expires <= self.clock.seconds() < expires + 5
+        self.two.on_elected.assert_called_once_with(None)
+        assert self.read_lease()['owner'] == 'two'
+
+    def test_stop_releases_lease(self):
+        self.one.start()
+        self.two.start()
+
+        self.one.stop()
+        assert self.read_lease() == {'owner': 'one', 'expires': 0}
+
+        self.clock.advance(5)
+        assert self.two.leader
+
+    def test_deposed_when_lease_taken(self):
+        self.one.start()
+
+        # Another instance took over while we couldn't renew
+        with open(self.path, 'w') as f:
+            json.dump({'owner': 'two', 'expires': 2000}, f)
+
+        self.clock.advance(5)
+
+        assert not self.one.leader
+        self.one.on_deposed.assert_called_once_with(None)
+        assert self.one._loop is None
+
+    def test_deposed_when_renewal_fails(self):
+        self.one.start()
+
+        with patch('cardinal.election.open', side_effect=OSError("Stale")):
+            # One missed renewal is tolerated
+            self.clock.advance(5)
+            assert self.one.leader
+
+            self.clock.advance(5)
+            assert not self.one.leader
+            self.one.on_deposed.assert_called_once_with(None)
+
+        # The lease wasn't released, as it couldn't be written
+        assert self.read_lease() == {'owner': 'one', 'expires': 1015}
+
+    def test_locked_lease_is_retried(self):
+        self.one.start()
+        self.two.start()
+        self.one._loop.stop()
+
+        # Another instance is updating the lease each time we check
+        with patch('cardinal.election.fcntl.flock',
+                   side_effect=BlockingIOError(11, "Locked")):
+            for _ in range(5):
+                self.clock.advance(5)
+
+        assert not self.two.leader
+
+        self.clock.advance(5)
+        assert self.two.leader
@@ -0,0 +1,249 @@
+import json
+import os
+import signal
+import socket
+from datetime import datetime
+
+import pytest
+from unittest.mock import Mock, patch
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.task import deferLater
+from twisted.protocols import basic
+
+from cardinal.bot import CardinalBotFactory, NetworkManager, server_info
+from cardinal.exceptions import HandoverError
+from cardinal.handover import (HANDOVER_VERSION, Adopter, Handover,
+                               handover_args)
+
+from .unittest_util import tempdir
+
+
+class FakeIRCServer(basic.LineReceiver):
+    delimiter = b'\r\n'
+
+    def connectionMade(self):
+        self.lines = []
+        self.factory.clients.append(self)
+
+    def lineReceived(self, line):
+        line = line.decode('utf-8')
+        self.lines.append(line)
+
+        if line.startswith('USER '):
+            self.send(':irc.test 001 Cardinal :Welcome')
+            self.send(':irc.test 005 Cardinal CHANMODES=b,k,l,imnpst '
+                      'PREFIX=(ov)@+ :are supported by this server')
+        elif line.startswith('JOIN '):
+            self.send(':Cardinal!cardinal@host JOIN #channel')
+            self.send(':irc.test 353 Cardinal = #channel :Cardinal @op')
+            self.send(':irc.test 366 Cardinal #channel :End of /NAMES list.')
+
+    def send(self, line):
+        self.sendLine(line.encode('utf-8'))
+
+
+class HandoverReactor:
+    """The real reactor, but without spawning processes or stopping"""
+
+    def __init__(self):
+        self.spawned = []
+        self.stop = Mock()
+
+    def __getattr__(self, name):
+        return getattr(reactor, name)
+
+    def spawnProcess(self, processProtocol, executable, args, **kwargs):
+        self.spawned.append(args)
+        return Mock()
+
+
+@defer.inlineCallbacks
+def wait_for(condition, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        yield deferLater(reactor, 0.01, lambda: None)
+
+    raise AssertionError("Timed out waiting for condition")
+
+
+class TestHandover:
+    def setup_method(self):
+        self.server_factory = protocol.Factory.forProtocol(FakeIRCServer)
+        self.server_factory.clients = []
+        self.port = reactor.listenTCP(0, self.server_factory,
+                                      interface='127.0.0.1')
+
+        self.reactor = HandoverReactor()
+        self.old = self._create_factory()
+        self.new = self._create_factory()
+
+    @defer.inlineCallbacks
+    def teardown_method(self, method):
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        for factory in (self.old, self.new):
+            factory.disconnect = True
+            if factory.cardinal and factory.cardinal.connected:
+                factory.cardinal.transport.abortConnection()
+
+        yield self.port.stopListening()
+
+    def _create_factory(self):
+        factory = CardinalBotFactory(
+            network='irc.test',
+            server_password=None,
+            server_commands=[],
+            channels=['#channel'],
+            nickname='Cardinal',
+            password=None,
+            username='cardinal',
+            realname='Cardinal',
+            plugins=[],
+            censored_words={},
+            blacklist={},
+            storage='/path/to/storage',
+            servers=[server_info('127.0.0.1', self.port.getHost().port,
+                                 False)],
+        )
+        factory._reactor = self.reactor
+
+        return factory
+
+    @defer.inlineCallbacks
+    def test_hand_over(self):
+        yield self.old.connect()
+        yield wait_for(lambda: self.old.cardinal is not None and
+                       self.old.cardinal.channels is not None and
+                       '#channel' in self.old.cardinal.channels and
+                       'op' in self.old.cardinal.channels['#channel'])
+
+        client = self.server_factory.clients[0]
+        old = self.old.cardinal
+        old.uptime = datetime(2020, 1, 1)
+
+        # Start the "new process" in this one
+        self.reactor.spawnProcess = lambda proto, executable, args, **kw: \
+            self.new.adopt(args[-1]) and Mock()
+
+        yield self.old.hand_over()
+
+        # The old connection is closed, without quitting
+        yield wait_for(lambda: self.reactor.stop.called)
+        assert old.transport.disconnected
+        assert not any(line.startswith('QUIT') for line in client.lines)
+
+        new = self.new.cardinal
+        assert new is not old
+        assert new.nickname == 'Cardinal'
+        assert new.uptime == datetime(2020, 1, 1)
+        assert self.new.booted == self.old.booted
+        assert new.channels['#channel'].is_op('op')
+        assert new.supported.getFeature('PREFIX') == \
+            {'o': ('@', 0), 'v': ('+', 1)}
+
+        # The new process owns the same connection
+        with patch.object(new, 'privmsg') as mock_privmsg:
+            client.send(':nick!user@host PRIVMSG #channel :hello')
+            yield wait_for(lambda: mock_privmsg.called)
+
+        new.msg('#channel', 'still here')
+        yield wait_for(
+            lambda: 'PRIVMSG #channel :still here' in client.lines)
+
+        # Registration wasn't repeated
+        assert [line for line in client.lines
+                if line.startswith('USER ')] == [client.lines[2]]
+
+    @defer.inlineCallbacks
+    def test_hand_over_fails_without_adoption(self):
+        yield self.old.connect()
+        yield wait_for(lambda: self.old.cardinal is not None and
+                       self.old.cardinal.channels is not None)
+
+        handover = Handover(self.old)
+        handover.TIMEOUT = 0.1
+
+        with pytest.raises(HandoverError):
+            yield handover.start(['cardinal.py', 'config.json'])
+
+        # The old process carries on as normal
+        old = self.old.cardinal
+        assert old.connected
+        assert not old.frozen
+        assert not self.reactor.stop.called
+
+        client = self.server_factory.clients[0]
+        old.msg('#channel', 'still here')
+        yield wait_for(
+            lambda: 'PRIVMSG #channel :still here' in client.lines)
+
+    def test_hand_over_tls(self):
+        self.old.cardinal = Mock()
+        self.old.server = server_info('irc.test', 6697, True)
+
+        d = self.old.hand_over()
+
+        failure = self.failure_of(d)
+        assert failure.check(HandoverError)
+        assert not self.reactor.spawned
+
+    def test_hand_over_with_leader_election(self):
+        self.old.cardinal = Mock()
+        self.old.server = server_info('irc.test', 6667, False)
+        NetworkManager([self.old]).election = Mock()
+
+        failure = self.failure_of(self.old.hand_over())
+
+        assert failure.check(HandoverError)
+        assert not self.reactor.spawned
+
+    def test_hand_over_not_connected(self):
+        failure = self.failure_of(self.old.hand_over())
+
+        assert failure.check(HandoverError)
+        assert not self.reactor.spawned
+
+    @staticmethod
+    def failure_of(d):
+        failures = []
+        d.addErrback(failures.append)
+        return failures[0]
+
+
+def test_handover_args():
+    assert handover_args(['cardinal.py', 'config.json']) == \
+        ['cardinal.py', 'config.json']
+    assert handover_args(
+        ['cardinal.py', 'config.json', '--adopt', '/tmp/x.sock']) == \
+        ['cardinal.py', 'config.json']
+
+
+@defer.inlineCallbacks
+def test_adopt_rejects_unknown_version():
+    factory = Mock(spec=CardinalBotFactory)
+    factory.reactor = reactor
+
+    with tempdir('cardinal-handover') as path:
+        path = os.path.join(path, 'handover.sock')
+
+        class OldProcess(basic.Int32StringReceiver):
+            def connectionMade(self):
+                self.sockets = socket.socketpair()
+                self.transport.sendFileDescriptor(self.sockets[0].fileno())
+                self.sendString(json.dumps(
+                    {'version': HANDOVER_VERSION + 1}).encode('utf-8'))
+
+            def connectionLost(self, reason):
+                for sock in self.sockets:
+                    sock.close()
+
+        port = reactor.listenUNIX(
+            path, protocol.Factory.forProtocol(OldProcess))
+        try:
+            with pytest.raises(HandoverError):
+                yield Adopter(factory).start(path)
+        finally:
+            yield port.stopListening()
+
+    assert not factory.adopt_connection.called
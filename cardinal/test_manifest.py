@@ -0,0 +1,181 @@
+import os
+import re
+
+import pytest
+
+from cardinal.manifest import read_manifest
+
+from .unittest_util import tempdir
+
+HEADER = """
+import re
+
+from cardinal.decorators import command, event, help, regex
+
+RELAY_REGEX = r'^<(\\w+)> '
+URL_REGEX = re.compile(r'https?://\\S+', flags=re.IGNORECASE | re.DOTALL)
+"""
+
+
+@pytest.fixture
+def plugin_file():
+    with tempdir('manifest') as directory:
+        path = os.path.join(directory, 'plugin.py')
+
+        def write(source):
+            with open(path, 'w') as f:
+                f.write(HEADER + source)
+            return path
+
+        yield write
+
+
+def test_read_manifest(plugin_file):
+    path = plugin_file("""
+class TestPlugin:
+    def __init__(self, cardinal):
+        import heavy_dependency
+
+    @command(['foo', 'f'])
+    @help("First line")
+    @help(["Second line", "Third line"])
+    def foo(self, cardinal, user, channel, msg):
+        pass
+
+    @regex(RELAY_REGEX + r'(\\.relay)$')
+    def relay(self, cardinal, user, channel, msg):
+        pass
+
+    @regex(URL_REGEX)
+    @event('irc.privmsg')
+    def url(self, cardinal, user, channel, msg):
+        pass
+
+    @event(['irc.join', 'irc.part'])
+    def presence(self, cardinal, *args):
+        pass
+
+    def helper(self):
+        pass
+
+
+entrypoint = TestPlugin
+""")
+
+    assert read_manifest(path) == {
+        'commands': [
+            {
+                'method': 'foo',
+                'commands': ['foo', 'f'],
+                'help': ["First line", "Second line", "Third line"],
+            },
+            {'method': 'relay', 'regex': r'^<(\w+)> (\.relay)$'},
+            {
+                'method': 'url',
+                'regex': re.compile(r'https?://\S+',
+                                    flags=re.IGNORECASE | re.DOTALL),
+            },
+        ],
+        'callbacks': [
+            {'method': 'url', 'event_names': ['irc.privmsg']},
+            {'method': 'presence', 'event_names': ['irc.join', 'irc.part']},
+        ],
+    }
+
+
+def test_read_manifest_old_style_setup(plugin_file):
+    path = plugin_file("""
+class TestPlugin:
+    @command('foo')
+    def foo(self, cardinal, user, channel, msg):
+        pass
+
+
+def setup():
+    return TestPlugin()
+""")
+
+    assert read_manifest(path) == {
+        'commands': [{'method': 'foo', 'commands': ['foo']}],
+        'callbacks': [],
+    }
+
+
+def test_read_manifest_async_factory(plugin_file):
+    path = plugin_file("""
+class TestPlugin:
+    def __init__(self, conn):
+        self.conn = conn
+
+    @command('foo')
+    def foo(self, cardinal, user, channel, msg):
+        pass
+
+
+async def setup(cardinal):
+    conn = await connect()
+    if conn is None:
+        return TestPlugin(None)
+    return TestPlugin(conn)
+
+
+entrypoint = setup
+""")
+
+    assert read_manifest(path) == {
+        'commands': [{'method': 'foo', 'commands': ['foo']}],
+        'callbacks': [],
+    }
+
+
+@pytest.mark.parametrize("source", [
+    # Not a constant
+    """
+class TestPlugin:
+    @command(get_commands())
+    def foo(self, cardinal, user, channel, msg):
+        pass
+
+entrypoint = TestPlugin
+""",
+    # Depends on which assignment a decorator sees
+    """
+TRIGGER = 'foo'
+
+class TestPlugin:
+    @command(TRIGGER)
+    def foo(self, cardinal, user, channel, msg):
+        pass
+
+TRIGGER = 'bar'
+entrypoint = TestPlugin
+""",
+    # Commands may be inherited
+    """
+class TestPlugin(BasePlugin):
+    pass
+
+entrypoint = TestPlugin
+""",
+    # Other plugins may depend on the events it registers
+    """
+class TestPlugin:
+    def __init__(self, cardinal):
+        cardinal.event_manager.register('test.event', 1)
+
+entrypoint = TestPlugin
+""",
+    # Can't tell what the entrypoint creates
+    """
+def setup(cardinal):
+    plugin = TestPlugin()
+    return plugin
+""",
+    "this isn't Python",
+])
+def test_read_manifest_unresolvable(plugin_file, source):
+    assert read_manifest(plugin_file(source)) is None
+
+
+def test_read_manifest_missing_file():
+    assert read_manifest('/path/to/missing/plugin.py') is None
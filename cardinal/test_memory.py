@@ -0,0 +1,171 @@
+import os
+import sys
+import tracemalloc
+from importlib import util
+from types import SimpleNamespace
+
+import pytest
+from twisted.internet import task
+
+from cardinal import metrics
+from cardinal.memory import MemoryMonitor, deep_size, plugin_of_file
+from cardinal.unittest_util import tempdir
+
+
+class Cache:
+    def __init__(self):
+        self.history = {}
+
+
+def test_deep_size():
+    cache = Cache()
+    empty = deep_size(cache)
+    assert empty >= sys.getsizeof(cache) + sys.getsizeof(cache.history)
+
+    cache.history['#channel'] = ['x' * 10000]
+    assert deep_size(cache) >= empty + 10000
+
+    # Excluded objects aren't counted, or followed
+    assert deep_size(cache, exclude=(cache.history,)) < empty
+
+    # Shared objects, such as classes and functions, aren't counted
+    cache.history = {'cls': Cache, 'function': test_deep_size}
+    assert deep_size(cache) < empty + 1000
+
+
+def test_deep_size_counts_each_object_once():
+    history = ['x' * 10000]
+    assert deep_size([history, history]) < 2 * 10000
+
+
+def test_deep_size_limit():
+    history = ['x' * 10000 for _ in range(10)]
+    assert deep_size(history, limit=3) < 3 * 10000 < deep_size(history)
+
+
+def test_plugin_of_file():
+    directory = os.path.join(os.sep, 'cardinal', 'plugins')
+    assert plugin_of_file(os.path.join(directory, 'sed', 'plugin.py'),
+                          [directory]) == 'sed'
+    assert plugin_of_file(os.path.join(directory, 'plugin.py'),
+                          [directory]) is None
+    assert plugin_of_file(os.path.join(os.sep, 'cardinal', 'bot.py'),
+                          [directory]) is None
+
+
+class TestMemoryMonitor:
+    @pytest.fixture
+    def plugins_directory(self):
+        with tempdir('memory_plugins') as directory:
+            os.makedirs(os.path.join(directory, 'leaky'))
+            with open(os.path.join(directory, 'leaky', 'plugin.py'),
+                      'w') as f:
+                f.write("def allocate(size):\n"
+                        "    return [object() for _ in range(size)]\n")
+
+            yield directory
+
+    @pytest.fixture
+    def monitor(self, plugins_directory):
+        spec = util.spec_from_file_location(
+            'memory_plugins.leaky.plugin',
+            os.path.join(plugins_directory, 'leaky', 'plugin.py'))
+        module = util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        cardinal = SimpleNamespace(_who_cache={'#channel': ['nick'] * 100})
+        self.leaky = SimpleNamespace(cardinal=cardinal, history=[])
+        plugin_manager = SimpleNamespace(
+            cardinal=cardinal,
+            plugins={
+                'leaky': {'instance': self.leaky},
+                'lazy': {'instance': None},
+            },
+            plugins_directory=plugins_directory,
+            _module_cache={'leaky': module},
+        )
+        self.factory = SimpleNamespace(network='irc.example.com',
+                                       cardinal=cardinal,
+                                       plugin_manager=plugin_manager)
+        networks = SimpleNamespace(factories=[
+            self.factory,
+            SimpleNamespace(network='irc.example.net', cardinal=None,
+                            plugin_manager=None),
+        ])
+
+        monitor = MemoryMonitor(networks, 60)
+        yield monitor
+        monitor.stop()
+
+    def test_snapshot(self, monitor):
+        snapshot = monitor.snapshot()
+        assert monitor.latest is snapshot
+        assert monitor.previous is None
+        assert monitor.growth() == {}
+
+        # The bot shared by plugins isn't counted
+        assert set(snapshot.plugins) == {('irc.example.com', 'leaky')}
+        assert snapshot.plugins['irc.example.com', 'leaky'] < 1000
+        assert snapshot.caches['irc.example.com', 'who'] > 100 * 8
+        assert ('irc.example.com', 'modules') in snapshot.caches
+        assert snapshot.allocations is None
+
+        assert metrics.PLUGIN_MEMORY.value('irc.example.com', 'leaky') == \
+            snapshot.plugins['irc.example.com', 'leaky']
+        assert metrics.CACHE_MEMORY.value('irc.example.com', 'who') == \
+            snapshot.caches['irc.example.com', 'who']
+
+        self.leaky.history.append('x' * 10000)
+        snapshot = monitor.snapshot()
+        assert monitor.previous is not None
+        assert monitor.growth()['plugins'][
+            'irc.example.com', 'leaky'] >= 10000
+        assert monitor.growth()['allocations'] == {}
+
+    def test_tracing(self, monitor):
+        monitor.start_tracing()
+        assert monitor.tracing
+        assert monitor.snapshot().allocations == {}
+        assert monitor.top_allocations(3) == []
+
+        module = self.factory.plugin_manager._module_cache['leaky']
+        self.leaky.history.append(module.allocate(1000))
+
+        snapshot = monitor.snapshot()
+        assert snapshot.allocations['leaky'] >= 1000 * 16
+        assert metrics.PLUGIN_ALLOCATED.value('leaky') == \
+            snapshot.allocations['leaky']
+        assert monitor.growth()['allocations']['leaky'] >= 1000 * 16
+        assert metrics.PLUGIN_ALLOCATED_GROWTH.value('leaky') >= 1000 * 16
+
+        top = monitor.top_allocations(3)
+        assert top[0][0] == '%s:2' % os.path.join(
+            self.factory.plugin_manager.plugins_directory, 'leaky',
+            'plugin.py')
+        assert top[0][1] >= 1000 * 16
+
+        monitor.stop_tracing()
+        assert not monitor.tracing
+        assert metrics.PLUGIN_ALLOCATED.value('leaky') is None
+
+    def test_object_limit(self, monitor):
+        self.leaky.history.extend('x' * 10000 for _ in range(10))
+        size = monitor.snapshot().plugins['irc.example.com', 'leaky']
+        assert size >= 10 * 10000
+
+        monitor.OBJECT_LIMIT = 3
+        limited = monitor.snapshot().plugins['irc.example.com', 'leaky']
+        assert limited < 3 * 10000
+
+    def test_start(self, monitor):
+        clock = monitor._reactor = task.Clock()
+        monitor.start()
+        assert monitor.latest is None
+
+        clock.advance(60)
+        assert monitor.latest is not None
+
+        monitor.start_tracing()
+        monitor.stop()
+        assert not tracemalloc.is_tracing()
+        assert not clock.getDelayedCalls()
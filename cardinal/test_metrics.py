@@ -0,0 +1,182 @@
+import urllib.request
+from unittest.mock import Mock
+
+import pytest
+from twisted.internet import defer, threads
+from twisted.internet.error import CannotListenError
+from twisted.internet.task import Clock
+
+from cardinal.metrics import (
+    CONTENT_TYPE,
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+    listen,
+    listen_or_retry,
+    merge,
+)
+
+
+def test_counter():
+    counter = Counter('lines_total', "Lines", ['network'])
+    assert counter.value('irc.test') is None
+
+    counter.inc('irc.test')
+    counter.inc('irc.test', amount=2)
+    counter.inc('irc.example')
+
+    assert counter.value('irc.test') == 3
+    assert counter.render() == [
+        '# HELP lines_total Lines',
+        '# TYPE lines_total counter',
+        'lines_total{network="irc.example"} 1',
+        'lines_total{network="irc.test"} 3',
+    ]
+
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_gauge():
+    gauge = Gauge('lag_seconds', "Lag", ['network'])
+    lag = None
+
+    gauge.set(5, 'irc.example')
+    gauge.set_function(lambda: lag, 'irc.test')
+
+    # Unknown values aren't rendered
+    assert gauge.value('irc.test') is None
+    assert gauge.render()[2:] == ['lag_seconds{network="irc.example"} 5']
+
+    lag = 0.25
+    gauge.remove('irc.example')
+    assert gauge.value('irc.test') == 0.25
+    assert gauge.render()[2:] == ['lag_seconds{network="irc.test"} 0.25']
+
+
+def test_histogram():
+    histogram = Histogram('latency_seconds', "Latency", ['plugin'],
+                          buckets=(0.1, 1))
+
+    histogram.observe(0.05, 'ping')
+    histogram.observe(0.1, 'ping')
+    histogram.observe(0.5, 'ping')
+    histogram.observe(2, 'ping')
+
+    assert histogram.value('ping') == (4, 2.65)
+    assert histogram.value('seen') is None
+    assert histogram.render()[2:] == [
+        'latency_seconds_bucket{plugin="ping",le="0.1"} 2',
+        'latency_seconds_bucket{plugin="ping",le="1"} 3',
+        'latency_seconds_bucket{plugin="ping",le="+Inf"} 4',
+        'latency_seconds_sum{plugin="ping"} 2.65',
+        'latency_seconds_count{plugin="ping"} 4',
+    ]
+
+
+def test_render_escapes():
+    counter = Counter('errors_total', 'Errors in "plugins"\n', ['event'])
+    counter.inc('a\\b"c\nd')
+
+    assert counter.render() == [
+        '# HELP errors_total Errors in "plugins"\\n',
+        '# TYPE errors_total counter',
+        'errors_total{event="a\\\\b\\"c\\nd"} 1',
+    ]
+
+
+def test_registry():
+    registry = Registry()
+    counter = registry.counter('b_total', "B")
+    gauge = registry.gauge('a', "A", ['network'])
+
+    # Metrics may be created again, e.g. by a reloaded plugin
+    assert registry.counter('b_total', "B") is counter
+    with pytest.raises(ValueError):
+        registry.gauge('b_total', "B")
+    with pytest.raises(ValueError):
+        registry.gauge('a', "A", ['channel'])
+
+    counter.inc()
+    gauge.set(1, 'irc.test')
+    assert registry.render() == '\n'.join([
+        '# HELP a A',
+        '# TYPE a gauge',
+        'a{network="irc.test"} 1',
+        '# HELP b_total B',
+        '# TYPE b_total counter',
+        'b_total 1',
+    ]) + '\n'
+
+
+def test_merge():
+    one, two = Registry(), Registry()
+    one.counter('lines_total', "Lines", ['network']).inc('irc.one.test')
+    one.histogram('db_seconds', "DB", buckets=[1]).observe(0.5)
+    two.counter('lines_total', "Lines", ['network']).inc('irc.two.test')
+    two.gauge('lag_seconds', "Lag").set(0.25)
+
+    assert merge([('one', one.render()), ('two', two.render())],
+                 'worker') == '\n'.join([
+        '# HELP db_seconds DB',
+        '# TYPE db_seconds histogram',
+        'db_seconds_bucket{worker="one",le="1"} 1',
+        'db_seconds_bucket{worker="one",le="+Inf"} 1',
+        'db_seconds_sum{worker="one"} 0.5',
+        'db_seconds_count{worker="one"} 1',
+        '# HELP lag_seconds Lag',
+        '# TYPE lag_seconds gauge',
+        'lag_seconds{worker="two"} 0.25',
+        '# HELP lines_total Lines',
+        '# TYPE lines_total counter',
+        'lines_total{worker="one",network="irc.one.test"} 1',
+        'lines_total{worker="two",network="irc.two.test"} 1',
+    ]) + '\n'
+
+    # Samples without HELP or TYPE are kept too
+    assert merge([('a"b', 'up 1\n')], 'worker') == 'up{worker="a\\"b"} 1\n'
+    assert merge([], 'worker') == ''
+
+
+@defer.inlineCallbacks
+def test_listen():
+    registry = Registry()
+    registry.counter('lines_total', "Lines").inc()
+
+    def scrape(url):
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status, response.headers['Content-Type'], \
+                response.read().decode('utf-8')
+
+    port = listen(0, registry=registry)
+    try:
+        status, content_type, body = yield threads.deferToThread(
+            scrape, 'http://127.0.0.1:%d/metrics' % port.getHost().port)
+    finally:
+        yield port.stopListening()
+
+    assert status == 200
+    assert content_type == CONTENT_TYPE
+    assert body == registry.render()
+
+
+def test_listen_or_retry():
+    port = Mock()
+    port.getHost.return_value.port = 9100
+    clock = Clock()
+    clock.listenTCP = Mock(side_effect=[
+        CannotListenError('127.0.0.1', 9100, OSError("in use")),
+        port,
+    ])
+    registry = Registry()
+
+    assert listen_or_retry(9100, registry=registry, retry_wait=5,
+                           _reactor=clock) is None
+    assert clock.listenTCP.call_count == 1
+
+    clock.advance(5)
+    assert clock.listenTCP.call_count == 2
+    assert clock.listenTCP.call_args[0][0] == 9100
+    assert clock.listenTCP.call_args[1] == {'interface': '127.0.0.1'}
+    assert not clock.getDelayedCalls()
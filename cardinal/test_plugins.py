@@ -4,9 +4,10 @@ import sys
 
 import pytest
 from twisted.internet import defer
+from twisted.internet.task import Clock
 from unittest.mock import Mock, patch
 
-from cardinal import exceptions
+from cardinal import exceptions, metrics, tracing
 from cardinal.bot import CardinalBot
 from cardinal.plugins import EventManager, PluginManager
 
@@ -331,6 +332,108 @@ def setup():
             finally:
                 sys.path.pop(0)
 
+    def test_reload_keeps_state(self):
+        name = 'state'
+        self.plugin_manager.load(name)
+        instance = self.plugin_manager.plugins[name]['instance']
+        instance.cache['key'] = 'value'
+
+        self.plugin_manager.load(name)
+
+        new_instance = self.plugin_manager.plugins[name]['instance']
+        assert new_instance is not instance
+        assert new_instance.cache == {'key': 'value'}
+
+    def test_reload_drops_incompatible_state(self):
+        name = 'state'
+        self.plugin_manager.load(name)
+        instance = self.plugin_manager.plugins[name]['instance']
+        instance.cache['key'] = 'value'
+        instance.STATE_VERSION = 0
+
+        self.plugin_manager.load(name)
+
+        assert self.plugin_manager.plugins[name]['instance'].cache == {}
+
+    def test_unload_drops_state(self):
+        name = 'state'
+        self.plugin_manager.load(name)
+        self.plugin_manager.plugins[name]['instance'].cache['key'] = 'value'
+
+        self.plugin_manager.unload(name)
+        self.plugin_manager.load(name)
+
+        assert self.plugin_manager.plugins[name]['instance'].cache == {}
+
+    def test_reload_changed(self):
+        plugins = {
+            'one': "VALUE = 1\n",
+            'two': "from reload_plugins.one.plugin import VALUE\n",
+            'three': "",
+        }
+
+        with tempdir('cardinal_fixtures') as fixture_dir:
+            plugins_dir = os.path.join(fixture_dir, 'reload_plugins')
+            os.mkdir(plugins_dir)
+            with open(os.path.join(plugins_dir, '__init__.py'), 'w'):
+                pass
+
+            def write(plugin, source, filename='plugin.py'):
+                with open(os.path.join(plugins_dir, plugin, filename),
+                          'w') as f:
+                    f.write(source + """
+class TestPlugin:
+    pass
+
+
+entrypoint = TestPlugin
+""")
+
+            for plugin, source in plugins.items():
+                os.mkdir(os.path.join(plugins_dir, plugin))
+                write(plugin, '', '__init__.py')
+                write(plugin, source)
+
+            sys.path.insert(0, fixture_dir)
+            try:
+                plugin_manager = PluginManager(
+                    self.cardinal,
+                    list(plugins.keys()),
+                    self.blacklist,
+                    _plugin_module_import_prefix='reload_plugins',
+                    _plugin_module_directory=plugins_dir)
+                instance = plugin_manager.plugins['three']['instance']
+
+                assert plugin_manager.reload() == \
+                    ([], ['one', 'three', 'two'], [])
+
+                # Touching a file doesn't change its contents
+                os.utime(os.path.join(plugins_dir, 'three', 'plugin.py'),
+                         (0, 0))
+                assert plugin_manager.reload() == \
+                    ([], ['one', 'three', 'two'], [])
+
+                # Plugins importing a changed plugin are reloaded with it
+                write('one', "VALUE = 2\n")
+                assert plugin_manager.reload() == \
+                    (['one', 'two'], ['three'], [])
+                assert plugin_manager.plugins['three']['instance'] is \
+                    instance
+
+                with open(os.path.join(plugins_dir, 'three', 'config.json'),
+                          'w') as f:
+                    f.write('{"key": "value"}')
+                assert plugin_manager.reload(['three', 'two']) == \
+                    (['three'], ['two'], [])
+                assert plugin_manager.plugins['three']['config'] == \
+                    {'key': 'value'}
+
+                write('two', "this isn't Python")
+                assert plugin_manager.reload() == \
+                    ([], ['one', 'three'], ['two'])
+            finally:
+                sys.path.pop(0)
+
     @pytest.mark.parametrize("plugins", [
         12345,
         0.0,
@@ -425,6 +528,41 @@ def setup():
 
         assert self.plugin_manager.plugins == {}
 
+    def test_rebind(self):
+        plugin = 'reconnect_hooks'
+        self.assert_load_success(plugin)
+        instance = self.plugin_manager.plugins[plugin]['instance']
+        assert instance.cardinal is self.cardinal
+
+        self.plugin_manager.disconnected()
+        assert instance.disconnected is self.cardinal
+
+        new_cardinal = Mock(spec=CardinalBot)
+        self.plugin_manager.rebind(new_cardinal)
+
+        assert self.plugin_manager.cardinal is new_cardinal
+        assert instance.cardinal is new_cardinal
+        assert instance.reconnected is new_cardinal
+
+        # Plugin is not reloaded
+        assert self.plugin_manager.plugins[plugin]['instance'] is instance
+
+    def test_rebind_hook_raises(self):
+        plugin = 'reconnect_hooks'
+        self.assert_load_success(plugin)
+        instance = self.plugin_manager.plugins[plugin]['instance']
+
+        def on_reconnect(self, cardinal):
+            raise Exception()
+
+        new_cardinal = Mock(spec=CardinalBot)
+        with patch.object(type(instance), 'on_reconnect', on_reconnect):
+            # Errors are logged, but don't prevent rebinding
+            self.plugin_manager.rebind(new_cardinal)
+
+        assert instance.cardinal is new_cardinal
+        assert plugin in self.plugin_manager.plugins
+
     def test_event_callback_registered(self):
         name = 'event_callback'
         event = 'irc.raw'
@@ -609,6 +747,24 @@ def setup():
         assert instance.command1_calls == []
         assert instance.command2_calls == []
 
+    def test_coroutine_command_called(self):
+        calls = []
+        d = defer.Deferred()
+
+        async def command(*args):
+            calls.append(args)
+            calls.append((await d))
+
+        user = ('user', 'ident', 'vhost')
+        result = self.plugin_manager._call_command(
+            command, user, '#channel', '.async')
+        assert calls == [(self.cardinal, user, '#channel', '.async')]
+        assert not result.called
+
+        d.callback('done')
+        assert calls[-1] == 'done'
+        assert result.called
+
     @defer.inlineCallbacks
     def test_command_raises_exception_caught(self):
         name = 'command_raises_exception'
@@ -627,6 +783,42 @@ def setup():
         yield self.plugin_manager.call_command(user, channel, message)
         assert instance.command_calls == expected_calls
 
+    @defer.inlineCallbacks
+    def test_command_metrics(self):
+        name = 'command_raises_exception'
+        self.assert_load_success(name, assert_commands_is_empty=False)
+
+        calls, _ = metrics.COMMAND_SECONDS.value(name, 'command') or (0, 0)
+        errors = metrics.COMMAND_ERRORS.value(name, 'command') or 0
+
+        yield self.plugin_manager.call_command(
+            ('user', 'ident', 'vhost'), '#channel', '.command')
+
+        assert metrics.COMMAND_SECONDS.value(name, 'command')[0] == calls + 1
+        assert metrics.COMMAND_ERRORS.value(name, 'command') == errors + 1
+
+    @defer.inlineCallbacks
+    def test_command_traced(self):
+        name = 'command_raises_exception'
+        self.assert_load_success(name, assert_commands_is_empty=False)
+
+        tracer = Mock(spec=tracing.Tracer)
+        root = tracing.Span(tracer, 'irc.line')
+        with tracing.activate(root):
+            d = self.plugin_manager.call_command(
+                ('user', 'ident', 'vhost'), '#channel', '.command')
+        yield d
+
+        span = tracer.export.call_args.args[0]
+        assert span.name == 'command'
+        assert span.parent_id == root.span_id
+        assert span.attributes == {
+            'plugin': name,
+            'command': 'command',
+            'channel': '#channel',
+        }
+        assert span.error is not None
+
     def test_blacklist_unloaded_plugin(self):
         name = 'commands'
         channel = '#channel'
@@ -750,6 +942,229 @@ def setup():
             yield self.plugin_manager.call_command(user, channel, message)
         assert instance.command1_calls == expected_calls
 
+    def test_load_lazy(self):
+        name = 'commands'
+        self.plugin_manager.lazy = True
+
+        assert self.plugin_manager.load(name) == []
+
+        plugin = self.plugin_manager.plugins[name]
+        assert plugin['lazy'] is True
+        assert plugin['instance'] is None
+        assert name not in self.plugin_manager._module_cache
+
+        commands = sorted(plugin['commands'], key=lambda c: c.__name__)
+        assert [c.__name__ for c in commands] == \
+            ['command1', 'command2', 'regex_command']
+        assert commands[0].commands == ['command1', 'command1_alias']
+        assert commands[2].regex == '^regex'
+
+    def test_load_lazy_without_manifest(self):
+        # Plugins registering their own events are needed by other plugins
+        name = 'registers_event'
+        self.plugin_manager.lazy = True
+
+        self.assert_load_success(name)
+
+        assert self.plugin_manager.plugins[name]['lazy'] is False
+        assert 'test.event' in self.event_manager.registered_events
+
+    @defer.inlineCallbacks
+    def test_lazy_command_loads_plugin(self):
+        name = 'commands'
+        self.plugin_manager.lazy = True
+        self.plugin_manager.load(name)
+
+        user = ('user', 'ident', 'vhost')
+        message = '.command1_alias foobar'
+        yield self.plugin_manager.call_command(user, '#channel', message)
+
+        plugin = self.plugin_manager.plugins[name]
+        assert plugin['lazy'] is False
+        assert plugin['instance'].command1_calls == [
+            (self.cardinal, user, '#channel', message)]
+
+        # The real command is called from now on
+        assert plugin['instance'].command1 in plugin['commands']
+
+    @defer.inlineCallbacks
+    def test_lazy_event_loads_plugin(self):
+        name = 'event_callback'
+        self.event_manager.register('irc.raw', 1)
+        self.plugin_manager.lazy = True
+        self.plugin_manager.load(name)
+
+        assert len(self.event_manager.registered_callbacks['irc.raw']) == 1
+
+        accepted = yield self.event_manager.fire('irc.raw', 'message')
+        assert accepted is True
+
+        instance = self.plugin_manager.plugins[name]['instance']
+        assert instance.messages == ['message']
+
+        # The stub was replaced by the real callback
+        yield self.event_manager.fire('irc.raw', 'message 2')
+        assert instance.messages == ['message', 'message 2']
+        assert len(self.event_manager.registered_callbacks['irc.raw']) == 1
+
+    @defer.inlineCallbacks
+    def test_lazy_plugin_keeps_blacklist(self):
+        name = 'commands'
+        self.plugin_manager.lazy = True
+        self.plugin_manager.load(name)
+
+        self.plugin_manager.blacklist(name, '#blacklisted')
+        yield self.plugin_manager.call_command(
+            ('user', 'ident', 'vhost'), '#channel', '.command2')
+
+        assert self.plugin_manager.plugins[name]['lazy'] is False
+        assert self.plugin_manager.plugins[name]['blacklist'] == \
+            ['#blacklisted']
+
+    def test_unload_lazy_plugin(self):
+        name = 'event_callback'
+        self.plugin_manager.lazy = True
+        self.plugin_manager.load(name)
+
+        assert self.plugin_manager.unload(name) == []
+
+        assert self.plugin_manager.plugins == {}
+        assert self.event_manager.registered_callbacks['irc.raw'] == {}
+
+    def test_warm(self):
+        self.plugin_manager._reactor = clock = Clock()
+        self.plugin_manager.lazy = True
+        self.plugin_manager.load(['commands', 'event_callback'])
+
+        d = self.plugin_manager.warm()
+
+        clock.advance(PluginManager.WARM_INTERVAL)
+        assert not self.plugin_manager.plugins['commands']['lazy']
+        assert self.plugin_manager.plugins['event_callback']['lazy']
+        assert not d.called
+
+        clock.advance(PluginManager.WARM_INTERVAL)
+        assert not self.plugin_manager.plugins['event_callback']['lazy']
+        assert d.called
+
+    def test_load_times(self):
+        self.plugin_manager.load(['commands', 'setup_missing'])
+
+        assert list(self.plugin_manager.load_times['commands'].keys()) == \
+            ['import', 'config', 'setup', 'register']
+        assert all(seconds >= 0 for seconds in
+                   self.plugin_manager.load_times['commands'].values())
+
+        # Steps are recorded until one fails
+        assert list(
+            self.plugin_manager.load_times['setup_missing'].keys()) == \
+            ['import', 'config']
+
+    @staticmethod
+    def async_setups():
+        # Reset each time the module is reloaded
+        return sys.modules['fake_plugins.async_setup.plugin'].setups
+
+    def test_load_async_setup(self):
+        name = 'async_setup'
+        assert self.plugin_manager.load([name, 'valid']) == []
+
+        # Other plugins don't wait for it
+        assert list(self.plugin_manager.plugins.keys()) == ['valid']
+        ready = self.plugin_manager.ready()
+        assert not ready.called
+
+        self.async_setups()[-1].callback(None)
+
+        assert ready.result == []
+        assert self.plugin_manager.plugins[name]['commands'] == [
+            self.plugin_manager.plugins[name]['instance'].async_command]
+
+    def test_load_async_setup_fails(self):
+        name = 'async_setup'
+        self.plugin_manager.load(name)
+        ready = self.plugin_manager.ready()
+
+        self.async_setups()[-1].errback(Exception())
+
+        assert ready.result == [name]
+        assert self.plugin_manager.plugins == {}
+
+    def test_unload_during_async_setup(self):
+        name = 'async_setup'
+        self.plugin_manager.load(name)
+
+        assert self.plugin_manager.unload(name) == []
+        self.async_setups()[-1].callback(None)
+
+        assert self.plugin_manager.plugins == {}
+
+    def test_reload_waits_for_async_close(self):
+        name = 'async_setup'
+        self.plugin_manager.load(name)
+        self.async_setups()[-1].callback(None)
+        instance = self.plugin_manager.plugins[name]['instance']
+
+        assert self.plugin_manager.load(name) == []
+        closed = self.plugin_manager.closed()
+        assert not closed.called
+        assert self.async_setups() == []
+
+        instance.closing.callback(None)
+
+        assert closed.called
+        assert len(self.async_setups()) == 1
+
+        self.async_setups()[-1].callback(None)
+        assert self.plugin_manager.plugins[name]['instance'] is not instance
+
+    @defer.inlineCallbacks
+    def test_get_instance_loads_lazy_plugin(self):
+        self.plugin_manager.lazy = True
+        self.plugin_manager.load('commands')
+        assert self.plugin_manager.plugins['commands']['instance'] is None
+
+        # e.g. another plugin using this one
+        instance = yield self.plugin_manager.get_instance('commands')
+        assert instance is not None
+        assert instance is self.plugin_manager.plugins['commands']['instance']
+        assert self.plugin_manager.plugins['commands']['lazy'] is False
+
+        assert (yield self.plugin_manager.get_instance('commands')) is \
+            instance
+
+        with pytest.raises(exceptions.PluginError):
+            yield self.plugin_manager.get_instance('missing')
+
+    @defer.inlineCallbacks
+    def test_get_instance_waits_for_async_setup(self):
+        self.plugin_manager.lazy = True
+        self.plugin_manager.load('async_setup')
+
+        d = self.plugin_manager.get_instance('async_setup')
+        assert not d.called
+
+        self.async_setups()[-1].callback(None)
+        instance = yield d
+        assert instance is \
+            self.plugin_manager.plugins['async_setup']['instance']
+
+    @defer.inlineCallbacks
+    def test_lazy_command_waits_for_async_setup(self):
+        name = 'async_setup'
+        self.plugin_manager.lazy = True
+        self.plugin_manager.load(name)
+
+        user = ('user', 'ident', 'vhost')
+        d = self.plugin_manager.call_command(user, '#channel', '.async')
+        assert not d.called
+
+        self.async_setups()[-1].callback(None)
+        yield d
+
+        instance = self.plugin_manager.plugins[name]['instance']
+        assert instance.calls == [(self.cardinal, user, '#channel', '.async')]
+
 
 class TestEventManager:
     def setup_method(self):
@@ -990,6 +1405,27 @@ class TestEventManager:
         assert accepted is False
         assert args == [self.cardinal]
 
+    @pytest.mark.parametrize("rejects", [False, True])
+    def test_fire_coroutine_callback(self, rejects):
+        d = defer.Deferred()
+
+        async def callback(cardinal):
+            await d
+            if rejects:
+                raise exceptions.EventRejectedMessage()
+
+        name = 'test_event'
+
+        self.assert_register_success(name)
+        self.assert_register_callback_success(name, callback)
+
+        accepted = []
+        self.event_manager.fire(name).addCallback(accepted.append)
+        assert accepted == []
+
+        d.callback(None)
+        assert accepted == [not rejects]
+
     @defer.inlineCallbacks
     def test_fire_multiple_callbacks(self):
         args = []
@@ -1032,6 +1468,33 @@ class TestEventManager:
 
         assert accepted is False
 
+    @defer.inlineCallbacks
+    def test_fire_metrics(self):
+        def accepts(cardinal):
+            pass
+
+        def rejects(cardinal):
+            raise exceptions.EventRejectedMessage()
+
+        def errors(cardinal):
+            raise Exception()
+
+        name = 'test_metrics_event'
+        self.assert_register_success(name)
+        for callback in (accepts, rejects, errors):
+            callback.__module__ = 'plugins.%s.plugin' % callback.__name__
+            self.assert_register_callback_success(name, callback)
+
+        yield self.event_manager.fire(name)
+        yield self.event_manager.fire(name)
+
+        assert metrics.EVENTS_FIRED.value(name) == 2
+        for plugin in ('accepts', 'rejects', 'errors'):
+            assert metrics.EVENT_SECONDS.value(plugin, name)[0] == 2
+        assert metrics.EVENT_ERRORS.value('accepts', name) is None
+        assert metrics.EVENT_ERRORS.value('rejects', name) is None
+        assert metrics.EVENT_ERRORS.value('errors', name) == 2
+
     @defer.inlineCallbacks
     def test_fire_multiple_callbacks_one_errors(self):
         def generate_cb(error):
@@ -0,0 +1,104 @@
+import threading
+import time
+
+from twisted.internet import defer
+from unittest.mock import Mock
+
+from cardinal.profiler import SamplingProfiler, reactor_threads
+
+from .unittest_util import tempdir
+
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_reactor_threads():
+    thread = Mock(ident=123)
+    thread.name = 'PoolThread-1'
+    reactor = Mock()
+    reactor.threadpool.threads = [thread, Mock(ident=None)]
+
+    assert reactor_threads(reactor) == {
+        threading.get_ident(): 'reactor',
+        123: 'PoolThread-1',
+    }
+
+
+def test_sample():
+    stop, idle = threading.Event(), threading.Event()
+    threads = [threading.Thread(target=busy, args=(stop,)),
+               threading.Thread(target=idle.wait)]
+    for thread in threads:
+        thread.start()
+
+    profiler = SamplingProfiler({threads[0].ident: 'busy',
+                                 threads[1].ident: 'idle',
+                                 -1: 'exited'})
+    try:
+        for _ in range(20):
+            profiler.sample()
+            time.sleep(0.001)
+    finally:
+        stop.set()
+        idle.set()
+        for thread in threads:
+            thread.join()
+
+    assert profiler.samples == 40
+    assert profiler.idle == 20
+    assert sum(profiler.stacks.values()) == 20
+    for stack in profiler.stacks:
+        assert stack.startswith('busy;threading:Thread._bootstrap;')
+        assert 'cardinal.test_profiler:busy' in stack.split(';')
+
+
+def test_top_functions():
+    profiler = SamplingProfiler({})
+    assert profiler.top_functions(5) == []
+
+    profiler.stacks.update({
+        'reactor;a:main;b:handle': 3,
+        'reactor;a:main;c:parse': 1,
+        'PoolThread-1;d:run;b:handle': 2,
+    })
+    profiler.samples = 8
+
+    assert profiler.top_functions(2) == [('b:handle', 0.625),
+                                         ('c:parse', 0.125)]
+
+
+def test_write():
+    profiler = SamplingProfiler({})
+    profiler.stacks.update({'reactor;a:main;b:handle': 3,
+                            'reactor;a:main': 1})
+
+    with tempdir('profiles') as path:
+        profiler.write(path + '/profile.txt')
+        with open(path + '/profile.txt') as f:
+            assert f.read() == 'reactor;a:main 1\n' \
+                               'reactor;a:main;b:handle 3\n'
+
+
+def test_profile_backs_off():
+    # Each sample takes 10ms of the clock, which is far too much
+    clock = Mock(side_effect=[i * 0.01 for i in range(100)])
+    profiler = SamplingProfiler({}, interval=0.001, max_overhead=0.05,
+                                clock=clock)
+
+    profiler.profile(0.1)
+
+    assert profiler.interval > 0.001
+    assert profiler.elapsed >= 0.1
+
+
+@defer.inlineCallbacks
+def test_start_and_stop():
+    profiler = SamplingProfiler({threading.get_ident(): 'reactor'},
+                                interval=0.001)
+    d = profiler.start(60)
+    profiler.stop()
+
+    assert (yield d) is profiler
+    assert profiler.elapsed < 60
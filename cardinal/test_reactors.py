@@ -0,0 +1,71 @@
+import json
+import os
+import select
+
+import pytest
+
+from cardinal.reactors import (
+    available_reactors,
+    install_reactor,
+    installed_reactor,
+    requested_reactor,
+)
+
+from .unittest_util import tempdir
+
+
+@pytest.fixture
+def config_file():
+    with tempdir('reactors') as directory:
+        path = os.path.join(directory, 'config.json')
+
+        def write(config):
+            with open(path, 'w') as f:
+                json.dump(config, f)
+            return path
+
+        yield write
+
+
+def test_requested_reactor(config_file):
+    path = config_file({'reactor': 'asyncio'})
+
+    assert requested_reactor([path]) == 'asyncio'
+    assert requested_reactor([path, '--reactor', 'default']) == 'default'
+    assert requested_reactor(['--reactor=asyncio', path]) == 'asyncio'
+
+
+@pytest.mark.parametrize("config", [{}, {'reactor': 1}, ['not', 'a', 'dict']])
+def test_requested_reactor_default(config_file, config):
+    assert requested_reactor([config_file(config)]) == 'default'
+
+
+def test_requested_reactor_missing_config():
+    assert requested_reactor(['/path/to/missing.json']) == 'default'
+    assert requested_reactor([]) == 'default'
+
+
+def test_install_reactor():
+    # The default reactor is installed by whatever imports it first, and is
+    # epoll where it's available
+    install_reactor('default')
+    assert installed_reactor() == \
+        ('epoll' if hasattr(select, 'epoll') else 'default')
+
+    # Too late to install another
+    with pytest.raises(ValueError):
+        install_reactor('asyncio')
+
+    with pytest.raises(ValueError):
+        install_reactor('unknown')
+
+
+def test_available_reactors():
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr('importlib.util.find_spec', lambda name: None)
+        assert 'uvloop' not in available_reactors()
+
+        with pytest.raises(ValueError, match="isn't available"):
+            install_reactor('uvloop')
+
+    assert {'default', 'asyncio'} <= set(available_reactors())
@@ -0,0 +1,225 @@
+import logging
+import sys
+import urllib.request
+
+import pytest
+from unittest.mock import Mock, patch
+from twisted.internet import defer, error, protocol, reactor, threads
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from cardinal.metrics import Registry, listen
+from cardinal.supervisor import Supervisor, SupervisorMetrics, group_networks
+
+
+def test_group_networks():
+    config = {
+        'network': 'irc.default.test',
+        'networks': [
+            {'network': 'IRC.One.Test'},
+            {'network': 'irc.two.test'},
+            {'nickname': 'Other'},
+        ],
+    }
+
+    assert group_networks(config) == [
+        ['irc.one.test'], ['irc.two.test'], ['irc.default.test']]
+    assert group_networks(config, [['irc.two.test', 'irc.default.test']]) \
+        == [['irc.two.test', 'irc.default.test'], ['irc.one.test']]
+
+
+def test_group_networks_unknown_network():
+    with pytest.raises(ValueError):
+        group_networks({'network': 'irc.one.test'}, [['irc.two.test']])
+
+
+def test_group_networks_default_network():
+    # cardinal.py picks the network when the config doesn't name one
+    assert group_networks({}) == [[]]
+
+
+class TestSupervisor:
+    def setup_method(self):
+        self.supervisor = Supervisor('cardinal.py', 'config.json',
+                                     [['irc.one.test'], ['irc.two.test']])
+        self.supervisor._reactor = self.clock = Clock()
+        self.clock.spawnProcess = Mock()
+        self.clock.stop = Mock()
+
+        self.one, self.two = self.supervisor.workers
+
+    @staticmethod
+    def exited(code=0, signal=None):
+        if signal is not None:
+            return Failure(error.ProcessTerminated(None, signal))
+        if code == 0:
+            return Failure(error.ProcessDone(None))
+        return Failure(error.ProcessTerminated(code))
+
+    def test_workers(self):
+        assert self.one.name == 'irc.one.test'
+        assert self.one.args == ['cardinal.py', 'config.json',
+                                 '--supervised', '--network', 'irc.one.test']
+
+    def test_workers_metrics_ports(self):
+        supervisor = Supervisor('cardinal.py', 'config.json',
+                                [['irc.one.test'], ['irc.two.test']], 9100)
+
+        # The configured port is left for the supervisor
+        assert [worker.metrics_port for worker in supervisor.workers] == \
+            [9101, 9102]
+        assert supervisor.workers[1].args[-2:] == ['--metrics-port', '9102']
+        assert self.one.metrics_port is None
+        assert '--metrics-port' not in self.one.args
+
+    def test_start(self):
+        self.supervisor.start()
+
+        assert self.clock.spawnProcess.call_count == 2
+        args = self.clock.spawnProcess.call_args[0]
+        assert args[1] == sys.executable
+        assert args[2] == [sys.executable, '-u'] + self.two.args
+
+        assert self.one.process is self.clock.spawnProcess.return_value
+        assert self.one.starts == 1
+
+    def test_crashed_worker_restarts_with_backoff(self):
+        self.supervisor.start()
+
+        waits = []
+        for _ in range(4):
+            self.supervisor.worker_ended(self.one, self.exited(1))
+            waits.append(self.one.restart_wait)
+            self.clock.advance(self.one.restart_wait)
+
+        assert waits == [1, 2, 4, 8]
+        assert self.one.starts == 5
+        assert self.one.crashes == 4
+        assert self.one.last_exit == 1
+
+        # Staying up resets the backoff
+        self.clock.advance(Supervisor.STABLE_UPTIME)
+        self.supervisor.worker_ended(self.one, self.exited(signal=9))
+        assert self.one.restart_wait == Supervisor.MINIMUM_RESTART_WAIT
+        assert self.one.last_exit == -9
+
+    def test_clean_exit_is_not_restarted(self):
+        self.supervisor.start()
+
+        self.supervisor.worker_ended(self.one, self.exited())
+        assert self.one.restart_call is None
+        assert not self.clock.stop.called
+
+        # Once every worker has exited, the supervisor stops
+        self.supervisor.worker_ended(self.two, self.exited())
+        self.clock.stop.assert_called_once_with()
+
+    def test_stop(self):
+        self.supervisor.start()
+        self.supervisor.worker_ended(self.one, self.exited(1))
+
+        self.supervisor.stop()
+        assert self.one.restart_call is None
+        self.two.process.signalProcess.assert_called_once_with('INT')
+        assert not self.clock.stop.called
+
+        self.supervisor.worker_ended(self.two, self.exited(1))
+        self.clock.stop.assert_called_once_with()
+        assert self.two.restart_call is None
+
+    def test_stats(self):
+        self.supervisor.start()
+        self.clock.advance(5)
+        self.supervisor.worker_ended(self.two, self.exited(1))
+
+        stats = self.supervisor.stats()
+        assert stats['irc.one.test'] == {
+            'pid': self.one.process.pid,
+            'uptime': 5,
+            'starts': 1,
+            'crashes': 0,
+            'last_exit': None,
+        }
+        assert stats['irc.two.test']['pid'] is None
+        assert stats['irc.two.test']['crashes'] == 1
+
+    def test_log(self, caplog):
+        lines = [
+            b'2024-01-01 00:00:00,000 - cardinal.bot - WARNING - Lag is high',
+            b'Traceback (most recent call last):\r',
+        ]
+
+        with caplog.at_level(logging.DEBUG):
+            for line in lines:
+                self.supervisor.log(self.one, line)
+
+        assert [(r.name, r.levelno, r.getMessage())
+                for r in caplog.records] == [
+            ('cardinal.bot', logging.WARNING, '[irc.one.test] Lag is high'),
+            ('cardinal.bot', logging.WARNING,
+             '[irc.one.test] Traceback (most recent call last):'),
+        ]
+
+
+@defer.inlineCallbacks
+def test_supervisor_runs_worker(caplog):
+    supervisor = Supervisor('cardinal.py', 'config.json', [['irc.one.test']])
+    worker = supervisor.workers[0]
+    worker.args = ['-c', 'import sys; print("worker output"); sys.exit(3)']
+
+    ended = defer.Deferred()
+    with patch.object(supervisor, 'worker_ended',
+                      side_effect=lambda worker, reason:
+                      ended.callback(reason.value)):
+        with caplog.at_level(logging.INFO):
+            supervisor.start()
+            reason = yield ended
+
+    assert reason.exitCode == 3
+    assert '[irc.one.test] worker output' in caplog.messages
+
+
+@defer.inlineCallbacks
+def test_supervisor_collects_worker_metrics():
+    supervisor = Supervisor('cardinal.py', 'config.json',
+                            [['irc.one.test'], ['irc.two.test'],
+                             ['irc.three.test']], 0)
+    one, two, three = supervisor.workers
+
+    registry = Registry()
+    registry.counter('cardinal_lines_received_total', "Lines received",
+                     ['network']).inc('irc.one.test', amount=3)
+    worker_port = listen(0, registry=registry)
+
+    # A free port, as if the worker hadn't started listening yet
+    listening = reactor.listenTCP(
+        0, protocol.Factory.forProtocol(protocol.Protocol),
+        interface='127.0.0.1')
+    free_port = listening.getHost().port
+    yield listening.stopListening()
+
+    one.metrics_port = worker_port.getHost().port
+    two.metrics_port = free_port
+    one.process = two.process = Mock()
+    one.started = two.started = supervisor.reactor.seconds()
+    supervisor.worker_starts.inc('irc.one.test')
+
+    port = listen(0, metrics_resource=SupervisorMetrics(supervisor))
+    try:
+        body = yield threads.deferToThread(
+            lambda: urllib.request.urlopen(
+                'http://127.0.0.1:%d/metrics' % port.getHost().port,
+                timeout=10).read().decode('utf-8'))
+    finally:
+        yield port.stopListening()
+        yield worker_port.stopListening()
+
+    lines = body.splitlines()
+    assert 'cardinal_lines_received_total{worker="irc.one.test",' \
+        'network="irc.one.test"} 3' in lines
+    assert 'cardinal_worker_up{worker="irc.one.test"} 1' in lines
+    assert 'cardinal_worker_up{worker="irc.three.test"} 0' in lines
+    assert 'cardinal_worker_starts_total{worker="irc.one.test"} 1' in lines
+    assert 'cardinal_worker_scrape_errors_total{worker="irc.two.test"} 1' \
+        in lines
+    assert supervisor.scrape_errors.value('irc.one.test') is None
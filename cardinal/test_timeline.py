@@ -0,0 +1,94 @@
+import time
+
+import pytest
+from twisted.internet.task import Clock
+
+from cardinal.timeline import (
+    Timeline,
+    plugin_report,
+    process_started,
+    timeline_entry,
+)
+
+
+class TestTimeline:
+    def setup_method(self):
+        self.clock = Clock()
+        self.clock.advance(100)
+        self.timeline = Timeline(clock=self.clock.seconds)
+
+    def test_entries(self):
+        self.clock.advance(1)
+        self.timeline.mark('imported')
+
+        with self.timeline.measure('config'):
+            self.clock.advance(0.5)
+
+        self.timeline.begin('connect')
+        self.clock.advance(2)
+        self.timeline.end('connect')
+
+        # Steps which were never started are ignored
+        self.timeline.end('register')
+
+        assert self.timeline.entries == [
+            timeline_entry('imported', 1, None),
+            timeline_entry('config', 1, 0.5),
+            timeline_entry('connect', 1.5, 2),
+        ]
+        assert self.timeline.report() == [
+            "   1.000s            imported",
+            "   1.000s   +0.500s  config",
+            "   1.500s   +2.000s  connect",
+        ]
+
+    def test_parent(self):
+        self.timeline.mark('imported')
+        network = Timeline(self.timeline, clock=self.clock.seconds)
+
+        self.clock.advance(1)
+        network.mark('signed on')
+        self.timeline.mark('another network signed on')
+
+        assert [entry.name for entry in network.entries] == \
+            ['imported', 'signed on', 'another network signed on']
+        assert self.timeline.entries[-1].start == 1
+
+    def test_finish(self):
+        self.timeline.begin('join #channel')
+        assert self.timeline.pending == ['join #channel']
+
+        self.clock.advance(3)
+        assert self.timeline.finish() == 3
+        assert self.timeline.duration == 3
+        assert self.timeline.pending == []
+
+        # Reconnecting doesn't add to the timeline
+        self.timeline.begin('connect')
+        self.timeline.end('connect')
+        self.timeline.mark('signed on')
+        assert self.timeline.entries == []
+
+
+def test_process_started():
+    started = process_started()
+
+    # Not available on every platform
+    if started is not None:
+        assert started <= time.monotonic()
+        assert Timeline().started == pytest.approx(started, abs=0.1)
+
+
+def test_plugin_report():
+    load_times = {
+        'fast': {'import': 0.001, 'setup': 0.001},
+        'slow': {'import': 0.5, 'config': 0.01, 'setup': 1.0},
+    }
+
+    assert plugin_report(load_times) == [
+        "slow 1.510s (import 0.500s, config 0.010s, setup 1.000s)",
+        "fast 0.002s (import 0.001s, setup 0.001s)",
+    ]
+    assert plugin_report(load_times, 1) == [
+        "slow 1.510s (import 0.500s, config 0.010s, setup 1.000s)",
+    ]
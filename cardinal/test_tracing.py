@@ -0,0 +1,145 @@
+import json
+import os
+
+import pytest
+from twisted.internet import defer, reactor
+from twisted.internet.threads import deferToThread
+from unittest.mock import Mock
+
+from cardinal import tracing
+from cardinal.bot import CardinalBot
+from cardinal.exceptions import EventRejectedMessage
+from cardinal.plugins import EventManager
+
+from .unittest_util import tempdir
+
+
+def read_spans(path):
+    with open(path) as f:
+        return {span['name']: span for span in map(json.loads, f)}
+
+
+class TestTracer:
+    @pytest.fixture(autouse=True)
+    def path(self):
+        with tempdir('traces') as path:
+            self.path = os.path.join(path, 'traces.jsonl')
+            yield
+
+    def test_sampling(self):
+        tracer = tracing.Tracer(self.path, 0.25, random=Mock(return_value=0.5))
+        assert tracer.trace('irc.line') is None
+
+        tracer.random.return_value = 0.1
+        assert tracer.trace('irc.line') is not None
+
+    def test_export(self):
+        tracer = tracing.Tracer(self.path, 1)
+        root = tracer.trace('irc.line', command='PRIVMSG')
+        child = root.child('command', plugin='weather')
+
+        child.finish(ValueError('no location'))
+        child.finish()
+        root.finish()
+        tracer.close()
+
+        spans = read_spans(self.path)
+        assert list(spans) == ['command', 'irc.line']
+        assert spans['irc.line']['parent_id'] is None
+        assert spans['irc.line']['attributes'] == {'command': 'PRIVMSG'}
+        assert 'error' not in spans['irc.line']
+        assert spans['command']['trace_id'] == root.trace_id
+        assert spans['command']['parent_id'] == root.span_id
+        assert spans['command']['error'] == "ValueError('no location')"
+        assert spans['command']['duration'] >= 0
+
+    def test_start_span(self):
+        tracer = tracing.Tracer(self.path, 1)
+        assert tracing.start_span('command') is None
+
+        root = tracer.trace('irc.line')
+        with tracing.activate(root):
+            span = tracing.start_span('command')
+            with tracing.activate(None):
+                assert tracing.current_span.get() is root
+
+        assert tracing.current_span.get() is None
+        assert span.parent_id == root.span_id
+
+    def test_finish_when_fired(self):
+        tracer = tracing.Tracer(self.path, 1)
+        root = tracer.trace('irc.line')
+
+        d = defer.Deferred()
+        assert tracing.finish_when_fired(d, None) is d
+
+        rejected = root.child('rejected')
+        tracing.finish_when_fired(
+            defer.fail(EventRejectedMessage()), rejected).addErrback(
+                lambda failure: None)
+        failed = root.child('failed')
+        tracing.finish_when_fired(
+            defer.fail(Exception('oops')), failed).addErrback(
+                lambda failure: None)
+
+        tracer.close()
+        spans = read_spans(self.path)
+        assert spans['rejected']['attributes'] == {'rejected': True}
+        assert 'error' not in spans['rejected']
+        assert spans['failed']['error'] == 'oops'
+
+    @defer.inlineCallbacks
+    def test_propagates_through_event_callbacks(self):
+        tracer = tracing.Tracer(self.path, 1)
+        tracer.trace_threadpool(reactor.getThreadPool())
+        tracing.install(tracer)
+
+        def fetch(url):
+            tracing.start_span('parse').finish()
+            return 'sunny'
+
+        @defer.inlineCallbacks
+        def callback(cardinal):
+            forecast = yield deferToThread(fetch, 'https://weather.test')
+            tracing.start_span('reply', forecast=forecast).finish()
+        callback.__module__ = 'plugins.weather.plugin'
+
+        event_manager = EventManager(Mock(spec=CardinalBot))
+        event_manager.register('irc.test', 0)
+        event_manager.register_callback('irc.test', callback)
+
+        try:
+            root = tracing.trace('irc.line')
+            with tracing.activate(root):
+                d = event_manager.fire('irc.test')
+            root.finish()
+            yield d
+        finally:
+            tracing.install(None)
+            tracer.close()
+
+        spans = read_spans(self.path)
+        assert spans['event']['parent_id'] == root.span_id
+        assert spans['event']['attributes'] == {
+            'event': 'irc.test',
+            'plugin': 'weather',
+        }
+
+        thread = spans['thread']
+        assert thread['parent_id'] == spans['event']['span_id']
+        assert thread['attributes']['function'] == \
+            'cardinal.test_tracing.TestTracer.' \
+            'test_propagates_through_event_callbacks.<locals>.fetch'
+        assert thread['attributes']['url'] == 'https://weather.test'
+        assert 0 <= thread['attributes']['queued'] <= thread['duration']
+        assert spans['parse']['parent_id'] == thread['span_id']
+
+        assert spans['reply']['parent_id'] == spans['event']['span_id']
+        assert spans['reply']['attributes'] == {'forecast': 'sunny'}
+
+        assert {span['trace_id'] for span in spans.values()} == \
+            {root.trace_id}
+
+        # The thread pool isn't traced once the tracer is closed
+        assert 'callInThreadWithCallback' not in \
+            vars(reactor.getThreadPool())
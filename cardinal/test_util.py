@@ -1,4 +1,6 @@
+import asyncio
 import datetime
+from unittest.mock import Mock, patch
 
 import pytest
 from twisted.internet import defer
@@ -94,3 +96,47 @@ class TestFormatting:
 
         # foreground color numbers must be zero-padded to a width of 2
         assert f(text) == '{}{}{}'.format(hex_code, text, hex_code)
+
+
+@defer.inlineCallbacks
+def test_run_coroutine():
+    d = defer.Deferred()
+
+    async def coro():
+        return await d
+
+    result = util.run_coroutine(coro())
+    assert not result.called
+
+    d.callback('done')
+    assert (yield result) == 'done'
+
+
+def test_run_coroutine_asyncio():
+    loop = asyncio.new_event_loop()
+
+    async def coro():
+        await asyncio.sleep(0)
+
+        d = defer.Deferred()
+        loop.call_soon(d.callback, 'deferred')
+        result = await d
+
+        failing = defer.Deferred()
+        loop.call_soon(failing.errback, ValueError(result))
+        try:
+            await failing
+        except ValueError as e:
+            return str(e)
+
+    with patch.object(util, 'reactor', Mock(_asyncioEventloop=loop)):
+        d = util.run_coroutine(coro())
+
+    results = []
+    d.addCallback(results.append)
+    try:
+        loop.run_until_complete(asyncio.sleep(0.01))
+    finally:
+        loop.close()
+
+    assert results == ['deferred']
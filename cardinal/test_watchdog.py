@@ -0,0 +1,126 @@
+import threading
+import time
+
+from twisted.internet import defer, reactor, task
+from unittest.mock import Mock
+
+from cardinal.bot import CardinalBot
+from cardinal.plugins import EventManager
+from cardinal.watchdog import (
+    UNATTRIBUTED,
+    Watchdog,
+    activity,
+    describe,
+    plugin_of,
+    running,
+)
+
+
+def slow_command(cardinal, user, channel, message):
+    pass
+
+
+slow_command.__module__ = 'plugins.slow.plugin'
+
+
+def test_plugin_of():
+    assert plugin_of(slow_command) == 'slow'
+    assert plugin_of(test_plugin_of) is None
+    assert plugin_of(object()) is None
+
+
+def test_describe():
+    assert describe(activity('slow', 'command', 'shorten')) == \
+        'slow (command shorten)'
+    assert describe(activity('slow', None, None)) == 'slow'
+    assert describe(UNATTRIBUTED) == 'unknown'
+
+
+class TestWatchdog:
+    def setup_method(self):
+        self.clock = Mock(return_value=0)
+        self.watchdog = Watchdog(0.5, clock=self.clock)
+
+        # Watch this thread, as if the watchdog had been started
+        self.watchdog._thread_id = threading.get_ident()
+        self.watchdog._last_beat = 0
+
+    def test_attributes_stall_to_running_command(self):
+        self.clock.return_value = 0.5
+        assert self.watchdog.check() is False
+
+        self.clock.return_value = 1
+        with running(slow_command, 'command', 'shorten'):
+            assert self.watchdog.check() is True
+            # Only captured once
+            assert self.watchdog.check() is False
+
+        assert self.watchdog.stalls == {}
+
+        self.clock.return_value = 2
+        self.watchdog.beat()
+
+        expected = activity('slow', 'command', 'shorten')
+        assert self.watchdog.stalls == {expected: 1}
+        assert self.watchdog.longest == {expected: 1.95}
+        assert self.watchdog.lag == 1.95
+
+        stall = self.watchdog.last_stall
+        assert stall.activity == expected
+        assert 'test_attributes_stall_to_running_command' in \
+            ''.join(stall.stack)
+
+    def test_attributes_stall_to_plugin_on_stack(self):
+        # e.g. a Deferred callback added by a plugin
+        scope = {'__name__': 'plugins.seen.plugin', 'watchdog': self.watchdog}
+        exec('def callback():\n    return watchdog.check()', scope)
+
+        self.clock.return_value = 1
+        assert scope['callback']() is True
+        self.watchdog.beat()
+
+        assert self.watchdog.stalls == {activity('seen', None, None): 1}
+
+    def test_unattributed_stall(self):
+        self.clock.return_value = 1
+        self.watchdog.check()
+        self.watchdog.beat()
+
+        assert self.watchdog.stalls == {UNATTRIBUTED: 1}
+        assert self.watchdog.total_stalls == 1
+
+    def test_stale_stall_ignored(self):
+        self.clock.return_value = 1
+        self.watchdog.check()
+
+        # A stall captured for an earlier heartbeat
+        self.watchdog._last_beat = 0.1
+        self.watchdog.beat()
+
+        assert self.watchdog.stalls == {}
+        assert self.watchdog.total_stalls == 0
+
+    @defer.inlineCallbacks
+    def test_detects_blocking_event_callback(self):
+        cardinal = Mock(spec=CardinalBot)
+        event_manager = EventManager(cardinal)
+        event_manager.register('irc.test', 0)
+
+        def callback(cardinal):
+            time.sleep(0.3)
+        callback.__module__ = 'plugins.slow.plugin'
+        event_manager.register_callback('irc.test', callback)
+
+        watchdog = Watchdog(0.1)
+        watchdog.start()
+        try:
+            yield task.deferLater(reactor, watchdog.INTERVAL, lambda: None)
+            yield event_manager.fire('irc.test')
+            yield task.deferLater(reactor, watchdog.INTERVAL * 2,
+                                  lambda: None)
+        finally:
+            watchdog.stop()
+
+        assert watchdog.stalls == {activity('slow', 'event', 'irc.test'): 1}
+        assert watchdog.longest[activity('slow', 'event', 'irc.test')] >= 0.2
+        assert 'time.sleep(0.3)' in ''.join(watchdog.last_stall.stack)
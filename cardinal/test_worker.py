@@ -0,0 +1,317 @@
+import json
+import os
+import re
+from datetime import datetime
+
+import pytest
+from twisted.internet import defer, reactor, task
+from twisted.protocols import amp
+from twisted.words.protocols import irc
+from unittest.mock import MagicMock, Mock, call, patch
+
+from cardinal.bot import (
+    NETSPLIT,
+    CardinalBot,
+    CardinalBotFactory,
+    batch_info,
+    user_info,
+)
+from cardinal.plugins import EventManager, PluginManager
+from cardinal.worker import (
+    Call,
+    WorkerPlugin,
+    decode,
+    encode,
+    plugin_manifest,
+    unavailable_attributes,
+)
+
+from .unittest_util import get_mock_db, tempdir
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+FIXTURE_PATH = os.path.join(DIR_PATH, 'fixtures', 'fake_plugins')
+
+
+def test_encode():
+    args = (user_info('nick', 'user', 'host'), '#channel', {'n': [1, 2]})
+
+    assert decode(encode(args)) == list(args)
+    assert isinstance(decode(encode(args))[0], user_info)
+
+
+def test_big_unicode():
+    proto = amp.AMP()
+    args = encode(['#channel', 'x' * 100000])
+
+    box = Call.makeArguments(
+        {'method': 'quit_batch', 'state': '{}', 'args': args}, proto)
+    boxes = amp.parseString(box.serialize())
+
+    assert len(boxes) == 1
+    assert sorted(boxes[0]) == [b'args', b'args.1', b'method', b'state']
+    assert Call.parseArguments(boxes[0], proto) == \
+        {'method': 'quit_batch', 'state': '{}', 'args': args}
+
+
+def test_plugin_manifest():
+    from cardinal.fixtures.fake_plugins.isolated.plugin import \
+        TestIsolatedPlugin
+
+    cardinal = Mock(spec=CardinalBot)
+    cardinal.get_db, _ = get_mock_db()
+
+    manifest = plugin_manifest(TestIsolatedPlugin(cardinal, None))
+
+    assert manifest == json.loads(json.dumps(manifest))
+    assert manifest == {
+        'commands': [
+            {'method': 'count', 'regex': {
+                'pattern': r'^count (\w+)$',
+                'flags': re.compile('').flags,
+            }},
+            {'method': 'crash', 'commands': ['crash']},
+            {'method': 'pid', 'commands': ['pid'],
+             'help': ["Replies with the worker's process ID"]},
+            {'method': 'state', 'commands': ['state']},
+        ],
+        'callbacks': [{'method': 'joined', 'event_names': ['irc.join']}],
+    }
+
+
+def test_unavailable_attributes():
+    from cardinal.fixtures.fake_plugins.isolated import plugin as isolated
+    from cardinal.fixtures.fake_plugins.isolated_channels import \
+        plugin as isolated_channels
+
+    assert unavailable_attributes(isolated) == []
+    assert unavailable_attributes(isolated_channels) == ['channels']
+
+
+@defer.inlineCallbacks
+def wait_for(condition, timeout=10):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return
+        yield task.deferLater(reactor, 0.05, lambda: None)
+
+    raise AssertionError("Timed out waiting for worker")
+
+
+class TestWorkerPlugin:
+    @pytest.fixture(autouse=True)
+    def storage(self):
+        with tempdir('worker_storage') as storage:
+            os.mkdir(os.path.join(storage, 'database'))
+            self.storage = storage
+            yield
+
+    def setup_method(self):
+        self.user = user_info('nick', 'user', 'host')
+
+        self.cardinal = Mock(spec=CardinalBot)
+        self.cardinal.nickname = 'Cardinal'
+        self.cardinal.network = 'irc.test'
+        self.cardinal.current_batch = None
+        self.cardinal.supported = irc.ServerSupportedFeatures()
+        self.cardinal.event_manager = EventManager(self.cardinal)
+        self.cardinal.event_manager.register('irc.join', 2)
+
+    def load(self, plugins, isolated=None):
+        self.cardinal.storage_path = self.storage
+        self.plugin_manager = PluginManager(
+            self.cardinal,
+            plugins,
+            {},
+            isolated=plugins if isolated is None else isolated,
+            _plugin_module_import_prefix='cardinal.fixtures.fake_plugins',
+            _plugin_module_directory=FIXTURE_PATH,
+        )
+
+        return self.plugin_manager.ready()
+
+    @defer.inlineCallbacks
+    def unload(self):
+        self.plugin_manager.unload_all()
+        yield self.plugin_manager.closed()
+
+    @defer.inlineCallbacks
+    def test_commands_and_events(self):
+        failed = yield self.load(['isolated'])
+        assert failed == []
+
+        worker = self.plugin_manager.plugins['isolated']['instance']
+        assert isinstance(worker, WorkerPlugin)
+
+        try:
+            yield self.plugin_manager.call_command(
+                self.user, '#channel', '.pid')
+            yield self.plugin_manager.call_command(
+                self.user, '#channel', 'count foo')
+            yield self.plugin_manager.call_command(
+                self.user, '#channel', 'count foo')
+
+            accepted = yield self.cardinal.event_manager.fire(
+                'irc.join', self.user, '#channel')
+            assert accepted is True
+            rejected = yield self.cardinal.event_manager.fire(
+                'irc.join', self.user, '#ignored')
+            assert rejected is False
+        finally:
+            yield self.unload()
+
+        # Ran in another process, and used the same storage
+        pid = int(self.cardinal.sendMsg.mock_calls[0].args[1].split()[-1])
+        assert pid != os.getpid()
+
+        assert self.cardinal.sendMsg.mock_calls == [
+            call('#channel', 'hello nick %d' % pid),
+            call('#channel', '1'),
+            call('#channel', '2'),
+            call('#channel', 'welcome nick'),
+            call('#chan', 'bye'),
+        ]
+        with open(os.path.join(self.storage, 'database',
+                               'isolated-irc.test.json')) as f:
+            assert json.load(f) == {'nick': 2}
+
+        assert worker.process is None
+        assert worker.crashes == 0
+
+    @defer.inlineCallbacks
+    def test_cardinal_state(self):
+        self.cardinal.supported.parse(['NETWORK=Test'])
+        self.cardinal.who.side_effect = \
+            lambda channels: defer.succeed([self.user])
+
+        failed = yield self.load(['config_valid_json', 'isolated'],
+                                 isolated=['isolated'])
+        assert failed == []
+
+        try:
+            yield self.plugin_manager.call_command(
+                self.user, '#channel', '.state')
+
+            self.cardinal.current_batch = batch_info(
+                None, NETSPLIT, ['a.example.com', 'b.example.com'],
+                [(self.user, 'a.example.com b.example.com')])
+            yield self.plugin_manager.call_command(
+                self.user, '#channel', '.state')
+        finally:
+            yield self.unload()
+
+        self.cardinal.who.assert_called_with('#channel')
+        assert self.cardinal.sendMsg.mock_calls[:2] == [
+            call('#channel', 'none True Test nick'),
+            call('#channel', 'netsplit True Test nick'),
+        ]
+
+    @defer.inlineCallbacks
+    def test_signed_on_loads_isolated_plugins(self):
+        cardinal = CardinalBot()
+        cardinal.factory = factory = Mock(spec=CardinalBotFactory)
+        factory.network = 'irc.test'
+        factory.storage_path = self.storage
+        factory.plugins = factory.isolated_plugins = ['ping']
+        factory.blacklist = {}
+        factory.lazy_plugins = False
+        factory.plugin_manager = None
+        factory.server_commands = []
+        factory.password = None
+        factory.channels = []
+        factory.booted = datetime(2020, 1, 1)
+        factory.timeline = MagicMock()
+        cardinal.nickname = 'Cardinal'
+        cardinal.supported = irc.ServerSupportedFeatures()
+
+        with patch.object(CardinalBot, 'send'), \
+                patch.object(CardinalBot, 'sendMsg') as mock_send_msg:
+            cardinal.signedOn()
+            self.plugin_manager = cardinal.plugin_manager
+
+            try:
+                failed = yield self.plugin_manager.ready()
+                assert failed == []
+                assert isinstance(self.plugin_manager.plugins['ping']
+                                  ['instance'], WorkerPlugin)
+
+                yield self.plugin_manager.call_command(
+                    self.user, '#channel', 'ping')
+            finally:
+                yield self.unload()
+
+        mock_send_msg.assert_called_once_with('#channel', 'nick: Pong.')
+
+    @defer.inlineCallbacks
+    def test_kills_worker_if_setup_fails(self):
+        processes = []
+
+        def spawn_process(*args, **kwargs):
+            processes.append(reactor.spawnProcess(*args, **kwargs))
+            return processes[-1]
+
+        with patch.object(WorkerPlugin, 'reactor', Mock(
+                spawnProcess=spawn_process, seconds=reactor.seconds)), \
+                patch.object(WorkerPlugin, '_state',
+                             side_effect=AttributeError('uptime')):
+            yield self.load(['isolated'])
+
+        assert 'isolated' not in self.plugin_manager.plugins
+        assert len(processes) == 1
+        yield wait_for(lambda: processes[0].pid is None)
+
+        yield self.unload()
+
+    @defer.inlineCallbacks
+    def test_rejects_unavailable_attributes(self):
+        failed = yield self.load(['isolated', 'isolated_channels'])
+
+        assert failed == ['isolated_channels']
+        assert list(self.plugin_manager.plugins.keys()) == ['isolated']
+
+        yield self.unload()
+
+    @defer.inlineCallbacks
+    def test_large_arguments(self):
+        yield self.load(['isolated'])
+
+        # Longer than an AMP value, in both directions
+        channel = '#' + 'x' * 100000
+        try:
+            accepted = yield self.cardinal.event_manager.fire(
+                'irc.join', self.user, channel)
+        finally:
+            yield self.unload()
+
+        assert accepted is True
+        assert self.cardinal.sendMsg.mock_calls[0] == \
+            call(channel, 'welcome nick')
+
+    @defer.inlineCallbacks
+    def test_restarts_after_crash(self):
+        yield self.load(['isolated'])
+        worker = self.plugin_manager.plugins['isolated']['instance']
+
+        with patch.object(WorkerPlugin, 'MINIMUM_RESTART_WAIT', 0):
+            try:
+                yield self.plugin_manager.call_command(
+                    self.user, '#channel', '.crash')
+                yield wait_for(lambda: worker.protocol is not None and
+                               worker.starts == 2)
+
+                yield self.plugin_manager.call_command(
+                    self.user, '#channel', '.pid')
+            finally:
+                yield self.unload()
+
+        assert worker.crashes == 1
+        assert self.cardinal.sendMsg.mock_calls[0].args[1] \
+            .startswith('hello nick ')
+
+    @defer.inlineCallbacks
+    def test_setup_fails(self):
+        failed = yield self.load(['isolated', 'setup_missing'])
+
+        assert failed == ['setup_missing']
+        assert list(self.plugin_manager.plugins.keys()) == ['isolated']
+
+        yield self.unload()
@@ -0,0 +1,167 @@
+import os
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+timeline_entry = namedtuple('timeline_entry', ['name', 'start', 'duration'])
+
+
+def process_started():
+    """Returns the time.monotonic() value at which this process started.
+
+    Returns:
+      float -- Time the process started, or None if it can't be determined
+        (e.g. when /proc isn't available.)
+    """
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            stat = f.read()
+        ticks = os.sysconf('SC_CLK_TCK')
+        uptime = time.clock_gettime(time.CLOCK_BOOTTIME)
+    except (AttributeError, OSError, ValueError):
+        return None
+
+    # The start time is in clock ticks since boot. The process name may
+    # contain spaces, so the fields are counted from the end of it.
+    try:
+        starttime = int(stat[stat.rindex(')') + 2:].split()[19])
+    except (IndexError, ValueError):
+        return None
+
+    return time.monotonic() - (uptime - starttime / ticks)
+
+
+class Timeline:
+    """Records when each step of starting up happened, and how long it took.
+
+    Times are relative to when the process started if that can be determined,
+    so that the time spent importing modules is included.
+    """
+
+    def __init__(self, parent=None, clock=time.monotonic):
+        """Constructor for Timeline
+
+        Keyword arguments:
+          parent -- A timeline whose entries come before this one's, e.g. the
+            process's timeline for a network's.
+          clock -- Returns the current time. Must match the parent's.
+        """
+        self.parent = parent
+        self.clock = clock
+
+        if parent is not None:
+            self.started = parent.started
+        else:
+            started = process_started() if clock is time.monotonic else None
+            self.started = started if started is not None else clock()
+
+        # Time in seconds it took to start up, once finished
+        self.finished = False
+        self.duration = None
+
+        self._entries = []
+        self._open = {}
+
+    def elapsed(self):
+        """Returns the time in seconds since starting"""
+        return self.clock() - self.started
+
+    def mark(self, name):
+        """Records that something happened now"""
+        if not self.finished:
+            self._entries.append(timeline_entry(name, self.elapsed(), None))
+
+    def record(self, name, start, end=None):
+        """Records a step that took place between two times.
+
+        Keyword arguments:
+          name -- Name of the step.
+          start -- Time the step started, from the timeline's clock.
+          end -- Time the step ended. Defaults to now.
+        """
+        if end is None:
+            end = self.clock()
+
+        if not self.finished:
+            self._entries.append(
+                timeline_entry(name, start - self.started, end - start))
+
+    def begin(self, name):
+        """Starts a step that is finished by calling end() with its name"""
+        if not self.finished:
+            self._open[name] = self.clock()
+
+    def end(self, name):
+        """Finishes a step started with begin(), if there is one"""
+        start = self._open.pop(name, None)
+        if start is not None:
+            self.record(name, start)
+
+    @property
+    def pending(self):
+        """Names of steps started with begin() which haven't ended"""
+        return sorted(self._open)
+
+    @contextmanager
+    def measure(self, name):
+        """Records how long the body of a with statement takes"""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def finish(self):
+        """Stops recording, e.g. once we're up and running.
+
+        Returns:
+          float -- Time in seconds it took to start up.
+        """
+        self._open = {}
+        self.finished = True
+        self.duration = self.elapsed()
+
+        return self.duration
+
+    @property
+    def entries(self):
+        """List of timeline_entry tuples, including the parent's, by start"""
+        entries = list(self._entries)
+        if self.parent is not None:
+            entries += self.parent.entries
+
+        return sorted(entries, key=lambda entry: entry.start)
+
+    def report(self):
+        """Formats the timeline.
+
+        Returns:
+          list -- A line for each entry, giving when it started and how long
+            it took.
+        """
+        return ["%8.3fs %9s  %s" % (
+            entry.start,
+            "+%.3fs" % entry.duration if entry.duration is not None else "",
+            entry.name,
+        ) for entry in self.entries]
+
+
+def plugin_report(load_times, limit=None):
+    """Formats how long plugins took to load, slowest first.
+
+    Keyword arguments:
+      load_times -- Maps plugin names to a dict of the time in seconds each
+        step of loading took, as kept by PluginManager.
+      limit -- Maximum number of plugins to include.
+
+    Returns:
+      list -- A line for each plugin.
+    """
+    totals = sorted(((sum(times.values()), plugin)
+                     for plugin, times in load_times.items()),
+                    reverse=True)
+
+    return ["%s %.3fs (%s)" % (plugin, total, ', '.join(
+        "%s %.3fs" % (step, seconds)
+        for step, seconds in load_times[plugin].items()))
+        for total, plugin in totals[:limit]]
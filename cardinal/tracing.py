@@ -0,0 +1,263 @@
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from twisted.python.failure import Failure
+
+from cardinal.exceptions import EventRejectedMessage
+
+# The span that work on the current line is recorded under. Deferreds don't
+# carry context into their callbacks, but inlineCallbacks and coroutines do,
+# so spans follow plugins through their HTTP calls and replies.
+current_span = contextvars.ContextVar('cardinal_span', default=None)
+
+# The tracer spans are exported by, or None if tracing is disabled
+_tracer = None
+
+
+class Span:
+    """A step in handling a line, such as a command or a reply"""
+
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name',
+                 'attributes', 'start', 'duration', 'error', '_started')
+
+    def __init__(self, tracer, name, trace_id=None, parent_id=None,
+                 attributes=None):
+        """Constructor for Span
+
+        Keyword arguments:
+          tracer -- The Tracer the span is exported by once finished.
+          name -- What the span measures, e.g. 'command'.
+          trace_id -- ID of the trace, or None to start a new trace.
+          parent_id -- ID of the span this span is part of, if any.
+          attributes -- A dict of details, e.g. the plugin's name.
+        """
+        self.tracer = tracer
+        self.trace_id = trace_id or _generate_id(16)
+        self.span_id = _generate_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        self._started = time.perf_counter()
+
+    def child(self, name, **attributes):
+        """Starts a span which is part of this one"""
+        return Span(self.tracer, name, self.trace_id, self.span_id,
+                    attributes)
+
+    def finish(self, error=None):
+        """Ends the span and exports it.
+
+        Keyword arguments:
+          error -- The exception or Failure the step failed with, if any.
+        """
+        if self.duration is not None:
+            return
+
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.error = error.getErrorMessage() \
+                if isinstance(error, Failure) else repr(error)
+
+        self.tracer.export(self)
+
+    def to_dict(self):
+        span = {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+        if self.error is not None:
+            span['error'] = self.error
+
+        return span
+
+
+class Tracer:
+    """Samples traces, and writes their spans to a JSONL file"""
+
+    DEFAULT_SAMPLE_RATE = 0.01
+    """Default fraction of received lines which are traced"""
+
+    def __init__(self, path, sample_rate=DEFAULT_SAMPLE_RATE,
+                 random=random.random):
+        """Constructor for Tracer
+
+        Keyword arguments:
+          path -- File to append spans to, one JSON object per line.
+          sample_rate -- Fraction of traces to record, from 0 to 1.
+          random -- Returns a random float from 0 to 1.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.sample_rate = sample_rate
+        self.random = random
+
+        # Spans are finished in the thread pool too
+        self._lock = threading.Lock()
+        self._file = None
+
+        # Thread pool whose calls are traced
+        self._threadpool = None
+
+    def trace(self, name, **attributes):
+        """Starts a trace, if it is sampled.
+
+        Returns:
+          Span -- The trace's root span, or None if it isn't sampled.
+        """
+        if self.random() >= self.sample_rate:
+            return None
+
+        return Span(self, name, attributes=attributes)
+
+    def export(self, span):
+        """Writes a finished span to the file"""
+        line = json.dumps(span.to_dict(), default=str) + '\n'
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, 'a', buffering=1)
+                self._file.write(line)
+            except OSError:
+                self.logger.exception("Unable to write span to %s" %
+                                      self.path)
+
+    def trace_threadpool(self, threadpool):
+        """Records calls made in a thread pool during a trace, e.g. HTTP
+        requests made with deferToThread().
+
+        The span's duration includes the time the call waited for a thread,
+        which is recorded separately as the queued attribute.
+        """
+        self._threadpool = threadpool
+        original = threadpool.callInThreadWithCallback
+
+        def callInThreadWithCallback(onResult, func, *args, **kwargs):
+            if current_span.get() is None:
+                return original(onResult, func, *args, **kwargs)
+
+            span = start_span('thread', function=_qualified_name(func))
+
+            if args and isinstance(args[0], str) and '://' in args[0]:
+                span.attributes['url'] = args[0]
+
+            def call(*args, **kwargs):
+                span.attributes['queued'] = \
+                    time.perf_counter() - span._started
+                try:
+                    with activate(span):
+                        result = func(*args, **kwargs)
+                except BaseException as e:
+                    span.finish(e)
+                    raise
+
+                span.finish()
+                return result
+
+            return original(onResult, call, *args, **kwargs)
+
+        threadpool.callInThreadWithCallback = callInThreadWithCallback
+
+    def close(self):
+        """Stops tracing the thread pool and closes the file"""
+        if self._threadpool is not None:
+            del self._threadpool.callInThreadWithCallback
+            self._threadpool = None
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def install(tracer):
+    """Sets the tracer lines are traced with, or disables tracing if None"""
+    global _tracer
+    _tracer = tracer
+
+
+def trace(name, **attributes):
+    """Starts a trace, if tracing is enabled and it is sampled.
+
+    Returns:
+      Span -- The trace's root span, or None.
+    """
+    if _tracer is None:
+        return None
+
+    return _tracer.trace(name, **attributes)
+
+
+def start_span(name, **attributes):
+    """Starts a span within the current span, if there is one.
+
+    Returns:
+      Span -- The new span, or None if the current work isn't being traced.
+    """
+    parent = current_span.get()
+    if parent is None:
+        return None
+
+    return parent.child(name, **attributes)
+
+
+@contextmanager
+def activate(span):
+    """Makes a span the current span, so that work started while it is
+    current (including in inlineCallbacks and coroutines) is recorded under
+    it. Does nothing if the span is None.
+    """
+    if span is None:
+        yield
+        return
+
+    token = current_span.set(span)
+    try:
+        yield
+    finally:
+        current_span.reset(token)
+
+
+def finish_when_fired(d, span):
+    """Finishes a span when a Deferred fires, recording any failure.
+
+    Events rejected by a plugin aren't failures.
+    """
+    if span is None:
+        return d
+
+    def finish(result):
+        if isinstance(result, Failure):
+            if result.check(EventRejectedMessage):
+                span.attributes['rejected'] = True
+                span.finish()
+            else:
+                span.finish(result)
+        else:
+            span.finish()
+
+        return result
+
+    return d.addBoth(finish)
+
+
+def _generate_id(size):
+    return '%0*x' % (size * 2, random.getrandbits(size * 8))
+
+
+def _qualified_name(func):
+    return '%s.%s' % (getattr(func, '__module__', None),
+                      getattr(func, '__qualname__', repr(func)))
@@ -1,6 +1,7 @@
+import asyncio
 import re
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from twisted.internet.task import deferLater
 
 
@@ -32,6 +33,53 @@ def sleep(secs):
     return deferLater(reactor, secs, lambda: None)
 
 
+def run_coroutine(coro):
+    """Runs a coroutine, returning a Deferred that fires with its result.
+
+    Coroutines may await Deferreds. When running on the asyncio reactor, they
+    may also await asyncio futures, so that asyncio libraries can be used.
+    """
+    loop = getattr(reactor, '_asyncioEventloop', None)
+    if loop is None:
+        return defer.Deferred.fromCoroutine(coro)
+
+    return defer.Deferred.fromFuture(
+        asyncio.ensure_future(_AsyncioCoroutine(coro, loop), loop=loop))
+
+
+class _AsyncioCoroutine:
+    """Runs a coroutine as an asyncio task, waiting for Deferreds it awaits"""
+
+    def __init__(self, coro, loop):
+        self.coro = coro
+        self.loop = loop
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            try:
+                if error is None:
+                    awaited = self.coro.send(value)
+                else:
+                    awaited = self.coro.throw(error)
+            except StopIteration as e:
+                return e.value
+
+            value, error = None, None
+            try:
+                if isinstance(awaited, defer.Deferred):
+                    # Awaiting a Deferred yields it until it has fired, and
+                    # then takes the result from it
+                    fired = defer.Deferred()
+                    awaited.addBoth(
+                        lambda result: (fired.callback(None), result)[1])
+                    yield from fired.asFuture(self.loop)
+                else:
+                    value = yield awaited
+            except BaseException as e:
+                error = e
+
+
 def strip_formatting(line):
     """Removes mIRC control code formatting"""
     return re.sub(r"(?:\x03\d\d?,\d\d?|\x03\d\d?|[\x01-\x1f])", "", line)
@@ -0,0 +1,226 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import namedtuple
+from contextlib import contextmanager
+
+from twisted.internet import reactor, task
+
+from cardinal import metrics
+
+# What the reactor thread was doing, e.g. ('urls', 'command', 'shorten_url')
+# while the urls plugin's shorten_url command is called. Kind and name are
+# None when only the plugin is known.
+activity = namedtuple('activity', ['plugin', 'kind', 'name'])
+
+stall = namedtuple('stall', ['duration', 'activity', 'stack'])
+
+# Activity of stalls which can't be attributed to a plugin
+UNATTRIBUTED = activity(None, None, None)
+
+# Activities being run on the reactor thread, innermost last
+_running = []
+
+
+@contextmanager
+def running(method, kind, name):
+    """Records that a plugin's command or event callback is being run.
+
+    Stalls of the reactor while it runs are attributed to it.
+
+    Keyword arguments:
+      method -- The plugin's method.
+      kind -- Either 'command' or 'event'.
+      name -- The name of the command's method, or of the event.
+    """
+    _running.append(activity(plugin_of(method), kind, name))
+    try:
+        yield
+    finally:
+        _running.pop()
+
+
+def plugin_of(method):
+    """Returns the name of the plugin a method belongs to, or None"""
+    return _plugin_of_module(getattr(method, '__module__', None))
+
+
+def _plugin_of_module(module):
+    # Plugins are imported as <prefix>.<plugin>.plugin
+    package, _, submodule = (module or '').rpartition('.')
+    if submodule != 'plugin' or not package:
+        return None
+
+    return package.rpartition('.')[2]
+
+
+def describe(activity):
+    """Describes an activity for logs and messages"""
+    if activity.plugin is None:
+        return 'unknown'
+    elif activity.kind is None:
+        return activity.plugin
+
+    return '%s (%s %s)' % (activity.plugin, activity.kind, activity.name)
+
+
+class Watchdog:
+    """Detects when the reactor is blocked, and what blocked it.
+
+    The reactor records a heartbeat every INTERVAL seconds. A thread checks
+    the heartbeat, and when it is late by more than the threshold, captures
+    the stack of the reactor thread and what plugin it was running. The stall
+    is logged and counted once the reactor catches up.
+    """
+
+    INTERVAL = 0.05
+    """Time in seconds between heartbeats of the reactor"""
+
+    DEFAULT_THRESHOLD = 0.5
+    """Default time in seconds the reactor may be blocked for"""
+
+    @property
+    def reactor(self):
+        """Allows us to inject a mock reactor in unit tests"""
+        return getattr(self, '_reactor', reactor)
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, clock=time.monotonic):
+        """Constructor for Watchdog
+
+        Keyword arguments:
+          threshold -- Time in seconds the reactor may be blocked for before
+            it is considered stalled.
+          clock -- Returns the current time.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.threshold = threshold
+        self.clock = clock
+
+        # How late the last heartbeat was, in seconds
+        self.lag = 0
+        self.max_lag = 0
+
+        # Number of stalls and their longest duration, by activity
+        self.stalls = {}
+        self.longest = {}
+
+        # The last stall, once the reactor has caught up
+        self.last_stall = None
+
+        self._heartbeat = None
+        self._last_beat = None
+        self._thread = None
+        self._thread_id = None
+        self._stopped = threading.Event()
+
+        # Set by the watchdog thread when the reactor is stalled, to the time
+        # of the last heartbeat, what it was doing, and its stack
+        self._stalled = None
+
+    @property
+    def total_stalls(self):
+        """Number of times the reactor has stalled"""
+        return sum(self.stalls.values())
+
+    def start(self):
+        """Starts watching the reactor. Must be called on the reactor thread.
+        """
+        if self._heartbeat is not None:
+            return
+
+        self._thread_id = threading.get_ident()
+        self._last_beat = self.clock()
+        self._stopped.clear()
+
+        self._heartbeat = task.LoopingCall(self.beat)
+        self._heartbeat.clock = self.reactor
+        self._heartbeat.start(self.INTERVAL, now=False)
+
+        self._thread = threading.Thread(target=self._watch,
+                                        name='cardinal-watchdog',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops watching the reactor"""
+        if self._heartbeat is None:
+            return
+
+        self._heartbeat.stop()
+        self._heartbeat = None
+
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def beat(self):
+        """Records a heartbeat of the reactor, reporting any stall it ended"""
+        now = self.clock()
+        previous, self._last_beat = self._last_beat, now
+        self.lag = max(now - previous - self.INTERVAL, 0)
+        self.max_lag = max(self.max_lag, self.lag)
+        metrics.REACTOR_LAG.set(self.lag)
+
+        # Stalls captured after the previous heartbeat ended are stale
+        stalled, self._stalled = self._stalled, None
+        if stalled is not None and stalled[0] == previous:
+            self.report(stall(self.lag, *stalled[1:]))
+
+    def check(self):
+        """Checks whether the reactor is stalled, capturing what it is doing.
+
+        Called from the watchdog thread. Each stall is captured only once.
+
+        Returns:
+          bool -- Whether a stall was captured.
+        """
+        last_beat = self._last_beat
+        if self._stalled is not None and self._stalled[0] == last_beat:
+            return False
+        if self.clock() - last_beat - self.INTERVAL <= self.threshold:
+            return False
+
+        frame = sys._current_frames().get(self._thread_id)
+        stack = traceback.format_stack(frame) if frame is not None else []
+        try:
+            current = _running[-1]
+        except IndexError:
+            current = self._attribute(frame)
+
+        # The reactor caught up while the stack was captured
+        if self._last_beat != last_beat:
+            return False
+
+        self._stalled = (last_beat, current, stack)
+        return True
+
+    def _attribute(self, frame):
+        """Finds the innermost plugin on a stack, e.g. for a stall in a
+        Deferred's callback rather than a command or event callback.
+        """
+        while frame is not None:
+            plugin = _plugin_of_module(frame.f_globals.get('__name__'))
+            if plugin is not None:
+                return activity(plugin, None, None)
+            frame = frame.f_back
+
+        return UNATTRIBUTED
+
+    def report(self, stall):
+        """Logs and counts a stall of the reactor"""
+        self.stalls[stall.activity] = self.stalls.get(stall.activity, 0) + 1
+        self.longest[stall.activity] = max(
+            self.longest.get(stall.activity, 0), stall.duration)
+        self.last_stall = stall
+        metrics.REACTOR_STALLS.inc(*(value or '' for value in stall.activity))
+
+        self.logger.warning(
+            "Reactor was blocked for %.3f seconds by %s:\n%s" %
+            (stall.duration, describe(stall.activity),
+             ''.join(stall.stack).rstrip()))
+
+    def _watch(self):
+        while not self._stopped.wait(self.INTERVAL):
+            self.check()
@@ -0,0 +1,813 @@
+import argparse
+import ast
+import importlib
+import inspect
+import json
+import logging
+import os
+import re
+import sys
+from datetime import datetime
+
+from twisted.internet import (
+    defer,
+    error,
+    interfaces,
+    protocol,
+    reactor,
+    stdio,
+)
+from twisted.protocols import amp
+from twisted.python.components import proxyForInterface
+
+from cardinal.bot import CardinalBot, batch_info, user_info
+from cardinal.exceptions import (
+    ConfigNotFoundError,
+    EventRejectedMessage,
+    PluginError,
+)
+from cardinal.plugins import call_plugin, close_plugin, instantiate_plugin
+from cardinal.reactors import installed_reactor
+from cardinal.supervisor import WORKER_LOG_REGEX
+
+# Run by workers, which use the same reactor as the main process
+WORKER_SCRIPT = ("from cardinal.reactors import install_reactor; "
+                 "install_reactor(%r); import %s; %s.main()")
+
+# Methods of CardinalBot which plugins in a worker may call
+CARDINAL_METHODS = (
+    'sendMsg',
+    'send',
+    'msg',
+    'notice',
+    'describe',
+    'join',
+    'leave',
+    'part',
+    'kick',
+    'mode',
+    'topic',
+    'setNick',
+)
+
+# Attributes of CardinalBot which plugins in a worker may use. Plugins using
+# any others, such as channels or plugin_manager, can't run in a worker.
+WORKER_ATTRIBUTES = CARDINAL_METHODS + (
+    'nickname',
+    'network',
+    'storage_path',
+    'get_db',
+    'get_user_tuple',
+    'config',
+    'who',
+    'current_batch',
+    'supported',
+    'uptime',
+    'booted',
+)
+
+
+class BigUnicode(amp.Unicode):
+    """A string which may be longer than an AMP value, e.g. the args of a
+    netsplit's quit_batch event, split across as many values as it needs
+    """
+
+    CHUNK_LENGTH = amp.MAX_VALUE_LENGTH
+    """Maximum length in bytes of each value"""
+
+    def toBox(self, name, strings, objects, proto):
+        amp.Unicode.toBox(self, name, strings, objects, proto)
+
+        # The first chunk keeps the argument's name, and the rest are
+        # numbered after it
+        value = strings[name]
+        for i in range(0, len(value), self.CHUNK_LENGTH):
+            key = b'%s.%d' % (name, i // self.CHUNK_LENGTH) if i else name
+            strings[key] = value[i:i + self.CHUNK_LENGTH]
+
+    def fromBox(self, name, strings, objects, proto):
+        chunks = [strings[name]]
+        while b'%s.%d' % (name, len(chunks)) in strings:
+            chunks.append(strings.pop(b'%s.%d' % (name, len(chunks))))
+
+        strings[name] = b''.join(chunks)
+        amp.Unicode.fromBox(self, name, strings, objects, proto)
+
+
+class Setup(amp.Command):
+    """Sent to a worker to import and instantiate its plugin"""
+    arguments = [
+        (b'config', BigUnicode()),
+        (b'configs', BigUnicode()),
+        (b'network', amp.Unicode()),
+        (b'storage', amp.Unicode()),
+        (b'state', BigUnicode()),
+    ]
+    response = [(b'manifest', BigUnicode())]
+    errors = {PluginError: b'PLUGIN_ERROR'}
+
+
+class Call(amp.Command):
+    """Sent to a worker to call one of its plugin's commands or callbacks"""
+    arguments = [
+        (b'method', amp.Unicode()),
+        (b'state', BigUnicode()),
+        (b'args', BigUnicode()),
+    ]
+    response = [(b'accepted', amp.Boolean())]
+    errors = {PluginError: b'PLUGIN_ERROR'}
+
+
+class Close(amp.Command):
+    """Sent to a worker to close its plugin before it exits"""
+    arguments = []
+    response = []
+
+
+class CallCardinal(amp.Command):
+    """Sent by a worker to call a method of CardinalBot"""
+    arguments = [
+        (b'method', amp.Unicode()),
+        (b'args', BigUnicode()),
+    ]
+    requiresAnswer = False
+
+
+class Who(amp.Command):
+    """Sent by a worker to list the users in channels"""
+    arguments = [(b'channels', BigUnicode())]
+    response = [(b'users', BigUnicode())]
+
+
+def encode(value):
+    """Encodes arguments and configs as JSON, keeping user_info tuples"""
+    def tag(value):
+        if isinstance(value, user_info):
+            return {'__user_info__': list(value)}
+        elif isinstance(value, (list, tuple)):
+            return [tag(item) for item in value]
+        elif isinstance(value, dict):
+            return {key: tag(item) for key, item in value.items()}
+        return value
+
+    return json.dumps(tag(value))
+
+
+def decode(value):
+    """Decodes JSON created by encode()"""
+    def untag(obj):
+        if list(obj) == ['__user_info__']:
+            return user_info(*obj['__user_info__'])
+        return obj
+
+    return json.loads(value, object_hook=untag)
+
+
+def plugin_manifest(instance):
+    """Describes the commands and event callbacks of a plugin's instance.
+
+    Returns:
+      dict -- The plugin's commands and callbacks, in the format used by
+        read_manifest(), with regexes given as a pattern and flags.
+    """
+    commands = []
+    callbacks = []
+    for name in dir(instance):
+        method = getattr(instance, name)
+        if not callable(method):
+            continue
+
+        if hasattr(method, 'regex') or hasattr(method, 'commands'):
+            command = {'method': name}
+            if hasattr(method, 'commands'):
+                command['commands'] = method.commands
+            if hasattr(method, 'regex'):
+                pattern = re.compile(method.regex)
+                command['regex'] = {'pattern': pattern.pattern,
+                                    'flags': pattern.flags}
+            if hasattr(method, 'help'):
+                command['help'] = method.help
+            commands.append(command)
+
+        if hasattr(method, 'events'):
+            callbacks.append({'method': name, 'event_names': method.events})
+
+    return {'commands': commands, 'callbacks': callbacks}
+
+
+def unavailable_attributes(module):
+    """Finds the attributes of CardinalBot which a plugin's module uses, but
+    which aren't available to it in a worker.
+
+    Uses of cardinal.name and self.cardinal.name are checked.
+
+    Returns:
+      list -- Names of the attributes, sorted.
+    """
+    try:
+        tree = ast.parse(inspect.getsource(module))
+    except (OSError, TypeError):
+        return []
+
+    names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Attribute):
+            continue
+
+        value = node.value
+        if isinstance(value, ast.Name) and value.id == 'cardinal' or \
+                isinstance(value, ast.Attribute) and value.attr == 'cardinal':
+            if node.attr not in WORKER_ATTRIBUTES:
+                names.add(node.attr)
+
+    return sorted(names)
+
+
+class WorkerPlugin:
+    """Runs a plugin in a worker process, standing in for its instance.
+
+    The plugin's commands and event callbacks are set on this object, and
+    forward calls to the worker. If the worker crashes, it is restarted,
+    waiting longer each time it crashes without staying up for STABLE_UPTIME.
+    """
+
+    MINIMUM_RESTART_WAIT = 1
+    """Minimum time in seconds before restarting a crashed worker"""
+
+    MAXIMUM_RESTART_WAIT = 300
+    """Maximum time in seconds before restarting a crashed worker"""
+
+    STABLE_UPTIME = 60
+    """Time in seconds a worker must run for its restart wait to be reset"""
+
+    CLOSE_TIMEOUT = 10
+    """Time in seconds to wait for a worker to exit before killing it"""
+
+    @property
+    def reactor(self):
+        """Allows us to inject a mock reactor in unit tests"""
+        return getattr(self, '_reactor', reactor)
+
+    def __init__(self, manager, plugin, config):
+        """Constructor for WorkerPlugin
+
+        Keyword arguments:
+          manager -- The PluginManager the plugin belongs to.
+          plugin -- Name of the plugin.
+          config -- The plugin's config, if any.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.manager = manager
+        self.plugin = plugin
+        self.config = config
+
+        # Set while the worker is running and set up
+        self.process = None
+        self.protocol = None
+        self.started = None
+
+        # Statistics about the worker
+        self.starts = 0
+        self.crashes = 0
+
+        # Time to wait before the next restart, doubled on each crash
+        self.restart_wait = None
+        self.restart_call = None
+
+        # Fires once the worker exits after being closed
+        self.closing = None
+
+        # Logger name and level of the last log line, for lines such as
+        # tracebacks which continue it
+        self.last_log = (__name__, logging.INFO)
+
+    def start(self):
+        """Starts the worker and sets up the plugin in it.
+
+        Returns:
+          Deferred -- Fires with this object once the plugin is set up.
+        """
+        d = defer.maybeDeferred(self._spawn)
+        d.addCallback(self._add_methods)
+
+        # Workers which never set up aren't restarted
+        def failed(failure):
+            self.closing = defer.Deferred()
+            if self.process is not None:
+                try:
+                    self.process.signalProcess('KILL')
+                except error.ProcessExitedAlready:
+                    pass
+            return failure
+
+        d.addErrback(failed)
+        return d
+
+    def _spawn(self):
+        self.restart_call = None
+
+        self.logger.info("Starting worker for plugin: %s" % self.plugin)
+        amp_protocol = HostProtocol(self)
+        self.process = self.reactor.spawnProcess(
+            WorkerProcessProtocol(self, amp_protocol),
+            sys.executable,
+            [sys.executable, '-u', '-c', WORKER_SCRIPT % (
+                installed_reactor(), __name__, __name__),
+             self.manager._plugin_module_import_prefix,
+             self.plugin,
+             '--log-level',
+             logging.getLevelName(logging.getLogger().getEffectiveLevel())],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+        )
+        self.started = self.reactor.seconds()
+        self.starts += 1
+
+        cardinal = self.manager.cardinal
+        configs = {name: plugin['config']
+                   for name, plugin in self.manager.plugins.items()
+                   if plugin['config'] is not None}
+        d = amp_protocol.callRemote(Setup,
+                                    config=encode(self.config),
+                                    configs=encode(configs),
+                                    network=cardinal.network,
+                                    storage=cardinal.storage_path,
+                                    state=self._state())
+
+        def set_up(response):
+            self.protocol = amp_protocol
+            return decode(response['manifest'])
+
+        d.addCallback(set_up)
+        return d
+
+    def _add_methods(self, manifest):
+        """Adds the plugin's commands and callbacks to this object"""
+        methods = {}
+        for command in manifest['commands']:
+            method = methods[command['method']] = \
+                self._method(command['method'])
+
+            for attribute in ('commands', 'help'):
+                if attribute in command:
+                    setattr(method, attribute, command[attribute])
+            if 'regex' in command:
+                method.regex = re.compile(command['regex']['pattern'],
+                                          command['regex']['flags'])
+
+        for callback in manifest['callbacks']:
+            if callback['method'] not in methods:
+                methods[callback['method']] = \
+                    self._method(callback['method'])
+            methods[callback['method']].events = callback['event_names']
+
+        for name, method in methods.items():
+            if hasattr(self, name):
+                raise PluginError(
+                    "Plugin method %s can't be called in a worker" % name)
+            setattr(self, name, method)
+
+        return self
+
+    def _method(self, name):
+        """Creates a function which calls a method of the plugin"""
+        def method(cardinal, *args):
+            return self.call(name, *args)
+
+        method.__name__ = name
+        method.__module__ = self.manager._plugin_module_name(self.plugin)
+        return method
+
+    def call(self, method, *args):
+        """Calls a command or callback of the plugin in the worker.
+
+        Keyword arguments:
+          method -- Name of the method.
+          args -- Arguments to pass after the instance of CardinalBot.
+
+        Returns:
+          Deferred -- Fires once the method has returned in the worker.
+            Fails with EventRejectedMessage if the plugin rejected an event.
+        """
+        if self.protocol is None:
+            return defer.fail(PluginError(
+                "Worker for plugin %s isn't running" % self.plugin))
+
+        d = self.protocol.callRemote(Call,
+                                     method=method,
+                                     state=self._state(),
+                                     args=encode(args))
+
+        def accepted(response):
+            if not response['accepted']:
+                raise EventRejectedMessage()
+
+        d.addCallback(accepted)
+        return d
+
+    def _state(self):
+        """Encodes the attributes of CardinalBot which may change between
+        calls, for the worker's WorkerCardinal
+        """
+        cardinal = self.manager.cardinal
+        batch = cardinal.current_batch
+
+        # Unset until the bot has signed on
+        uptime = getattr(cardinal, 'uptime', None)
+        booted = getattr(cardinal, 'booted', None)
+
+        return encode({
+            'nickname': cardinal.nickname,
+            # The batch's events are passed to its own event, e.g. quit_batch
+            'current_batch': batch._replace(events=[]) if batch else None,
+            'supported': cardinal.supported._features,
+            'uptime': uptime.timestamp() if uptime else None,
+            'booted': booted.timestamp() if booted else None,
+        })
+
+    def call_cardinal(self, method, args):
+        """Calls a method of CardinalBot on behalf of the worker"""
+        if method not in CARDINAL_METHODS:
+            self.logger.warning("Plugin %s can't call %s from a worker" %
+                                (self.plugin, method))
+            return
+
+        getattr(self.manager.cardinal, method)(*args)
+
+    def close(self):
+        """Closes the plugin and waits for its worker to exit.
+
+        Returns:
+          Deferred -- Fires once the worker has exited, or None if it wasn't
+            running.
+        """
+        if self.restart_call is not None:
+            self.restart_call.cancel()
+            self.restart_call = None
+
+        if self.process is None:
+            return None
+
+        self.closing = defer.Deferred()
+        process, amp_protocol = self.process, self.protocol
+        self.protocol = None
+
+        # The worker exits once its stdin is closed
+        def close_stdin(_):
+            if self.process is process:
+                process.closeStdin()
+
+        def kill():
+            try:
+                process.signalProcess('KILL')
+            except error.ProcessExitedAlready:
+                pass
+
+        timeout = self.reactor.callLater(self.CLOSE_TIMEOUT, kill)
+        self.closing.addBoth(
+            lambda result: timeout.cancel() if timeout.active() else None)
+
+        if amp_protocol is not None:
+            d = amp_protocol.callRemote(Close)
+            d.addErrback(lambda failure: self.logger.warning(
+                "Worker for plugin %s didn't close it cleanly: %s" %
+                (self.plugin, failure.getErrorMessage())))
+            d.addCallback(close_stdin)
+        else:
+            close_stdin(None)
+
+        return self.closing
+
+    def log(self, line):
+        """Logs a line written to stderr by the worker.
+
+        Lines are logged with the logger name and level used by the worker.
+
+        Keyword arguments:
+          line -- A line of output, as bytes.
+        """
+        line = line.decode('utf-8', errors='replace').rstrip('\r')
+
+        match = WORKER_LOG_REGEX.match(line)
+        if match:
+            name, level, line = match.groups()
+            self.last_log = (name, logging.getLevelName(level))
+
+        name, level = self.last_log
+        logging.getLogger(name).log(level, "[%s] %s" % (self.plugin, line))
+
+    def ended(self, reason):
+        """Called when the worker exits, restarting it if it crashed.
+
+        Keyword arguments:
+          reason -- A Failure wrapping ProcessDone or ProcessTerminated.
+        """
+        uptime = self.reactor.seconds() - self.started
+        self.process = None
+        self.protocol = None
+        self.started = None
+
+        if self.closing is not None:
+            self.logger.info("Worker for plugin %s exited" % self.plugin)
+            self.closing.callback(None)
+            return
+
+        self.crashes += 1
+        if self.restart_wait is None or uptime >= self.STABLE_UPTIME:
+            self.restart_wait = self.MINIMUM_RESTART_WAIT
+        else:
+            self.restart_wait = min(self.restart_wait * 2,
+                                    self.MAXIMUM_RESTART_WAIT)
+
+        self.logger.warning(
+            "Worker for plugin %s exited (%s), restarting in %d seconds" %
+            (self.plugin, reason.getErrorMessage(), self.restart_wait))
+
+        self.restart_call = self.reactor.callLater(
+            self.restart_wait, self._restart)
+
+    def _restart(self):
+        d = defer.maybeDeferred(self._spawn)
+
+        def restarted(manifest):
+            self.logger.info("Restarted worker for plugin: %s" % self.plugin)
+
+        def failed(failure):
+            self.logger.error("Couldn't restart worker for plugin %s: %s" %
+                              (self.plugin, failure.getErrorMessage()))
+
+            # Kill it, so it's restarted again after waiting longer
+            if self.process is not None:
+                try:
+                    self.process.signalProcess('KILL')
+                except error.ProcessExitedAlready:
+                    pass
+
+        d.addCallbacks(restarted, failed)
+
+
+class HostProtocol(amp.AMP):
+    """Handles calls to CardinalBot from a worker"""
+
+    def __init__(self, worker):
+        amp.AMP.__init__(self)
+        self.worker = worker
+
+    @CallCardinal.responder
+    def call_cardinal(self, method, args):
+        self.worker.call_cardinal(method, decode(args))
+        return {}
+
+    @Who.responder
+    def who(self, channels):
+        d = self.worker.manager.cardinal.who(decode(channels))
+        d.addCallback(lambda users: {'users': encode(users)})
+        return d
+
+
+class WorkerTransport(proxyForInterface(interfaces.IProcessTransport)):
+    """A worker's process transport, with the addresses AMP expects"""
+
+    def getPeer(self):
+        return stdio.PipeAddress()
+
+    def getHost(self):
+        return stdio.PipeAddress()
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    """Speaks AMP over a worker's stdio, and logs what it writes to stderr"""
+
+    def __init__(self, worker, amp_protocol):
+        self.worker = worker
+        self.amp_protocol = amp_protocol
+        self._buffer = b''
+
+    def connectionMade(self):
+        self.amp_protocol.makeConnection(WorkerTransport(self.transport))
+
+    def outReceived(self, data):
+        self.amp_protocol.dataReceived(data)
+
+    def errReceived(self, data):
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+
+        for line in lines:
+            self.worker.log(line)
+
+    def processEnded(self, reason):
+        if self._buffer:
+            self.worker.log(self._buffer)
+        self._buffer = b''
+
+        self.amp_protocol.connectionLost(reason)
+        self.worker.ended(reason)
+
+
+class WorkerSupported:
+    """Stands in for the features supported by the server, in a worker"""
+
+    def __init__(self, features):
+        self.features = features
+
+    def getFeature(self, feature, default=None):
+        return self.features.get(feature, default)
+
+    def hasFeature(self, feature):
+        return self.getFeature(feature) is not None
+
+
+class WorkerCardinal:
+    """Stands in for CardinalBot in a worker, calling it in the main process.
+
+    Databases are opened directly from the shared storage directory, as
+    plugins use them synchronously. get_db() locks their files, so the main
+    process and workers can't use a database at the same time.
+    """
+
+    get_db = CardinalBot.get_db
+    get_user_tuple = staticmethod(CardinalBot.get_user_tuple)
+
+    def __init__(self, amp_protocol, network, storage_path, configs):
+        """Constructor for WorkerCardinal
+
+        Keyword arguments:
+          amp_protocol -- The worker's connection to the main process.
+          network -- Name of the network.
+          storage_path -- Path to the storage directory.
+          configs -- Configs of the plugins loaded when the worker was set
+            up, by plugin.
+        """
+        self.amp_protocol = amp_protocol
+        self.network = network
+        self.storage_path = storage_path
+        self.configs = configs
+
+        # Updated by the main process before each call
+        self.nickname = None
+        self.current_batch = None
+        self.supported = WorkerSupported({})
+        self.uptime = None
+        self.booted = None
+
+        # Used by get_db() for database locks within this process
+        self.factory = argparse.Namespace(db_locks={})
+
+    def update(self, state):
+        """Updates the attributes encoded by WorkerPlugin._state()"""
+        state = decode(state)
+        batch = state['current_batch']
+
+        self.nickname = state['nickname']
+        self.current_batch = batch_info(*batch) if batch else None
+        self.supported = WorkerSupported(state['supported'])
+        self.uptime = datetime.fromtimestamp(state['uptime']) \
+            if state['uptime'] is not None else None
+        self.booted = datetime.fromtimestamp(state['booted']) \
+            if state['booted'] is not None else None
+
+    def config(self, plugin):
+        """Returns a plugin's config, as CardinalBot.config() does.
+
+        Raises:
+          ConfigNotFoundError -- When the plugin had no config when the
+            worker was set up.
+        """
+        if plugin not in self.configs:
+            raise ConfigNotFoundError("Couldn't find requested plugin config")
+
+        return self.configs[plugin]
+
+    def who(self, channels):
+        """Lists the users in a channel or channels, as CardinalBot.who() does.
+
+        Returns:
+          Deferred -- Fires with the users, or a dict mapping channels to
+            users if a list of channels was given.
+        """
+        d = self.amp_protocol.callRemote(Who, channels=encode(channels))
+        d.addCallback(lambda response: decode(response['users']))
+        return d
+
+    def __getattr__(self, name):
+        if name not in CARDINAL_METHODS:
+            raise AttributeError(
+                "%s isn't available to plugins in a worker" % name)
+
+        def method(*args):
+            self.amp_protocol.callRemote(CallCardinal,
+                                         method=name,
+                                         args=encode(args))
+
+        return method
+
+
+class WorkerProtocol(amp.AMP):
+    """Runs a plugin in a worker, as told by the main process"""
+
+    def __init__(self, prefix, plugin):
+        amp.AMP.__init__(self)
+        self.logger = logging.getLogger(__name__)
+        self.prefix = prefix
+        self.plugin = plugin
+        self.cardinal = None
+        self.instance = None
+
+    @Setup.responder
+    def setup(self, config, configs, network, storage, state):
+        self.cardinal = WorkerCardinal(self, network, storage, decode(configs))
+        self.cardinal.update(state)
+
+        try:
+            module = importlib.import_module(
+                '%s.%s.plugin' % (self.prefix, self.plugin))
+        except Exception:
+            self.logger.exception(
+                "Could not load plugin module: %s" % self.plugin)
+            raise PluginError("Could not load plugin: %s" % self.plugin)
+
+        unavailable = unavailable_attributes(module)
+        if unavailable:
+            self.logger.error(
+                "Plugin %s uses cardinal.%s, which can't be used in a worker" %
+                (self.plugin, ', cardinal.'.join(unavailable)))
+            raise PluginError("Plugin %s can't run in a worker" % self.plugin)
+
+        d = call_plugin(instantiate_plugin,
+                        module, self.cardinal, decode(config))
+
+        def set_up(instance):
+            self.instance = instance
+            return {'manifest': encode(plugin_manifest(instance))}
+
+        def failed(failure):
+            self.logger.error("Could not instantiate plugin: %s\n%s" %
+                              (self.plugin, failure.getTraceback()))
+            raise PluginError("Could not load plugin: %s" % self.plugin)
+
+        d.addCallbacks(set_up, failed)
+        return d
+
+    @Call.responder
+    def call(self, method, state, args):
+        self.cardinal.update(state)
+
+        d = call_plugin(getattr(self.instance, method),
+                        self.cardinal, *decode(args))
+
+        def failed(failure):
+            if failure.check(EventRejectedMessage):
+                return {'accepted': False}
+
+            self.logger.error("Error calling %s on plugin %s:\n%s" %
+                              (method, self.plugin, failure.getTraceback()))
+            raise PluginError("Error calling %s" % method)
+
+        d.addCallbacks(lambda _: {'accepted': True}, failed)
+        return d
+
+    @Close.responder
+    def close(self):
+        instance, self.instance = self.instance, None
+        if instance is None:
+            return {}
+
+        d = call_plugin(close_plugin, instance, self.cardinal)
+        d.addErrback(lambda failure: self.logger.error(
+            "Didn't close plugin cleanly: %s\n%s" %
+            (self.plugin, failure.getTraceback())))
+        d.addCallback(lambda _: {})
+        return d
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+
+        # The main process closed our stdin, or exited
+        if self.instance is not None:
+            self.close()
+        if reactor.running:
+            reactor.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog=__name__,
+        description="Runs a Cardinal plugin for another process")
+    parser.add_argument('prefix', help='package the plugin is imported from')
+    parser.add_argument('plugin', help='name of the plugin')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+
+    # Logged to stderr, in the format the main process expects
+    logging.basicConfig(
+        level=args.log_level,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    stdio.StandardIO(WorkerProtocol(args.prefix, args.plugin))
+
+    # Our stdout is used to talk to the main process
+    sys.stdout = sys.stderr
+
+    reactor.run()
+
@@ -1,16 +1,52 @@
 import logging
+import os
+import time
+
+from twisted.internet import defer
 
 from cardinal.bot import user_info
 from cardinal.decorators import command, help
+from cardinal.profiler import SamplingProfiler, reactor_threads
+from cardinal.timeline import plugin_report
+from cardinal.watchdog import describe
 
 
 class AdminPlugin:
+    SLOWEST_PLUGINS = 5
+    """Number of plugins listed by the startup command"""
+
+    WORST_STALLS = 5
+    """Number of causes of stalls listed by the stalls command"""
+
+    DEFAULT_PROFILE_DURATION = 10
+    """Default time in seconds the profile command profiles for"""
+
+    DEFAULT_MAX_PROFILE_DURATION = 60
+    """Default limit on the time the profile command may profile for"""
+
+    TOP_FUNCTIONS = 5
+    """Number of functions listed by the profile command"""
+
+    LARGEST_PLUGINS = 5
+    """Number of plugins listed by the memory command"""
+
+    TOP_ALLOCATIONS = 3
+    """Number of lines allocating memory listed by the memory command"""
+
     def __init__(self, cardinal, config):
         self.logger = logging.getLogger(__name__)
 
         self.admins = []
 
-        if config is None or not config.get('admins', False):
+        # Limits on profiling production, and the profiler that is running
+        config = config or {}
+        self.max_profile_duration = config.get(
+            'max_profile_duration', self.DEFAULT_MAX_PROFILE_DURATION)
+        self.max_profile_overhead = config.get(
+            'max_profile_overhead', SamplingProfiler.DEFAULT_MAX_OVERHEAD)
+        self.profiler = None
+
+        if not config.get('admins', False):
             self.logger.warning("No admins configured for admin plugin -- "
                                 "copy config.example.json to config.json and "
                                 "add your information.")
@@ -74,9 +110,11 @@ class AdminPlugin:
                     raise
 
     @command(['load', 'reload'])
-    @help("If no plugins are given after the command, reload all plugins. "
-          "Otherwise, load (or reload) the selected plugins. (admin only)")
+    @help("If no plugins are given after the command, reload all plugins "
+          "that changed since they were loaded. Otherwise, load (or reload) "
+          "the selected plugins. (admin only)")
     @help("Syntax: .load [plugin [plugin ...]]")
+    @defer.inlineCallbacks
     def load_plugins(self, cardinal, user, channel, msg):
         if self.is_admin(user):
             cardinal.sendMsg(channel, "%s: Loading plugins..." % user.nick)
@@ -85,11 +123,19 @@ class AdminPlugin:
             plugins.pop(0)
 
             if len(plugins) == 0:
-                plugins = []
-                for plugin in cardinal.plugin_manager:
-                    plugins.append(plugin['name'])
+                result = cardinal.plugin_manager.reload()
+                plugins = result.reloaded + result.failed
+                failed = list(result.failed)
 
-            failed = cardinal.plugin_manager.load(plugins)
+                if len(result.skipped) > 0:
+                    cardinal.sendMsg(channel,
+                                     "Unchanged plugins skipped: %s." %
+                                     ', '.join(sorted(result.skipped)))
+            else:
+                failed = cardinal.plugin_manager.load(plugins)
+
+            # Wait for plugins that set up asynchronously
+            failed += yield cardinal.plugin_manager.ready(plugins)
 
             successful = [
                 plugin for plugin in plugins if plugin not in failed
@@ -233,6 +279,219 @@ class AdminPlugin:
         if self.is_admin(user):
             cardinal.disconnect(' '.join(msg.split(' ')[1:]))
 
+    @command('upgrade')
+    @help("Restarts Cardinal to pick up code changes, handing the connection "
+          "over to the new process without leaving IRC. (admin only)")
+    @help("Syntax: .upgrade")
+    def upgrade(self, cardinal, user, channel, msg):
+        if not self.is_admin(user):
+            return
+
+        def failed(failure):
+            cardinal.sendMsg(channel, "Upgrade failed: %s" %
+                             failure.getErrorMessage())
+
+        cardinal.sendMsg(channel, "Upgrading...")
+        d = cardinal.factory.hand_over()
+        d.addErrback(failed)
+
+    @command('startup')
+    @help("Shows how long starting up took, and the slowest plugins to load, "
+          "or how long each step of loading a plugin took. (admin only)")
+    @help("Syntax: .startup [plugin]")
+    def startup(self, cardinal, user, channel, msg):
+        if not self.is_admin(user):
+            return
+
+        load_times = cardinal.plugin_manager.load_times
+
+        args = msg.split()
+        if len(args) > 1:
+            plugin = args[1]
+            if plugin not in load_times:
+                cardinal.sendMsg(channel, "Plugin %s hasn't been loaded." %
+                                 plugin)
+                return
+
+            cardinal.sendMsg(channel, plugin_report(
+                {plugin: load_times[plugin]})[0])
+            return
+
+        timeline = cardinal.factory.timeline
+        steps = ', '.join("%s %.3fs" % (entry.name, entry.duration)
+                          for entry in timeline.entries
+                          if entry.duration is not None)
+        if timeline.finished:
+            cardinal.sendMsg(channel, "Started up in %.3fs: %s" %
+                             (timeline.duration, steps))
+        else:
+            cardinal.sendMsg(channel, "Still starting up after %.3fs "
+                                      "(waiting on %s): %s" %
+                             (timeline.elapsed(),
+                              ', '.join(timeline.pending), steps))
+
+        cardinal.sendMsg(channel, "Slowest plugins: %s" % '; '.join(
+            plugin_report(load_times, self.SLOWEST_PLUGINS)))
+
+    @command('stalls')
+    @help("Shows how often plugins have blocked the bot, and for how long. "
+          "(admin only)")
+    @help("Syntax: .stalls")
+    def stalls(self, cardinal, user, channel, msg):
+        if not self.is_admin(user):
+            return
+
+        watchdog = getattr(cardinal.factory.networks, 'watchdog', None)
+        if watchdog is None:
+            cardinal.sendMsg(channel, "The watchdog isn't running.")
+            return
+
+        if not watchdog.stalls:
+            cardinal.sendMsg(channel, "No stalls longer than %.3fs (lag "
+                                      "%.3fs, max %.3fs)." %
+                             (watchdog.threshold, watchdog.lag,
+                              watchdog.max_lag))
+            return
+
+        worst = sorted(watchdog.stalls,
+                       key=lambda activity: (watchdog.stalls[activity],
+                                             watchdog.longest[activity]),
+                       reverse=True)[:self.WORST_STALLS]
+        cardinal.sendMsg(channel, "%d stalls longer than %.3fs: %s" % (
+            watchdog.total_stalls,
+            watchdog.threshold,
+            '; '.join("%s %dx, longest %.3fs" %
+                      (describe(activity), watchdog.stalls[activity],
+                       watchdog.longest[activity])
+                      for activity in worst)))
+
+    @command('profile')
+    @help("Profiles the bot and its threads, writing a flamegraph-ready file "
+          "of collapsed stacks to storage, and lists the functions it spent "
+          "the most time in. (admin only)")
+    @help("Syntax: .profile [seconds]")
+    @defer.inlineCallbacks
+    def profile(self, cardinal, user, channel, msg):
+        if not self.is_admin(user):
+            return
+
+        if self.profiler is not None:
+            cardinal.sendMsg(channel, "Already profiling.")
+            return
+
+        args = msg.split()
+        try:
+            duration = float(args[1]) if len(args) > 1 else \
+                self.DEFAULT_PROFILE_DURATION
+        except ValueError:
+            cardinal.sendMsg(channel, "Syntax: .profile [seconds]")
+            return
+        duration = max(min(duration, self.max_profile_duration), 0)
+
+        cardinal.sendMsg(channel, "Profiling for %.1fs..." % duration)
+        self.profiler = SamplingProfiler(
+            reactor_threads(), max_overhead=self.max_profile_overhead)
+        try:
+            profiler = yield self.profiler.start(duration)
+        finally:
+            self.profiler = None
+
+        directory = os.path.join(cardinal.storage_path, 'profiles')
+        path = os.path.join(directory, time.strftime(
+            'profile-%Y%m%d-%H%M%S.txt'))
+        os.makedirs(directory, exist_ok=True)
+        profiler.write(path)
+
+        overhead = profiler.overhead / (profiler.elapsed or 1)
+        idle = profiler.idle / (profiler.samples or 1)
+        cardinal.sendMsg(channel, "Took %d samples in %.1fs (%.1f%% overhead, "
+                                  "%.0f%% idle), wrote %s" %
+                         (profiler.samples, profiler.elapsed, overhead * 100,
+                          idle * 100,
+                          os.path.relpath(path, cardinal.storage_path)))
+
+        top = profiler.top_functions(self.TOP_FUNCTIONS)
+        if top:
+            cardinal.sendMsg(channel, "Top functions: %s" % '; '.join(
+                "%s %.1f%%" % (function, fraction * 100)
+                for function, fraction in top))
+
+    @command('memory')
+    @help("Measures the memory retained by plugins and caches, and how much "
+          "it grew since it was last measured. While tracing, also lists the "
+          "memory allocated by each plugin's code, which slows the bot down. "
+          "(admin only)")
+    @help("Syntax: .memory [trace|untrace]")
+    def memory(self, cardinal, user, channel, msg):
+        if not self.is_admin(user):
+            return
+
+        monitor = getattr(cardinal.factory.networks, 'memory', None)
+        if monitor is None:
+            cardinal.sendMsg(channel, "Memory isn't being measured.")
+            return
+
+        args = msg.split()
+        if len(args) > 1:
+            if args[1] == 'trace':
+                monitor.start_tracing()
+                monitor.snapshot()
+                cardinal.sendMsg(channel, "Tracing allocations. Use .memory "
+                                          "to see what plugins allocate.")
+            elif args[1] == 'untrace':
+                monitor.stop_tracing()
+                cardinal.sendMsg(channel, "Stopped tracing allocations.")
+            else:
+                cardinal.sendMsg(channel, "Syntax: .memory [trace|untrace]")
+            return
+
+        snapshot = monitor.snapshot()
+        growth = monitor.growth()
+        network = cardinal.factory.network
+
+        plugins = {plugin: size
+                   for (plugin_network, plugin), size in
+                   snapshot.plugins.items() if plugin_network == network}
+        largest = sorted(plugins, key=plugins.get,
+                         reverse=True)[:self.LARGEST_PLUGINS]
+        cardinal.sendMsg(channel, "Plugins (%s total): %s" % (
+            _format_size(sum(plugins.values())),
+            '; '.join(_describe_size(
+                plugin, plugins[plugin],
+                growth.get('plugins', {}).get((network, plugin)))
+                for plugin in largest) or 'none loaded'))
+
+        caches = {cache: size
+                  for (cache_network, cache), size in
+                  snapshot.caches.items() if cache_network == network}
+        cardinal.sendMsg(channel, "Caches: %s" % '; '.join(
+            _describe_size(cache, caches[cache],
+                           growth.get('caches', {}).get((network, cache)))
+            for cache in sorted(caches)))
+
+        if snapshot.allocations is None:
+            return
+
+        allocations = snapshot.allocations
+        largest = sorted(allocations, key=allocations.get,
+                         reverse=True)[:self.LARGEST_PLUGINS]
+        cardinal.sendMsg(channel, "Allocated by plugins: %s" % ('; '.join(
+            _describe_size(plugin, allocations[plugin],
+                           growth.get('allocations', {}).get(plugin))
+            for plugin in largest) or 'nothing'))
+
+        top = monitor.top_allocations(self.TOP_ALLOCATIONS)
+        if top:
+            directory = cardinal.plugin_manager.plugins_directory
+            cardinal.sendMsg(channel, "Top growth: %s" % '; '.join(
+                "%s %s" % (os.path.relpath(line, directory),
+                           _format_size(size, sign=True))
+                for line, size in top))
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+
     @command('dbg_quit')
     @help("Quits the network without setting disconnect flag "
           "(for testing reconnection, admin only)")
@@ -242,4 +501,26 @@ class AdminPlugin:
             cardinal.quit('Debug disconnect')
 
 
+def _format_size(size, sign=False):
+    """Formats a number of bytes, e.g. 1536 as 1.5KiB"""
+    prefix = ('+' if size >= 0 else '-') if sign else ''
+    size = abs(size)
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'GiB'
+
+    return '%s%s%s' % (prefix, size if unit == 'B' else '%.1f' % size, unit)
+
+
+def _describe_size(name, size, growth=None):
+    if not growth:
+        return '%s %s' % (name, _format_size(size))
+
+    return '%s %s (%s)' % (name, _format_size(size),
+                           _format_size(growth, sign=True))
+
+
 entrypoint = AdminPlugin
@@ -1,4 +1,16 @@
+import os
+import re
+from unittest.mock import Mock, call
+
+from twisted.internet import defer
+
 from cardinal.bot import user_info
+from cardinal.exceptions import HandoverError
+from cardinal.memory import memory_snapshot
+from cardinal.plugins import reload_result
+from cardinal.timeline import Timeline
+from cardinal.unittest_util import tempdir
+from cardinal.watchdog import UNATTRIBUTED, Watchdog, activity, stall
 from plugins.admin.plugin import AdminPlugin
 
 
@@ -69,3 +81,215 @@ class TestAdminPlugin:
         assert plugin.is_admin(user_info('bad_nick', 'user', 'vhost')) is False
         assert plugin.is_admin(user_info('nick', 'bad_user', 'vhost')) is False
         assert plugin.is_admin(user_info('nick', 'user', 'bad_vhost')) is False
+
+    def test_load_plugins_reloads_changed(self):
+        plugin = AdminPlugin(None, {'admins': [{'nick': 'nick'}]})
+        cardinal = Mock()
+        cardinal.plugin_manager.reload.return_value = reload_result(
+            ['ping'], ['admin', 'help'], ['urls'])
+        cardinal.plugin_manager.ready.return_value = defer.succeed([])
+
+        plugin.load_plugins(cardinal, user_info('nick', 'user', 'vhost'),
+                            '#channel', '.reload')
+
+        cardinal.plugin_manager.reload.assert_called_once_with()
+        assert not cardinal.plugin_manager.load.called
+        cardinal.plugin_manager.ready.assert_called_once_with(
+            ['ping', 'urls'])
+        assert cardinal.sendMsg.mock_calls[1:] == [
+            call('#channel', "Unchanged plugins skipped: admin, help."),
+            call('#channel', "Plugins loaded succesfully: ping."),
+            call('#channel', "Plugins failed to load: urls."),
+        ]
+
+    def test_upgrade(self):
+        plugin = AdminPlugin(None, {'admins': [{'nick': 'nick'}]})
+        cardinal = Mock()
+        cardinal.factory.hand_over.return_value = defer.fail(
+            HandoverError("TLS connections can't be handed over"))
+
+        plugin.upgrade(cardinal, user_info('bad_nick', 'user', 'vhost'),
+                       '#channel', '.upgrade')
+        assert not cardinal.factory.hand_over.called
+
+        plugin.upgrade(cardinal, user_info('nick', 'user', 'vhost'),
+                       '#channel', '.upgrade')
+        cardinal.factory.hand_over.assert_called_once_with()
+        cardinal.sendMsg.assert_called_with(
+            '#channel',
+            "Upgrade failed: TLS connections can't be handed over")
+
+    def test_startup(self):
+        plugin = AdminPlugin(None, {'admins': [{'nick': 'nick'}]})
+        admin = user_info('nick', 'user', 'vhost')
+
+        clock = Mock(return_value=0)
+        cardinal = Mock()
+        cardinal.factory.timeline = timeline = Timeline(clock=clock)
+        cardinal.plugin_manager.load_times = {
+            'ping': {'import': 0.25, 'setup': 0.5},
+            'admin': {'import': 0.125},
+        }
+
+        timeline.begin('join #channel')
+        clock.return_value = 1.5
+        plugin.startup(cardinal, admin, '#channel', '.startup')
+        cardinal.sendMsg.assert_any_call(
+            '#channel', "Still starting up after 1.500s "
+                        "(waiting on join #channel): ")
+
+        timeline.end('join #channel')
+        timeline.finish()
+        cardinal.sendMsg.reset_mock()
+        plugin.startup(cardinal, admin, '#channel', '.startup')
+        assert cardinal.sendMsg.mock_calls == [
+            call('#channel', "Started up in 1.500s: join #channel 1.500s"),
+            call('#channel', "Slowest plugins: "
+                             "ping 0.750s (import 0.250s, setup 0.500s); "
+                             "admin 0.125s (import 0.125s)"),
+        ]
+
+        cardinal.sendMsg.reset_mock()
+        plugin.startup(cardinal, admin, '#channel', '.startup admin')
+        cardinal.sendMsg.assert_called_once_with(
+            '#channel', "admin 0.125s (import 0.125s)")
+
+        plugin.startup(cardinal, admin, '#channel', '.startup foo')
+        cardinal.sendMsg.assert_called_with(
+            '#channel', "Plugin foo hasn't been loaded.")
+
+    def test_stalls(self):
+        plugin = AdminPlugin(None, {'admins': [{'nick': 'nick'}]})
+        admin = user_info('nick', 'user', 'vhost')
+
+        cardinal = Mock()
+        cardinal.factory.networks.watchdog = None
+        plugin.stalls(cardinal, admin, '#channel', '.stalls')
+        cardinal.sendMsg.assert_called_with(
+            '#channel', "The watchdog isn't running.")
+
+        watchdog = cardinal.factory.networks.watchdog = \
+            Watchdog(0.5, clock=Mock(return_value=0))
+        watchdog.lag, watchdog.max_lag = 0.001, 0.25
+        plugin.stalls(cardinal, admin, '#channel', '.stalls')
+        cardinal.sendMsg.assert_called_with(
+            '#channel', "No stalls longer than 0.500s "
+                        "(lag 0.001s, max 0.250s).")
+
+        watchdog.report(stall(1.5, activity('urls', 'command', 'shorten'),
+                              []))
+        watchdog.report(stall(0.75, UNATTRIBUTED, []))
+        watchdog.report(stall(0.5, UNATTRIBUTED, []))
+        plugin.stalls(cardinal, admin, '#channel', '.stalls')
+        cardinal.sendMsg.assert_called_with(
+            '#channel', "3 stalls longer than 0.500s: "
+                        "unknown 2x, longest 0.750s; "
+                        "urls (command shorten) 1x, longest 1.500s")
+
+        cardinal.sendMsg.reset_mock()
+        plugin.stalls(cardinal, user_info('bad_nick', 'user', 'vhost'),
+                      '#channel', '.stalls')
+        assert not cardinal.sendMsg.called
+
+    def test_memory(self):
+        plugin = AdminPlugin(None, {'admins': [{'nick': 'nick'}]})
+        admin = user_info('nick', 'user', 'vhost')
+
+        cardinal = Mock()
+        cardinal.factory.networks.memory = None
+        plugin.memory(cardinal, admin, '#channel', '.memory')
+        cardinal.sendMsg.assert_called_with(
+            '#channel', "Memory isn't being measured.")
+
+        monitor = cardinal.factory.networks.memory = Mock()
+        cardinal.factory.network = 'irc.example.com'
+        cardinal.plugin_manager.plugins_directory = '/cardinal/plugins'
+        monitor.snapshot.return_value = memory_snapshot(
+            0,
+            {('irc.example.com', 'sed'): 3 * 1024 * 1024,
+             ('irc.example.com', 'ping'): 512,
+             ('irc.example.net', 'urls'): 2048},
+            {('irc.example.com', 'who'): 1536,
+             ('irc.example.com', 'modules'): 4096},
+            None)
+        monitor.growth.return_value = {}
+        cardinal.sendMsg.reset_mock()
+        plugin.memory(cardinal, admin, '#channel', '.memory')
+        assert cardinal.sendMsg.mock_calls == [
+            call('#channel', "Plugins (3.0MiB total): sed 3.0MiB; "
+                             "ping 512B"),
+            call('#channel', "Caches: modules 4.0KiB; who 1.5KiB"),
+        ]
+
+        cardinal.sendMsg.reset_mock()
+        monitor.snapshot.return_value = \
+            monitor.snapshot.return_value._replace(
+                allocations={'sed': 2048, 'ping': 0})
+        monitor.growth.return_value = {
+            'plugins': {('irc.example.com', 'sed'): -1024},
+            'caches': {('irc.example.com', 'who'): 0},
+            'allocations': {'sed': 1024},
+        }
+        monitor.top_allocations.return_value = [
+            ('/cardinal/plugins/sed/plugin.py:42', 1024),
+        ]
+        plugin.memory(cardinal, admin, '#channel', '.memory')
+        assert cardinal.sendMsg.mock_calls == [
+            call('#channel', "Plugins (3.0MiB total): sed 3.0MiB (-1.0KiB); "
+                             "ping 512B"),
+            call('#channel', "Caches: modules 4.0KiB; who 1.5KiB"),
+            call('#channel', "Allocated by plugins: sed 2.0KiB (+1.0KiB); "
+                             "ping 0B"),
+            call('#channel', "Top growth: sed/plugin.py:42 +1.0KiB"),
+        ]
+
+        plugin.memory(cardinal, admin, '#channel', '.memory trace')
+        monitor.start_tracing.assert_called_once_with()
+        plugin.memory(cardinal, admin, '#channel', '.memory untrace')
+        monitor.stop_tracing.assert_called_once_with()
+        plugin.memory(cardinal, admin, '#channel', '.memory foo')
+        cardinal.sendMsg.assert_called_with(
+            '#channel', "Syntax: .memory [trace|untrace]")
+
+        cardinal.sendMsg.reset_mock()
+        plugin.memory(cardinal, user_info('bad_nick', 'user', 'vhost'),
+                      '#channel', '.memory')
+        assert not cardinal.sendMsg.called
+
+    @defer.inlineCallbacks
+    def test_profile(self):
+        plugin = AdminPlugin(None, {'admins': [{'nick': 'nick'}],
+                                    'max_profile_duration': 0.1})
+        admin = user_info('nick', 'user', 'vhost')
+        cardinal = Mock()
+
+        with tempdir('admin_storage') as storage:
+            cardinal.storage_path = storage
+
+            d = plugin.profile(cardinal, admin, '#channel', '.profile 600')
+            assert plugin.profiler is not None
+
+            plugin.profile(cardinal, admin, '#channel', '.profile')
+            cardinal.sendMsg.assert_called_with('#channel',
+                                                "Already profiling.")
+
+            yield d
+            assert plugin.profiler is None
+
+            profiles = os.listdir(os.path.join(storage, 'profiles'))
+            assert len(profiles) == 1
+
+        messages = [c.args[1] for c in cardinal.sendMsg.mock_calls]
+        assert messages[0] == "Profiling for 0.1s..."
+        assert re.match(r"Took \d+ samples in 0\.1s \([\d.]+% overhead, "
+                        r"\d+% idle\), wrote profiles/profile-[\d-]+\.txt$",
+                        messages[2])
+
+        cardinal.sendMsg.reset_mock()
+        plugin.profile(cardinal, admin, '#channel', '.profile soon')
+        cardinal.sendMsg.assert_called_once_with(
+            '#channel', "Syntax: .profile [seconds]")
+
+        plugin.profile(cardinal, user_info('bad_nick', 'user', 'vhost'),
+                       '#channel', '.profile')
+        assert plugin.profiler is None
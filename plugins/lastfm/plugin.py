@@ -7,44 +7,43 @@ from twisted.internet import defer
 from twisted.internet.threads import deferToThread
 
 from cardinal.decorators import command, help
+from cardinal.exceptions import PluginError
+
+
+def _connect_or_create_db(path):
+    # Created in a thread, but used from the reactor thread afterwards
+    conn = sqlite3.connect(path, check_same_thread=False)
+
+    c = conn.cursor()
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS users ("
+        "   nick text collate nocase,"
+        "   vhost text,"
+        "   username text"
+        ")"
+    )
+    conn.commit()
+
+    return conn
 
 
 class LastfmPlugin:
-    def __init__(self, cardinal, config):
+    def __init__(self, cardinal, config, conn):
         # Initialize logger
         self.logger = logging.getLogger(__name__)
 
         self.cardinal = cardinal
+        self.conn = conn
 
         self.config = config or {}
         if 'api_key' not in self.config:
+            self.conn.close()
             raise Exception("Missing required api_key in config")
 
-        # Connect to or create the database - raises on failure
-        self._connect_or_create_db(cardinal)
-
     @property
     def api_key(self):
         return self.config['api_key']
 
-    def _connect_or_create_db(self, cardinal):
-        self.conn = None
-        self.conn = sqlite3.connect(os.path.join(
-            cardinal.storage_path,
-            'database',
-            'lastfm-%s.db' % cardinal.network
-        ))
-
-        c = self.conn.cursor()
-        c.execute(
-            "CREATE TABLE IF NOT EXISTS users ("
-            "   nick text collate nocase,"
-            "   vhost text,"
-            "   username text"
-            ")"
-        )
-        self.conn.commit()
-
     @command('setlastfm')
     @help(["Sets the default Last.fm username for your nick.",
            "Syntax: .setlastfm <username>"])
@@ -206,10 +205,10 @@ class LastfmPlugin:
 
     @defer.inlineCallbacks
     def _get_yt_url(self, song, artist):
-        # XXX does this look safe to you?
+        # Loads the YouTube plugin if it was registered lazily
         try:
-            yt = self.cardinal.plugin_manager.plugins['youtube']['instance']
-        except KeyError:
+            yt = yield self.cardinal.plugin_manager.get_instance('youtube')
+        except PluginError:
             return None
 
         video = yield yt._search("{} {}".format(song, artist))
@@ -223,4 +222,16 @@ class LastfmPlugin:
             self.conn.close()
 
 
-entrypoint = LastfmPlugin
+async def setup(cardinal, config):
+    # Connect to or create the database without blocking the reactor - raises
+    # on failure
+    conn = await deferToThread(_connect_or_create_db, os.path.join(
+        cardinal.storage_path,
+        'database',
+        'lastfm-%s.db' % cardinal.network
+    ))
+
+    return LastfmPlugin(cardinal, config, conn)
+
+
+entrypoint = setup
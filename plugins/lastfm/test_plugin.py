@@ -0,0 +1,40 @@
+from unittest.mock import Mock, patch
+
+from twisted.internet import defer
+
+from cardinal.bot import CardinalBot
+from cardinal.plugins import EventManager, PluginManager
+from plugins.lastfm.plugin import LastfmPlugin
+from plugins.youtube.plugin import YouTubePlugin
+
+
+class TestLastfmPlugin:
+    def setup_method(self):
+        self.cardinal = Mock(spec=CardinalBot)
+        self.cardinal.network = 'irc.example.com'
+        self.cardinal.event_manager = EventManager(self.cardinal)
+        self.cardinal.event_manager.register('urls.detection', 2)
+        self.cardinal.plugin_manager = PluginManager(self.cardinal, [], [],
+                                                     lazy=True)
+
+        self.plugin = LastfmPlugin(self.cardinal, {'api_key': 'key'}, Mock())
+
+    @defer.inlineCallbacks
+    def test_get_yt_url_loads_lazy_youtube_plugin(self):
+        plugin_manager = self.cardinal.plugin_manager
+        plugin_manager.load('youtube')
+        assert plugin_manager.plugins['youtube']['instance'] is None
+
+        video = {'id': {'videoId': 'dQw4w9WgXcQ'}}
+        with patch.object(YouTubePlugin, '_search',
+                          return_value=defer.succeed(video)) as mock_search:
+            url = yield self.plugin._get_yt_url('Song', 'Artist')
+
+        mock_search.assert_called_once_with('Song Artist')
+        assert url == 'https://youtu.be/watch?v=dQw4w9WgXcQ'
+        assert plugin_manager.plugins['youtube']['lazy'] is False
+
+    @defer.inlineCallbacks
+    def test_get_yt_url_without_youtube_plugin(self):
+        url = yield self.plugin._get_yt_url('Song', 'Artist')
+        assert url is None
@@ -39,6 +39,10 @@ class SearchCache:
     def get(self, channel):
         return self._cache[channel]
 
+    def items(self):
+        """Returns cached results, oldest first"""
+        return [(key, self._cache[key]) for key in self._keys]
+
 
 def get_imdb_link(id):
     return "https://imdb.com/title/{}".format(id)
@@ -95,6 +99,9 @@ def format_data_full(data):
 
 
 class MoviePlugin:
+    STATE_VERSION = 1
+    """Version of the state kept across reloads"""
+
     def __init__(self, cardinal, config):
         self.logger = logging.getLogger(__name__)
         self.cardinal = cardinal
@@ -113,6 +120,13 @@ class MoviePlugin:
         # Stores results for quick lookup
         self._search_cache = SearchCache(5)
 
+    def export_state(self):
+        return {'search_cache': self._search_cache.items()}
+
+    def import_state(self, state):
+        for channel, results in state['search_cache']:
+            self._search_cache.add(channel, results)
+
     def search_allowed(self, channel):
         chantypes = self.cardinal.supported.getFeature("CHANTYPES") or ('#',)
         if channel[0] not in chantypes:
@@ -11,9 +11,18 @@ ESCAPE_PLACEHOLDER = '!EsCaPeD SlASh!'
 
 
 class SedPlugin:
+    STATE_VERSION = 1
+    """Version of the state kept across reloads"""
+
     def __init__(self):
         self.history = defaultdict(dict)
 
+    def export_state(self):
+        return self.history
+
+    def import_state(self, history):
+        self.history = history
+
     def substitute(self, user, channel, message):
         """Parse the message and return the substituted message or None.
 
@@ -101,6 +101,21 @@ def test_substitution_doesnt_match():
     assert plugin.substitute(user, channel, 's/foo/bar/') == 'doesnt matter'
 
 
+def test_state_kept_across_reload():
+    user = user_info('nick', None, None)
+    cardinal = Mock()
+
+    plugin = SedPlugin()
+    plugin.on_msg(cardinal, user, '#channel', 'hello wrold')
+
+    new_plugin = SedPlugin()
+    new_plugin.import_state(plugin.export_state())
+    new_plugin.on_msg(cardinal, user, '#channel', 's/wrold/world/')
+
+    cardinal.sendMsg.assert_called_once_with(
+        '#channel', 'nick meant: hello world')
+
+
 def test_should_send_correction():
     assert SedPlugin.should_send_correction('a', 'b')
     assert not SedPlugin.should_send_correction('a', 'a')
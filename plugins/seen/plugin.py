@@ -1,5 +1,6 @@
 from datetime import datetime, timezone
 
+from cardinal.bot import NETJOIN, NETSPLIT
 from cardinal.decorators import command, help, event
 from cardinal.util import (
     is_action,
@@ -42,15 +43,26 @@ class SeenPlugin:
             db['users'] = users
 
     def update_user(self, nick, action, params):
-        if not isinstance(params, list):
-            raise TypeError("params must be a list")
+        self.update_users([(nick, action, params)])
+
+    def update_users(self, updates):
+        """Updates many users with a single database write.
+
+        updates -- A list of (nick, action, params) tuples.
+        """
+        timestamp = datetime.now(tz=timezone.utc).timestamp()
+
+        for _, _, params in updates:
+            if not isinstance(params, list):
+                raise TypeError("params must be a list")
 
         with self.db() as db:
-            db['users'][nick.lower()] = {
-                'timestamp': datetime.now(tz=timezone.utc).timestamp(),
-                'action': action,
-                'params': params,
-            }
+            for nick, action, params in updates:
+                db['users'][nick.lower()] = {
+                    'timestamp': timestamp,
+                    'action': action,
+                    'params': params,
+                }
 
     @event('irc.privmsg')
     def irc_privmsg(self, cardinal, user, channel, message):
@@ -84,11 +96,25 @@ class SeenPlugin:
 
     @event('irc.join')
     def irc_join(self, cardinal, user, channel):
+        # Netjoins are handled all at once by irc_join_batch
+        if cardinal.current_batch is not None and \
+                cardinal.current_batch.type == NETJOIN:
+            return
+
         if channel not in self.ignored_channels:
             self.update_user(user.nick, JOIN, [channel])
 
         self.do_tell(user.nick)
 
+    @event('irc.join_batch')
+    def irc_join_batch(self, cardinal, joins):
+        self.update_users([
+            (user.nick, JOIN, [channel]) for user, channel in joins
+            if channel not in self.ignored_channels
+        ])
+
+        self.do_tells([user.nick for user, _ in joins])
+
     @event('irc.part')
     def irc_part(self, cardinal, user, channel, reason):
         if channel not in self.ignored_channels:
@@ -104,15 +130,36 @@ class SeenPlugin:
 
     @event('irc.quit')
     def irc_quit(self, cardinal, user, reason):
+        # Netsplits are handled all at once by irc_quit_batch
+        if cardinal.current_batch is not None and \
+                cardinal.current_batch.type == NETSPLIT:
+            return
+
         self.update_user(user.nick, QUIT, [reason])
 
+    @event('irc.quit_batch')
+    def irc_quit_batch(self, cardinal, quits):
+        self.update_users([
+            (user.nick, QUIT, [reason]) for user, reason in quits
+        ])
+
     # TODO Add irc_kick/irc_kicked
 
     def do_tell(self, nick):
-        nick = nick.lower()
+        self.do_tells([nick])
+
+    def do_tells(self, nicks):
+        """Delivers messages left for many users with a single database
+        write.
 
+        nicks -- A list of nicks.
+        """
         with self.db() as db:
-            if nick in db['tells']:
+            for nick in nicks:
+                nick = nick.lower()
+                if nick not in db['tells']:
+                    continue
+
                 for message in db['tells'][nick]:
                     self.cardinal.sendMsg(
                         nick,
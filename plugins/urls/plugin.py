@@ -51,6 +51,9 @@ class URLsPlugin:
     LOOKUP_COOLOFF = 10
     """Timeout in seconds before looking up the same URL again"""
 
+    STATE_VERSION = 1
+    """Version of the state kept across reloads"""
+
     def __init__(self, cardinal, config):
         # Initialize logger
         self.logger = logging.getLogger(__name__)
@@ -78,6 +81,13 @@ class URLsPlugin:
     def close(self, cardinal):
         cardinal.event_manager.remove('urls.detection')
 
+    def export_state(self):
+        return {'last_url': self.last_url, 'last_url_at': self.last_url_at}
+
+    def import_state(self, state):
+        self.last_url = state['last_url']
+        self.last_url_at = state['last_url_at']
+
     @regex(URL_REGEX)
     @defer.inlineCallbacks
     def get_title(self, cardinal, user, channel, msg):
@@ -21,6 +21,9 @@ def class_is_not_mw_empty_elt(css_class):
 
 
 class WikipediaPlugin:
+    STATE_VERSION = 1
+    """Version of the state kept across reloads"""
+
     def __init__(self, cardinal, config):
         """Registers a callback for URL detection."""
         # Initialize logger
@@ -36,6 +39,15 @@ class WikipediaPlugin:
 
         self._wiki = None
 
+    def export_state(self):
+        return {'language_code': self._language_code, 'wiki': self._wiki}
+
+    def import_state(self, state):
+        # Creating the client makes a network call, so keep it unless the
+        # language changed
+        if state['language_code'] == self._language_code:
+            self._wiki = state['wiki']
+
     @defer.inlineCallbacks
     def get_wiki(self):
         if self._wiki:
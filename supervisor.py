@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import argparse
+import logging
+import logging.config
+import signal
+
+from twisted.internet import reactor
+
+from cardinal.config import ConfigParser, ConfigSpec
+from cardinal.supervisor import Supervisor, group_networks
+
+
+def setup_logging(config=None):
+    if config is None:
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
+    else:
+        logging.config.dictConfig(config)
+
+    return logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="""
+Cardinal supervisor
+
+Runs each network from a Cardinal config in its own process, so that a busy
+network can't slow down the others, and restarts them if they crash.
+""", formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    arg_parser.add_argument('config', metavar='config',
+                            help='custom config location')
+    arg_parser.add_argument('--group', action='append', dest='groups',
+                            metavar='NETWORK,NETWORK',
+                            help='run these networks in the same process '
+                                 '(may be given more than once)')
+
+    args = arg_parser.parse_args()
+    config_file = os.path.abspath(args.config)
+
+    # Only the options the supervisor needs, cardinal.py validates the rest
+    spec = ConfigSpec()
+    spec.add_option('network', str, None)
+    spec.add_option('networks', list, None)
+    spec.add_option('logging', dict, None)
+    spec.add_option('metrics_port', int, None)
+
+    parser = ConfigParser(spec)
+
+    try:
+        config = parser.load_config(config_file)
+    except Exception:
+        logger = setup_logging()
+        logger.exception("Unable to load config: {}".format(config_file))
+        sys.exit(1)
+
+    # Workers send their logs to us, so the logging config is applied here
+    logger = setup_logging(config['logging'])
+
+    try:
+        groups = group_networks(
+            config,
+            [group.split(',') for group in args.groups or []])
+    except ValueError:
+        logger.exception("Invalid network group")
+        sys.exit(1)
+
+    supervisor = Supervisor(
+        os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     'cardinal.py'),
+        config_file,
+        groups,
+        config['metrics_port'])
+
+    # Let workers quit cleanly before stopping
+    def stop(signum, frame):
+        reactor.callFromThread(supervisor.stop)
+
+    def start():
+        # Replaces the handlers Twisted installs when the reactor starts
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        # Serves the combined metrics of every worker, on the loopback
+        # interface
+        if config['metrics_port'] is not None:
+            supervisor.serve_metrics(config['metrics_port'])
+
+        supervisor.start()
+
+    reactor.callWhenRunning(start)
+    reactor.run()